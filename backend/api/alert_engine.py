@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Motor de alertas de la ingesta.
+
+- Umbrales en memoria: se cargan de la tabla umbrales al arrancar y se recargan
+  cuando llega un NOTIFY de umbrales (mismo canal que el registro de dispositivos).
+- Reglas compiladas por dispositivo: (voltaje_min, voltaje_max, potencia_max)
+  resueltas una vez con la misma prioridad de siempre: company -> usuario -> defaults.
+- De-duplicación de 20 s en memoria, por (dispositivo, tipo de alerta).
+- Las alertas de un lote de telemetría se insertan juntas con un solo commit.
+
+Una lectura dentro de rango no hace ninguna consulta a la base de datos.
+"""
+import time
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from hotlog import get_logger
+from instrumentation import pg_query_seconds, timed
+
+log = get_logger("alerts")
+
+DEFAULT_UMBRALES = (200, 250, 5000)  # voltaje_min, voltaje_max, potencia_max
+
+UMBRALES_SQL = """
+    SELECT company_id, user_id, voltaje_min, voltaje_max, potencia_max
+    FROM umbrales
+    ORDER BY id
+"""
+
+INSERT_ALERTS_SQL = """
+    INSERT INTO alerts (user_id, fecha, tipo, mensaje, valor, dispositivo, company_id, device_id)
+    VALUES %s
+"""
+
+Rule = Tuple[Any, Any, Any]
+
+
+def _rule_from_row(vmin, vmax, pmax) -> Rule:
+    return (
+        vmin if vmin is not None else DEFAULT_UMBRALES[0],
+        vmax if vmax is not None else DEFAULT_UMBRALES[1],
+        pmax if pmax is not None else DEFAULT_UMBRALES[2],
+    )
+
+
+class AlertEngine:
+    """
+    Parámetros:
+    - registry: DeviceRegistry (nombre del dispositivo y canal de NOTIFY)
+    - dedup_window_s: ventana de de-duplicación por (device_id, tipo)
+    - stale_s: si el listener está caído, recargar umbrales cada stale_s segundos
+    """
+
+    def __init__(self, registry=None, dedup_window_s: float = 20.0, stale_s: float = 60.0):
+        self.registry = registry
+        self.dedup_window_s = dedup_window_s
+        self.stale_s = stale_s
+        self._by_company: Dict[int, Rule] = {}
+        self._by_user: Dict[int, Rule] = {}
+        self._rules: Dict[Tuple, Rule] = {}       # (company_id, user_id) -> regla compilada
+        self._loaded_at: Optional[float] = None
+        self._last_alert: Dict[Tuple[int, str], float] = {}
+        self._lock = threading.Lock()
+        self.stats = {"evaluated": 0, "alerts_written": 0, "alerts_deduped": 0, "threshold_reloads": 0}
+        if registry is not None:
+            registry.subscribe("umbrales", self.load_thresholds)
+
+    # ---------- Umbrales ----------
+    def load_thresholds(self, conn_or_cursor):
+        """Carga todos los umbrales. Acepta una conexión (listener) o un cursor."""
+        own_cursor = hasattr(conn_or_cursor, "cursor")
+        cur = conn_or_cursor.cursor() if own_cursor else conn_or_cursor
+        with timed(pg_query_seconds, "alerts_load_thresholds"):
+            cur.execute(UMBRALES_SQL)
+        by_company: Dict[int, Rule] = {}
+        by_user: Dict[int, Rule] = {}
+        for company_id, user_id, vmin, vmax, pmax in cur.fetchall():
+            # Igual que antes: una fila sin voltaje_min no cuenta
+            if vmin is None:
+                continue
+            if company_id is not None and user_id is None:
+                by_company.setdefault(company_id, _rule_from_row(vmin, vmax, pmax))
+            if user_id is not None:
+                by_user.setdefault(user_id, _rule_from_row(vmin, vmax, pmax))
+        if own_cursor:
+            cur.close()
+        self._by_company, self._by_user, self._rules = by_company, by_user, {}
+        self._loaded_at = time.monotonic()
+        self.stats["threshold_reloads"] += 1
+
+    def _ensure_fresh(self, cursor):
+        listening = self.registry is not None and self.registry.ready
+        if self._loaded_at is None or (not listening and time.monotonic() - self._loaded_at > self.stale_s):
+            self.load_thresholds(cursor)
+
+    def rule_for(self, company_id, user_id) -> Rule:
+        key = (company_id, user_id)
+        rule = self._rules.get(key)
+        if rule is None:
+            rule = (self._by_company.get(company_id) if company_id else None) \
+                or self._by_user.get(user_id) \
+                or DEFAULT_UMBRALES
+            self._rules[key] = rule
+        return rule
+
+    # ---------- Evaluación ----------
+    def evaluate(self, voltaje, potencia, company_id, user_id) -> List[Tuple[str, str, str]]:
+        """Devuelve [(tipo, mensaje, valor)] para una lectura (sin de-duplicar)."""
+        voltaje_min, voltaje_max, potencia_max = self.rule_for(company_id, user_id)
+        alerts = []
+        if voltaje is not None and isinstance(voltaje, (int, float)):
+            if voltaje > voltaje_max:
+                alerts.append((
+                    'Alta tensión',
+                    f"Voltaje excede el umbral máximo ({voltaje_max}V). Valor actual: {voltaje:.2f}V",
+                    f"{voltaje:.2f}V",
+                ))
+            elif voltaje < voltaje_min:
+                alerts.append((
+                    'Baja tensión',
+                    f"Voltaje está por debajo del umbral mínimo ({voltaje_min}V). Valor actual: {voltaje:.2f}V",
+                    f"{voltaje:.2f}V",
+                ))
+        if potencia is not None and isinstance(potencia, (int, float)):
+            potencia_abs = abs(potencia)
+            if potencia_abs > potencia_max:
+                alerts.append((
+                    'Alto consumo',
+                    f"Potencia excede el umbral máximo ({potencia_max}W). Valor actual: {potencia_abs:.2f}W",
+                    f"{potencia_abs:.2f}W",
+                ))
+        return alerts
+
+    def _should_emit(self, key: Tuple[int, str], now: float) -> bool:
+        with self._lock:
+            last = self._last_alert.get(key)
+        return last is None or now - last >= self.dedup_window_s
+
+    def _record(self, keys, now: float):
+        """Marca las alertas como emitidas; solo después del commit que las guardó."""
+        with self._lock:
+            for key in keys:
+                self._last_alert[key] = now
+
+    def _device_name(self, cursor, device_id):
+        dev = self.registry.get_by_id(device_id) if self.registry is not None else None
+        if dev is not None:
+            return dev.name
+        cursor.execute("SELECT name FROM devices WHERE id = %s", (device_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def process_batch(self, cursor, conn, rows) -> int:
+        """
+        Callback after_flush del TelemetryWriter. rows = [(device_code, valores_insertados, energy_kwh)].
+        Inserta todas las alertas del lote con un solo commit; devuelve cuántas escribió.
+        La ventana de de-duplicación empieza recién con el commit: si el INSERT falla,
+        la próxima lectura fuera de rango vuelve a generar la alerta.
+        """
+        self._ensure_fresh(cursor)
+        now = time.monotonic()
+        pending = []
+        emitted = set()     # (device_id, tipo) ya incluidas en este lote
+        for device_code, values, _ in rows:
+            user_id, fecha, voltaje, corriente, potencia, _, company_id, device_id, _ = values
+            if not user_id:
+                continue
+            self.stats["evaluated"] += 1
+            for tipo, mensaje, valor in self.evaluate(voltaje, potencia, company_id, user_id):
+                key = (device_id, tipo)
+                if key in emitted or not self._should_emit(key, now):
+                    self.stats["alerts_deduped"] += 1
+                    continue
+                emitted.add(key)
+                pending.append((user_id, fecha, tipo, mensaje, valor, device_id, company_id, device_code))
+
+        if not pending:
+            return 0
+        values = [
+            (user_id, fecha, tipo, mensaje, valor, self._device_name(cursor, device_id), company_id, device_id)
+            for user_id, fecha, tipo, mensaje, valor, device_id, company_id, _ in pending
+        ]
+        with timed(pg_query_seconds, "alerts_insert_batch"):
+            execute_values(cursor, INSERT_ALERTS_SQL, values)
+            conn.commit()
+        self._record(emitted, now)
+        self.stats["alerts_written"] += len(values)
+        for _, _, tipo, _, _, device_id, _, device_code in pending:
+            log.info("✅ Alerta creada: %s para dispositivo %s (device_id=%s)", tipo, device_code, device_id)
+        return len(values)
+
+    def prime_dedup(self, cursor):
+        """Al arrancar, cargar alertas recientes para no duplicarlas tras un reinicio."""
+        cursor.execute("""
+            SELECT device_id, tipo, EXTRACT(EPOCH FROM (NOW() - MAX(created_at)))
+            FROM alerts
+            WHERE created_at > NOW() - make_interval(secs => %s)
+            GROUP BY device_id, tipo
+        """, (self.dedup_window_s,))
+        now = time.monotonic()
+        with self._lock:
+            for device_id, tipo, age_s in cursor.fetchall():
+                self._last_alert[(device_id, tipo)] = now - float(age_s or 0)
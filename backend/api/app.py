@@ -14,11 +14,14 @@ import os
 import json
 import time
 import queue
+import logging
+import functools
+import itertools
 import threading
 from collections import deque
-from typing import Dict, Any
+from typing import Dict, Any, Tuple
 
-from flask import Flask, jsonify, request, Response
+from flask import Flask, g, jsonify, request, Response
 from urllib.parse import urlencode
 from flask_cors import CORS
 import paho.mqtt.client as mqtt
@@ -27,15 +30,63 @@ from influxdb_client import InfluxDBClient
 import psycopg2
 from datetime import datetime, timezone, timedelta
 
+from db_pool import ConnectionPool, PoolError
+from alert_engine import AlertEngine
+from device_registry import DeviceRegistry
+from event_hub import EventHub, Lagged
+from ingest import TelemetryWriter, chain_hooks
+from live_state import LiveState
+from liveness import LivenessTracker, parse_status
+from outage_tracker import OutageTracker
+from outages import OUTAGE_MODES, ColumnarOutageDetector, detect_outages_sql
+from telemetry_queries import (BUCKET_COLUMNS, BUCKET_EXPRS, RANGE_EXPRS, STREAM_COLUMNS,
+                               stream_device_buckets, stream_device_range,
+                               stream_devices_buckets, stream_devices_range)
+import history_export
+import history_batch
+from response_cache import ResponseCache
+from time_args import parse_time_arg
+import downsample
+import rollups
+from history_planner import HistoryPlanner, merge_streams
+import influx_queries as flux
+from influx_queries import InfluxQueries
+import energy
+import quality
+from ws_hub import WsHub
+import hotlog
+from hotlog import get_logger, sampled, setup_logging
+from instrumentation import CONTENT_TYPE, REGISTRY, pg_query_seconds, timed
+
 # Zona horaria de Paraguay (UTC-3)
 PYT_TIMEZONE = timezone(timedelta(hours=-3))
 
+# Logging: niveles por LOG_LEVEL, escritura en un hilo de fondo (ver hotlog.py)
+setup_logging()
+log_mqtt = get_logger("mqtt")
+log_pg = get_logger("postgres")
+log_alerts = get_logger("alerts")
+log_stream = get_logger("stream")
+log_hist = get_logger("history-smart")
+log_outages = get_logger("power-outages")
+# Se loguea 1 de cada N mensajes aceptados (el detalle por mensaje va en DEBUG)
+LOG_SAMPLE_ACCEPTED = int(os.getenv("LOG_SAMPLE_ACCEPTED", "1000"))
+
+# Instrumentación (ver instrumentation.py y /internal/metrics)
+mqtt_messages = REGISTRY.counter("iot_mqtt_messages_total", "Mensajes MQTT recibidos por tópico suscrito (patrón)", ("topic",))
+mqtt_decode_errors = REGISTRY.counter("iot_mqtt_decode_errors_total", "Payloads MQTT que no son JSON válido", ("topic",))
+broadcast_seconds = REGISTRY.histogram("iot_broadcast_seconds", "Serialización y difusión de un evento a SSE y WS")
+http_request_seconds = REGISTRY.histogram(
+    "iot_http_request_seconds", "Latencia de requests HTTP por endpoint", ("endpoint", "method", "status"))
+
 INFLUXDB_URL   = os.getenv("INFLUXDB_URL")
 INFLUXDB_TOKEN = os.getenv("INFLUXDB_TOKEN")
 INFLUXDB_ORG   = os.getenv("INFLUXDB_ORG")
 INFLUXDB_BUCKET= os.getenv("INFLUXDB_BUCKET")
 
 influx = InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG) if INFLUXDB_URL and INFLUXDB_TOKEN else None
+# Consultas Flux con parámetros y un solo query_api (ver influx_queries.py)
+influx_queries = InfluxQueries(influx, INFLUXDB_BUCKET, INFLUXDB_ORG)
 
 # PostgreSQL configuration
 POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
@@ -62,9 +113,62 @@ def get_postgres_connection():
                 password=POSTGRES_PASSWORD
             )
     except Exception as e:
-        print(f"Error conectando a PostgreSQL: {e}")
+        log_pg.error(f"Error conectando a PostgreSQL: {e}")
         return None
 
+# Pool compartido por los endpoints y el escritor de ingesta
+PG_POOL_MIN        = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX        = int(os.getenv("PG_POOL_MAX", "10"))
+PG_POOL_TIMEOUT_S  = float(os.getenv("PG_POOL_TIMEOUT_S", "5"))
+PG_POOL_PING_IDLE_S = float(os.getenv("PG_POOL_PING_IDLE_S", "5"))
+
+pg_pool = ConnectionPool(
+    get_postgres_connection,
+    minconn=PG_POOL_MIN,
+    maxconn=PG_POOL_MAX,
+    checkout_timeout=PG_POOL_TIMEOUT_S,
+    ping_idle_s=PG_POOL_PING_IDLE_S,
+)
+pg_pool.prefill()
+
+# Registro de dispositivos en memoria (se actualiza con LISTEN/NOTIFY)
+device_registry = DeviceRegistry(get_postgres_connection)
+
+# Motor de alertas: umbrales en memoria (recargados por NOTIFY) y de-duplicación local
+ALERT_DEDUP_WINDOW_S = float(os.getenv("ALERT_DEDUP_WINDOW_S", "20"))
+alert_engine = AlertEngine(device_registry, dedup_window_s=ALERT_DEDUP_WINDOW_S)
+device_registry.start()
+try:
+    with pg_pool.connection() as _conn:
+        _cur = _conn.cursor()
+        alert_engine.prime_dedup(_cur)
+        _cur.close()
+except Exception as e:
+    log_alerts.info(f"No se pudieron cargar alertas recientes: {e}")
+
+def _resolve_device(cursor, device: str):
+    """Devuelve (id, code, name) del dispositivo por código o id, o None si no existe."""
+    if device_registry.ready:
+        dev = device_registry.resolve(device)
+        return (dev.id, dev.code, dev.name) if dev else None
+    # Registro no disponible (listener caído): consultar directamente
+    with timed(pg_query_seconds, "resolve_device"):
+        cursor.execute("SELECT id, code, name FROM devices WHERE code = %s OR id::text = %s", [device, device])
+        return cursor.fetchone()
+
+def _parse_range_args(default_tz=timezone.utc) -> Tuple[datetime, datetime]:
+    """start / end de la query (ms unix o ISO 8601; sin zona = default_tz). Lanza ValueError."""
+    return (parse_time_arg(request.args["start"], default_tz),
+            parse_time_arg(request.args["end"], default_tz))
+
+def _company_devices(cursor, company_id: int):
+    """(id, code, name) de los dispositivos de la empresa, ordenados por id."""
+    if device_registry.ready:
+        return sorted((d.id, d.code, d.name) for d in device_registry.devices_for_company(company_id))
+    with timed(pg_query_seconds, "company_devices"):
+        cursor.execute("SELECT id, code, name FROM devices WHERE company_id = %s ORDER BY id", [company_id])
+        return cursor.fetchall()
+
 
 # =========================
 # CONFIG
@@ -77,6 +181,8 @@ MQTT_BASE   = os.getenv("MQTT_BASE", "tesis/iot/esp32")
 
 # Nuevo formato: esp/energia/{device_id}/state
 TOPIC_ENERGY_STATE = "esp/energia/+/state"  # + es wildcard para cualquier device_id
+# Last Will del firmware: "online" al conectar, "offline" al caerse (retenido)
+TOPIC_ENERGY_STATUS = "esp/energia/+/status"
 
 # Tópicos antiguos (mantenidos por compatibilidad si es necesario)
 TOPIC_VRMS       = f"{MQTT_BASE}/metrics/vrms"
@@ -87,9 +193,61 @@ TOPIC_S_V        = f"{MQTT_BASE}/samples/voltage"
 TOPIC_S_I        = f"{MQTT_BASE}/samples/current"
 TOPIC_STATUS     = f"{MQTT_BASE}/status"
 
+MQTT_SUBSCRIPTIONS = (
+    (TOPIC_ENERGY_STATE, 1),  # Nuevo formato: esp/energia/+/state
+    (TOPIC_ENERGY_STATUS, 1),
+    # Tópicos antiguos (mantenidos por compatibilidad)
+    (TOPIC_VRMS, 1),
+    (TOPIC_IRMS, 1),
+    (TOPIC_S_APPARENT, 1),
+    (TOPIC_TELEMETRY, 1),
+    (TOPIC_S_V, 0),
+    (TOPIC_S_I, 0),
+    (TOPIC_STATUS, 1),
+)
+_FIXED_TOPICS = frozenset(t for t, _ in MQTT_SUBSCRIPTIONS if "+" not in t and "#" not in t)
+
+
+def _topic_label(topic: str) -> str:
+    """
+    Etiqueta de las métricas MQTT: el patrón suscrito, no el tópico. El tópico
+    esp/energia/{device}/... lleva el código del equipo (una serie por dispositivo).
+    """
+    if topic.startswith("esp/energia/"):
+        if topic.endswith("/state"):
+            return TOPIC_ENERGY_STATE
+        if topic.endswith("/status"):
+            return TOPIC_ENERGY_STATUS
+    return topic if topic in _FIXED_TOPICS else "other"
+
 # Tamaño de buffers para muestras instantáneas
 SAMPLES_BUFFER_SIZE = int(os.getenv("SAMPLES_BUFFER_SIZE", "2000"))
 
+# Eventos SSE retenidos para reenviar tras una reconexión (Last-Event-ID)
+SSE_RING_SIZE = int(os.getenv("SSE_RING_SIZE", "4096"))
+
+# WebSocket: cola de salida por cliente y qué hacer si se llena ('drop_oldest' | 'disconnect')
+WS_CLIENT_QUEUE = int(os.getenv("WS_CLIENT_QUEUE", "1000"))
+WS_SLOW_POLICY  = os.getenv("WS_SLOW_POLICY", "drop_oldest")
+
+# Escritor por lotes de telemetry_history
+INGEST_BATCH_SIZE     = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_LINGER_MS      = int(os.getenv("INGEST_LINGER_MS", "200"))
+INGEST_QUEUE_CAPACITY = int(os.getenv("INGEST_QUEUE_CAPACITY", "20000"))
+INGEST_WORKERS        = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_BLOCK_MS       = int(os.getenv("INGEST_BLOCK_MS", "0"))  # 0 = descartar sin bloquear al hilo MQTT
+
+# Rollups 1m/1h/1d (ver rollups.py): se mantienen en cada flush y los lee /metrics/history-smart
+ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "1") not in ("0", "false", "False")
+# Integración de potencia -> energia_acumulada en la ingesta (ver energy.py)
+ENERGY_ENABLED = os.getenv("ENERGY_ENABLED", "1") not in ("0", "false", "False")
+# Cortes detectados en la ingesta -> power_outages (ver outage_tracker.py)
+OUTAGE_TRACKER_ENABLED = os.getenv("OUTAGE_TRACKER_ENABLED", "1") not in ("0", "false", "False")
+# Estado de conexión por dispositivo: Last Will + timeout sin lecturas (ver liveness.py)
+LIVENESS_ENABLED = os.getenv("LIVENESS_ENABLED", "1") not in ("0", "false", "False")
+# Sketches de cuantiles y tiempo en bandas de tensión por hora -> power_quality_1h (ver quality.py)
+QUALITY_ENABLED = os.getenv("QUALITY_ENABLED", "1") not in ("0", "false", "False")
+
 # =========================
 # ESTADO EN MEMORIA (thread-safe)
 # =========================
@@ -104,261 +262,85 @@ last_metrics: Dict[str, Any] = {
     "ts": None
 }
 last_telemetry: Dict[str, Any] = {}  # payload tal cual llega
+# Último estado de cada dispositivo (esp/energia/{device_id}/state); lectura sin lock
+live_state = LiveState()
 samples_voltage = deque(maxlen=SAMPLES_BUFFER_SIZE)
 samples_current = deque(maxlen=SAMPLES_BUFFER_SIZE)
 
-# Cola para broadcasting SSE (cada item es str ya serializado)
-sse_queue = queue.Queue()
+# Hub SSE: ring buffer de eventos ya serializados, un cursor por suscriptor
+sse_hub = EventHub(SSE_RING_SIZE)
 
 def _save_to_telemetry_history(device_code: str, voltaje: float = None, corriente: float = None, potencia: float = None, timestamp: datetime = None):
-    """Guarda datos en telemetry_history en segundo plano"""
-    print(f"[MQTT] _save_to_telemetry_history llamado - device_code={device_code}, voltaje={voltaje}, corriente={corriente}, potencia={potencia}")
-    def save_task():
-        try:
-            print(f"[MQTT] [Thread] Iniciando guardado para device={device_code}")
-            conn = get_postgres_connection()
-            if not conn:
-                print(f"[MQTT] [Thread] Error: No se pudo conectar a PostgreSQL para guardar datos de {device_code}")
-                return
-            
-            print(f"[MQTT] [Thread] Conectado a PostgreSQL, buscando dispositivo {device_code}")
-            cursor = conn.cursor()
-            
-            # Obtener device_id, company_id y user_id desde el código del dispositivo
-            cursor.execute("""
-                SELECT d.id as device_id, d.company_id, 
-                       COALESCE(
-                           (SELECT u.id FROM users u 
-                            INNER JOIN roles r ON u.role_id = r.id
-                            WHERE u.company_id = d.company_id 
-                            AND (r.name = 'admin' OR r.name = 'super_admin')
-                            LIMIT 1),
-                           (SELECT u.id FROM users u 
-                            WHERE u.company_id = d.company_id 
-                            LIMIT 1),
-                           NULL
-                       ) as user_id
-                FROM devices d
-                WHERE d.code = %s OR d.id::text = %s
-                LIMIT 1
-            """, (device_code, device_code))
-            
-            device_info = cursor.fetchone()
-            if not device_info:
-                print(f"[MQTT] Warning: No se encontró dispositivo con code/id='{device_code}' en la base de datos")
-                cursor.close()
-                conn.close()
-                return
-            
-            device_id = device_info[0]
-            company_id = device_info[1]
-            user_id = device_info[2]
-            
-            # Convertir timestamp de UTC a horario paraguayo
-            if timestamp:
-                # Si el timestamp viene sin timezone, asumir que es UTC
-                timestamp_utc = timestamp
-                if timestamp_utc.tzinfo is None:
-                    timestamp_utc = timestamp_utc.replace(tzinfo=timezone.utc)
-                # Convertir de UTC (o cualquier timezone) a horario paraguayo
-                timestamp_pyt = timestamp_utc.astimezone(PYT_TIMEZONE)
-                fecha = timestamp_pyt.date()
-                created_at = timestamp_pyt
-            else:
-                now_pyt = datetime.now(PYT_TIMEZONE)
-                fecha = now_pyt.date()
-                created_at = now_pyt
-            
-            # Insertar en telemetry_history
-            cursor.execute("""
-                INSERT INTO telemetry_history (
-                    user_id, fecha, voltaje, corriente, potencia, energia_acumulada,
-                    company_id, device_id, created_at
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                user_id,
-                fecha,
-                voltaje,
-                corriente,
-                potencia,
-                None,  # energia_acumulada no se calcula aquí
-                company_id,
-                device_id,
-                created_at
-            ))
-            conn.commit()
-            print(f"[MQTT] Guardado en telemetry_history: device={device_code}, device_id={device_id}, fecha={fecha}, voltaje={voltaje}, corriente={corriente}, potencia={potencia}")
-            
-            # Generar alertas automáticamente si los valores exceden umbrales
-            if user_id:
-                try:
-                    _check_and_generate_alerts(
-                        cursor, conn, voltaje, corriente, potencia,
-                        company_id, device_id, user_id, fecha, device_code
-                    )
-                except Exception as alert_error:
-                    print(f"[MQTT] Error generando alertas: {alert_error}")
-                    import traceback
-                    traceback.print_exc()
-                    # No fallar si la generación de alertas falla
-            
-            cursor.close()
-            conn.close()
-        except Exception as e:
-            print(f"[MQTT] Error guardando en telemetry_history: {e}")
-            import traceback
-            traceback.print_exc()
-            if conn:
-                try:
-                    conn.rollback()
-                    conn.close()
-                except:
-                    pass
-    
-    # Ejecutar en segundo plano
-    thread = threading.Thread(target=save_task, daemon=True)
-    thread.start()
-
-def _check_and_generate_alerts(cursor, conn, voltaje, corriente, potencia, company_id, device_id, user_id, fecha, device_code):
-    """Verifica umbrales y genera alertas automáticamente"""
-    if not user_id:
-        print(f"[MQTT] ⚠️ No se puede generar alertas sin user_id para device {device_code}")
-        return
-    
-    umbrales = None
-    
-    # Primero intentar obtener umbrales de la company
-    if company_id:
-        cursor.execute("""
-            SELECT voltaje_min, voltaje_max, potencia_max 
-            FROM umbrales 
-            WHERE company_id = %s AND user_id IS NULL 
-            LIMIT 1
-        """, (company_id,))
-        
-        umbrales_row = cursor.fetchone()
-        if umbrales_row and umbrales_row[0] is not None:
-            # Verificar que los valores no sean NULL
-            umbrales = {
-                'voltaje_min': umbrales_row[0] if umbrales_row[0] is not None else 200,
-                'voltaje_max': umbrales_row[1] if umbrales_row[1] is not None else 250,
-                'potencia_max': umbrales_row[2] if umbrales_row[2] is not None else 5000
-            }
-            print(f"[MQTT] ✅ Umbrales obtenidos de company_id={company_id}: min={umbrales['voltaje_min']}V, max={umbrales['voltaje_max']}V, potencia_max={umbrales['potencia_max']}W")
-    
-    # Si no hay umbrales de company, buscar del usuario
-    if not umbrales and user_id:
-        cursor.execute("""
-            SELECT voltaje_min, voltaje_max, potencia_max 
-            FROM umbrales 
-            WHERE user_id = %s 
-            LIMIT 1
-        """, (user_id,))
-        
-        umbrales_row = cursor.fetchone()
-        if umbrales_row and umbrales_row[0] is not None:
-            umbrales = {
-                'voltaje_min': umbrales_row[0] if umbrales_row[0] is not None else 200,
-                'voltaje_max': umbrales_row[1] if umbrales_row[1] is not None else 250,
-                'potencia_max': umbrales_row[2] if umbrales_row[2] is not None else 5000
-            }
-            print(f"[MQTT] ✅ Umbrales obtenidos de user_id={user_id}: min={umbrales['voltaje_min']}V, max={umbrales['voltaje_max']}V, potencia_max={umbrales['potencia_max']}W")
-    
-    # Si aún no hay umbrales, usar valores por defecto
-    if not umbrales:
-        umbrales = {
-            'voltaje_min': 200,
-            'voltaje_max': 250,
-            'potencia_max': 5000
-        }
-        print(f"[MQTT] ⚠️ No se encontraron umbrales, usando valores por defecto: min={umbrales['voltaje_min']}V, max={umbrales['voltaje_max']}V, potencia_max={umbrales['potencia_max']}W")
-    
-    # Obtener nombre del dispositivo
-    cursor.execute("SELECT name FROM devices WHERE id = %s", (device_id,))
-    device_result = cursor.fetchone()
-    device_name = device_result[0] if device_result else None
-    
-    alerts = []
-    
-    # Verificar voltaje
-    if voltaje is not None and isinstance(voltaje, (int, float)):
-        if voltaje > umbrales['voltaje_max']:
-            alerts.append({
-                'tipo': 'Alta tensión',
-                'mensaje': f"Voltaje excede el umbral máximo ({umbrales['voltaje_max']}V). Valor actual: {voltaje:.2f}V",
-                'valor': f"{voltaje:.2f}V"
-            })
-            print(f"[MQTT] ⚠️ Alta tensión detectada: {voltaje:.2f}V > {umbrales['voltaje_max']}V")
-        elif voltaje < umbrales['voltaje_min']:
-            alerts.append({
-                'tipo': 'Baja tensión',
-                'mensaje': f"Voltaje está por debajo del umbral mínimo ({umbrales['voltaje_min']}V). Valor actual: {voltaje:.2f}V",
-                'valor': f"{voltaje:.2f}V"
-            })
-            print(f"[MQTT] ⚠️ Baja tensión detectada: {voltaje:.2f}V < {umbrales['voltaje_min']}V")
-    
-    # Verificar potencia
-    if potencia is not None and isinstance(potencia, (int, float)):
-        potencia_abs = abs(potencia)
-        if potencia_abs > umbrales['potencia_max']:
-            alerts.append({
-                'tipo': 'Alto consumo',
-                'mensaje': f"Potencia excede el umbral máximo ({umbrales['potencia_max']}W). Valor actual: {potencia_abs:.2f}W",
-                'valor': f"{potencia_abs:.2f}W"
-            })
-            print(f"[MQTT] ⚠️ Alto consumo detectado: {potencia_abs:.2f}W > {umbrales['potencia_max']}W")
-    
-    # Crear alertas en la base de datos solo si no existe una alerta del mismo tipo en los últimos 20 segundos
-    for alert in alerts:
-        # Validar que el mensaje y el valor no estén vacíos
-        if not alert['mensaje'] or not alert['mensaje'].strip():
-            print(f"[MQTT] ⚠️ Alerta de tipo '{alert['tipo']}' tiene mensaje vacío, omitiendo inserción")
-            continue
-        
-        if not alert['valor'] or not alert['valor'].strip():
-            print(f"[MQTT] ⚠️ Alerta de tipo '{alert['tipo']}' tiene valor vacío, omitiendo inserción")
-            continue
-        
-        # Verificar si ya existe una alerta del mismo tipo para este dispositivo en los últimos 20 segundos
-        cursor.execute("""
-            SELECT id FROM alerts 
-            WHERE tipo = %s 
-            AND device_id = %s 
-            AND company_id = %s
-            AND created_at > NOW() - INTERVAL '20 seconds'
-            LIMIT 1
-        """, (alert['tipo'], device_id, company_id))
-        
-        existing_alert = cursor.fetchone()
-        
-        # Solo crear la alerta si no existe una reciente (últimos 20 segundos)
-        if not existing_alert:
-            cursor.execute("""
-                INSERT INTO alerts (user_id, fecha, tipo, mensaje, valor, dispositivo, company_id, device_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """, (
-                user_id,
-                fecha,
-                alert['tipo'],
-                alert['mensaje'].strip(),
-                alert['valor'].strip(),
-                device_name,
-                company_id,
-                device_id
-            ))
-            conn.commit()
-            print(f"[MQTT] ✅ Alerta creada: {alert['tipo']} para dispositivo {device_code} (device_id={device_id})")
-        else:
-            print(f"[MQTT] ⏭️ Alerta de tipo '{alert['tipo']}' para dispositivo {device_code} (ID: {device_id}) omitida debido al intervalo de 20 segundos")
+    """Encola la medición para el escritor por lotes de telemetry_history (no bloquea)."""
+    # Convertir timestamp de UTC a horario paraguayo
+    if timestamp:
+        # Si el timestamp viene sin timezone, asumir que es UTC
+        timestamp_utc = timestamp
+        if timestamp_utc.tzinfo is None:
+            timestamp_utc = timestamp_utc.replace(tzinfo=timezone.utc)
+        # Convertir de UTC (o cualquier timezone) a horario paraguayo
+        created_at = timestamp_utc.astimezone(PYT_TIMEZONE)
+    else:
+        created_at = datetime.now(PYT_TIMEZONE)
+    fecha = created_at.date()
+
+    telemetry_writer.submit((device_code, fecha, voltaje, corriente, potencia, created_at))
+
+rollup_writer = rollups.RollupWriter() if ROLLUPS_ENABLED else None
+# Respuestas de historial/cortes ya calculadas (ver response_cache.py)
+response_cache = ResponseCache()
+# /metrics/history-smart: tramo reciente desde InfluxDB, el resto desde PostgreSQL
+history_planner = HistoryPlanner(influx_queries)
+energy_integrator = energy.EnergyIntegrator() if ENERGY_ENABLED else None
+outage_tracker = OutageTracker() if OUTAGE_TRACKER_ENABLED else None
+quality_writer = quality.QualityWriter() if QUALITY_ENABLED else None
+
+# Después de cada lote escrito: rollups, alertas, cortes y calidad (cada uno con su manejo de errores)
+after_flush_hooks = [alert_engine.process_batch]
+if rollup_writer:
+    after_flush_hooks.insert(0, rollup_writer.process_batch)
+if outage_tracker:
+    after_flush_hooks.append(outage_tracker.process_batch)
+if quality_writer:
+    after_flush_hooks.append(quality_writer.process_batch)
+
+telemetry_writer = TelemetryWriter(
+    pg_pool,
+    batch_size=INGEST_BATCH_SIZE,
+    linger_ms=INGEST_LINGER_MS,
+    queue_capacity=INGEST_QUEUE_CAPACITY,
+    workers=INGEST_WORKERS,
+    block_ms=INGEST_BLOCK_MS,
+    after_flush=chain_hooks(*after_flush_hooks),
+    registry=device_registry,
+    energy=energy_integrator,
+)
+telemetry_writer.start()
+
+# Cambios online/offline: a SSE/WS (tópico liveness/<code>) y a device_liveness_events
+liveness = (LivenessTracker(pg_pool, on_change=lambda event: _fanout(f"liveness/{event['device']}", event))
+            if LIVENESS_ENABLED else None)
+if liveness:
+    liveness.start()
 
 def _update_metrics(topic: str, payload: Dict[str, Any]):
     """Actualiza el estado en memoria y encola eventos SSE."""
     global last_metrics, last_telemetry
 
+    ts = payload.get("ts", int(time.time()*1000))
+    if topic.startswith("esp/energia/") and topic.endswith("/state"):
+        # Estado por dispositivo: el código viene en el payload o en el tópico
+        live_state.update(
+            payload.get("device") or topic.split("/")[2],
+            ts,
+            payload.get("V"),
+            payload.get("I"),
+            payload.get("S"),
+            payload.get("P"),
+            payload.get("PF"),
+        )
+
     with state_lock:
-        ts = payload.get("ts", int(time.time()*1000))
-        
         # Nuevo formato: esp/energia/{device_id}/state
         if topic.startswith("esp/energia/") and topic.endswith("/state"):
             # Mapear campos del nuevo formato
@@ -427,62 +409,64 @@ def _update_metrics(topic: str, payload: Dict[str, Any]):
 # MQTT
 # =========================
 def on_connect(client, userdata, flags, rc, properties=None):
-    print(f"[MQTT] Connected rc={rc}")
+    log_mqtt.info("Connected rc=%s", rc)
     # Suscribirse a todos los tópicos necesarios
-    subscriptions = [
-        (TOPIC_ENERGY_STATE, 1),  # Nuevo formato: esp/energia/+/state
-        # Tópicos antiguos (mantenidos por compatibilidad)
-        (TOPIC_VRMS, 1),
-        (TOPIC_IRMS, 1),
-        (TOPIC_S_APPARENT, 1),
-        (TOPIC_TELEMETRY, 1),
-        (TOPIC_S_V, 0),
-        (TOPIC_S_I, 0),
-        (TOPIC_STATUS, 1),
-    ]
+    subscriptions = list(MQTT_SUBSCRIPTIONS)
     client.subscribe(subscriptions)
-    print(f"[MQTT] Subscribed to topics: {[s[0] for s in subscriptions]}")
+    log_mqtt.info(f"Subscribed to topics: {[s[0] for s in subscriptions]}")
 
 def on_message(client, userdata, msg):
     topic = msg.topic
     payload_raw = msg.payload.decode("utf-8", errors="ignore")
-    print(f"[MQTT] Mensaje recibido - Topic: {topic}, Payload: {payload_raw[:200]}")
+    if log_mqtt.isEnabledFor(logging.DEBUG):
+        log_mqtt.debug("Mensaje recibido - Topic: %s, Payload: %.200s", topic, payload_raw)
     
     # Intenta parsear JSON si corresponde; las muestras vienen como JSON {"ts":..,"v":..} / {"ts":..,"i":..}
+    topic_label = _topic_label(topic)
+    mqtt_messages.inc(topic_label)
     try:
         data = json.loads(payload_raw)
     except json.JSONDecodeError:
         data = payload_raw
+        mqtt_decode_errors.inc(topic_label)
 
     # Nuevo formato: esp/energia/{device_id}/state
     if topic.startswith("esp/energia/") and topic.endswith("/state"):
-        print(f"[MQTT] Procesando mensaje del tópico esp/energia/+/state")
         if isinstance(data, dict):
             # Agregar timestamp si no viene en el payload
             if "ts" not in data:
                 data["ts"] = int(time.time() * 1000)
             _update_metrics(topic, data)
+            if liveness:
+                liveness.seen(data.get("device") or topic.split("/")[2], data.get("ts"))
             
             # Guardar en telemetry_history en segundo plano
             device_code = data.get("device")
-            print(f"[MQTT] Device code extraído: {device_code}")
             if device_code:
                 # Mapear campos: V -> voltaje, I -> corriente, P -> potencia
                 voltaje = data.get("V")
                 corriente = data.get("I")
                 potencia = data.get("P")
-                print(f"[MQTT] Datos extraídos - V={voltaje}, I={corriente}, P={potencia}")
                 
                 # Convertir timestamp a datetime
                 ts_ms = data.get("ts", int(time.time() * 1000))
                 timestamp = datetime.fromtimestamp(ts_ms / 1000.0, tz=timezone.utc)
                 
                 # Guardar en segundo plano
-                print(f"[MQTT] Llamando a _save_to_telemetry_history para device={device_code}")
                 _save_to_telemetry_history(device_code, voltaje, corriente, potencia, timestamp)
+                if sampled("mqtt.accepted", LOG_SAMPLE_ACCEPTED):
+                    log_mqtt.info("Mensaje aceptado (1 de cada %d): device=%s V=%s I=%s P=%s",
+                                  LOG_SAMPLE_ACCEPTED, device_code, voltaje, corriente, potencia)
             else:
-                print(f"[MQTT] Warning: No se encontró 'device' en el payload: {data}")
+                log_mqtt.warning("No se encontró 'device' en el payload: %.200s", payload_raw)
     
+    # Last Will / conexión: esp/energia/{device_id}/status
+    elif topic.startswith("esp/energia/") and topic.endswith("/status"):
+        status = parse_status(data)
+        if liveness and status:
+            liveness.status(topic.split("/")[2], status)
+        _fanout(topic, data)
+
     # Formato antiguo (compatibilidad)
     elif topic in (TOPIC_VRMS, TOPIC_IRMS, TOPIC_S_APPARENT, TOPIC_TELEMETRY):
         if isinstance(data, dict):
@@ -516,7 +500,10 @@ def on_message(client, userdata, msg):
             pass
 
     elif topic == TOPIC_STATUS:
-        # broadcast de cambios de estado
+        # broadcast de cambios de estado (con "device" en el payload también cuenta para liveness)
+        status = parse_status(data)
+        if liveness and status and isinstance(data, dict) and data.get("device"):
+            liveness.status(str(data["device"]), status)
         try:
           #  sse_queue.put_nowait(json.dumps({"topic": topic, "data": data}))
                   # antes:
@@ -533,14 +520,14 @@ def build_mqtt_client():
     # Siempre usar autenticación (las credenciales vienen de variables de entorno)
     if MQTT_USER and MQTT_PASS:
         c.username_pw_set(MQTT_USER, MQTT_PASS)
-        print(f"[MQTT] Configurando autenticación con usuario: {MQTT_USER}")
+        log_mqtt.info(f"Configurando autenticación con usuario: {MQTT_USER}")
     else:
-        print(f"[MQTT] ADVERTENCIA: No se configuraron credenciales MQTT")
+        log_mqtt.warning("ADVERTENCIA: No se configuraron credenciales MQTT")
     c.on_connect = on_connect
     c.on_message = on_message
     # TLS opcional si configurás broker con SSL:
     # c.tls_set() ; usar MQTT_PORT típico 8883
-    print(f"[MQTT] Conectando a {MQTT_BROKER}:{MQTT_PORT} con usuario: {MQTT_USER}")
+    log_mqtt.info(f"Conectando a {MQTT_BROKER}:{MQTT_PORT} con usuario: {MQTT_USER}")
     c.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
     return c
 
@@ -549,8 +536,12 @@ def start_mqtt_loop():
     client = build_mqtt_client()
     client.loop_forever()
 
+# MQTT_ENABLED=0 importa la app sin conectarse al broker (benchmarks, herramientas)
+MQTT_ENABLED = os.getenv("MQTT_ENABLED", "1") not in ("0", "false", "no")
+
 mqtt_thread = threading.Thread(target=start_mqtt_loop, daemon=True)
-mqtt_thread.start()
+if MQTT_ENABLED:
+    mqtt_thread.start()
 
 # =========================
 # FLASK
@@ -560,19 +551,161 @@ CORS(app)  # si lo vas a consumir desde un front
 
 # ... (después de crear app = Flask(__name__) y CORS)
 sock = Sock(app)  # NUEVO
+
+@app.before_request
+def _start_request_timer():
+    g.request_t0 = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    t0 = g.get("request_t0")
+    if t0 is not None:
+        http_request_seconds.observe(time.perf_counter() - t0, request.endpoint or "unmatched",
+                                     request.method, response.status_code)
+    return response
+
 @app.route("/health", methods=["GET"])
 def health():
     return jsonify({"status": "ok", "broker": MQTT_BROKER, "base": MQTT_BASE})
 
+@app.route("/ingest/stats", methods=["GET"])
+def ingest_stats():
+    """Estado del escritor por lotes: profundidad de cola, descartes y bloqueos."""
+    return jsonify(telemetry_writer.stats())
+
+@app.route("/logs/stats", methods=["GET"])
+def logs_stats():
+    """Registros de log descartados por cola llena o por límite de tasa."""
+    return jsonify({"level": logging.getLevelName(logging.getLogger(hotlog.ROOT_LOGGER).level), **hotlog.stats})
+
+@app.route("/rollups/stats", methods=["GET"])
+def rollups_stats():
+    return jsonify({"enabled": ROLLUPS_ENABLED, **(rollup_writer.stats if rollup_writer else {})})
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify(response_cache.snapshot())
+
+@app.route("/energy/stats", methods=["GET"])
+def energy_stats():
+    return jsonify({"enabled": ENERGY_ENABLED, **(energy_integrator.stats if energy_integrator else {})})
+
+@app.route("/devices/liveness", methods=["GET"])
+def devices_liveness():
+    """
+    Estado de conexión de cada dispositivo visto desde que arrancó la API (o guardado antes):
+    status (online/offline), reason (data/lwt/timeout), since y last_seen en ms.
+    ?device=<code> devuelve solo ese. Los cambios llegan por SSE/WS con el tópico liveness/<code>.
+    """
+    if not liveness:
+        return jsonify({"error": "LIVENESS_ENABLED=0"}), 503
+    device = request.args.get("device")
+    if device:
+        rec = liveness.get(device)
+        if rec is None:
+            return jsonify({"error": f"Dispositivo '{device}' sin datos de conexión"}), 404
+        return jsonify(rec)
+    return jsonify(liveness.snapshot())
+
+@app.route("/liveness/stats", methods=["GET"])
+def liveness_stats():
+    return jsonify({"enabled": LIVENESS_ENABLED, **(liveness.summary() if liveness else {})})
+
+@app.route("/outages/stats", methods=["GET"])
+def outages_stats():
+    if not outage_tracker:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, "min_voltage": outage_tracker.min_voltage,
+                    "max_gap_minutes": outage_tracker.max_gap_minutes, **outage_tracker.stats})
+
+@app.route("/quality/stats", methods=["GET"])
+def quality_stats():
+    if not quality_writer:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **quality_writer.bands.describe(), **quality_writer.stats})
+
+@app.route("/history/planner/stats", methods=["GET"])
+def history_planner_stats():
+    return jsonify(history_planner.snapshot())
+
+@app.route("/db/pool", methods=["GET"])
+def db_pool_stats():
+    """Estado del pool de PostgreSQL: en uso, esperando y latencia de checkout."""
+    return jsonify(pg_pool.stats())
+
+@app.route("/db/devices", methods=["GET"])
+def db_device_registry():
+    """Estado del registro de dispositivos en memoria."""
+    return jsonify(device_registry.snapshot())
+
+@app.route("/alerts/engine", methods=["GET"])
+def alert_engine_stats():
+    """Contadores del motor de alertas (evaluadas, escritas, de-duplicadas)."""
+    return jsonify(alert_engine.stats)
+
+def _state_snapshot() -> Dict[str, Any]:
+    """Snapshot para hidratar SSE/WS: se copia bajo el lock y se serializa fuera."""
+    with state_lock:
+        metrics = dict(last_metrics)
+        telemetry = dict(last_telemetry)
+    _, devices = live_state.snapshot()
+    return {
+        "topic": "snapshot",
+        "data": {
+            "metrics": metrics,
+            "telemetry": telemetry,
+            "devices": {code: rec.to_dict() for code, rec in devices.items()},
+        }
+    }
+
 @app.route("/metrics", methods=["GET"])
 def get_metrics():
+    """
+    Últimas métricas. Con ?device=<código> devuelve las de ese dispositivo;
+    sin parámetro, las del último mensaje recibido (cualquier dispositivo).
+    """
+    device = request.args.get("device")
+    if device:
+        rec = live_state.get(device)
+        if rec is None:
+            return jsonify({"error": f"Sin datos en vivo para el dispositivo '{device}'"}), 404
+        return jsonify(rec.to_dict())
     with state_lock:
-        return jsonify(last_metrics)
+        data = dict(last_metrics)
+    return jsonify(data)
+
+@app.route("/metrics/all", methods=["GET"])
+def get_metrics_all():
+    """
+    Estado en vivo de toda la flota, con versión y ETag.
+    - If-None-Match: <etag> -> 304 si no hubo cambios
+    - since=<version>: solo los dispositivos que cambiaron después de esa versión;
+      si no hay cambios espera hasta 'timeout' segundos (long-polling, default 25, máx 60)
+    """
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since_v = int(since)
+            timeout = min(float(request.args.get("timeout", "25")), 60.0)
+        except ValueError:
+            return jsonify({"error": "since and timeout must be numeric"}), 400
+        live_state.wait_for_change(since_v, max(timeout, 0.0))
+        version, changed = live_state.changed_since(since_v)
+        resp = jsonify({"version": max(version, since_v), "devices": changed})
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+
+    version, body = live_state.fleet_json()
+    etag = f'W/"{version}"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=304, headers={"ETag": etag})
+    return Response(body, mimetype="application/json", headers={"ETag": etag, "Cache-Control": "no-cache"})
 
 @app.route("/telemetry", methods=["GET"])
 def get_telemetry():
     with state_lock:
-        return jsonify(last_telemetry or {})
+        data = dict(last_telemetry or {})
+    return jsonify(data)
 
 @app.route("/samples/voltage", methods=["GET"])
 def get_samples_voltage():
@@ -596,27 +729,37 @@ def stream():
     Uso desde JS:
       const es = new EventSource("/stream");
       es.onmessage = (e) => { const msg = JSON.parse(e.data); ... }
+    Cada evento lleva 'id:'; al reconectar, el navegador manda Last-Event-ID y
+    se reenvían los eventos perdidos que sigan en el ring (si no, snapshot).
     """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("lastEventId")
+    cursor, replay_ok = sse_hub.resume_cursor(last_event_id)
+
     def event_stream():
-        # Emitimos primero el estado actual (si hay) para "hidratar" el front
-        with state_lock:
-            snapshot = {
-                "topic": "snapshot",
-                "data": {
-                    "metrics": last_metrics,
-                    "telemetry": last_telemetry,
-                }
-            }
-        yield f"data: {json.dumps(snapshot)}\n\n"
+        nonlocal cursor
+        sse_hub.subscribe()
+        try:
+            if not replay_ok:
+                # Emitimos primero el estado actual (si hay) para "hidratar" el front
+                snapshot = _state_snapshot()
+                yield f"data: {json.dumps(snapshot)}\n\n"
 
-        # Loop de eventos en tiempo real
-        while True:
-            try:
-                item = sse_queue.get(timeout=30)
-                yield f"data: {item}\n\n"
-            except queue.Empty:
-                # keep-alive cada ~30s
-                yield "data: {\"type\":\"keepalive\"}\n\n"
+            # Loop de eventos en tiempo real
+            while True:
+                try:
+                    events = sse_hub.read(cursor, timeout=30)
+                except Lagged as e:
+                    # Cliente lento: cortamos; EventSource reconecta con Last-Event-ID
+                    log_stream.info(f"Cliente descartado por lento: {e}")
+                    return
+                if not events:
+                    # keep-alive cada ~30s
+                    yield "data: {\"type\":\"keepalive\"}\n\n"
+                    continue
+                cursor = events[-1][0]
+                yield "".join(f"id: {seq}\ndata: {msg}\n\n" for seq, msg in events)
+        finally:
+            sse_hub.unsubscribe()
 
     headers = {
         "Content-Type": "text/event-stream",
@@ -625,94 +768,83 @@ def stream():
         "X-Accel-Buffering": "no",  # Nginx: deshabilita buffering para SSE
     }
     return Response(event_stream(), headers=headers)
-# === WebSocket: clientes conectados y broadcaster ===
-ws_clients = set()                   # conjunto de websockets abiertos
-ws_lock = threading.Lock()
-ws_broadcast_q = queue.Queue(maxsize=10000)
-
-def _ws_broadcast_enq(obj: dict):
-    """Encola un evento JSON para ser enviado a todos los WS."""
-    msg = json.dumps(obj)
-    try:
-        ws_broadcast_q.put_nowait(msg)
-    except queue.Full:
-        # si está lleno, descartamos lo más viejo y encolamos (backpressure simple)
-        try:
-            ws_broadcast_q.get_nowait()
-        except queue.Empty:
-            pass
-        ws_broadcast_q.put_nowait(msg)
-
-def _ws_broadcast_loop():
-    while True:
-        msg = ws_broadcast_q.get()
-        dead = []
-        with ws_lock:
-            for ws in list(ws_clients):
-                try:
-                    ws.send(msg)
-                except Exception:
-                    dead.append(ws)
-            for ws in dead:
-                ws_clients.discard(ws)
-
-# Hilo broadcaster WS
-ws_thread = threading.Thread(target=_ws_broadcast_loop, daemon=True)
-ws_thread.start()
+@app.route("/stream/stats", methods=["GET"])
+def stream_stats():
+    """Estado del hub SSE: suscriptores, último id y clientes descartados."""
+    return jsonify(dict(sse_hub.stats, subscribers=sse_hub.subscribers, last_id=sse_hub.last_id, ring_size=sse_hub.size))
+
+# === WebSocket: una cola de salida y un emisor por cliente ===
+ws_hub = WsHub(max_queue=WS_CLIENT_QUEUE, policy=WS_SLOW_POLICY)
+
 def _fanout(topic: str, payload: dict):
-    # SSE
-    try:
-        sse_queue.put_nowait(json.dumps({"topic": topic, "data": payload}))
-    except queue.Full:
-        pass
-    # WS
-    _ws_broadcast_enq({"topic": topic, "data": payload})
+    # Se serializa una sola vez para SSE y WS
+    with timed(broadcast_seconds):
+        msg = sse_hub.publish(topic, payload)
+        ws_hub.publish(topic, msg)
 
 @sock.route("/ws")
 def ws_endpoint(ws):
-    """WebSocket: envía snapshot inicial y luego broadcast en tiempo real."""
-    # 1) Enviamos snapshot (estado actual)
-    with state_lock:
-        snapshot = {
-            "topic": "snapshot",
-            "data": {
-                "metrics": last_metrics,
-                "telemetry": last_telemetry,
-            }
-        }
-    try:
-        ws.send(json.dumps(snapshot))
-    except Exception:
-        return  # si no pudimos ni enviar el snapshot, cortamos
-
-    # 2) Registramos el cliente y mantenemos la conexión
-    with ws_lock:
-        ws_clients.add(ws)
+    """
+    WebSocket: envía snapshot inicial y luego broadcast en tiempo real.
+    El cliente puede filtrar tópicos (comodines MQTT + y #):
+      {"subscribe": ["esp/energia/E2641D44/state"]}
+      {"unsubscribe": ["esp/energia/E2641D44/state"]}
+    """
+    # 1) Registramos el cliente con el snapshot (estado actual) como primer mensaje
+    client = ws_hub.register(ws, initial=json.dumps(_state_snapshot()))
 
     try:
-        # Loop de lectura (keep-alive; opcionalmente responder "pong")
-        while True:
+        # 2) Loop de lectura (keep-alive, "pong" y suscripciones)
+        while not client.closed:
             msg = ws.receive()  # bloquea hasta que el cliente cierre o envíe algo
             if msg is None:
                 break  # desconectó
             if isinstance(msg, str) and msg.strip().lower() == "ping":
-                ws.send(json.dumps({"type": "pong"}))
+                client.offer(json.dumps({"type": "pong"}))
+            elif isinstance(msg, str):
+                ws_hub.handle_control(client, msg)
     except Exception:
         pass
     finally:
-        with ws_lock:
-            ws_clients.discard(ws)
+        ws_hub.unregister(client)
+
+@app.route("/ws/stats", methods=["GET"])
+def ws_stats():
+    """Estado del hub WebSocket: clientes, profundidad de colas y descartes."""
+    return jsonify(ws_hub.snapshot())
+
+# === Métricas internas (formato Prometheus) ===
+REGISTRY.gauge("iot_ingest_queue_depth", "Filas esperando en la cola del escritor por lotes",
+               lambda: telemetry_writer.stats()["queue_depth"])
+REGISTRY.counter_func("iot_ingest_rows_total", "Filas de telemetría por resultado",
+                      lambda: {k: v for k, v in telemetry_writer.stats().items()
+                               if k in ("enqueued", "written", "dropped_full", "dropped_unknown_device", "failed")},
+                      ("result",))
+REGISTRY.gauge("iot_pg_pool_connections", "Conexiones del pool PostgreSQL por estado",
+               lambda: {k: v for k, v in pg_pool.stats().items() if k in ("size", "in_use", "idle", "waiting")},
+               ("state",))
+REGISTRY.gauge("iot_response_cache_bytes", "Bytes en el cache de respuestas de historial",
+               lambda: response_cache.snapshot()["bytes"])
+REGISTRY.gauge("iot_sse_subscribers", "Suscriptores SSE conectados", lambda: sse_hub.subscribers)
+REGISTRY.gauge("iot_ws_clients", "Clientes WebSocket conectados", lambda: len(ws_hub.clients()))
+REGISTRY.gauge("iot_ws_client_queue_depth", "Mensajes pendientes en la cola de cada cliente WebSocket",
+               lambda: {str(c.id): c.queue_depth() for c in ws_hub.clients()}, ("client",))
+REGISTRY.counter_func("iot_events_dropped_total", "Eventos descartados por clientes lentos",
+                      lambda: {"sse": sse_hub.stats["dropped_slow"],
+                               "ws": ws_hub.stats.get("dropped_closed", 0) + sum(c.dropped for c in ws_hub.clients())},
+                      ("hub",))
+REGISTRY.counter_func("iot_events_published_total", "Eventos publicados por hub",
+                      lambda: {"sse": sse_hub.stats["published"], "ws": ws_hub.stats["published"]}, ("hub",))
+
+@app.route("/internal/metrics", methods=["GET"])
+def internal_metrics():
+    """Métricas de la API en formato de exposición de Prometheus."""
+    return Response(REGISTRY.expose(), headers={"Content-Type": CONTENT_TYPE})
+
 @app.route("/metrics/last-from-db", methods=["GET"])
 def metrics_last_from_db():
-    if not influx:
+    if not influx_queries.configured:
         return jsonify({"error":"influx not configured"}), 500
-    q = f'''
-    from(bucket:"{INFLUXDB_BUCKET}")
-      |> range(start: -30m)
-      |> filter(fn: (r) => r._measurement == "esp" or r._measurement == "telemetry")
-      |> last()
-    '''
-    tables = influx.query_api().query(q, org=INFLUXDB_ORG)
     out = {
         "ts": None, 
         "vrms": None, 
@@ -722,43 +854,36 @@ def metrics_last_from_db():
         "factor_potencia": None,
         "device": None
     }
-    for t in tables:
-        for r in t.records:
-            if r.field in ("vrms", "irms", "s_apparent_va", "potencia_activa", "factor_potencia", "device"):
-                out[r.field] = r.get_value()
-            if r.get_time():
-                out["ts"] = int(r.get_time().timestamp()*1000)
+    params = influx_queries.params(start=datetime.now(timezone.utc) - timedelta(minutes=30))
+    for chunk in influx_queries.rows("last_from_db", flux.LAST_FLUX, params, ("ts", "_field", "_value")):
+        for ts, field, value in chunk:
+            if field in out and field != "ts":
+                out[field] = value
+            if ts is not None:
+                out["ts"] = ts
     return jsonify(out)
 
 @app.route("/metrics/history", methods=["GET"])
 def metrics_history():
-    if not influx:
+    """
+    Últimas lecturas de InfluxDB de todos los dispositivos.
+    - range: (opcional) cuánto hacia atrás: -15m (default), -1h, -7d, ...
+    """
+    if not influx_queries.configured:
         return jsonify({"error":"influx not configured"}), 500
-    rng = request.args.get("range","-15m")
-    q = f'''
-    from(bucket:"{INFLUXDB_BUCKET}")
-      |> range(start: {rng})
-      |> filter(fn: (r) => r._measurement == "esp" or r._measurement == "telemetry")
-      |> keep(columns: ["_time","_field","_value"])
-      |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-      |> sort(columns: ["_time"])
-    '''
-    tables = influx.query_api().query(q, org=INFLUXDB_ORG)
-    rows = []
-    for t in tables:
-        for r in t.records:
-            rows.append({
-                "ts": int(r.get_time().timestamp()*1000),
-                "vrms": r.values.get("vrms"),
-                "irms": r.values.get("irms"),
-                "s_apparent_va": r.values.get("s_apparent_va"),
-                "potencia_activa": r.values.get("potencia_activa"),
-                "factor_potencia": r.values.get("factor_potencia"),
-                "device": r.values.get("device"),
-            })
-    return jsonify(rows)
+    try:
+        since = flux.parse_range(request.args.get("range", "-15m"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    params = influx_queries.params(start=datetime.now(timezone.utc) - since)
+    chunks = influx_queries.rows("history", flux.HISTORY_FLUX, params, flux.HISTORY_COLUMNS)
+    first = next(chunks, [])  # ejecuta la consulta ya: un error sale como 500
+    return Response(history_export.body("json", itertools.chain([first], chunks), flux.HISTORY_COLUMNS,
+                                        flux.HISTORY_COLUMNS, None),
+                    mimetype=history_export.FORMATS["json"])
 
 @app.route("/metrics/history-postgres", methods=["GET"])
+@response_cache.cached()
 def metrics_history_postgres():
     """
     Consulta datos históricos desde PostgreSQL.
@@ -766,9 +891,25 @@ def metrics_history_postgres():
     - start: fecha inicio (ISO 8601 o timestamp unix en ms)
     - end: fecha fin (ISO 8601 o timestamp unix en ms)
     - device: (requerido) código o ID del dispositivo
+    - bucket: (opcional) agrega por ventanas (30s, 5m, 1h, 1d): promedio, mínimo y máximo
+    - max_points: (opcional) como máximo N puntos (ventanas de rango/N)
+    - downsample: (opcional) 'lttb' para elegir max_points puntos reales con LTTB
+    - lttb_field: (opcional) serie que guía LTTB (default potencia_activa)
+    - format: (opcional) json (default), csv, msgpack, arrow (IPC stream) o parquet
+    - fields: (opcional) columnas a leer y devolver, p. ej. ts,vrms,potencia_activa,device
+    """
+    return _history_postgres(use_rollups=False)
+
+def _history_postgres(use_rollups: bool, planner: HistoryPlanner = None):
+    """
+    Implementación de /metrics/history-postgres. Con use_rollups, las consultas
+    agregadas (bucket / max_points) leen del tier de rollup más grueso que alcance.
+    Con planner, las filas crudas se reparten entre InfluxDB y PostgreSQL.
     """
-    conn = get_postgres_connection()
-    if not conn:
+    try:
+        conn = pg_pool.getconn()
+    except PoolError as e:
+        log_pg.info(f"{e}")
         return jsonify({"error": "PostgreSQL not configured or connection failed"}), 500
     
     try:
@@ -786,572 +927,324 @@ def metrics_history_postgres():
         
         # Convertir fechas a datetime
         try:
-            # Intentar parsear como timestamp unix (ms)
-            if start.isdigit():
-                start_dt = datetime.fromtimestamp(int(start) / 1000, tz=timezone.utc)
-            else:
-                start_dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-            
-            if end.isdigit():
-                end_dt = datetime.fromtimestamp(int(end) / 1000, tz=timezone.utc)
-            else:
-                end_dt = datetime.fromisoformat(end.replace('Z', '+00:00'))
+            start_dt, end_dt = _parse_range_args()
         except Exception as e:
             return jsonify({"error": f"Invalid date format: {e}"}), 400
         
+        # Reducción de puntos opcional (bucket / max_points / downsample=lttb) y formato de salida
+        try:
+            ds = downsample.from_args(request.args, start_dt, end_dt)
+            fmt = history_export.parse_format(request.args.get("format"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         cursor = conn.cursor()
         
         # Verificar qué dispositivo existe y su código
-        cursor.execute("SELECT id, code, name FROM devices WHERE code = %s OR id::text = %s", [device, device])
-        device_info = cursor.fetchone()
-        print(f"[POSTGRES] Dispositivo buscado: '{device}'")
+        device_info = _resolve_device(cursor, device)
+        log_pg.debug(f"Dispositivo buscado: '{device}'")
         if device_info:
-            print(f"[POSTGRES] Dispositivo encontrado: id={device_info[0]}, code={device_info[1]}, name={device_info[2]}")
+            log_pg.debug(f"Dispositivo encontrado: id={device_info[0]}, code={device_info[1]}, name={device_info[2]}")
         else:
-            print(f"[POSTGRES] ADVERTENCIA: No se encontró dispositivo con code/id='{device}'")
+            log_pg.warning(f"ADVERTENCIA: No se encontró dispositivo con code/id='{device}'")
             # Intentar buscar sin filtro de dispositivo para ver qué hay
             cursor.execute("SELECT id, code, name FROM devices LIMIT 5")
             all_devices = cursor.fetchall()
-            print(f"[POSTGRES] Dispositivos disponibles: {all_devices}")
+            log_pg.debug(f"Dispositivos disponibles: {all_devices}")
             return jsonify({"error": f"Dispositivo '{device}' no encontrado"}), 404
         
-        # Construir query - usar telemetry_history que es donde se guardan los datos
-        # IMPORTANTE: Los datos se almacenan con precisión de hora/minuto (created_at es TIMESTAMP)
-        # El frontend agrupa estos datos por día para el reporte
-        # Necesitamos hacer JOIN con devices para obtener el código del dispositivo
-        # Usar created_at para el timestamp (precisión hora/minuto) y fecha para el filtro de fechas
-        # SIEMPRE filtrar por dispositivo
-        query = """
-            SELECT 
-                th.created_at as "time",  -- Timestamp preciso (hora/minuto) para cálculos de energía
-                COALESCE(d.code, d.id::text, 'UNKNOWN') as device,
-                th.voltaje as vrms,
-                th.corriente as irms,
-                (th.voltaje * th.corriente) as s_apparent_va,
-                th.potencia as potencia_activa,
-                CASE 
-                    WHEN th.voltaje > 0 AND th.corriente > 0 
-                    THEN (th.potencia / (th.voltaje * th.corriente))
-                    ELSE NULL 
-                END as factor_potencia
-            FROM telemetry_history th
-            LEFT JOIN devices d ON th.device_id = d.id
-            WHERE th.created_at >= %s AND th.created_at <= %s
-            AND (d.code = %s OR d.id::text = %s OR th.device_id::text = %s)
-        """
-        params = [start_dt, end_dt, device, device, device]
+        # El dispositivo ya está resuelto: range scan sobre (device_id, created_at), ordenado.
+        # Para totales de energía por día usar /metrics/energy (no hace falta traer las filas crudas).
+        device_id, device_code = device_info[0], device_info[1] or str(device_info[0])
+        log_pg.debug(f"Rango de fechas: {start_dt} a {end_dt}, device_id={device_id}")
+        cursor.close()
         
-        print(f"[POSTGRES] Ejecutando query: {query}")
-        print(f"[POSTGRES] Parámetros: {params}")
-        print(f"[POSTGRES] Rango de fechas: {start_dt} a {end_dt}")
+        tier = None
+        if ds.mode == "bucket" and use_rollups and ROLLUPS_ENABLED:
+            # bucket explícito: el tier tiene que dividir la ventana; max_points: se redondea la ventana
+            tier = rollups.pick_tier(ds.bucket_s, exact=ds.max_points is None)
+        if tier is not None:
+            available, default = tuple(rollups.READ_EXPRS), rollups.ROLLUP_COLUMNS
+        elif ds.mode == "bucket":
+            available, default = tuple(BUCKET_EXPRS), BUCKET_COLUMNS
+        else:
+            available, default = tuple(RANGE_EXPRS), STREAM_COLUMNS
+        # Proyección: solo se leen (y codifican) las columnas pedidas
+        try:
+            fields = history_export.parse_fields(request.args.get("fields"), available)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        columns = history_export.columns_to_read(fields, default)
+        out = history_export.output_columns(fields, columns)
         
-        cursor.execute(query, params)
-        rows = []
-        for row in cursor.fetchall():
-            # Convertir datetime a timestamp unix en ms (mantiene precisión de hora/minuto)
-            # Este timestamp preciso se usa en el frontend para calcular intervalos de tiempo
-            # y así obtener el consumo diario total (energía = integral de potencia)
-            ts = int(row[0].timestamp() * 1000) if row[0] else None
-            rows.append({
-                "ts": ts,
-                "device": row[1] if row[1] else "UNKNOWN",
-                "vrms": float(row[2]) if row[2] is not None else None,
-                "irms": float(row[3]) if row[3] is not None else None,
-                "s_apparent_va": float(row[4]) if row[4] is not None else None,
-                "potencia_activa": float(row[5]) if row[5] is not None else None,
-                "factor_potencia": float(row[6]) if row[6] is not None else None,
-            })
+        if ds.mode == "lttb":
+            # LTTB sobre la serie completa (en arrays NumPy, no en dicts); a lo sumo max_points filas.
+            # Se leen también ts y la serie guía aunque no se pidan.
+            columns = tuple(dict.fromkeys(("ts", ds.field) + columns))
+            raw = stream_device_range(conn, device_id, start_dt, end_dt, "history_lttb", columns=columns)
+            rows = downsample.lttb_rows(raw, columns.index(ds.field), ds.max_points)
+            log_pg.info(f"Retornando {len(rows)} registros (lttb, max_points={ds.max_points})")
+            return Response(history_export.body(fmt, [rows], columns, out, device_code),
+                            mimetype=history_export.FORMATS[fmt],
+                            headers=history_export.headers(fmt, device_code))
         
-        print(f"[POSTGRES] Retornando {len(rows)} registros")
-        cursor.close()
-        conn.close()
-        return jsonify(rows)
+        # Cursor del lado del servidor: las filas se leen y se codifican de a bloques
+        if tier is not None:
+            tier_name, tier_s = tier
+            bucket_s = -(-ds.bucket_s // tier_s) * tier_s
+            log_pg.debug(f"Usando rollup {tier_name} (ventana {bucket_s}s)")
+            chunks = rollups.stream_rollup_buckets(conn, "device", device_id, tier_name, start_dt, end_dt,
+                                                   bucket_s, f"history_rollup_{tier_name}", columns=columns)
+        elif ds.mode == "bucket":
+            chunks = stream_device_buckets(conn, device_id, start_dt, end_dt, ds.bucket_s, "history_buckets",
+                                           columns=columns)
+        elif planner is not None and planner.influx is not None and planner.influx_serves(columns):
+            # ts hace falta para unir los tramos aunque no se pida (out no cambia)
+            columns = tuple(dict.fromkeys(("ts",) + columns))
+            chunks = _planned_range(conn, planner, device_id, device_code, start_dt, end_dt, columns)
+        else:
+            chunks = stream_device_range(conn, device_id, start_dt, end_dt, "history_postgres", columns=columns)
+        first = next(chunks, [])  # ejecuta la consulta ya: un error sale como 500
+        response = _stream_points(chunks, first, columns, out, fmt, device_code, conn)
+        conn = None  # la conexión vuelve al pool cuando termina la respuesta
+        return response
     except Exception as e:
-        if conn:
-            conn.close()
         return jsonify({"error": str(e)}), 500
+    finally:
+        if conn is not None:
+            pg_pool.putconn(conn)
+
+def _planned_range(conn, planner: HistoryPlanner, device_id: int, device_code: str,
+                   start_dt: datetime, end_dt: datetime, columns):
+    """Bloques del rango según el plan: Influx en un hilo, PostgreSQL acá, unidos por ts."""
+    cursor = conn.cursor()
+    try:
+        parts = planner.plan(cursor, device_id, device_code, start_dt, end_dt)
+    finally:
+        cursor.close()
+    log_hist.debug(f"Plan para {device_code}: {parts}")
+    streams = []
+    try:
+        for part in parts:
+            if part.store == "influx":
+                fallback = functools.partial(stream_device_range, conn, device_id, part.start, part.end,
+                                             "history_smart_fallback", columns=columns)
+                streams.append(planner.start_influx(device_code, part, columns, fallback))
+            else:
+                streams.append(stream_device_range(conn, device_id, part.start, part.end, "history_smart",
+                                                   columns=columns))
+        yield from merge_streams(streams, columns.index("ts"), planner.incr)
+    finally:
+        for stream in streams:
+            stream.close()
+
+def _stream_points(chunks, first, columns, out, fmt: str, device_code: str, conn, keys=None) -> Response:
+    """
+    Respuesta en 'fmt' (ver history_export.py) que se genera a medida que llegan los bloques.
+    Con keys (códigos pedidos) es la respuesta de /metrics/history-batch.
+    """
+    sent = [0]
+
+    def counted():
+        for chunk in itertools.chain([first], chunks):
+            sent[0] += len(chunk)
+            yield chunk
+
+    def close():
+        chunks.close()
+        pg_pool.putconn(conn)
+        log_pg.info(f"Retornados {sent[0]} registros (stream, {fmt})")
+
+    if keys is None:
+        body = history_export.body(fmt, counted(), columns, out, device_code)
+    else:
+        body = history_export.batch_body(fmt, counted(), columns, out, keys)
+    response = Response(body, mimetype=history_export.FORMATS[fmt], headers=history_export.headers(fmt, device_code))
+    response.call_on_close(close)
+    return response
 
 @app.route("/metrics/history-smart", methods=["GET"])
+@response_cache.cached()
 def metrics_history_smart():
     """
-    Endpoint inteligente que decide automáticamente entre InfluxDB y PostgreSQL
-    según el rango de fechas:
-    - 1 a 30 días: InfluxDB
-    - Más de 30 días: PostgreSQL
+    Historial de un dispositivo desde el store que tiene cada parte del rango
+    (ver history_planner.py): las filas crudas dentro de la retención de InfluxDB se
+    leen de Influx, las anteriores de PostgreSQL; si el rango cruza el límite se
+    consultan ambos en paralelo y se unen por ts. A lo sumo dos consultas por request.
     
     Parámetros:
     - start: fecha inicio (ISO 8601 o timestamp unix en ms)
     - end: fecha fin (ISO 8601 o timestamp unix en ms)
     - device: (requerido) código o ID del dispositivo
+    - bucket / max_points / downsample / lttb_field / format / fields: ver /metrics/history-postgres.
+      Con bucket o max_points se lee del rollup más grueso que cubra la resolución
+      pedida (1d, 1h o 1m; ver rollups.py) y cada punto trae además energy_wh.
+    """
+    return _history_postgres(use_rollups=True, planner=history_planner)
+
+@app.route("/metrics/history-batch", methods=["GET"])
+@response_cache.cached()
+def metrics_history_batch():
+    """
+    Historial de varios dispositivos con una sola conexión y una sola consulta
+    (device_id = ANY, ver history_batch.py), para dashboards por empresa.
+    
+    Parámetros:
+    - devices: códigos o IDs separados por coma, o
+    - company_id: todos los dispositivos de la empresa
+    - start / end: (requeridos) ISO 8601 o timestamp unix en ms
+    - bucket / max_points / downsample / lttb_field / fields / format: ver /metrics/history-postgres.
+      max_points es por dispositivo; con bucket o max_points se lee del rollup que alcance.
+    
+    Respuesta: json -> {código: [puntos]} (también los dispositivos sin datos);
+    csv / msgpack / arrow / parquet -> una tabla con la columna device, ordenada por
+    dispositivo y tiempo.
     """
     start = request.args.get("start")
     end = request.args.get("end")
-    device = request.args.get("device")
-    
+    company_id = request.args.get("company_id")
     if not start or not end:
         return jsonify({"error": "start and end parameters are required"}), 400
-    
-    # Requerir dispositivo para evitar traer todos los datos
-    if not device:
-        return jsonify({"error": "device parameter is required"}), 400
-    
-    # Calcular días entre fechas
     try:
-        if start.isdigit():
-            start_dt = datetime.fromtimestamp(int(start) / 1000, tz=timezone.utc)
+        if company_id is not None:
+            company_id = int(company_id)
+            keys = None
         else:
-            start_dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-        
-        if end.isdigit():
-            end_dt = datetime.fromtimestamp(int(end) / 1000, tz=timezone.utc)
-        else:
-            end_dt = datetime.fromisoformat(end.replace('Z', '+00:00'))
-        
-        delta = end_dt - start_dt
-        dias = delta.days
+            keys = history_batch.parse_devices(request.args.get("devices"))
+    except ValueError as e:
+        return jsonify({"error": f"devices o company_id inválidos: {e}"}), 400
+    try:
+        start_dt, end_dt = _parse_range_args()
     except Exception as e:
         return jsonify({"error": f"Invalid date format: {e}"}), 400
+    try:
+        ds = downsample.from_args(request.args, start_dt, end_dt)
+        fmt = history_export.parse_format(request.args.get("format"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    # USAR POSTGRESQL DIRECTAMENTE (InfluxDB no está trayendo datos)
-    # USAR SOLO POSTGRESQL - NO consultar InfluxDB
-    print(f"[HISTORY-SMART] Rango: {dias} días, start: {start_dt}, end: {end_dt}, device: {device}")
-    print(f"[HISTORY-SMART] Usando SOLO PostgreSQL (InfluxDB deshabilitado)")
-    
-    # Siempre usar PostgreSQL
-    use_influx = False
-    
-    # Inicializar variable para evitar errores de scope
-    available_measurements = []
-    
-    if use_influx:
-        print(f"[HISTORY-SMART] Intentando InfluxDB primero (rango incluye datos recientes)")
-        print(f"[HISTORY-SMART] InfluxDB configurado: URL={INFLUXDB_URL}, Org={INFLUXDB_ORG}, Bucket={INFLUXDB_BUCKET}")
-        print(f"[HISTORY-SMART] Rango solicitado: {start_dt} a {end_dt}, device: {device}")
-        
-        # Primero, verificar qué devices hay disponibles en InfluxDB en el rango de fechas solicitado
-        try:
-            # Usar el rango de fechas solicitado para buscar devices
-            start_iso_temp = start_dt.replace(hour=0, minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M:%SZ")
-            end_iso_temp = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999).strftime("%Y-%m-%dT%H:%M:%SZ")
-            
-            # Primero verificar qué measurements hay realmente
-            query_measurements = f'from(bucket:"{INFLUXDB_BUCKET}") |> range(start: {start_iso_temp}, stop: {end_iso_temp}) |> group() |> distinct(column: "_measurement") |> limit(n: 10)'
-            print(f"[HISTORY-SMART] Query para buscar measurements: {query_measurements}")
-            tables_measurements = influx.query_api().query(query_measurements, org=INFLUXDB_ORG)
-            for t in tables_measurements:
-                for r in t.records:
-                    meas = r.values.get("_measurement")
-                    if meas:
-                        available_measurements.append(meas)
-            available_measurements = list(set(available_measurements))
-            print(f"[HISTORY-SMART] Measurements disponibles en InfluxDB: {available_measurements}")
-            
-            # Construir filtro de measurements dinámicamente
-            if available_measurements:
-                measurement_filter = " or ".join([f'r._measurement == "{m}"' for m in available_measurements])
-            else:
-                # Fallback: buscar en ambos por si acaso
-                measurement_filter = 'r._measurement == "esp" or r._measurement == "telemetry"'
-            
-            query_devices = f'from(bucket:"{INFLUXDB_BUCKET}") |> range(start: {start_iso_temp}, stop: {end_iso_temp}) |> filter(fn: (r) => {measurement_filter}) |> filter(fn: (r) => exists r.device) |> distinct(column: "device") |> limit(n: 10)'
-            print(f"[HISTORY-SMART] Query para buscar devices: {query_devices}")
-            tables_devices = influx.query_api().query(query_devices, org=INFLUXDB_ORG)
-            available_devices_influx = []
-            for t in tables_devices:
-                for r in t.records:
-                    device_val = r.values.get("device")
-                    if device_val:
-                        available_devices_influx.append(device_val)
-            print(f"[HISTORY-SMART] Devices disponibles en InfluxDB en el rango: {list(set(available_devices_influx))}")
-            
-            # También verificar si hay datos sin filtro de device para diagnosticar
-            query_count = f'from(bucket:"{INFLUXDB_BUCKET}") |> range(start: {start_iso_temp}, stop: {end_iso_temp}) |> filter(fn: (r) => {measurement_filter}) |> count()'
-            tables_count = influx.query_api().query(query_count, org=INFLUXDB_ORG)
-            total_count = 0
-            for t in tables_count:
-                for r in t.records:
-                    total_count += r.values.get("_value", 0)
-            print(f"[HISTORY-SMART] Total de registros en InfluxDB (sin filtro device): {total_count}")
-        except Exception as e:
-            print(f"[HISTORY-SMART] Error consultando devices en InfluxDB: {e}")
-            import traceback
-            traceback.print_exc()
-            available_devices_influx = []
-            if not available_measurements:
-                available_measurements = []
-        
-        # Mapear código de dispositivo a device ID de MQTT
-        # En InfluxDB, el device es el chip ID del ESP32 (ej: "E2641D44")
-        # Pero el usuario busca por código de la BD (ej: "PRINCIPAL")
-        device_ids_to_search = [device]  # Incluir el código original
-        
-        # Si el código es "PRINCIPAL", buscar también device IDs disponibles en InfluxDB
-        if device == "PRINCIPAL":
-            print(f"[HISTORY-SMART] Código 'PRINCIPAL' detectado")
-            if available_devices_influx:
-                print(f"[HISTORY-SMART] Agregando devices de InfluxDB a la búsqueda: {available_devices_influx}")
-                device_ids_to_search.extend(available_devices_influx)
-            else:
-                # Fallback: usar device ID común
-                print(f"[HISTORY-SMART] No se encontraron devices en InfluxDB, usando 'E2641D44' como fallback")
-                device_ids_to_search.append("E2641D44")
-        
-        # Eliminar duplicados
-        device_ids_to_search = list(dict.fromkeys(device_ids_to_search))
-        print(f"[HISTORY-SMART] Device IDs a buscar: {device_ids_to_search}")
-        
-        # Convertir a formato de rango de InfluxDB
-        # Asegurar que incluya todo el día (desde inicio del día hasta fin del día)
-        start_iso = start_dt.replace(hour=0, minute=0, second=0, microsecond=0).strftime("%Y-%m-%dT%H:%M:%SZ")
-        end_iso = end_dt.replace(hour=23, minute=59, second=59, microsecond=999999).strftime("%Y-%m-%dT%H:%M:%SZ")
-        
-        print(f"[HISTORY-SMART] Rango InfluxDB: {start_iso} a {end_iso}")
-        print(f"[HISTORY-SMART] Dispositivos a buscar en InfluxDB: {device_ids_to_search}")
+    try:
+        conn = pg_pool.getconn()
+    except PoolError as e:
+        log_pg.info(f"{e}")
+        return jsonify({"error": "PostgreSQL not configured or connection failed"}), 500
+    try:
+        cursor = conn.cursor()
+        if keys is None:
+            devices = _company_devices(cursor, company_id)
+            if len(devices) > history_batch.HISTORY_BATCH_MAX_DEVICES:
+                cursor.close()
+                return jsonify({"error": f"La empresa tiene más de {history_batch.HISTORY_BATCH_MAX_DEVICES} "
+                                         "dispositivos; usar devices="}), 400
+        else:
+            found = {key: _resolve_device(cursor, key) for key in keys}
+            missing = [key for key, info in found.items() if info is None]
+            if missing:
+                cursor.close()
+                return jsonify({"error": f"Dispositivos no encontrados: {', '.join(missing)}"}), 404
+            devices = list({info[0]: info for info in found.values()}.values())
+        cursor.close()
+        codes = {d[0]: d[1] or str(d[0]) for d in devices}
+        device_ids = sorted(codes)
+        requested = list(codes.values())  # orden del pedido (o por id con company_id)
+        log_pg.debug(f"Batch de {len(device_ids)} dispositivos, {start_dt} a {end_dt}")
         
-        # BUSCAR DIRECTAMENTE TODOS LOS DATOS SIN FILTROS (basado en ejemplo del usuario)
-        all_rows = []
-        print(f"[HISTORY-SMART] ===== BUSCANDO DIRECTAMENTE TODOS LOS DATOS EN INFLUXDB SIN FILTROS =====")
+        tier = None
+        if ds.mode == "bucket" and ROLLUPS_ENABLED:
+            tier = rollups.pick_tier(ds.bucket_s, exact=ds.max_points is None)
+        if tier is not None:
+            available, default = tuple(rollups.READ_EXPRS), rollups.ROLLUP_COLUMNS
+        elif ds.mode == "bucket":
+            available, default = tuple(BUCKET_EXPRS), BUCKET_COLUMNS
+        else:
+            available, default = tuple(RANGE_EXPRS), STREAM_COLUMNS
         try:
-            # Búsqueda amplia: obtener TODOS los datos del rango sin ningún filtro
-            # Basado en el ejemplo: measurement="esp", topic="esp/energia/E2641D44/state"
-            q_broad_all = f'''
-            from(bucket:"{INFLUXDB_BUCKET}")
-              |> range(start: {start_iso}, stop: {end_iso})
-              |> filter(fn: (r) => r["_measurement"] == "esp")
-              |> keep(columns: ["_time","_field","_value","_measurement","device","topic","host"])
-              |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-              |> sort(columns: ["_time"])
-            '''
-            print(f"[HISTORY-SMART] Query búsqueda TODOS los datos en InfluxDB (measurement=esp, sin filtros de device/topic):")
-            print(q_broad_all)
-            tables_broad = influx.query_api().query(q_broad_all, org=INFLUXDB_ORG)
-            broad_count = 0
-            for t in tables_broad:
-                for r in t.records:
-                    broad_count += 1
-                    ts_ms = int(r.get_time().timestamp()*1000)
-                    if broad_count <= 10:
-                        print(f"[HISTORY-SMART] Record {broad_count}: time={r.get_time()}, measurement={r.values.get('_measurement')}, device={r.values.get('device')}, topic={r.values.get('topic')}, host={r.values.get('host')}, campos={[k for k in r.values.keys() if k not in ['_measurement','device','topic','host']]}")
-                    # Buscar potencia_activa o potencia_actesp o P
-                    potencia = r.values.get("potencia_activa") or r.values.get("potencia_actesp") or r.values.get("P")
-                    all_rows.append({
-                        "ts": ts_ms,
-                        "vrms": r.values.get("vrms") or r.values.get("V"),
-                        "irms": r.values.get("irms") or r.values.get("I"),
-                        "s_apparent_va": r.values.get("s_apparent_va") or r.values.get("S"),
-                        "potencia_activa": potencia,
-                        "factor_potencia": r.values.get("factor_potencia") or r.values.get("PF"),
-                        "device": r.values.get("device") or device,
-                    })
-            print(f"[HISTORY-SMART] Búsqueda TODOS los datos (measurement=esp): {broad_count} registros encontrados")
-        except Exception as e_broad:
-            print(f"[HISTORY-SMART] Error en búsqueda amplia: {e_broad}")
-            import traceback
-            traceback.print_exc()
+            fields = history_export.parse_fields(request.args.get("fields"), available)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        columns = history_export.columns_to_read(fields, default)
+        out = history_export.output_columns(fields, columns)
+        if history_export.DEVICE not in out:
+            out += (history_export.DEVICE,)  # sin device las filas de la tabla no se distinguen
         
-        # Si ya encontramos datos, saltar el resto de búsquedas
-        if len(all_rows) == 0:
-            print(f"[HISTORY-SMART] No se encontraron datos con búsqueda directa, intentando búsquedas con filtros...")
-            # Buscar en todos los device IDs posibles (código original)
-            for device_id in device_ids_to_search:
-                # SIEMPRE filtrar por dispositivo
-                # Telegraf guarda: measurement="esp", tag=device="E2641D44", fields=vrms,irms,etc
-                # También puede haber measurement="telemetry" para tópicos antiguos
-                # Buscar en ambos measurements
-                # Usar los measurements encontrados o fallback
-                if available_measurements:
-                    measurement_filter_q = " or ".join([f'r._measurement == "{m}"' for m in available_measurements])
-                else:
-                    measurement_filter_q = 'r._measurement == "esp" or r._measurement == "telemetry"'
-                
-                # Intentar primero con filtro de device si existe
-                try:
-                    q = f'''
-            from(bucket:"{INFLUXDB_BUCKET}")
-              |> range(start: {start_iso}, stop: {end_iso})
-              |> filter(fn: (r) => {measurement_filter_q})
-              |> filter(fn: (r) => exists r.device)
-              |> filter(fn: (r) => r.device == "{device_id}")
-              |> keep(columns: ["_time","_field","_value","device"])
-              |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-              |> sort(columns: ["_time"])
-            '''
-                    
-                    print(f"[HISTORY-SMART] Query InfluxDB para device '{device_id}' (con filtro device):")
-                    print(q)
-                    tables = influx.query_api().query(q, org=INFLUXDB_ORG)
-                    record_count = 0
-                    table_count = 0
-                    for t in tables:
-                        table_count += 1
-                        for r in t.records:
-                            record_count += 1
-                            ts_ms = int(r.get_time().timestamp()*1000)
-                            if record_count <= 3:
-                                print(f"[HISTORY-SMART] Record {record_count}: time={r.get_time()}, values={r.values}")
-                            # Buscar potencia_activa o potencia_actesp (dependiendo de cómo se guardó)
-                            potencia = r.values.get("potencia_activa") or r.values.get("potencia_actesp") or r.values.get("P")
-                            all_rows.append({
-                                "ts": ts_ms,
-                                "vrms": r.values.get("vrms") or r.values.get("V"),
-                                "irms": r.values.get("irms") or r.values.get("I"),
-                                "s_apparent_va": r.values.get("s_apparent_va") or r.values.get("S"),
-                                "potencia_activa": potencia,
-                                "factor_potencia": r.values.get("factor_potencia") or r.values.get("PF"),
-                                "device": r.values.get("device") or device_id,
-                            })
-                    print(f"[HISTORY-SMART] Device '{device_id}' (con filtro device): {record_count} registros encontrados")
-                    
-                    # Si no se encontraron datos con filtro de device, intentar sin filtro de device
-                    # (puede que el device tag no esté presente y los datos estén en el topic)
-                    if record_count == 0:
-                        print(f"[HISTORY-SMART] No se encontraron datos con filtro device, intentando sin filtro de device...")
-                        # Buscar por topic si está disponible
-                        q_no_device = f'''
-                    from(bucket:"{INFLUXDB_BUCKET}")
-                      |> range(start: {start_iso}, stop: {end_iso})
-                      |> filter(fn: (r) => {measurement_filter_q})
-                      |> filter(fn: (r) => r.topic == "esp/energia/{device_id}/state" or r.topic =~ /esp\\/energia\\/.*\\/state/)
-                      |> keep(columns: ["_time","_field","_value","device","topic","host"])
-                      |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-                      |> sort(columns: ["_time"])
-                    '''
-                        print(f"[HISTORY-SMART] Query sin filtro device (por topic):")
-                        print(q_no_device)
-                        tables_no_device = influx.query_api().query(q_no_device, org=INFLUXDB_ORG)
-                        for t in tables_no_device:
-                            for r in t.records:
-                                record_count += 1
-                                ts_ms = int(r.get_time().timestamp()*1000)
-                                if record_count <= 3:
-                                    print(f"[HISTORY-SMART] Record {record_count} (sin device): time={r.get_time()}, values={r.values}")
-                                # Buscar potencia_activa o potencia_actesp
-                                potencia = r.values.get("potencia_activa") or r.values.get("potencia_actesp") or r.values.get("P")
-                                all_rows.append({
-                                    "ts": ts_ms,
-                                    "vrms": r.values.get("vrms") or r.values.get("V"),
-                                    "irms": r.values.get("irms") or r.values.get("I"),
-                                    "s_apparent_va": r.values.get("s_apparent_va") or r.values.get("S"),
-                                    "potencia_activa": potencia,
-                                    "factor_potencia": r.values.get("factor_potencia") or r.values.get("PF"),
-                                    "device": r.values.get("device") or device_id,
-                                })
-                        print(f"[HISTORY-SMART] Device '{device_id}' (sin filtro device): {record_count} registros totales encontrados")
-                    
-                    # Si aún no hay datos, intentar búsqueda más amplia sin filtros de device
-                    if record_count == 0:
-                            # Búsqueda amplia: obtener todos los datos del rango y filtrar después
-                            print(f"[HISTORY-SMART] Intentando búsqueda amplia sin filtros de device/topic...")
-                            q_broad = f'''
-                    from(bucket:"{INFLUXDB_BUCKET}")
-                      |> range(start: {start_iso}, stop: {end_iso})
-                      |> filter(fn: (r) => {measurement_filter_q})
-                      |> keep(columns: ["_time","_field","_value","device","topic","host"])
-                      |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-                      |> sort(columns: ["_time"])
-                    '''
-                            print(f"[HISTORY-SMART] Query amplia (sin filtros):")
-                            print(q_broad)
-                            try:
-                                tables_broad = influx.query_api().query(q_broad, org=INFLUXDB_ORG)
-                                broad_count = 0
-                                for t in tables_broad:
-                                    for r in t.records:
-                                        broad_count += 1
-                                        # Incluir todos los registros del rango (sin filtrar por device)
-                                        # ya que puede que no haya tag device
-                                        ts_ms = int(r.get_time().timestamp()*1000)
-                                        if broad_count <= 5:
-                                            print(f"[HISTORY-SMART] Record amplio {broad_count}: time={r.get_time()}, device={r.values.get('device')}, topic={r.values.get('topic')}, host={r.values.get('host')}, fields={[k for k in r.values.keys() if k not in ['device','topic','host']]}")
-                                        # Buscar potencia_activa o potencia_actesp
-                                        potencia = r.values.get("potencia_activa") or r.values.get("potencia_actesp") or r.values.get("P")
-                                        all_rows.append({
-                                            "ts": ts_ms,
-                                            "vrms": r.values.get("vrms") or r.values.get("V"),
-                                            "irms": r.values.get("irms") or r.values.get("I"),
-                                            "s_apparent_va": r.values.get("s_apparent_va") or r.values.get("S"),
-                                            "potencia_activa": potencia,
-                                            "factor_potencia": r.values.get("factor_potencia") or r.values.get("PF"),
-                                            "device": r.values.get("device") or device_id,
-                                        })
-                                        record_count += 1
-                                print(f"[HISTORY-SMART] Búsqueda amplia: {broad_count} registros encontrados (todos incluidos)")
-                            except Exception as e_broad:
-                                print(f"[HISTORY-SMART] Error en búsqueda amplia: {e_broad}")
-                                import traceback
-                                traceback.print_exc()
-                except Exception as e:
-                    print(f"[HISTORY-SMART] Error consultando device '{device_id}': {e}")
-                    import traceback
-                    traceback.print_exc()
-        
-        # SIEMPRE buscar TODOS los datos en InfluxDB sin filtros si no se encontraron datos
-        # Esto es necesario porque los datos pueden no tener tag device o measurement
-        if len(all_rows) == 0:
-            print(f"[HISTORY-SMART] ===== BUSCANDO TODOS LOS DATOS EN INFLUXDB SIN FILTROS =====")
-            print(f"[HISTORY-SMART] No se encontraron datos con filtros, buscando TODOS los datos en InfluxDB (sin filtros)...")
-            print(f"[HISTORY-SMART] Total de intentos con filtros: {len(device_ids_to_search)} devices, all_rows={len(all_rows)}")
-            try:
-                # Búsqueda amplia: obtener TODOS los datos del rango sin ningún filtro
-                # Sin filtrar por measurement, device, topic, etc.
-                q_broad_all = f'''
-                from(bucket:"{INFLUXDB_BUCKET}")
-                  |> range(start: {start_iso}, stop: {end_iso})
-                  |> keep(columns: ["_time","_field","_value","_measurement","device","topic","host"])
-                  |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-                  |> sort(columns: ["_time"])
-                '''
-                print(f"[HISTORY-SMART] Query búsqueda TODOS los datos en InfluxDB (sin filtros):")
-                print(q_broad_all)
-                tables_broad = influx.query_api().query(q_broad_all, org=INFLUXDB_ORG)
-                broad_count = 0
-                for t in tables_broad:
-                    for r in t.records:
-                        broad_count += 1
-                        ts_ms = int(r.get_time().timestamp()*1000)
-                        if broad_count <= 10:
-                            print(f"[HISTORY-SMART] Record {broad_count}: time={r.get_time()}, measurement={r.values.get('_measurement')}, device={r.values.get('device')}, topic={r.values.get('topic')}, host={r.values.get('host')}, campos={[k for k in r.values.keys() if k not in ['_measurement','device','topic','host']]}")
-                        # Buscar potencia_activa o potencia_actesp o P
-                        potencia = r.values.get("potencia_activa") or r.values.get("potencia_actesp") or r.values.get("P")
-                        all_rows.append({
-                            "ts": ts_ms,
-                            "vrms": r.values.get("vrms") or r.values.get("V"),
-                            "irms": r.values.get("irms") or r.values.get("I"),
-                            "s_apparent_va": r.values.get("s_apparent_va") or r.values.get("S"),
-                            "potencia_activa": potencia,
-                            "factor_potencia": r.values.get("factor_potencia") or r.values.get("PF"),
-                            "device": r.values.get("device") or device,
-                        })
-                print(f"[HISTORY-SMART] Búsqueda TODOS los datos: {broad_count} registros encontrados")
-            except Exception as e_broad:
-                print(f"[HISTORY-SMART] Error en búsqueda amplia: {e_broad}")
-                import traceback
-                traceback.print_exc()
-        
-        # Eliminar duplicados por timestamp (si hay overlap)
-        seen_timestamps = set()
-        unique_rows = []
-        for row in all_rows:
-            if row["ts"] not in seen_timestamps:
-                seen_timestamps.add(row["ts"])
-                unique_rows.append(row)
-        
-        rows = sorted(unique_rows, key=lambda x: x["ts"])
-        
-        print(f"[HISTORY-SMART] InfluxDB total: {len(rows)} registros únicos")
-        
-        # Mostrar rango de fechas de los datos obtenidos
-        if len(rows) > 0:
-            min_ts = min(r["ts"] for r in rows)
-            max_ts = max(r["ts"] for r in rows)
-            min_date = datetime.fromtimestamp(min_ts/1000, tz=timezone.utc)
-            max_date = datetime.fromtimestamp(max_ts/1000, tz=timezone.utc)
-            print(f"[HISTORY-SMART] Rango de datos InfluxDB: {min_date} a {max_date}")
-        
-        # Si InfluxDB tiene datos, usarlos (incluso si son pocos, son los más recientes)
-        if len(rows) > 0:
-            print(f"[HISTORY-SMART] Usando datos de InfluxDB ({len(rows)} registros)")
-            return jsonify(rows)
+        if ds.mode == "lttb":
+            columns = tuple(dict.fromkeys(("ts", ds.field) + columns))
+            raw = stream_devices_range(conn, device_ids, start_dt, end_dt, "history_batch_lttb", columns=columns)
+            chunks = history_batch.lttb_by_device(raw, columns.index(ds.field), ds.max_points, codes)
+        elif tier is not None:
+            tier_name, tier_s = tier
+            bucket_s = -(-ds.bucket_s // tier_s) * tier_s
+            chunks = history_batch.with_codes(rollups.stream_rollup_buckets_many(
+                conn, "device", device_ids, tier_name, start_dt, end_dt, bucket_s,
+                f"history_batch_rollup_{tier_name}", columns=columns), codes)
+        elif ds.mode == "bucket":
+            chunks = history_batch.with_codes(stream_devices_buckets(
+                conn, device_ids, start_dt, end_dt, ds.bucket_s, "history_batch_buckets", columns=columns), codes)
         else:
-            print("[HISTORY-SMART] InfluxDB sin datos para este rango/dispositivo, usando PostgreSQL como fallback")
-    
-    # Usar PostgreSQL (para rangos antiguos o como fallback)
-    print(f"[HISTORY-SMART] Usando PostgreSQL para rango de {dias} días")
-    return metrics_history_postgres()
+            chunks = history_batch.with_codes(stream_devices_range(
+                conn, device_ids, start_dt, end_dt, "history_batch", columns=columns), codes)
+        columns += (history_export.DEVICE,)
+        first = next(chunks, [])  # ejecuta la consulta ya: un error sale como 500
+        response = _stream_points(chunks, first, columns, out, fmt, "batch", conn, keys=requested)
+        conn = None  # la conexión vuelve al pool cuando termina la respuesta
+        return response
+    except Exception as e:
+        log_pg.exception(f"Error en /metrics/history-batch: {e}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        if conn is not None:
+            pg_pool.putconn(conn)
 
 @app.route("/debug/influx-check", methods=["GET"])
 def debug_influx_check():
-    """Endpoint temporal para verificar datos en InfluxDB"""
-    if not influx:
+    """Endpoint temporal para verificar datos en InfluxDB (device: default E2641D44)"""
+    if not influx_queries.configured:
         return jsonify({"error": "InfluxDB no configurado"}), 500
     
-    results = {}
-    
-    # 1. Ver qué measurements hay
-    query1 = f'from(bucket:"{INFLUXDB_BUCKET}") |> range(start: -7d) |> group() |> distinct(column: "_measurement") |> limit(n: 10)'
-    tables1 = influx.query_api().query(query1, org=INFLUXDB_ORG)
-    measurements = []
-    for t in tables1:
-        for r in t.records:
-            if r.values.get("_measurement"):
-                measurements.append(r.values.get("_measurement"))
-    results["measurements"] = list(set(measurements))
-    
-    # 2. Ver qué devices hay
-    query2 = f'from(bucket:"{INFLUXDB_BUCKET}") |> range(start: -7d) |> filter(fn: (r) => r._measurement == "esp" or r._measurement == "telemetry") |> filter(fn: (r) => exists r.device) |> distinct(column: "device") |> limit(n: 10)'
-    tables2 = influx.query_api().query(query2, org=INFLUXDB_ORG)
-    devices = []
-    for t in tables2:
-        for r in t.records:
-            if r.values.get("device"):
-                devices.append(r.values.get("device"))
-    results["devices"] = list(set(devices))
+    device = request.args.get("device", "E2641D44")
+    now = datetime.now(timezone.utc)
+    week = influx_queries.params(start=now - timedelta(days=7))
+    day = influx_queries.params(start=now - timedelta(days=1), device=device)
     
-    # 3. Contar registros del último día para E2641D44
-    from datetime import timedelta
-    end = datetime.now(timezone.utc)
-    start = end - timedelta(days=1)
-    start_iso = start.strftime("%Y-%m-%dT%H:%M:%SZ")
-    end_iso = end.strftime("%Y-%m-%dT%H:%M:%SZ")
+    def values(query_name, query, params):
+        return [v for chunk in influx_queries.rows(query_name, query, params, ("_value",))
+                for (v,) in chunk if v is not None]
     
-    query3 = f'''
-    from(bucket:"{INFLUXDB_BUCKET}")
-      |> range(start: {start_iso}, stop: {end_iso})
-      |> filter(fn: (r) => r._measurement == "esp" or r._measurement == "telemetry")
-      |> filter(fn: (r) => exists r.device)
-      |> filter(fn: (r) => r.device == "E2641D44")
-      |> count()
-    '''
-    tables3 = influx.query_api().query(query3, org=INFLUXDB_ORG)
-    count = 0
-    for t in tables3:
-        for r in t.records:
-            count += r.values.get("_value", 0)
-    results["count_e2641d44_last_day"] = count
-    
-    # 4. Ver algunos registros de ejemplo
-    query4 = f'''
-    from(bucket:"{INFLUXDB_BUCKET}")
-      |> range(start: {start_iso}, stop: {end_iso})
-      |> filter(fn: (r) => r._measurement == "esp")
-      |> filter(fn: (r) => exists r.device)
-      |> filter(fn: (r) => r.device == "E2641D44")
-      |> keep(columns: ["_time","_field","_value","device"])
-      |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-      |> sort(columns: ["_time"], desc: true)
-      |> limit(n: 3)
-    '''
-    tables4 = influx.query_api().query(query4, org=INFLUXDB_ORG)
-    sample_records = []
-    for t in tables4:
-        for r in t.records[:3]:
-            sample_records.append({
-                "time": str(r.get_time()),
-                "values": r.values
-            })
-    results["sample_records"] = sample_records
-    
-    # 5. Verificar campos disponibles
-    query5 = f'''
-    from(bucket:"{INFLUXDB_BUCKET}")
-      |> range(start: {start_iso}, stop: {end_iso})
-      |> filter(fn: (r) => r._measurement == "esp")
-      |> filter(fn: (r) => exists r.device)
-      |> filter(fn: (r) => r.device == "E2641D44")
-      |> distinct(column: "_field")
-      |> limit(n: 20)
-    '''
-    tables5 = influx.query_api().query(query5, org=INFLUXDB_ORG)
-    fields = []
-    for t in tables5:
-        for r in t.records:
-            if r.values.get("_field"):
-                fields.append(r.values.get("_field"))
-    results["fields"] = list(set(fields))
+    results = {"device": device}
+    # 1. Measurements y 2. devices de la última semana
+    results["measurements"] = sorted(set(values("debug_measurements", flux.MEASUREMENTS_FLUX, week)))
+    results["devices"] = sorted(set(values("debug_devices", flux.DEVICES_FLUX, week)))
+    # 3. Registros del último día para el dispositivo
+    results["count_last_day"] = int(sum(values("debug_count", flux.DEVICE_COUNT_FLUX, day)))
+    # 4. Algunos registros de ejemplo
+    results["sample_records"] = [
+        {"time": str(r.get_time()), "values": r.values}
+        for r in influx_queries.records("debug_sample", flux.DEVICE_SAMPLE_FLUX, day)
+    ]
+    # 5. Campos disponibles
+    results["fields"] = sorted(set(values("debug_fields", flux.DEVICE_FIELDS_FLUX, day)))
     
     return jsonify(results)
 
+def _stored_outages(device: str, start_dt: datetime, end_dt: datetime, full: bool):
+    """Eventos de power_outages, o None si no cubren el rango (full), no existe el dispositivo o falla la lectura."""
+    try:
+        with pg_pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                device_info = _resolve_device(cursor, device)
+                if not device_info:
+                    return None
+                device_code = device_info[1] or str(device_info[0])
+                return outage_tracker.read(cursor, device_info[0], start_dt, end_dt, device_code, full)
+            finally:
+                cursor.close()
+    except Exception as e:
+        log_outages.warning(f"No se pudo leer power_outages ({e}), se detecta sobre las lecturas")
+        return None
+
 @app.route("/metrics/power-outages", methods=["GET"])
+@response_cache.cached()
 def metrics_power_outages():
     """
     Endpoint para detectar cortes de luz y períodos sin datos.
@@ -1362,6 +1255,13 @@ def metrics_power_outages():
     - device: (requerido) código o ID del dispositivo
     - min_voltage: (opcional) voltaje mínimo para considerar corte (default: 50V)
     - max_gap_minutes: (opcional) máximo gap en minutos para considerar período sin datos (default: 10)
+    - mode: (opcional) dónde se detecta
+        auto   (default) los eventos ya detectados en la ingesta (table) si cubren el rango y los
+               umbrales son los de OUTAGE_MIN_VOLTAGE / OUTAGE_MAX_GAP_MINUTES; si no, InfluxDB si el
+               rango es de 1-30 días y, sin datos, en PostgreSQL (sql)
+        table  lectura de power_outages (outage_tracker.py), con el corte en curso al momento
+        sql    en PostgreSQL (outages.detect_outages_sql): solo viajan los intervalos
+        stream las lecturas de PostgreSQL se traen y se detecta en Python (ColumnarOutageDetector)
     
     Retorna:
     - Array de objetos con información de cortes y períodos sin datos
@@ -1371,6 +1271,10 @@ def metrics_power_outages():
     device = request.args.get("device")
     min_voltage = float(request.args.get("min_voltage", 50))
     max_gap_minutes = int(request.args.get("max_gap_minutes", 10))
+    mode = request.args.get("mode", "auto")
+    
+    if mode not in OUTAGE_MODES:
+        return jsonify({"error": f"mode debe ser uno de {', '.join(OUTAGE_MODES)}"}), 400
     
     if not start or not end:
         return jsonify({"error": "start and end parameters are required"}), 400
@@ -1380,243 +1284,212 @@ def metrics_power_outages():
         return jsonify({"error": "device parameter is required"}), 400
     
     try:
-        # Parsear fechas
-        if start.isdigit():
-            start_dt = datetime.fromtimestamp(int(start) / 1000, tz=timezone.utc)
-        else:
-            start_dt = datetime.fromisoformat(start.replace('Z', '+00:00'))
-        
-        if end.isdigit():
-            end_dt = datetime.fromtimestamp(int(end) / 1000, tz=timezone.utc)
-        else:
-            end_dt = datetime.fromisoformat(end.replace('Z', '+00:00'))
+        start_dt, end_dt = _parse_range_args()
         
         delta = end_dt - start_dt
         dias = delta.days
         
-        # Obtener datos históricos directamente
-        data = []
+        # Eventos ya detectados en la ingesta: lectura por índice (device_id, start_at)
+        if mode in ("auto", "table"):
+            if not outage_tracker or not outage_tracker.matches(min_voltage, max_gap_minutes):
+                if mode == "table":
+                    return jsonify({"error": "mode=table requiere OUTAGE_TRACKER_ENABLED y los umbrales "
+                                             "OUTAGE_MIN_VOLTAGE / OUTAGE_MAX_GAP_MINUTES"}), 400
+            else:
+                outages = _stored_outages(device, start_dt, end_dt, full=(mode == "auto"))
+                if outages is not None:
+                    log_outages.info(f"{len(outages)} eventos desde power_outages")
+                    return jsonify(outages)
+        
+        # Detección sobre arrays (ts, vrms) con NumPy: ver outages.detect_outages
+        detector = ColumnarOutageDetector(min_voltage, max_gap_minutes)
         
-        # Si el rango es 1-30 días, intentar InfluxDB primero
-        if dias >= 1 and dias <= 30 and influx:
+        # mode=auto con rango de 1-30 días: intentar InfluxDB primero (puntos ya ordenados en el servidor)
+        if mode == "auto" and dias >= 1 and dias <= 30 and influx_queries.configured:
             try:
-                # Construir query de InfluxDB
-                start_iso = start_dt.isoformat()
-                end_iso = end_dt.isoformat()
-                
-                # SIEMPRE filtrar por dispositivo
-                # Telegraf guarda: measurement="esp", tag=device, fields=vrms,irms,etc
-                q = f'''
-                from(bucket:"{INFLUXDB_BUCKET}")
-                  |> range(start: {start_iso}, stop: {end_iso})
-                  |> filter(fn: (r) => r._measurement == "esp" or r._measurement == "telemetry")
-                  |> filter(fn: (r) => exists r.device)
-                  |> filter(fn: (r) => r.device == "{device}")
-                  |> keep(columns: ["_time","_field","_value","device"])
-                  |> pivot(rowKey:["_time"], columnKey:["_field"], valueColumn:"_value")
-                  |> sort(columns: ["_time"])
-                '''
-                
-                tables = influx.query_api().query(q, org=INFLUXDB_ORG)
-                for t in tables:
-                    for r in t.records:
-                        data.append({
-                            "ts": int(r.get_time().timestamp()*1000),
-                            "vrms": r.values.get("vrms"),
-                            "irms": r.values.get("irms"),
-                            "s_apparent_va": r.values.get("s_apparent_va"),
-                            "potencia_activa": r.values.get("potencia_activa"),
-                            "factor_potencia": r.values.get("factor_potencia"),
-                            "device": r.values.get("device"),
-                        })
+                params = influx_queries.params(start=start_dt, stop=end_dt, device=device)
+                columns = {"ts": ("ts",), "vrms": flux.TELEMETRY_FIELDS["vrms"]}
+                for chunk in influx_queries.rows("power_outages", flux.device_range_flux(("vrms",)),
+                                                 params, columns):
+                    detector.feed_chunk(chunk, device)
             except Exception as e:
-                print(f"[POWER-OUTAGES] Error con InfluxDB: {e}, usando PostgreSQL")
-                pass
+                log_outages.error(f"Error con InfluxDB: {e}, usando PostgreSQL")
         
         # Si no hay datos de InfluxDB o el rango es >30 días, usar PostgreSQL
-        if len(data) == 0:
+        if detector.points == 0:
+            try:
+                conn = pg_pool.getconn()
+            except PoolError as e:
+                log_outages.info(f"{e}")
+                return jsonify({"error": "No se pudo conectar a PostgreSQL"}), 500
             try:
-                conn = get_postgres_connection()
-                if not conn:
-                    return jsonify({"error": "No se pudo conectar a PostgreSQL"}), 500
-                
                 cursor = conn.cursor()
                 
-                # Verificar dispositivo si se proporciona
-                if device:
-                    cursor.execute("SELECT id, code, name FROM devices WHERE code = %s OR id::text = %s", [device, device])
-                    device_info = cursor.fetchone()
-                    print(f"[POWER-OUTAGES] Dispositivo buscado: '{device}'")
-                    if device_info:
-                        print(f"[POWER-OUTAGES] Dispositivo encontrado: id={device_info[0]}, code={device_info[1]}, name={device_info[2]}")
-                    else:
-                        print(f"[POWER-OUTAGES] ADVERTENCIA: No se encontró dispositivo con code/id='{device}'")
-                
                 # Verificar dispositivo primero
-                cursor.execute("SELECT id, code, name FROM devices WHERE code = %s OR id::text = %s", [device, device])
-                device_info = cursor.fetchone()
+                device_info = _resolve_device(cursor, device)
+                log_outages.debug(f"Dispositivo buscado: '{device}'")
                 if not device_info:
+                    log_outages.warning(f"ADVERTENCIA: No se encontró dispositivo con code/id='{device}'")
                     cursor.close()
-                    conn.close()
                     return jsonify({"error": f"Dispositivo '{device}' no encontrado"}), 404
                 
-                # SIEMPRE filtrar por dispositivo
-                query = """
-                    SELECT 
-                        th.created_at as "time",
-                        COALESCE(d.code, d.id::text, 'UNKNOWN') as device,
-                        th.voltaje as vrms,
-                        th.corriente as irms
-                    FROM telemetry_history th
-                    LEFT JOIN devices d ON th.device_id = d.id
-                    WHERE th.created_at >= %s AND th.created_at <= %s
-                    AND (d.code = %s OR d.id::text = %s OR th.device_id::text = %s)
-                """
-                params = [start_dt, end_dt, device, device, device]
-                
-                query += " ORDER BY th.created_at ASC"
-                
-                print(f"[POWER-OUTAGES] Ejecutando query: {query}")
-                print(f"[POWER-OUTAGES] Parámetros: {params}")
-                print(f"[POWER-OUTAGES] Rango de fechas: {start_dt} a {end_dt}")
-                
-                cursor.execute(query, params)
-                rows_fetched = 0
-                for row in cursor.fetchall():
-                    rows_fetched += 1
-                    ts = int(row[0].timestamp() * 1000) if row[0] else None
-                    data.append({
-                        "ts": ts,
-                        "device": row[1] if row[1] else "UNKNOWN",
-                        "vrms": float(row[2]) if row[2] is not None else None,
-                        "irms": float(row[3]) if row[3] is not None else None,
-                    })
+                device_id, device_code = device_info[0], device_info[1] or str(device_info[0])
+                log_outages.debug(f"Rango de fechas: {start_dt} a {end_dt}, device_id={device_id}")
+                if mode != "stream":
+                    # Gaps-and-islands en la base: solo se transfieren los eventos
+                    outages = detect_outages_sql(cursor, device_id, start_dt, end_dt, device_code,
+                                                 min_voltage, max_gap_minutes)
+                    cursor.close()
+                    log_outages.info(f"Detectados {len(outages)} eventos en PostgreSQL (cortes + gaps)")
+                    return jsonify(outages)
                 
-                print(f"[POWER-OUTAGES] Registros obtenidos de PostgreSQL: {rows_fetched}")
+                # Misma consulta por índice (device_id, created_at) que /metrics/history-postgres,
+                # solo ts y vrms, consumida de a bloques hacia los arrays del detector
                 cursor.close()
-                conn.close()
+                for chunk in stream_device_range(conn, device_id, start_dt, end_dt, "power_outages",
+                                                 columns=("ts", "vrms")):
+                    detector.feed_chunk(chunk, device_code)
+                
+                log_outages.info(f"Registros obtenidos de PostgreSQL: {detector.points}")
             except Exception as e:
-                print(f"[POWER-OUTAGES] Error con PostgreSQL: {e}")
-                import traceback
-                traceback.print_exc()
+                log_outages.exception(f"Error con PostgreSQL: {e}")
                 return jsonify({"error": f"Error obteniendo datos: {e}"}), 500
+            finally:
+                pg_pool.putconn(conn)
         
-        if not isinstance(data, list) or len(data) == 0:
-            return jsonify([])
-        
-        # Procesar datos para detectar cortes y gaps
-        outages = []
-        
-        # Ordenar datos por timestamp
-        sorted_data = sorted(data, key=lambda x: x.get("ts", 0))
-        
-        # Intervalo esperado entre mediciones (en milisegundos)
-        # Asumimos 1 minuto entre mediciones
-        expected_interval_ms = 60000
-        
-        i = 0
-        while i < len(sorted_data):
-            current = sorted_data[i]
-            current_ts = current.get("ts", 0)
-            current_vrms = current.get("vrms")
-            
-            # Detectar corte de luz (voltaje bajo)
-            if current_vrms is not None and current_vrms < min_voltage:
-                outage_start = current_ts
-                outage_start_date = datetime.fromtimestamp(current_ts / 1000, tz=timezone.utc)
-                min_voltage_during_outage = current_vrms
-                max_voltage_during_outage = current_vrms
-                count = 1
-                
-                # Buscar el final del corte
-                j = i + 1
-                while j < len(sorted_data):
-                    next_point = sorted_data[j]
-                    next_ts = next_point.get("ts", 0)
-                    next_vrms = next_point.get("vrms")
-                    
-                    # Si el siguiente punto también tiene voltaje bajo, continuar el corte
-                    if next_vrms is not None and next_vrms < min_voltage:
-                        min_voltage_during_outage = min(min_voltage_during_outage, next_vrms)
-                        max_voltage_during_outage = max(max_voltage_during_outage, next_vrms)
-                        count += 1
-                        j += 1
-                    else:
-                        # Si hay un gap grande o el voltaje vuelve a ser normal, terminar el corte
-                        gap = next_ts - current_ts
-                        if gap > expected_interval_ms * max_gap_minutes or (next_vrms is not None and next_vrms >= min_voltage):
-                            break
-                        j += 1
-                
-                outage_end_ts = sorted_data[j - 1].get("ts", current_ts) if j > i else current_ts
-                outage_end_date = datetime.fromtimestamp(outage_end_ts / 1000, tz=timezone.utc)
-                duration_seconds = (outage_end_ts - outage_start) / 1000
-                
-                outages.append({
-                    "type": "power_outage",
-                    "start": outage_start_date.isoformat(),
-                    "end": outage_end_date.isoformat(),
-                    "start_ts": outage_start,
-                    "end_ts": outage_end_ts,
-                    "duration_seconds": duration_seconds,
-                    "duration_formatted": format_duration(duration_seconds),
-                    "min_voltage": round(min_voltage_during_outage, 2),
-                    "max_voltage": round(max_voltage_during_outage, 2),
-                    "data_points": count,
-                    "device": current.get("device", "UNKNOWN")
-                })
-                
-                i = j
-                continue
-            
-            # Detectar períodos sin datos (gaps)
-            if i < len(sorted_data) - 1:
-                next_point = sorted_data[i + 1]
-                next_ts = next_point.get("ts", 0)
-                gap_ms = next_ts - current_ts
-                
-                # Si el gap es mayor al esperado, es un período sin datos
-                if gap_ms > expected_interval_ms * max_gap_minutes:
-                    gap_start_date = datetime.fromtimestamp(current_ts / 1000, tz=timezone.utc)
-                    gap_end_date = datetime.fromtimestamp(next_ts / 1000, tz=timezone.utc)
-                    gap_seconds = gap_ms / 1000
-                    
-                    outages.append({
-                        "type": "no_data",
-                        "start": gap_start_date.isoformat(),
-                        "end": gap_end_date.isoformat(),
-                        "start_ts": current_ts,
-                        "end_ts": next_ts,
-                        "duration_seconds": gap_seconds,
-                        "duration_formatted": format_duration(gap_seconds),
-                        "gap_minutes": round(gap_seconds / 60, 1),
-                        "device": current.get("device", "UNKNOWN")
-                    })
-            
-            i += 1
-        
-        print(f"[POWER-OUTAGES] Detectados {len(outages)} eventos (cortes + gaps)")
+        outages = detector.finish()
+        log_outages.info(f"Detectados {len(outages)} eventos (cortes + gaps)")
         return jsonify(outages)
         
     except Exception as e:
-        print(f"[POWER-OUTAGES] Error: {e}")
-        import traceback
-        traceback.print_exc()
+        log_outages.exception(f"Error: {e}")
         return jsonify({"error": str(e)}), 500
 
-def format_duration(seconds):
-    """Formatea una duración en segundos a formato legible"""
-    if seconds < 60:
-        return f"{int(seconds)}s"
-    elif seconds < 3600:
-        minutes = int(seconds / 60)
-        secs = int(seconds % 60)
-        return f"{minutes}m {secs}s"
-    else:
-        hours = int(seconds / 3600)
-        minutes = int((seconds % 3600) / 60)
-        secs = int(seconds % 60)
-        return f"{hours}h {minutes}m {secs}s"
+@app.route("/metrics/energy", methods=["GET"])
+def metrics_energy():
+    """
+    Consumo de energía (kWh) por hora, día o mes, desde los rollups por hora
+    (energía integrada en la ingesta, ver energy.py y rollups.py).
+
+    Parámetros:
+    - device: (requerido) código o ID del dispositivo
+    - start / end: (requeridos) ISO 8601 o timestamp unix en ms; sin zona = hora de Paraguay
+    - bucket: hour | day | month (default: day, días locales de Paraguay)
+    """
+    device = request.args.get("device")
+    start = request.args.get("start")
+    end = request.args.get("end")
+    unit = request.args.get("bucket", "day")
+    if not device:
+        return jsonify({"error": "device parameter is required"}), 400
+    if not start or not end:
+        return jsonify({"error": "start and end parameters are required"}), 400
+    if unit not in energy.ENERGY_UNITS:
+        return jsonify({"error": f"bucket debe ser uno de {', '.join(energy.ENERGY_UNITS)}"}), 400
+    if not ROLLUPS_ENABLED:
+        return jsonify({"error": "Rollups deshabilitados (ROLLUPS_ENABLED=0)"}), 503
+    try:
+        start_dt, end_dt = _parse_range_args(PYT_TIMEZONE)
+    except Exception as e:
+        return jsonify({"error": f"Invalid date format: {e}"}), 400
+
+    try:
+        with pg_pool.connection() as conn:
+            cursor = conn.cursor()
+            device_info = _resolve_device(cursor, device)
+            if not device_info:
+                cursor.close()
+                return jsonify({"error": f"Dispositivo '{device}' no encontrado"}), 404
+            device_id, device_code = device_info[0], device_info[1] or str(device_info[0])
+            offset_s = int(PYT_TIMEZONE.utcoffset(None).total_seconds())
+            rows = energy.energy_buckets(cursor, device_id, start_dt, end_dt, unit, offset_s)
+            meter = energy.meter_kwh(cursor, device_id)
+            cursor.close()
+    except PoolError as e:
+        log_pg.info(f"{e}")
+        return jsonify({"error": "PostgreSQL not configured or connection failed"}), 500
+    except Exception as e:
+        log_pg.exception(f"Error en /metrics/energy: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    points = []
+    for local_start, energy_kwh, samples in rows:
+        local_start = local_start.replace(tzinfo=PYT_TIMEZONE)
+        points.append({
+            "start": local_start.isoformat(),
+            "ts": int(local_start.timestamp() * 1000),
+            "energy_kwh": round(float(energy_kwh or 0), 6),
+            "samples": samples,
+        })
+    return jsonify({
+        "device": device_code,
+        "bucket": unit,
+        "unit": "kWh",
+        "total_kwh": round(sum(p["energy_kwh"] for p in points), 6),
+        "meter_kwh": meter,
+        "points": points,
+    })
+
+@app.route("/metrics/quality", methods=["GET"])
+@response_cache.cached(PYT_TIMEZONE)
+def metrics_quality():
+    """
+    Estadísticas de calidad de energía desde power_quality_1h (sketches por hora, ver quality.py):
+    cuantiles de voltaje y factor de potencia, y tiempo en cada banda de tensión
+    (interruption / sag / normal / swell respecto de QUALITY_NOMINAL_V).
+
+    Parámetros:
+    - device: (requerido) código o ID del dispositivo
+    - start / end: (requeridos) ISO 8601 o timestamp unix en ms; sin zona = hora de Paraguay.
+      La resolución es la hora: start se trunca a la hora
+    - bucket: total | hour | day | month (default: total; ventanas locales de Paraguay)
+    - q: (opcional) cuantiles separados por coma (default: 0.01,0.05,0.5,0.95,0.99)
+    """
+    device = request.args.get("device")
+    start = request.args.get("start")
+    end = request.args.get("end")
+    unit = request.args.get("bucket", "total")
+    if not device:
+        return jsonify({"error": "device parameter is required"}), 400
+    if not start or not end:
+        return jsonify({"error": "start and end parameters are required"}), 400
+    if unit not in quality.QUALITY_UNITS:
+        return jsonify({"error": f"bucket debe ser uno de {', '.join(quality.QUALITY_UNITS)}"}), 400
+    if not quality_writer:
+        return jsonify({"error": "Estadísticas de calidad deshabilitadas (QUALITY_ENABLED=0)"}), 503
+    try:
+        qs = quality.parse_quantiles(request.args.get("q"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        start_dt, end_dt = _parse_range_args(PYT_TIMEZONE)
+    except Exception as e:
+        return jsonify({"error": f"Invalid date format: {e}"}), 400
+
+    try:
+        with pg_pool.connection() as conn:
+            cursor = conn.cursor()
+            device_info = _resolve_device(cursor, device)
+            if not device_info:
+                cursor.close()
+                return jsonify({"error": f"Dispositivo '{device}' no encontrado"}), 404
+            device_id, device_code = device_info[0], device_info[1] or str(device_info[0])
+            items = quality.read(cursor, device_id, start_dt, end_dt, unit, PYT_TIMEZONE, qs)
+            cursor.close()
+    except PoolError as e:
+        log_pg.info(f"{e}")
+        return jsonify({"error": "PostgreSQL not configured or connection failed"}), 500
+    except Exception as e:
+        log_pg.exception(f"Error en /metrics/quality: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    return jsonify({
+        "device": device_code,
+        "bucket": unit,
+        "relative_accuracy": quality.SKETCH_RELATIVE_ACCURACY,
+        "bands": quality_writer.bands.describe(),
+        "points": items,
+    })
 
 if __name__ == "__main__":
     # Desarrollo: Flask server
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Pool de conexiones PostgreSQL compartido por todo el proceso.
+
+- Tamaño mínimo/máximo configurable.
+- Checkout con timeout: si no hay conexiones libres y el pool está al máximo,
+  el pedido espera hasta checkout_timeout y luego falla con PoolError.
+- Verificación de vida al hacer checkout (conn.closed siempre, SELECT 1 si la
+  conexión estuvo ociosa más de ping_idle_s).
+- Las conexiones rotas se descartan y se reemplazan en el siguiente pedido.
+- Estadísticas: en uso, ociosas, esperando, latencia de checkout.
+"""
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolError(Exception):
+    """No se pudo obtener una conexión del pool (timeout o base caída)."""
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable[[], Any], minconn: int = 1, maxconn: int = 10,
+                 checkout_timeout: float = 5.0, ping_idle_s: float = 5.0):
+        self._connect = connect
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.checkout_timeout = checkout_timeout
+        self.ping_idle_s = ping_idle_s
+
+        self._cond = threading.Condition()
+        self._idle: List[tuple] = []      # (conn, momento en que volvió al pool)
+        self._in_use = set()
+        self._size = 0                    # conexiones abiertas (ociosas + en uso)
+        self._waiting = 0
+        self._stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "connect_errors": 0,
+            "checkout_ms_total": 0.0,
+            "checkout_ms_max": 0.0,
+        }
+
+    # ---------- API pública ----------
+    def prefill(self):
+        """Abre minconn conexiones por adelantado (ignora errores de conexión)."""
+        for _ in range(self.minconn):
+            conn = self._open()
+            if conn is None:
+                break
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self, timeout: Optional[float] = None):
+        timeout = self.checkout_timeout if timeout is None else timeout
+        t0 = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        while True:
+            conn, idle_since, must_open = self._acquire_slot(deadline)
+            if must_open:
+                conn = self._open(reserved=True)
+                if conn is None:
+                    raise PoolError("No se pudo conectar a PostgreSQL")
+            elif not self._alive(conn, idle_since):
+                self._discard(conn)
+                continue
+            with self._cond:
+                self._in_use.add(conn)
+                elapsed_ms = (time.perf_counter() - t0) * 1000
+                self._stats["checkouts"] += 1
+                self._stats["checkout_ms_total"] += elapsed_ms
+                if elapsed_ms > self._stats["checkout_ms_max"]:
+                    self._stats["checkout_ms_max"] = elapsed_ms
+            return conn
+
+    def putconn(self, conn, broken: bool = False):
+        with self._cond:
+            self._in_use.discard(conn)
+        if not broken and not conn.closed:
+            try:
+                # Dejar la conexión limpia para el próximo usuario
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """with pool.connection() as conn: ... (devuelve la conexión al salir)."""
+        conn = self.getconn(timeout)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken or conn.closed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            out = dict(self._stats)
+            out["size"] = self._size
+            out["in_use"] = len(self._in_use)
+            out["idle"] = len(self._idle)
+            out["waiting"] = self._waiting
+        checkouts = out["checkouts"] or 1
+        out["checkout_ms_avg"] = round(out.pop("checkout_ms_total") / checkouts, 3)
+        out["checkout_ms_max"] = round(out["checkout_ms_max"], 3)
+        out["minconn"] = self.minconn
+        out["maxconn"] = self.maxconn
+        return out
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    # ---------- Internos ----------
+    def _acquire_slot(self, deadline: float):
+        """Devuelve (conn, idle_since, must_open). Reserva un lugar si hay que abrir."""
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    return conn, idle_since, False
+                if self._size < self.maxconn:
+                    self._size += 1
+                    return None, None, True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolError(f"Timeout esperando conexión del pool (max={self.maxconn})")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+    def _open(self, reserved: bool = False):
+        if not reserved:
+            with self._cond:
+                if self._size >= self.maxconn:
+                    return None
+                self._size += 1
+        conn = self._connect()
+        with self._cond:
+            if conn is None:
+                self._size -= 1
+                self._stats["connect_errors"] += 1
+                self._cond.notify()
+            else:
+                self._stats["created"] += 1
+        return conn
+
+    def _alive(self, conn, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.ping_idle_s:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["recycled"] += 1
+            self._cond.notify()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Registro de dispositivos en memoria (code/id -> device_id, company_id, user_id).
+
+- Carga la tabla devices una sola vez (con el company_id y el usuario dueño ya
+  resueltos, igual que la consulta que antes se hacía por mensaje).
+- Se mantiene al día con LISTEN/NOTIFY: los triggers de devices, users y roles
+  publican en el canal 'device_registry' (ver scripts/init-db.js).
+- Las lecturas son un dict.get() sobre un snapshot inmutable: el hilo que
+  escucha arma un dict nuevo y lo reemplaza, los lectores nunca bloquean.
+- Otros módulos pueden suscribirse a cambios de otras tablas que publiquen en
+  el mismo canal (subscribe), reutilizando la conexión de LISTEN.
+"""
+import json
+import time
+import select
+import threading
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from hotlog import get_logger
+from instrumentation import pg_query_seconds, timed
+
+log = get_logger("registry")
+
+NOTIFY_CHANNEL = "device_registry"
+
+DEVICES_SQL = """
+    SELECT d.id, d.code, d.name, d.company_id,
+           COALESCE(
+               (SELECT u.id FROM users u
+                INNER JOIN roles r ON u.role_id = r.id
+                WHERE u.company_id = d.company_id
+                AND (r.name = 'admin' OR r.name = 'super_admin')
+                LIMIT 1),
+               (SELECT u.id FROM users u
+                WHERE u.company_id = d.company_id
+                LIMIT 1),
+               NULL
+           ) as user_id
+    FROM devices d
+"""
+
+
+class DeviceInfo(NamedTuple):
+    id: int
+    code: Optional[str]
+    name: Optional[str]
+    company_id: Optional[int]
+    user_id: Optional[int]
+
+
+def _index(devices: Iterable[DeviceInfo]) -> Dict[str, DeviceInfo]:
+    """Indexa por id (texto) y por código, igual que 'd.code = %s OR d.id::text = %s'."""
+    out: Dict[str, DeviceInfo] = {}
+    for dev in devices:
+        out[str(dev.id)] = dev
+    for dev in devices:
+        # Un code que coincide con el id de otro dispositivo no lo pisa
+        if dev.code is not None and dev.code not in out:
+            out[dev.code] = dev
+    return out
+
+
+class DeviceRegistry:
+    """
+    Parámetros:
+    - connect: función que devuelve una conexión psycopg2 nueva (no del pool:
+      la conexión queda dedicada a LISTEN mientras viva el proceso)
+    """
+
+    def __init__(self, connect: Callable[[], Any], reconnect_s: float = 5.0):
+        self._connect = connect
+        self.reconnect_s = reconnect_s
+        self._devices: Dict[int, DeviceInfo] = {}
+        self._by_key: Dict[str, DeviceInfo] = {}
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._subscribers: Dict[str, List[Callable[[Any], None]]] = {}
+        self.stats = {"full_reloads": 0, "incremental_updates": 0, "notifications": 0, "reconnects": 0}
+
+    @property
+    def ready(self) -> bool:
+        """True si el snapshot está cargado y el listener está conectado."""
+        return self._ready.is_set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="device-registry", daemon=True)
+            self._thread.start()
+
+    def subscribe(self, table: str, reload: Callable[[Any], None]):
+        """
+        reload(conn) se llama desde el hilo listener al conectar y cada vez que
+        llega un NOTIFY de esa tabla. Registrar antes de start().
+        """
+        self._subscribers.setdefault(table, []).append(reload)
+
+    def resolve(self, code_or_id) -> Optional[DeviceInfo]:
+        if code_or_id is None:
+            return None
+        return self._by_key.get(str(code_or_id))
+
+    def get_by_id(self, device_id: int) -> Optional[DeviceInfo]:
+        return self._devices.get(device_id)
+
+    def devices_for_company(self, company_id: int):
+        return [d for d in self._devices.values() if d.company_id == company_id]
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = dict(self.stats)
+        out["devices"] = len(self._devices)
+        out["ready"] = self.ready
+        return out
+
+    # ---------- Carga ----------
+    def _publish(self, devices: Dict[int, DeviceInfo]):
+        # Asignaciones atómicas: los lectores ven el snapshot viejo o el nuevo
+        self._by_key = _index(devices.values())
+        self._devices = devices
+
+    def _load_all(self, conn):
+        cur = conn.cursor()
+        with timed(pg_query_seconds, "registry_load_all"):
+            cur.execute(DEVICES_SQL)
+        devices = {row[0]: DeviceInfo(*row) for row in cur.fetchall()}
+        cur.close()
+        self._publish(devices)
+        self.stats["full_reloads"] += 1
+
+    def _reload_devices(self, conn, ids):
+        cur = conn.cursor()
+        with timed(pg_query_seconds, "registry_reload_devices"):
+            cur.execute(DEVICES_SQL + " WHERE d.id = ANY(%s)", (list(ids),))
+        fresh = {row[0]: DeviceInfo(*row) for row in cur.fetchall()}
+        cur.close()
+        devices = dict(self._devices)
+        for device_id in ids:
+            devices.pop(device_id, None)
+        devices.update(fresh)
+        self._publish(devices)
+        self.stats["incremental_updates"] += 1
+
+    def _apply(self, conn, payloads):
+        device_ids = set()
+        tables = set()
+        full = False
+        for raw in payloads:
+            try:
+                msg = json.loads(raw)
+            except (TypeError, ValueError):
+                full = True
+                continue
+            table = msg.get("table")
+            if table in self._subscribers:
+                tables.add(table)
+            elif table == "devices" and msg.get("id") is not None:
+                device_ids.add(int(msg["id"]))
+            else:
+                # users/roles cambian el dueño de todos los dispositivos de una company
+                full = True
+        if full:
+            self._load_all(conn)
+        elif device_ids:
+            self._reload_devices(conn, device_ids)
+        for table in tables:
+            self._notify_subscribers(conn, table)
+
+    def _notify_subscribers(self, conn, table: str):
+        for reload in self._subscribers.get(table, []):
+            try:
+                reload(conn)
+            except Exception as e:
+                log.exception(f"Error recargando suscriptor de '{table}': {e}")
+
+    # ---------- Listener ----------
+    def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                if conn is None:
+                    raise RuntimeError("sin conexión a PostgreSQL")
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                cur.close()
+                # Cargar después de LISTEN para no perder cambios intermedios
+                self._load_all(conn)
+                for table in self._subscribers:
+                    self._notify_subscribers(conn, table)
+                self._ready.set()
+                log.info(f"{len(self._devices)} dispositivos cargados, escuchando '{NOTIFY_CHANNEL}'")
+                while True:
+                    if select.select([conn], [], [], 30.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    payloads = []
+                    while conn.notifies:
+                        payloads.append(conn.notifies.pop(0).payload)
+                    if payloads:
+                        self.stats["notifications"] += len(payloads)
+                        self._apply(conn, payloads)
+            except Exception as e:
+                self._ready.clear()
+                self.stats["reconnects"] += 1
+                log.warning(f"Listener desconectado ({e}), reintentando en {self.reconnect_s}s")
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                time.sleep(self.reconnect_s)
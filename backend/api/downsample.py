@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Reducción de puntos para los endpoints de historial.
+
+Parámetros de la request:
+- bucket=<dur>      agrega en SQL por ventanas fijas (30s, 5m, 1h, 1d o segundos):
+                    promedio, mínimo y máximo por ventana (se conservan picos y caídas).
+- max_points=<N>    devuelve a lo sumo N puntos. Sin 'bucket', el ancho de ventana
+                    se calcula como rango / N; con 'bucket', se agranda si hace falta.
+- downsample=lttb   en lugar de agregar, elige N puntos reales con
+                    Largest-Triangle-Three-Buckets (NumPy) sobre 'lttb_field'
+                    (por defecto potencia_activa).
+"""
+import math
+import re
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+MAX_POINTS_LIMIT = 100000
+LTTB_FIELDS = ("vrms", "irms", "s_apparent_va", "potencia_activa", "factor_potencia")
+
+_DURATION_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$")
+_UNIT_S = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class Downsample(NamedTuple):
+    mode: str                      # "raw" | "bucket" | "lttb"
+    bucket_s: Optional[int] = None
+    max_points: Optional[int] = None
+    field: str = "potencia_activa"
+
+
+def parse_duration_s(value: str) -> int:
+    m = _DURATION_RE.match(value or "")
+    if not m:
+        raise ValueError(f"bucket inválido: '{value}' (usar p. ej. 30s, 5m, 1h, 1d)")
+    seconds = float(m.group(1)) * _UNIT_S[m.group(2)]
+    if seconds < 1:
+        raise ValueError("bucket debe ser de al menos 1s")
+    return int(math.ceil(seconds))
+
+
+def from_args(args, start_dt, end_dt) -> Downsample:
+    """Interpreta bucket/max_points/downsample/lttb_field. Lanza ValueError si son inválidos."""
+    bucket = args.get("bucket")
+    max_points = args.get("max_points")
+    mode = (args.get("downsample") or "").lower()
+    field = args.get("lttb_field") or "potencia_activa"
+
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            raise ValueError("max_points debe ser un entero")
+        if not 2 < max_points <= MAX_POINTS_LIMIT:
+            raise ValueError(f"max_points debe estar entre 3 y {MAX_POINTS_LIMIT}")
+    if mode not in ("", "bucket", "lttb"):
+        raise ValueError("downsample debe ser 'bucket' o 'lttb'")
+    if field not in LTTB_FIELDS:
+        raise ValueError(f"lttb_field debe ser uno de {', '.join(LTTB_FIELDS)}")
+
+    if mode == "lttb":
+        if max_points is None:
+            raise ValueError("downsample=lttb requiere max_points")
+        return Downsample("lttb", max_points=max_points, field=field)
+
+    bucket_s = parse_duration_s(bucket) if bucket else None
+    if max_points is not None:
+        span_s = max(1.0, (end_dt - start_dt).total_seconds())
+        bucket_s = max(bucket_s or 1, int(math.ceil(span_s / max_points)))
+    if bucket_s is None:
+        return Downsample("raw")
+    return Downsample("bucket", bucket_s=bucket_s, max_points=max_points)
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Índices de los n puntos elegidos por LTTB (siempre incluye el primero y el último).
+    Los y NaN nunca se eligen dentro de un bucket mientras haya otro candidato.
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    # n-2 buckets entre el primer y el último punto; el "siguiente" del último es el punto final
+    edges = np.append(np.linspace(1, size - 1, n - 1).astype(np.int64), size)
+    valid = ~np.isnan(y)
+    out = np.empty(n, dtype=np.int64)
+    out[0] = 0
+    out[-1] = size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = edges[i + 1], edges[i + 2]
+        ax, ay = x[a], (y[a] if valid[a] else 0.0)
+        nmask = valid[nlo:nhi]
+        if nmask.any():
+            cx = x[nlo:nhi][nmask].mean()
+            cy = y[nlo:nhi][nmask].mean()
+        else:
+            cx, cy = x[nlo:nhi].mean(), ay
+        area = np.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        area[~valid[lo:hi]] = -1.0
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def lttb_rows(chunks, field_index: int, n: int) -> list:
+    """
+    Aplica LTTB a bloques de filas numéricas (la columna 0 es el ts en ms).
+    Devuelve las filas elegidas como tuplas, con NaN -> None y ts entero.
+    """
+    arrays = [np.array(chunk, dtype=np.float64) for chunk in chunks if chunk]
+    if not arrays:
+        return []
+    data = np.concatenate(arrays)
+    picked = data[lttb_indices(data[:, 0], data[:, field_index], n)]
+    out = []
+    for row in picked.tolist():
+        out.append((int(row[0]),) + tuple(None if v != v else v for v in row[1:]))
+    return out
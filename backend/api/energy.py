@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Integración de energía en la ingesta.
+
+Cada dispositivo tiene un acumulador en device_energy_state (ver scripts/init-db.js):
+última lectura (last_at, last_potencia) y total_kwh. Entre dos lecturas consecutivas
+se suma el trapecio (p0 + p1) / 2 * dt; si dt supera ENERGY_MAX_GAP_S (equipo sin
+datos) o falta la potencia en un extremo, ese intervalo no suma. Una lectura con
+created_at anterior a la última procesada no mueve el acumulador.
+
+EnergyIntegrator.assign() corre dentro de la transacción del INSERT del lote:
+bloquea las filas de estado de los dispositivos del lote (FOR UPDATE, en orden de
+device_id), completa energia_acumulada (kWh, contador del dispositivo) en cada fila
+y guarda el nuevo estado. También devuelve la energía de cada fila (el intervalo
+que cierra): es la que suman los rollups (energy_wh), así /metrics/energy y el
+contador salen del mismo integrador. Si el lote hace rollback, el estado también;
+tras un reinicio el acumulador sigue desde la base.
+
+postgres_writer.py (Telegraf) aplica la misma regla sobre la misma tabla, así que
+energia_acumulada no depende del camino de escritura. Sus filas, en cambio, no pasan
+por los callbacks del TelemetryWriter: no llegan a los rollups y /metrics/energy no
+las cuenta hasta que se corre el backfill de rollups.py para esos días.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from psycopg2.extras import execute_values
+
+from ingest import COL_CREATED_AT, COL_DEVICE_ID, COL_ENERGIA, COL_POTENCIA
+from instrumentation import pg_query_seconds, timed
+
+ENERGY_MAX_GAP_S = float(os.getenv("ENERGY_MAX_GAP_S", "300"))
+
+LOCK_STATE_SQL = """
+    SELECT device_id, last_at, last_potencia, total_kwh
+    FROM device_energy_state
+    WHERE device_id = ANY(%s)
+    ORDER BY device_id
+    FOR UPDATE
+"""
+
+SAVE_STATE_SQL = """
+    INSERT INTO device_energy_state (device_id, last_at, last_potencia, total_kwh)
+    VALUES %s
+    ON CONFLICT (device_id) DO UPDATE SET
+        last_at = EXCLUDED.last_at,
+        last_potencia = EXCLUDED.last_potencia,
+        total_kwh = EXCLUDED.total_kwh,
+        updated_at = NOW()
+"""
+
+
+def naive_utc(ts: datetime) -> datetime:
+    """created_at como lo guarda la columna TIMESTAMP (UTC, sin zona)."""
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def trapezoid_kwh(prev_at: datetime, prev_p: Optional[float], at: datetime, p: Optional[float],
+                  max_gap_s: float = ENERGY_MAX_GAP_S) -> float:
+    """Energía (kWh) entre dos lecturas de potencia (W); 0 si hay gap o falta un valor."""
+    if prev_p is None or p is None:
+        return 0.0
+    dt = (at - prev_at).total_seconds()
+    if dt <= 0 or dt > max_gap_s:
+        return 0.0
+    return (float(prev_p) + float(p)) / 2.0 * dt / 3_600_000.0
+
+
+class EnergyIntegrator:
+    def __init__(self, max_gap_s: float = ENERGY_MAX_GAP_S):
+        self.max_gap_s = max_gap_s
+        self.stats = {"batches": 0, "rows": 0, "out_of_order": 0, "gaps": 0}
+
+    def assign(self, cursor, values: Sequence[tuple]) -> Tuple[List[tuple], List[float]]:
+        """
+        Devuelve las filas de telemetry_history con energia_acumulada completada
+        y la energía (kWh) del intervalo que cierra cada fila (mismo orden; 0 para la
+        primera lectura, una fuera de orden o un gap), y actualiza device_energy_state
+        en la transacción actual.
+        """
+        device_ids = sorted({v[COL_DEVICE_ID] for v in values if v[COL_DEVICE_ID] is not None})
+        if not device_ids:
+            return list(values), [0.0] * len(values)
+        with timed(pg_query_seconds, "energy_lock_state"):
+            cursor.execute(LOCK_STATE_SQL, (device_ids,))
+            state: Dict[int, list] = {
+                device_id: [last_at, last_p, total or 0.0]
+                for device_id, last_at, last_p, total in cursor.fetchall()
+            }
+
+        # Recorrer cada dispositivo en orden de tiempo; la salida conserva el orden del lote
+        order = sorted(
+            (i for i, v in enumerate(values) if v[COL_DEVICE_ID] is not None and v[COL_CREATED_AT] is not None),
+            key=lambda i: (values[i][COL_DEVICE_ID], naive_utc(values[i][COL_CREATED_AT])),
+        )
+        out = list(values)
+        deltas = [0.0] * len(values)
+        for i in order:
+            row = values[i]
+            at = naive_utc(row[COL_CREATED_AT])
+            p = None if row[COL_POTENCIA] is None else float(row[COL_POTENCIA])
+            st = state.get(row[COL_DEVICE_ID])
+            if st is None:
+                st = state[row[COL_DEVICE_ID]] = [at, p, 0.0]
+            elif st[0] is not None and at <= st[0]:
+                self.stats["out_of_order"] += 1
+            else:
+                if st[0] is not None and (at - st[0]).total_seconds() > self.max_gap_s:
+                    self.stats["gaps"] += 1
+                if st[0] is not None:
+                    deltas[i] = trapezoid_kwh(st[0], st[1], at, p, self.max_gap_s)
+                    st[2] += deltas[i]
+                st[0], st[1] = at, p
+            out[i] = row[:COL_ENERGIA] + (round(st[2], 6),) + row[COL_ENERGIA + 1:]
+
+        with timed(pg_query_seconds, "energy_save_state"):
+            execute_values(cursor, SAVE_STATE_SQL,
+                           [(device_id, st[0], st[1], st[2]) for device_id, st in sorted(state.items())])
+        self.stats["batches"] += 1
+        self.stats["rows"] += len(order)
+        return out, deltas
+
+
+# ---------------------------------------------------------------------------
+# Consulta de /metrics/energy (desde los rollups por hora, ver rollups.py)
+# ---------------------------------------------------------------------------
+
+# Ventanas locales: las horas UTC del rollup se corren offset_s antes de truncar
+ENERGY_BUCKETS_SQL = """
+    SELECT date_trunc(%(unit)s, bucket + make_interval(secs => %(offset_s)s)) AS local_start,
+           sum(energy_wh) / 1000.0 AS energy_kwh,
+           sum(samples)::bigint AS samples
+    FROM telemetry_rollup_device_1h
+    WHERE device_id = %(device_id)s
+      AND bucket >= %(start)s AND bucket < %(end)s
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+ENERGY_UNITS = {"hour": "hour", "day": "day", "month": "month"}
+
+
+def energy_buckets(cursor, device_id: int, start: datetime, end: datetime, unit: str,
+                   offset_s: int) -> List[Tuple[datetime, float, int]]:
+    """(inicio local, kWh, muestras) por hora, día o mes; start/end en UTC."""
+    params = {"device_id": device_id, "start": naive_utc(start), "end": naive_utc(end),
+              "unit": ENERGY_UNITS[unit], "offset_s": offset_s}
+    with timed(pg_query_seconds, "energy_buckets"):
+        cursor.execute(ENERGY_BUCKETS_SQL, params)
+        return cursor.fetchall()
+
+
+def meter_kwh(cursor, device_id: int) -> Optional[float]:
+    """Valor actual del acumulador del dispositivo (kWh), o None si nunca se integró."""
+    cursor.execute("SELECT total_kwh FROM device_energy_state WHERE device_id = %s", (device_id,))
+    row = cursor.fetchone()
+    return float(row[0]) if row else None
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Hub de difusión de eventos en tiempo real (SSE).
+
+- Cada evento se serializa una sola vez y se guarda en un ring buffer con un
+  número de secuencia creciente (el 'id:' de SSE).
+- Cada suscriptor lee desde su propio cursor: todos reciben todos los eventos,
+  en lugar de competir por una cola compartida.
+- La memoria queda acotada por el tamaño del ring, haya o no clientes.
+- Un cliente que se atrasa más que el ring se detecta (lagged) y se corta;
+  al reconectar con Last-Event-ID se le reenvía lo que todavía esté en el ring.
+"""
+import json
+import threading
+from typing import List, Optional, Tuple
+
+
+class Lagged(Exception):
+    """El suscriptor perdió eventos: su cursor ya salió del ring."""
+
+
+class EventHub:
+    def __init__(self, size: int = 4096):
+        self.size = max(16, size)
+        self._ring: List[Optional[Tuple[int, str]]] = [None] * self.size
+        self._seq = 0                      # último id publicado
+        self._cond = threading.Condition(threading.Lock())
+        self._subscribers = 0
+        self.stats = {"published": 0, "dropped_slow": 0, "replayed": 0}
+
+    @property
+    def last_id(self) -> int:
+        return self._seq
+
+    @property
+    def subscribers(self) -> int:
+        return self._subscribers
+
+    def publish(self, topic: str, payload) -> str:
+        """Serializa y publica un evento; devuelve el JSON para reutilizarlo (WS)."""
+        msg = json.dumps({"topic": topic, "data": payload})
+        self.publish_raw(msg)
+        return msg
+
+    def publish_raw(self, msg: str) -> int:
+        with self._cond:
+            self._seq += 1
+            seq = self._seq
+            self._ring[seq % self.size] = (seq, msg)
+            self.stats["published"] += 1
+            if self._subscribers:
+                self._cond.notify_all()
+        return seq
+
+    def resume_cursor(self, last_event_id: Optional[str]) -> Tuple[int, bool]:
+        """
+        Cursor inicial para un suscriptor. Devuelve (cursor, replay_ok).
+        replay_ok=False si el Last-Event-ID ya no está en el ring (o no vino):
+        el cliente arranca desde el evento actual y necesita un snapshot.
+        """
+        head = self._seq
+        if last_event_id is None:
+            return head, False
+        try:
+            cursor = int(last_event_id)
+        except ValueError:
+            return head, False
+        oldest = max(1, head - self.size + 1)
+        if cursor > head or cursor + 1 < oldest:
+            return head, False
+        self.stats["replayed"] += head - cursor
+        return cursor, True
+
+    def read(self, cursor: int, timeout: float) -> List[Tuple[int, str]]:
+        """
+        Devuelve los eventos con id > cursor (vacío si vence el timeout).
+        Lanza Lagged si el suscriptor quedó más atrás que el ring.
+        """
+        with self._cond:
+            if self._seq <= cursor:
+                self._cond.wait_for(lambda: self._seq > cursor, timeout)
+            head = self._seq
+            if head <= cursor:
+                return []
+            if head - cursor > self.size:
+                self.stats["dropped_slow"] += 1
+                raise Lagged(f"cursor {cursor} fuera del ring (head={head}, size={self.size})")
+            return [self._ring[seq % self.size] for seq in range(cursor + 1, head + 1)]
+
+    def subscribe(self):
+        with self._cond:
+            self._subscribers += 1
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Historial de varios dispositivos en una sola consulta (/metrics/history-batch).
+
+Las consultas devices_* / *_many (telemetry_queries.py, rollups.py) devuelven
+(device_id, *columnas) ordenadas por dispositivo y tiempo sobre el mismo índice
+(device_id, created_at) que las de un dispositivo. Acá se cambia el device_id por
+el código (última columna, "device") para history_export y, con downsample=lttb,
+se aplica LTTB a cada dispositivo por separado (en memoria solo la serie del
+dispositivo en curso).
+"""
+import os
+import itertools
+from operator import itemgetter
+from typing import Dict, Iterator, List, Optional
+
+import downsample
+
+HISTORY_BATCH_MAX_DEVICES = int(os.getenv("HISTORY_BATCH_MAX_DEVICES", "200"))
+
+
+def parse_devices(value: Optional[str]) -> List[str]:
+    """devices=a,b,c (códigos o IDs, sin repetir). Lanza ValueError."""
+    keys = list(dict.fromkeys(k.strip() for k in (value or "").split(",") if k.strip()))
+    if not keys:
+        raise ValueError("devices debe tener al menos un código o ID")
+    if len(keys) > HISTORY_BATCH_MAX_DEVICES:
+        raise ValueError(f"a lo sumo {HISTORY_BATCH_MAX_DEVICES} dispositivos por request")
+    return keys
+
+
+def with_codes(chunks: Iterator[List[tuple]], codes: Dict[int, str]) -> Iterator[List[tuple]]:
+    """(device_id, *columnas) -> (*columnas, código)."""
+    for chunk in chunks:
+        yield [row[1:] + (codes[row[0]],) for row in chunk]
+
+
+def lttb_by_device(chunks: Iterator[List[tuple]], field_index: int, n: int,
+                   codes: Dict[int, str]) -> Iterator[List[tuple]]:
+    """
+    LTTB por dispositivo sobre filas (device_id, ts, ...) ordenadas por dispositivo.
+    field_index es relativo a las filas sin device_id. Un bloque por dispositivo.
+    """
+    current = None
+    pending: List[List[tuple]] = []
+    for chunk in chunks:
+        for device_id, rows in itertools.groupby(chunk, key=itemgetter(0)):
+            if device_id != current and pending:
+                yield _lttb(pending, field_index, n, codes[current])
+                pending = []
+            current = device_id
+            pending.append([row[1:] for row in rows])
+    if pending:
+        yield _lttb(pending, field_index, n, codes[current])
+
+
+def _lttb(chunks: List[List[tuple]], field_index: int, n: int, code: str) -> List[tuple]:
+    return [row + (code,) for row in downsample.lttb_rows(chunks, field_index, n)]
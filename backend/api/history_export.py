@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Formatos de salida de los endpoints de historial (format= y fields=).
+
+- json     array de objetos (el formato de siempre); /metrics/history-batch devuelve
+           un objeto {dispositivo: [puntos]} (grouped_json_body)
+- csv      encabezado + una fila por punto (ts en ms)
+- msgpack  secuencia de objetos MessagePack: primero {"columns": [...]} y luego
+           un array de filas (arrays) por bloque; leer con msgpack.Unpacker
+- arrow    Arrow IPC stream (un record batch por bloque); pyarrow.ipc.open_stream
+- parquet  Parquet con row groups de EXPORT_PARQUET_ROW_GROUP filas; el footer va
+           al final, así que el archivo solo es legible completo
+
+Todos se generan a medida que llegan los bloques del cursor: la memoria depende del
+tamaño de bloque (y del row group en Parquet), no del rango. "device" es una
+columna virtual (el código del dispositivo, constante en la respuesta), salvo que
+venga en las filas (/metrics/history, varios dispositivos).
+"""
+import io
+import os
+import csv
+import json
+import itertools
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import msgpack
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+EXPORT_PARQUET_ROW_GROUP = int(os.getenv("EXPORT_PARQUET_ROW_GROUP", "131072"))
+
+FORMATS = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "msgpack": "application/msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXTENSIONS = {"csv": "csv", "msgpack": "msgpack", "arrow": "arrows", "parquet": "parquet"}
+
+DEVICE = "device"
+_INT_COLUMNS = ("count",)
+
+
+def parse_format(value: Optional[str]) -> str:
+    fmt = (value or "json").lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"format debe ser uno de {', '.join(FORMATS)}")
+    return fmt
+
+
+def parse_fields(value: Optional[str], available: Sequence[str]) -> Optional[Tuple[str, ...]]:
+    """
+    Columnas pedidas en fields=a,b,c (en ese orden, sin repetir), o None si no se
+    pidió proyección. Acepta las de 'available' y "device". Lanza ValueError.
+    """
+    if value is None:
+        return None
+    fields = tuple(dict.fromkeys(f.strip() for f in value.split(",") if f.strip()))
+    unknown = [f for f in fields if f != DEVICE and f not in available]
+    if unknown:
+        raise ValueError(f"fields inválidos: {', '.join(unknown)} (disponibles: {', '.join(available)}, device)")
+    if not any(f != DEVICE for f in fields):
+        raise ValueError("fields debe incluir al menos una columna además de device")
+    return fields
+
+
+def columns_to_read(fields: Optional[Sequence[str]], default: Sequence[str]) -> Tuple[str, ...]:
+    """Columnas a pedir a la base: las de fields (sin device) o las por defecto."""
+    if fields is None:
+        return tuple(default)
+    return tuple(f for f in fields if f != DEVICE)
+
+
+def output_columns(fields: Optional[Sequence[str]], columns: Sequence[str]) -> Tuple[str, ...]:
+    """Columnas de salida: las de fields, o todas las leídas + device."""
+    return tuple(fields) if fields is not None else tuple(columns) + (DEVICE,)
+
+
+def _projector(columns: Sequence[str], out: Sequence[str], device_code: str):
+    """Función fila (en orden de 'columns') -> lista en orden de 'out'."""
+    idx = [None if c == DEVICE and DEVICE not in columns else columns.index(c) for c in out]
+    if idx == list(range(len(columns))):
+        return list
+    return lambda row: [device_code if i is None else row[i] for i in idx]
+
+
+def _json_body(chunks, columns, out, device_code) -> Iterator[str]:
+    project = _projector(columns, out, device_code)
+    yield "["
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        body = json.dumps([dict(zip(out, project(row))) for row in chunk])[1:-1]
+        yield body if first else "," + body
+        first = False
+    yield "]"
+
+
+def grouped_json_body(chunks, columns, out, keys: Sequence[str] = ()) -> Iterator[str]:
+    """
+    JSON {dispositivo: [puntos]} para filas ordenadas por la columna device. Los
+    dispositivos de 'keys' sin filas salen con [] (en ese orden, al final).
+    """
+    columns, out = tuple(columns), tuple(c for c in out if c != DEVICE)
+    k = columns.index(DEVICE)
+    project = _projector(columns, out, None)
+    seen = set()
+    current = None
+    yield "{"
+    for chunk in chunks:
+        for device, rows in itertools.groupby(chunk, key=lambda row: row[k]):
+            body = json.dumps([dict(zip(out, project(row))) for row in rows])[1:-1]
+            if device == current:
+                yield "," + body
+                continue
+            yield ("]," if current is not None else "") + json.dumps(device) + ":[" + body
+            current = device
+            seen.add(device)
+    rest = [key for key in keys if key not in seen]
+    if current is not None:
+        yield "]" + ("," if rest else "")
+    yield ",".join(json.dumps(key) + ":[]" for key in rest)
+    yield "}"
+
+
+def _csv_body(chunks, columns, out, device_code) -> Iterator[str]:
+    project = _projector(columns, out, device_code)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(out)
+    for chunk in chunks:
+        writer.writerows(project(row) for row in chunk)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def _msgpack_body(chunks, columns, out, device_code) -> Iterator[bytes]:
+    project = _projector(columns, out, device_code)
+    packer = msgpack.Packer()
+    yield packer.pack({"columns": list(out)})
+    for chunk in chunks:
+        if chunk:
+            yield packer.pack([project(row) for row in chunk])
+
+
+def arrow_schema(out: Sequence[str]) -> pa.Schema:
+    fields = []
+    for c in out:
+        if c == "ts":
+            fields.append(pa.field(c, pa.timestamp("ms", tz="UTC")))
+        elif c == DEVICE:
+            fields.append(pa.field(c, pa.string()))
+        elif c in _INT_COLUMNS:
+            fields.append(pa.field(c, pa.int64()))
+        else:
+            fields.append(pa.field(c, pa.float64()))
+    return pa.schema(fields)
+
+
+def _record_batch(chunk, columns, out, schema, device_code) -> pa.RecordBatch:
+    data = list(zip(*chunk))
+    arrays = []
+    for c, field in zip(out, schema):
+        if c == DEVICE and DEVICE not in columns:
+            arrays.append(pa.array([device_code] * len(chunk), type=field.type))
+        else:
+            arrays.append(pa.array(data[columns.index(c)], type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _Drain:
+    """Archivo de solo escritura para pyarrow: acumula lo escrito hasta drain()."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        out = b"".join(self._parts)
+        self._parts.clear()
+        return out
+
+
+def _arrow_body(chunks, columns, out, device_code) -> Iterator[bytes]:
+    schema = arrow_schema(out)
+    sink = _Drain()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    for chunk in chunks:
+        if chunk:
+            writer.write_batch(_record_batch(chunk, columns, out, schema, device_code))
+            yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _parquet_body(chunks, columns, out, device_code) -> Iterator[bytes]:
+    schema = arrow_schema(out)
+    sink = _Drain()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="snappy")
+    pending: List[pa.RecordBatch] = []
+    pending_rows = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        pending.append(_record_batch(chunk, columns, out, schema, device_code))
+        pending_rows += len(chunk)
+        if pending_rows >= EXPORT_PARQUET_ROW_GROUP:
+            writer.write_table(pa.Table.from_batches(pending, schema=schema), row_group_size=pending_rows)
+            pending, pending_rows = [], 0
+            yield sink.drain()
+    if pending:
+        writer.write_table(pa.Table.from_batches(pending, schema=schema), row_group_size=pending_rows)
+    writer.close()
+    yield sink.drain()
+
+
+_BODIES = {
+    "json": _json_body,
+    "csv": _csv_body,
+    "msgpack": _msgpack_body,
+    "arrow": _arrow_body,
+    "parquet": _parquet_body,
+}
+
+
+def body(fmt: str, chunks: Iterable[Sequence[tuple]], columns: Sequence[str], out: Sequence[str],
+         device_code: str) -> Iterator[Union[str, bytes]]:
+    """Generador del cuerpo de la respuesta en 'fmt' para bloques de filas en orden 'columns'."""
+    return _BODIES[fmt](chunks, tuple(columns), tuple(out), device_code)
+
+
+def batch_body(fmt: str, chunks: Iterable[Sequence[tuple]], columns: Sequence[str], out: Sequence[str],
+               keys: Sequence[str]) -> Iterator[Union[str, bytes]]:
+    """Cuerpo de /metrics/history-batch: json agrupado por dispositivo, el resto como tabla con device."""
+    if fmt == "json":
+        return grouped_json_body(chunks, columns, out, keys)
+    return body(fmt, chunks, columns, out, None)
+
+
+def headers(fmt: str, device_code: str) -> dict:
+    """Content-Disposition para los formatos de descarga (json se sirve inline)."""
+    if fmt not in EXTENSIONS:
+        return {}
+    return {"Content-Disposition": f'attachment; filename="history_{device_code}.{EXTENSIONS[fmt]}"'}
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Planificador de /metrics/history-smart (filas crudas) entre InfluxDB y PostgreSQL.
+
+InfluxDB guarda los últimos INFLUX_RETENTION_DAYS días (o lo que diga la regla de
+retención del bucket); telemetry_history guarda todo. Para cada dispositivo se
+cachea desde cuándo tiene datos cada store (Coverage, TTL PLANNER_COVERAGE_TTL_S);
+el extremo superior de ambos es "ahora", así que no se cachea.
+
+plan() corta el rango en el límite de Influx:
+
+    [start ........ boundary) -> PostgreSQL (range scan por device_id, created_at)
+    [boundary ........... end] -> InfluxDB (un pivot filtrado por device y campos)
+
+boundary = max(primer dato en Influx, ahora - retención + PLANNER_BOUNDARY_MARGIN_S)
+(el margen evita pedirle a Influx datos que está por borrar). Si Influx no está
+configurado o no tiene el dispositivo, todo va a PostgreSQL; una parte fuera de la
+cobertura de su store no se consulta. Como mucho dos consultas por request.
+
+La parte de Influx (influx_queries.device_range_flux, con parámetros) corre en un
+hilo (PLANNER_WORKERS) mientras PostgreSQL hace streaming; merge_streams() las une
+por ts y descarta ts repetidos (gana PostgreSQL). Si Influx falla antes de devolver
+filas, su tramo se lee de PostgreSQL.
+"""
+import os
+import time
+import heapq
+import queue
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from hotlog import get_logger, sampled
+from influx_queries import DEVICE_FIRST_FLUX, TELEMETRY_FIELDS, InfluxQueries, device_range_flux
+from instrumentation import REGISTRY, pg_query_seconds, timed
+from telemetry_queries import STREAM_CHUNK_ROWS
+
+log = get_logger("history-planner")
+
+INFLUX_RETENTION_DAYS = float(os.getenv("INFLUX_RETENTION_DAYS", "30"))
+PLANNER_COVERAGE_TTL_S = float(os.getenv("PLANNER_COVERAGE_TTL_S", "300"))
+PLANNER_BOUNDARY_MARGIN_S = float(os.getenv("PLANNER_BOUNDARY_MARGIN_S", "3600"))
+PLANNER_WORKERS = int(os.getenv("PLANNER_WORKERS", "4"))
+# Bloques de Influx que el hilo adelanta mientras PostgreSQL todavía está enviando
+PLANNER_PREFETCH_CHUNKS = int(os.getenv("PLANNER_PREFETCH_CHUNKS", "4"))
+
+planner_parts = REGISTRY.counter(
+    "iot_history_planner_parts_total", "Tramos planificados por store", ("store",))
+
+PG_FIRST_SQL = "SELECT min(created_at) FROM telemetry_history WHERE device_id = %s"
+
+
+class Part(NamedTuple):
+    store: str          # "postgres" | "influx"
+    start: datetime
+    end: datetime       # inclusive
+
+
+def _aware(ts: Optional[datetime]) -> Optional[datetime]:
+    """created_at (UTC sin zona) o tiempo de Influx -> datetime con zona UTC."""
+    if ts is None or ts.tzinfo is not None:
+        return ts
+    return ts.replace(tzinfo=timezone.utc)
+
+
+class Coverage:
+    """Primer dato por (store, dispositivo); None también se cachea (sin datos o store caído)."""
+
+    def __init__(self, ttl_s: float = PLANNER_COVERAGE_TTL_S):
+        self.ttl_s = ttl_s
+        self._entries: Dict[Tuple[str, str], Tuple[float, Optional[datetime]]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "loads": 0}
+
+    def first(self, store: str, key: str, load: Callable[[], Optional[datetime]]) -> Optional[datetime]:
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get((store, key))
+            if cached is not None and cached[0] > now:
+                self.stats["hits"] += 1
+                return cached[1]
+        value = _aware(load())
+        self.put(store, key, value, loaded=True)
+        return value
+
+    def put(self, store: str, key: str, value: Optional[datetime], loaded: bool = False):
+        with self._lock:
+            self._entries[(store, key)] = (time.monotonic() + self.ttl_s, value)
+            if loaded:
+                self.stats["loads"] += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {"entries": len(self._entries), **self.stats}
+
+
+class HistoryPlanner:
+    def __init__(self, influx: InfluxQueries, retention_days: float = INFLUX_RETENTION_DAYS,
+                 workers: int = PLANNER_WORKERS):
+        self.influx = influx if influx.configured else None
+        self.coverage = Coverage()
+        self._default_retention_s = retention_days * 86400
+        self._retention: Optional[Tuple[float, float]] = None   # (vence, segundos)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="history-influx")
+        # Se actualiza desde los requests y desde los hilos de Influx: siempre con incr()
+        self._stats_lock = threading.Lock()
+        self.stats = {"plans": 0, "postgres_parts": 0, "influx_parts": 0, "split": 0,
+                      "influx_errors": 0, "influx_fallbacks": 0, "duplicates": 0}
+
+    def incr(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    # --- cobertura ---
+
+    def retention_s(self) -> float:
+        """Retención del bucket (regla de Influx, 0 = infinita) o INFLUX_RETENTION_DAYS."""
+        now = time.monotonic()
+        if self._retention is not None and self._retention[0] > now:
+            return self._retention[1]
+        seconds = self._default_retention_s
+        try:
+            bucket = self.influx.client.buckets_api().find_bucket_by_name(self.influx.bucket)
+            rules = bucket.retention_rules if bucket is not None else None
+            if rules:
+                seconds = float(rules[0].every_seconds or 0) or float("inf")
+        except Exception as e:
+            if sampled("planner_retention", 300):
+                log.info(f"Retención de Influx no disponible, usando {INFLUX_RETENTION_DAYS} días: {e}")
+        self._retention = (now + PLANNER_COVERAGE_TTL_S, seconds)
+        return seconds
+
+    def _influx_first(self, device_code: str) -> Optional[datetime]:
+        retention = self.retention_s()
+        since = (datetime.fromtimestamp(0, tz=timezone.utc) if retention == float("inf")
+                 else datetime.now(timezone.utc) - timedelta(seconds=retention))
+        params = self.influx.params(start=since, device=device_code)
+        for chunk in self.influx.rows("coverage_first", DEVICE_FIRST_FLUX, params, ("ts",)):
+            for (ts,) in chunk:
+                if ts is not None:
+                    return datetime.fromtimestamp(ts / 1000, tz=timezone.utc)
+        return None
+
+    def _postgres_first(self, cursor, device_id: int) -> Optional[datetime]:
+        with timed(pg_query_seconds, "coverage_first"):
+            cursor.execute(PG_FIRST_SQL, (device_id,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    # --- plan ---
+
+    @staticmethod
+    def influx_serves(columns: Sequence[str]) -> bool:
+        """Influx solo tiene las mediciones (no energia_acumulada)."""
+        return all(c == "ts" or c in TELEMETRY_FIELDS for c in columns)
+
+    def plan(self, cursor, device_id: int, device_code: str, start: datetime, end: datetime) -> List[Part]:
+        """Tramos a consultar, en orden de tiempo (a lo sumo uno por store)."""
+        self.incr("plans")
+        parts: List[Part] = []
+        pg_end = end
+        if self.influx is not None:
+            try:
+                influx_first = self.coverage.first("influx", device_code, lambda: self._influx_first(device_code))
+            except Exception as e:
+                # Influx caído: todo a PostgreSQL hasta que venza la entrada
+                self.incr("influx_errors")
+                if sampled("planner_influx_coverage", 60):
+                    log.warning(f"No se pudo leer la cobertura de InfluxDB para {device_code}: {e}")
+                self.coverage.put("influx", device_code, None)
+                influx_first = None
+            if influx_first is not None:
+                retention = self.retention_s()
+                boundary = influx_first
+                if retention != float("inf"):
+                    horizon = datetime.now(timezone.utc) - timedelta(seconds=retention - PLANNER_BOUNDARY_MARGIN_S)
+                    boundary = max(boundary, horizon)
+                if boundary <= end:
+                    influx_start = max(start, boundary)
+                    parts.append(Part("influx", influx_start, end))
+                    pg_end = influx_start
+        if pg_end > start or not parts:
+            pg_first = self.coverage.first("postgres", str(device_id), lambda: self._postgres_first(cursor, device_id))
+            if pg_first is not None and pg_first <= pg_end:
+                parts.insert(0, Part("postgres", start, pg_end))
+        if len(parts) == 2:
+            self.incr("split")
+        for part in parts:
+            self.incr(f"{part.store}_parts")
+            planner_parts.inc(part.store)
+        return parts
+
+    # --- Influx ---
+
+    def _influx_rows(self, device_code: str, part: Part, columns: Sequence[str]) -> Iterator[List[tuple]]:
+        fields = tuple(c for c in columns if c != "ts") or ("potencia_activa",)
+        # stop es exclusivo en Flux: +1 ms para incluir end como en PostgreSQL
+        params = self.influx.params(start=part.start, stop=part.end + timedelta(milliseconds=1),
+                                    device=device_code)
+        sources = {c: ("ts",) if c == "ts" else TELEMETRY_FIELDS[c] for c in columns}
+        return self.influx.rows("history_range", device_range_flux(fields), params, sources)
+
+    def start_influx(self, device_code: str, part: Part, columns: Sequence[str],
+                     fallback: Callable[[], Iterator[List[tuple]]]) -> "InfluxStream":
+        """Lanza la consulta de Influx en un hilo; devuelve el iterador de sus bloques."""
+        stream = InfluxStream(self, fallback)
+        stream.future = self._executor.submit(stream.produce,
+                                              lambda: self._influx_rows(device_code, part, columns))
+        return stream
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {"influx": self.influx is not None, **stats, "coverage": self.coverage.snapshot()}
+
+
+_DONE = object()
+
+
+class InfluxStream:
+    """
+    Bloques de Influx producidos en un hilo (cola acotada). Si la consulta falla sin
+    haber entregado filas se sigue con fallback() (el mismo tramo desde PostgreSQL);
+    si falla a mitad del stream se relanza el error: la respuesta se corta en lugar
+    de salir completa sin un tramo (y el cache de respuestas no la guarda).
+    """
+
+    def __init__(self, planner: HistoryPlanner, fallback: Callable[[], Iterator[List[tuple]]]):
+        self.planner = planner
+        self.fallback = fallback
+        self.future = None
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, PLANNER_PREFETCH_CHUNKS))
+        self._closed = threading.Event()
+
+    def _put(self, item) -> bool:
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(self, rows: Callable[[], Iterator[List[tuple]]]):
+        result = _DONE
+        try:
+            for chunk in rows():
+                if not self._put(chunk):
+                    return
+        except BaseException as e:
+            # También GreenletExit y similares: el lector no puede quedar esperando
+            result = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self._put(result)
+
+    def __iter__(self) -> Iterator[List[tuple]]:
+        delivered = 0
+        while True:
+            item = self._queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                self.planner.incr("influx_errors")
+                if delivered:
+                    log.error(f"InfluxDB falló a mitad del stream ({delivered} filas enviadas): {item!r}")
+                    if not isinstance(item, Exception):
+                        raise RuntimeError(f"Consulta de InfluxDB interrumpida: {item!r}")
+                    raise item
+                log.warning(f"InfluxDB falló, leyendo el tramo desde PostgreSQL: {item!r}")
+                self.planner.incr("influx_fallbacks")
+                yield from self.fallback()
+                return
+            delivered += len(item)
+            yield item
+
+    def close(self):
+        self._closed.set()
+
+
+def merge_streams(parts: Sequence[Iterator[List[tuple]]], ts_index: int,
+                  incr: Optional[Callable[[str, int], None]] = None,
+                  chunk_rows: Optional[int] = None) -> Iterator[List[tuple]]:
+    """
+    Une bloques ordenados por ts de varios tramos en bloques ordenados por ts. Con el
+    mismo ts queda la fila del primer tramo (heapq.merge es estable). Los duplicados
+    descartados se informan al final con incr("duplicates", n) (p. ej. HistoryPlanner.incr).
+    """
+    chunk_rows = chunk_rows or STREAM_CHUNK_ROWS
+    if len(parts) == 1:
+        yield from parts[0]
+        return
+    rows = heapq.merge(*(itertools.chain.from_iterable(p) for p in parts), key=lambda r: r[ts_index])
+    last_ts = None
+    duplicates = 0
+    chunk: List[tuple] = []
+    try:
+        for row in rows:
+            ts = row[ts_index]
+            if ts == last_ts:
+                duplicates += 1
+                continue
+            last_ts = ts
+            chunk.append(row)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    finally:
+        if duplicates and incr is not None:
+            incr("duplicates", duplicates)
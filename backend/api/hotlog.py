@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Logging de bajo costo para el camino caliente (ingesta MQTT).
+
+- logging estándar con niveles (LOG_LEVEL) y formato texto o JSON (LOG_FORMAT).
+- Los hilos que loguean solo encolan el LogRecord (QueueHandler con cola acotada);
+  un hilo de fondo (QueueListener) escribe a stdout. Si la cola se llena se
+  descarta el registro: el hilo MQTT nunca espera por I/O.
+- Límite por sitio (archivo:línea): como máximo LOG_RATE_PER_SITE registros por
+  segundo; el resto se cuenta y se informa en el siguiente registro permitido.
+- Muestreo: sampled("clave", n) es True 1 de cada n llamadas, para loguear por
+  ejemplo 1 de cada N mensajes aceptados.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import itertools
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+ROOT_LOGGER = "iot"
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+_counters: Dict[str, "itertools.count"] = {}
+stats = {"dropped_queue_full": 0, "suppressed_rate_limit": 0}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        return json.dumps(out, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """QueueHandler que descarta (y cuenta) en vez de bloquear con la cola llena."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats["dropped_queue_full"] += 1
+
+
+class SiteRateLimit(logging.Filter):
+    """Máximo 'per_second' registros por segundo por sitio (logger, archivo, línea)."""
+
+    def __init__(self, per_second: int):
+        super().__init__()
+        self.per_second = per_second
+        self._windows: Dict[Tuple[str, str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.per_second <= 0 or record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now_s = int(time.monotonic())
+        window = self._windows.get(key)
+        if window is None or window[0] != now_s:
+            suppressed = window[2] if window else 0
+            self._windows[key] = [now_s, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} (+{suppressed} suprimidos)"
+            return True
+        if window[1] < self.per_second:
+            window[1] += 1
+            return True
+        window[2] += 1
+        stats["suppressed_rate_limit"] += 1
+        return False
+
+
+def setup_logging(level: Optional[str] = None, fmt: Optional[str] = None,
+                  queue_size: Optional[int] = None, rate_per_site: Optional[int] = None) -> logging.Logger:
+    """Configura el logger raíz 'iot' (idempotente). Devuelve ese logger."""
+    global _listener
+    root = logging.getLogger(ROOT_LOGGER)
+    with _setup_lock:
+        if _listener is not None:
+            return root
+        level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+        fmt = (fmt or os.getenv("LOG_FORMAT", "text")).lower()
+        queue_size = queue_size or int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+        rate_per_site = rate_per_site if rate_per_site is not None else int(os.getenv("LOG_RATE_PER_SITE", "20"))
+
+        stream = logging.StreamHandler(sys.stdout)
+        if fmt == "json":
+            stream.setFormatter(JsonFormatter())
+        else:
+            stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+
+        q: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        qh = _DroppingQueueHandler(q)
+        qh.addFilter(SiteRateLimit(rate_per_site))
+
+        root.setLevel(level)
+        root.handlers[:] = [qh]
+        root.propagate = False
+        _listener = QueueListener(q, stream, respect_handler_level=False)
+        _listener.start()
+    return root
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def sampled(key: str, every: int) -> bool:
+    """True una de cada 'every' llamadas para esa clave (every <= 1: siempre)."""
+    if every <= 1:
+        return True
+    counter = _counters.get(key)
+    if counter is None:
+        counter = _counters.setdefault(key, itertools.count())
+    return next(counter) % every == 0
+
+
+def flush():
+    """Detiene el listener vaciando la cola (tests/benchmarks y apagado ordenado)."""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
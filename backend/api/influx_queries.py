@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Consultas Flux de los endpoints que leen InfluxDB.
+
+- Todo lo que viene de la request (dispositivo, rango) va como parámetro
+  (params= del cliente, 'params.x' en Flux), nunca interpolado en el texto.
+  Los textos de las consultas son constantes o se arman solo con nombres de
+  campos conocidos (device_range_flux, con lru_cache).
+- Un solo query_api por proceso (InfluxQueries).
+- rows() lee la respuesta como CSV sin anotaciones, fila a fila: no se crea un
+  FluxRecord ni un dict por fila. El pivot, la selección de columnas y ts en ms
+  (int(v: r._time) / 1000000) se hacen en el servidor; acá solo se convierten los
+  textos de las columnas pedidas y se arman bloques de STREAM_CHUNK_ROWS tuplas.
+
+Lo usan /metrics/history, /metrics/last-from-db, /metrics/power-outages,
+/debug/influx-check y history_planner.py.
+"""
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+from influxdb_client import Dialect
+
+import downsample
+from instrumentation import REGISTRY, timed
+from telemetry_queries import STREAM_CHUNK_ROWS
+
+influx_query_seconds = REGISTRY.histogram(
+    "iot_influx_query_seconds", "Duración de consultas a InfluxDB", ("query",))
+
+# Medidas donde Telegraf escribe la telemetría (ver backend/telegraf/telegraf.conf)
+MEASUREMENT_FILTER = 'r._measurement == "esp" or r._measurement == "telemetry"'
+# Columna de salida -> campos de Influx (el primero presente gana; los cortos son del formato sin renombrar)
+TELEMETRY_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "vrms": ("vrms", "V"),
+    "irms": ("irms", "I"),
+    "s_apparent_va": ("s_apparent_va", "S"),
+    "potencia_activa": ("potencia_activa", "potencia_actesp", "P"),
+    "factor_potencia": ("factor_potencia", "PF"),
+}
+HISTORY_COLUMNS = ("ts",) + tuple(TELEMETRY_FIELDS) + ("device",)
+
+# Columnas de texto; "ts" es entero y el resto numérico
+_STRING_COLUMNS = frozenset(("device", "_field", "_measurement", "topic", "host"))
+
+_CSV_DIALECT = Dialect(header=True, delimiter=",", annotations=[], comment_prefix="#",
+                       date_time_format="RFC3339")
+
+_TS_MAP = "map(fn: (r) => ({r with ts: int(v: r._time) / 1000000}))"
+
+
+def _field_filter(fields: Sequence[str]) -> str:
+    names = sorted({f for c in fields for f in TELEMETRY_FIELDS[c]})
+    return " or ".join(f'r._field == "{name}"' for name in names)
+
+
+# Últimas lecturas (/metrics/last-from-db): una fila por campo
+LAST_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> last()
+  |> {_TS_MAP}
+  |> keep(columns: ["ts", "_field", "_value"])
+'''
+
+# Todos los dispositivos desde params.start (/metrics/history)
+HISTORY_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => {_field_filter(tuple(TELEMETRY_FIELDS))})
+  |> keep(columns: ["_time", "_field", "_value", "device"])
+  |> group()
+  |> pivot(rowKey: ["_time", "device"], columnKey: ["_field"], valueColumn: "_value")
+  |> sort(columns: ["_time"])
+  |> {_TS_MAP}
+  |> drop(columns: ["_time"])
+'''
+
+
+@lru_cache(maxsize=32)
+def device_range_flux(fields: Sequence[str] = tuple(TELEMETRY_FIELDS)) -> str:
+    """Pivot de los campos pedidos de params.device en [params.start, params.stop), ordenado por tiempo."""
+    unknown = [f for f in fields if f not in TELEMETRY_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"campos inválidos: {', '.join(unknown) or '(ninguno)'}")
+    return f'''
+from(bucket: params.bucket)
+  |> range(start: params.start, stop: params.stop)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => r.device == params.device)
+  |> filter(fn: (r) => {_field_filter(fields)})
+  |> keep(columns: ["_time", "_field", "_value"])
+  |> group()
+  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+  |> sort(columns: ["_time"])
+  |> {_TS_MAP}
+  |> drop(columns: ["_time"])
+'''
+
+
+# Primer dato del dispositivo desde params.start (cobertura, ver history_planner.py)
+DEVICE_FIRST_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => r.device == params.device)
+  |> first()
+  |> group()
+  |> sort(columns: ["_time"])
+  |> limit(n: 1)
+  |> {_TS_MAP}
+  |> keep(columns: ["ts"])
+'''
+
+
+# /debug/influx-check
+MEASUREMENTS_FLUX = '''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> group()
+  |> distinct(column: "_measurement")
+  |> limit(n: 10)
+'''
+
+DEVICES_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => exists r.device)
+  |> group()
+  |> distinct(column: "device")
+  |> limit(n: 10)
+'''
+
+DEVICE_COUNT_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => r.device == params.device)
+  |> count()
+'''
+
+DEVICE_SAMPLE_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => r.device == params.device)
+  |> keep(columns: ["_time", "_field", "_value", "device"])
+  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+  |> group()
+  |> sort(columns: ["_time"], desc: true)
+  |> limit(n: 3)
+'''
+
+DEVICE_FIELDS_FLUX = f'''
+from(bucket: params.bucket)
+  |> range(start: params.start)
+  |> filter(fn: (r) => {MEASUREMENT_FILTER})
+  |> filter(fn: (r) => r.device == params.device)
+  |> group()
+  |> distinct(column: "_field")
+  |> limit(n: 20)
+'''
+
+
+def parse_range(value: Optional[str]) -> timedelta:
+    """range= de /metrics/history ('-15m', '2h', '7d'): cuánto hacia atrás. Lanza ValueError."""
+    try:
+        return timedelta(seconds=downsample.parse_duration_s((value or "").strip().lstrip("-")))
+    except ValueError:
+        raise ValueError(f"range inválido: '{value}' (usar p. ej. -15m, -1h, -7d)")
+
+
+def _number(text: str) -> Optional[float]:
+    return float(text) if text else None
+
+
+def _number_or_text(text: str) -> Union[float, str, None]:
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def _converter(column: str):
+    if column == "ts":
+        return lambda text: int(text) if text else None
+    if column in _STRING_COLUMNS:
+        return lambda text: text or None
+    if column == "_value":
+        return _number_or_text
+    return _number
+
+
+def _getter(conv, positions: List[int]):
+    """Valor de la columna de salida en una línea CSV: el primero no vacío de 'positions'."""
+    if not positions:
+        return lambda line: None
+    if len(positions) == 1:
+        i = positions[0]
+        return lambda line: conv(line[i])
+    return lambda line: conv(next((line[i] for i in positions if line[i]), ""))
+
+
+class InfluxQueries:
+    def __init__(self, client, bucket: Optional[str], org: Optional[str]):
+        self.client = client if client is not None and bucket else None
+        self.bucket = bucket
+        self.org = org
+        self._api = self.client.query_api() if self.client is not None else None
+
+    @property
+    def configured(self) -> bool:
+        return self._api is not None
+
+    def params(self, **values) -> Dict[str, object]:
+        """Parámetros de la consulta (siempre incluye bucket); datetimes en UTC."""
+        out = {"bucket": self.bucket}
+        for k, v in values.items():
+            out[k] = v.astimezone(timezone.utc) if isinstance(v, datetime) else v
+        return out
+
+    def rows(self, query_name: str, flux: str, params: Mapping[str, object],
+             columns: Union[Sequence[str], Mapping[str, Sequence[str]]],
+             chunk_rows: Optional[int] = None) -> Iterator[List[tuple]]:
+        """
+        Bloques de tuplas en el orden de 'columns'. Con un mapping, cada columna de
+        salida toma en cada fila la primera de sus columnas de origen con valor;
+        una columna ausente sale como None.
+        """
+        chunk_rows = chunk_rows or STREAM_CHUNK_ROWS
+        if not isinstance(columns, Mapping):
+            columns = {c: (c,) for c in columns}
+        specs = [(_converter(c), names) for c, names in columns.items()]
+        chunk: List[tuple] = []
+        with timed(influx_query_seconds, query_name):
+            lines = self._api.query_csv(flux, org=self.org, dialect=_CSV_DIALECT, params=dict(params))
+            getters = None
+            for line in lines:
+                if len(line) <= 1:
+                    continue            # separador entre tablas
+                if getters is None or line[1] == "result":
+                    # encabezado: cada tabla con otro esquema trae el suyo
+                    getters = [_getter(conv, [line.index(n) for n in names if n in line]) for conv, names in specs]
+                    continue
+                chunk.append(tuple(get(line) for get in getters))
+                if len(chunk) >= chunk_rows:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def records(self, query_name: str, flux: str, params: Mapping[str, object]) -> Iterator:
+        """FluxRecords de a uno (query_stream); para consultas chicas que necesitan r.values."""
+        with timed(influx_query_seconds, query_name):
+            yield from self._api.query_stream(flux, org=self.org, params=dict(params))
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Escritor de telemetría por lotes (etapa única de ingesta hacia PostgreSQL).
+
+- Cola acotada: on_message solo encola, nunca toca la base de datos.
+- Uno o pocos hilos worker que vacían la cola y hacen flush por tamaño
+  (batch_size) o por tiempo (linger_ms).
+- Con varios workers hay una cola por worker y cada dispositivo va siempre a la
+  misma (hash del código): sus filas se escriben en orden, que es lo que suponen
+  los callbacks after_flush (energía, cortes, calidad), que descartan como fuera
+  de orden toda lectura anterior a la última procesada.
+- Cada flush es un INSERT multi-fila en telemetry_history dentro de una sola
+  transacción.
+- Contadores de encolados, escritos, descartados y bloqueos para monitoreo.
+"""
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from psycopg2.extras import execute_values
+
+from db_pool import PoolError
+from hotlog import get_logger, sampled
+from instrumentation import REGISTRY, pg_query_seconds, timed
+
+log = get_logger("ingest")
+
+flush_seconds = REGISTRY.histogram(
+    "iot_ingest_flush_seconds", "Duración de cada flush de lote a telemetry_history")
+batch_rows = REGISTRY.histogram(
+    "iot_ingest_batch_rows", "Filas por lote escrito",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+
+
+# Fila tal como se inserta en telemetry_history (antes de resolver el dispositivo)
+# (device_code, fecha, voltaje, corriente, potencia, created_at)
+INSERT_TELEMETRY_SQL = """
+    INSERT INTO telemetry_history (
+        user_id, fecha, voltaje, corriente, potencia, energia_acumulada,
+        company_id, device_id, created_at
+    )
+    VALUES %s
+"""
+# Posición de cada columna en las filas de INSERT_TELEMETRY_SQL: son las filas que
+# completa energy.py y que reciben los callbacks after_flush (alertas, rollups, ...)
+(COL_USER_ID, COL_FECHA, COL_VOLTAJE, COL_CORRIENTE, COL_POTENCIA, COL_ENERGIA,
+ COL_COMPANY_ID, COL_DEVICE_ID, COL_CREATED_AT) = range(9)
+
+RESOLVE_DEVICES_SQL = """
+    SELECT d.code, d.id::text, d.id as device_id, d.company_id,
+           COALESCE(
+               (SELECT u.id FROM users u
+                INNER JOIN roles r ON u.role_id = r.id
+                WHERE u.company_id = d.company_id
+                AND (r.name = 'admin' OR r.name = 'super_admin')
+                LIMIT 1),
+               (SELECT u.id FROM users u
+                WHERE u.company_id = d.company_id
+                LIMIT 1),
+               NULL
+           ) as user_id
+    FROM devices d
+    WHERE d.code = ANY(%s) OR d.id::text = ANY(%s)
+"""
+
+
+class TelemetryWriter:
+    """
+    Cola acotada + workers que insertan en telemetry_history por lotes.
+
+    Parámetros:
+    - pool: ConnectionPool compartido del proceso (ver db_pool.py)
+    - batch_size: máximo de filas por flush
+    - linger_ms: tiempo máximo que una fila espera en el lote antes del flush
+    - queue_capacity: tamaño máximo de la cola (repartido entre los workers)
+    - workers: cantidad de hilos escritores; cada uno con su cola y su parte de los dispositivos
+    - block_ms: cuánto puede bloquear submit() con la cola llena antes de descartar
+      (0 = descartar inmediatamente, nunca bloquear al hilo MQTT)
+    - after_flush: callback(cursor, conn, filas_resueltas) ejecutado tras cada commit;
+      filas_resueltas = [(device_code, fila_insertada, energy_kwh)], con energy_kwh la
+      energía del intervalo que cierra la fila según energy (None sin integrador)
+    - registry: DeviceRegistry opcional; si está listo, la resolución de
+      dispositivos no consulta la base de datos
+    - energy: EnergyIntegrator opcional (ver energy.py); completa energia_acumulada
+      y guarda su estado en la misma transacción que el INSERT
+    """
+
+    def __init__(self, pool, batch_size: int = 500, linger_ms: int = 200,
+                 queue_capacity: int = 10000, workers: int = 1, block_ms: int = 0,
+                 after_flush: Optional[Callable] = None, registry=None, energy=None):
+        self._pool = pool
+        self.registry = registry
+        self.energy = energy
+        self.batch_size = max(1, batch_size)
+        self.linger_s = max(0, linger_ms) / 1000.0
+        self.queue_capacity = max(1, queue_capacity)
+        self.workers = max(1, workers)
+        self.block_s = max(0, block_ms) / 1000.0
+        self.after_flush = after_flush
+
+        # Una cola por worker: las filas de un dispositivo las escribe siempre el mismo
+        per_worker = -(-self.queue_capacity // self.workers)
+        self._queues: List["queue.Queue"] = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._threads: List[threading.Thread] = []
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "enqueued": 0,
+            "written": 0,
+            "dropped_full": 0,
+            "dropped_unknown_device": 0,
+            "failed": 0,
+            "blocked": 0,
+            "blocked_ms_total": 0.0,
+            "batches": 0,
+            "batch_fallbacks": 0,
+            "last_batch_size": 0,
+            "last_flush_ms": 0.0,
+        }
+
+    # ---------- API pública ----------
+    def start(self):
+        if self._threads:
+            return
+        for n, q in enumerate(self._queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"telemetry-writer-{n}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5.0):
+        """Detiene los workers tras vaciar lo que quede en la cola."""
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def submit(self, row: Sequence[Any]) -> bool:
+        """Encola una fila en la cola de su dispositivo. Devuelve False si se descartó por cola llena."""
+        q = self._queues[hash(row[0]) % len(self._queues)]
+        try:
+            q.put_nowait(row)
+        except queue.Full:
+            if self.block_s <= 0:
+                self._incr("dropped_full")
+                return False
+            t0 = time.perf_counter()
+            try:
+                q.put(row, timeout=self.block_s)
+            except queue.Full:
+                self._incr("dropped_full")
+                return False
+            finally:
+                waited_ms = (time.perf_counter() - t0) * 1000
+                with self._stats_lock:
+                    self._stats["blocked"] += 1
+                    self._stats["blocked_ms_total"] += waited_ms
+        self._incr("enqueued")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["blocked_ms_total"] = round(out["blocked_ms_total"], 2)
+        out["last_flush_ms"] = round(out["last_flush_ms"], 2)
+        out["queue_depth"] = sum(q.qsize() for q in self._queues)
+        out["queue_capacity"] = self.queue_capacity
+        out["batch_size"] = self.batch_size
+        out["linger_ms"] = int(self.linger_s * 1000)
+        out["workers"] = self.workers
+        return out
+
+    # ---------- Internos ----------
+    def _incr(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def _collect(self, q: "queue.Queue") -> List[Sequence[Any]]:
+        """Bloquea hasta tener una fila y luego junta más hasta batch_size o linger."""
+        try:
+            first = q.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.linger_s
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(q.get_nowait())
+                else:
+                    batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, q: "queue.Queue"):
+        while not (self._stop.is_set() and q.empty()):
+            batch = self._collect(q)
+            if not batch:
+                continue
+            try:
+                with self._pool.connection() as conn:
+                    self._flush(conn, batch)
+            except PoolError as e:
+                log.error(f"Sin conexión a PostgreSQL ({e}), se pierden {len(batch)} filas")
+                self._incr("failed", len(batch))
+                time.sleep(1.0)
+            except Exception as e:
+                log.exception(f"Error en flush de {len(batch)} filas: {e}")
+                self._incr("failed", len(batch))
+
+    def _resolve(self, cursor, codes: List[str]) -> Dict[str, tuple]:
+        """Resuelve code/id -> (device_id, company_id, user_id) en una sola consulta."""
+        if self.registry is not None and self.registry.ready:
+            out = {}
+            for code in codes:
+                dev = self.registry.resolve(code)
+                if dev is not None:
+                    out[code] = (dev.id, dev.company_id, dev.user_id)
+            return out
+        with timed(pg_query_seconds, "ingest_resolve_devices"):
+            cursor.execute(RESOLVE_DEVICES_SQL, (codes, codes))
+        out = {}
+        for code, id_text, device_id, company_id, user_id in cursor.fetchall():
+            info = (device_id, company_id, user_id)
+            out[id_text] = info
+            if code is not None:
+                out[code] = info
+        return out
+
+    def _flush(self, conn, batch: List[Sequence[Any]]):
+        t0 = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            codes = list({row[0] for row in batch})
+            devices = self._resolve(cursor, codes)
+
+            resolved = []
+            unknown = 0
+            for device_code, fecha, voltaje, corriente, potencia, created_at in batch:
+                info = devices.get(device_code)
+                if not info:
+                    unknown += 1
+                    continue
+                device_id, company_id, user_id = info
+                resolved.append((device_code, (
+                    user_id, fecha, voltaje, corriente, potencia, None,
+                    company_id, device_id, created_at,
+                ), None))
+            if unknown:
+                self._incr("dropped_unknown_device", unknown)
+
+            if resolved:
+                values = [r[1] for r in resolved]
+                if self.energy:
+                    try:
+                        values, deltas = self.energy.assign(cursor, values)
+                        resolved = [(r[0], v, d) for r, v, d in zip(resolved, values, deltas)]
+                    except Exception as e:
+                        # Sin integración (p. ej. falta device_energy_state): el lote se escribe igual
+                        conn.rollback()
+                        if sampled("ingest_energy_error", 100):
+                            log.warning(f"No se pudo integrar energía del lote: {e}")
+                try:
+                    with timed(pg_query_seconds, "ingest_insert_batch"):
+                        execute_values(cursor, INSERT_TELEMETRY_SQL, values, page_size=len(values))
+                        conn.commit()
+                    written = len(values)
+                except Exception as e:
+                    # Una fila inválida no debe tirar el lote entero: reintentar de a una
+                    conn.rollback()
+                    log.warning(f"Lote rechazado ({e}); reintentando fila por fila")
+                    self._incr("batch_fallbacks")
+                    ok = self._insert_one_by_one(conn, cursor, values)
+                    # after_flush solo ve las filas que quedaron en telemetry_history
+                    resolved = [resolved[i] for i in ok]
+                    written = len(ok)
+                    if self.energy and resolved:
+                        # El rollback deshizo el estado de energía: avanzarlo con las filas escritas
+                        # (sus energia_acumulada ya se calcularon con el lote completo)
+                        try:
+                            _, deltas = self.energy.assign(cursor, [r[1] for r in resolved])
+                            conn.commit()
+                            resolved = [(r[0], r[1], d) for r, d in zip(resolved, deltas)]
+                        except Exception as e:
+                            conn.rollback()
+                            log.exception(f"Error guardando el estado de energía: {e}")
+
+                self._incr("written", written)
+                if self.after_flush and resolved:
+                    try:
+                        self.after_flush(cursor, conn, resolved)
+                    except Exception as e:
+                        conn.rollback()
+                        log.exception(f"Error en after_flush: {e}")
+        finally:
+            cursor.close()
+
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+        flush_seconds.observe(elapsed_ms / 1000)
+        batch_rows.observe(len(batch))
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["last_batch_size"] = len(batch)
+            self._stats["last_flush_ms"] = elapsed_ms
+
+    def _insert_one_by_one(self, conn, cursor, values) -> List[int]:
+        """Inserta fila por fila; devuelve los índices de las filas escritas."""
+        written = []
+        for i, v in enumerate(values):
+            try:
+                execute_values(cursor, INSERT_TELEMETRY_SQL, [v])
+                conn.commit()
+                written.append(i)
+            except Exception:
+                conn.rollback()
+                self._incr("failed")
+        return written
+
+
+def chain_hooks(*hooks: Callable) -> Callable:
+    """
+    Combina varios callbacks after_flush en uno. Cada uno corre en orden con su
+    propio manejo de errores: si uno falla se hace rollback y se sigue con el resto.
+    """
+    def after_flush(cursor, conn, rows):
+        for hook in hooks:
+            try:
+                hook(cursor, conn, rows)
+            except Exception as e:
+                conn.rollback()
+                log.exception(f"Error en after_flush {getattr(hook, '__qualname__', hook)}: {e}")
+    return after_flush
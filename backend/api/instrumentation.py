@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentación de la API en formato de exposición de Prometheus (texto 0.0.4).
+
+- Counter / Histogram: cada hilo escribe en su propio shard (threading.local),
+  sin locks en el camino caliente. El scrape suma todos los shards.
+  Cuando un hilo termina, su shard se pliega en un acumulado "retirado".
+- Gauge: función que se evalúa recién en el scrape (profundidad de colas,
+  clientes conectados, etc.), sin costo mientras nadie mira.
+- timed(hist, *labels): context manager para medir latencias en segundos.
+
+Se expone en /internal/metrics (ver app.py).
+"""
+import time
+import bisect
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+
+# Buckets por defecto (segundos): de 0.5 ms a 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v) -> str:
+    if isinstance(v, float):
+        if v == float("inf"):
+            return "+Inf"
+        return repr(v)
+    return str(v)
+
+
+class _Shard(dict):
+    """Valores de un hilo. Al liberarse (fin del hilo) se suma al acumulado."""
+    __slots__ = ("_owner", "__weakref__")
+
+    def __del__(self):
+        owner = self._owner
+        if owner is not None:
+            owner._retire(self)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: "weakref.WeakValueDictionary[int, _Shard]" = weakref.WeakValueDictionary()
+        self._retired: Dict[Labels, object] = {}
+        self._lock = threading.RLock()
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _Shard()
+            shard._owner = self
+            self._local.shard = shard
+            with self._lock:
+                self._shards[id(shard)] = shard
+        return shard
+
+    def _retire(self, shard: _Shard):
+        with self._lock:
+            for key, value in shard.items():
+                self._retired[key] = self._merge(self._retired.get(key), value)
+
+    def _collect(self) -> Dict[Labels, object]:
+        with self._lock:
+            total = {k: self._copy(v) for k, v in self._retired.items()}
+            shards = list(self._shards.values())
+        for shard in shards:
+            for key, value in shard.copy().items():
+                total[key] = self._merge(total.get(key), value)
+        return total
+
+    # Implementadas por cada tipo
+    def _merge(self, acc, value):
+        raise NotImplementedError
+
+    def _copy(self, value):
+        return value
+
+    def expose(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + n
+
+    def _merge(self, acc, value):
+        return value if acc is None else acc + value
+
+    def expose(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_value(v)}"
+                for k, v in sorted(self._collect().items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # [conteos por bucket (sin acumular)..., +Inf, suma]
+            cell = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[labels] = cell
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+    def _merge(self, acc, value):
+        if acc is None:
+            return list(value)
+        for i, v in enumerate(value):
+            acc[i] += v
+        return acc
+
+    def expose(self) -> List[str]:
+        out = []
+        for key, cell in sorted(self._collect().items()):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + (float("inf"),)):
+                cumulative += cell[i]
+                le = 'le="%s"' % _fmt_value(float(bound))
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {cumulative}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_value(float(cell[-1]))}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {cumulative}")
+        return out
+
+
+class Gauge:
+    """Valor calculado en el scrape: fn() -> número o {labels_tuple: número}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Callable, labelnames: Sequence[str] = (),
+                 kind: str = "gauge"):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def expose(self) -> List[str]:
+        value = self.fn()
+        if value is None:
+            return []
+        if not isinstance(value, dict):
+            return [f"{self.name} {_fmt_value(value)}"]
+        return [f"{self.name}{_fmt_labels(self.labelnames, k if isinstance(k, tuple) else (k,))} {_fmt_value(v)}"
+                for k, v in sorted(value.items())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name: str, help_text: str, fn: Callable, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help_text, fn, labelnames))
+
+    def counter_func(self, name: str, help_text: str, fn: Callable, labelnames: Sequence[str] = ()) -> Gauge:
+        """Contador que ya lleva otro componente (p. ej. stats de un hub), leído en el scrape."""
+        return self._add(Gauge(name, help_text, fn, labelnames, kind="counter"))
+
+    def expose(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for m in metrics:
+            try:
+                body = m.expose()
+            except Exception:
+                # Un gauge roto no debe romper el scrape completo
+                continue
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(body)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@contextmanager
+def timed(hist: Optional[Histogram], *labels):
+    """Observa en 'hist' la duración del bloque (también si lanza)."""
+    if hist is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        hist.observe(time.perf_counter() - t0, *labels)
+
+
+# Métricas compartidas entre módulos (ingest, alertas, consultas de app.py)
+pg_query_seconds = REGISTRY.histogram(
+    "iot_pg_query_seconds", "Latencia de consultas PostgreSQL por nombre", ("query",))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Estado en vivo por dispositivo (último valor de cada uno).
+
+- Un registro compacto e inmutable por dispositivo (NamedTuple), indexado por código.
+- El hilo MQTT reemplaza el registro completo del dispositivo; nunca se modifica
+  un registro publicado, así que los lectores no necesitan lock.
+- Cada actualización incrementa una versión global; cada registro guarda la
+  versión en que cambió. Con eso salen el ETag de /metrics/all y las consultas
+  incrementales ?since=<version>.
+- Long-polling: los lectores pueden esperar a que la versión supere 'since'.
+"""
+import json
+import threading
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+
+class DeviceState(NamedTuple):
+    version: int
+    ts: Optional[int]
+    device: Optional[str]
+    vrms: Optional[float]
+    irms: Optional[float]
+    s_apparent_va: Optional[float]
+    potencia_activa: Optional[float]
+    factor_potencia: Optional[float]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+class LiveState:
+    def __init__(self):
+        self._records: Dict[str, DeviceState] = {}
+        self._version = 0
+        self._latest: Optional[DeviceState] = None
+        self._write_lock = threading.Lock()
+        self._cond = threading.Condition(threading.Lock())
+        self._waiters = 0
+        # Cache de la serialización completa de la flota (por versión)
+        self._fleet_cache: Tuple[int, Optional[str]] = (-1, None)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    # ---------- Escritura (hilo MQTT) ----------
+    def update(self, code: str, ts, vrms, irms, s_apparent_va, potencia_activa, factor_potencia) -> DeviceState:
+        with self._write_lock:
+            version = self._version + 1
+            rec = DeviceState(version, ts, code, vrms, irms, s_apparent_va, potencia_activa, factor_potencia)
+            # Asignación atómica bajo el GIL: un lector ve el registro viejo o el nuevo
+            self._records[code] = rec
+            self._latest = rec
+            self._version = version
+        if self._waiters:
+            with self._cond:
+                self._cond.notify_all()
+        return rec
+
+    # ---------- Lectura (sin lock) ----------
+    def get(self, code: str) -> Optional[DeviceState]:
+        return self._records.get(code)
+
+    def latest(self) -> Optional[DeviceState]:
+        return self._latest
+
+    def snapshot(self) -> Tuple[int, Dict[str, DeviceState]]:
+        """(versión, copia del índice). dict.copy() es atómico con claves str."""
+        version = self._version
+        return version, self._records.copy()
+
+    def fleet_json(self) -> Tuple[int, str]:
+        """JSON de toda la flota, serializado una sola vez por versión."""
+        cached_version, body = self._fleet_cache
+        version, records = self.snapshot()
+        if cached_version == version and body is not None:
+            return version, body
+        # La versión del snapshot puede ser menor que la de algún registro copiado
+        version = max([version] + [r.version for r in records.values()])
+        body = json.dumps({
+            "version": version,
+            "devices": {code: rec.to_dict() for code, rec in records.items()},
+        })
+        self._fleet_cache = (version, body)
+        return version, body
+
+    def changed_since(self, since: int) -> Tuple[int, Dict[str, Dict[str, Any]]]:
+        version, records = self.snapshot()
+        changed = {code: rec.to_dict() for code, rec in records.items() if rec.version > since}
+        if changed:
+            version = max(version, max(r["version"] for r in changed.values()))
+        return version, changed
+
+    def wait_for_change(self, since: int, timeout: float) -> bool:
+        """Bloquea hasta que la versión supere 'since' o venza el timeout."""
+        if self._version > since:
+            return True
+        with self._cond:
+            self._waiters += 1
+            try:
+                return self._cond.wait_for(lambda: self._version > since, timeout)
+            finally:
+                self._waiters -= 1
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Estado de conexión de los dispositivos (online / offline) en vivo.
+
+Fuentes:
+- lecturas (esp/energia/<code>/state): el dispositivo está vivo; cada una solo
+  actualiza su last_seen (O(1), sin tocar la rueda).
+- Last Will (esp/energia/<code>/status, "online" / "offline" o {"status": ...}):
+  cambio inmediato de estado.
+- timeout: sin lecturas durante LIVENESS_TIMEOUT_S -> offline.
+
+Los vencimientos están en una rueda de timers con hash (TimerWheel): un slot por
+tick de LIVENESS_TICK_S, cada dispositivo a lo sumo una vez en la rueda. Al vencer
+su slot se mira el last_seen real: si hubo lecturas se vuelve a agendar en
+last_seen + timeout, si no pasa a offline. Cada tick cuesta lo que vence en él, no
+la cantidad de dispositivos.
+
+Cada cambio de estado se entrega a on_change (app.py lo publica en SSE/WS con el
+tópico liveness/<code>) y se guarda en device_liveness_events desde el hilo del
+watchdog, en lotes, sin bloquear al hilo MQTT. Al arrancar se retoma el último
+estado guardado de cada dispositivo (load), así los Last Will retenidos que
+reenvía el broker no se registran otra vez.
+"""
+import os
+import math
+import time
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from psycopg2.extras import execute_values
+
+from hotlog import get_logger
+from instrumentation import REGISTRY, pg_query_seconds, timed
+
+log = get_logger("liveness")
+
+LIVENESS_TIMEOUT_S = float(os.getenv("LIVENESS_TIMEOUT_S", "60"))
+LIVENESS_TICK_S = float(os.getenv("LIVENESS_TICK_S", "1"))
+LIVENESS_WHEEL_SLOTS = int(os.getenv("LIVENESS_WHEEL_SLOTS", "512"))
+
+ONLINE, OFFLINE = "online", "offline"
+
+liveness_changes = REGISTRY.counter(
+    "iot_liveness_changes_total", "Cambios de estado de conexión por estado y causa", ("status", "reason"))
+
+# Resuelve el código en la base: eventos de dispositivos desconocidos no se guardan
+INSERT_EVENTS_SQL = """
+    INSERT INTO device_liveness_events (device_id, status, reason, at, last_seen)
+    SELECT d.id, v.status, v.reason, v.at, v.last_seen
+    FROM (VALUES %s) AS v(code, status, reason, at, last_seen)
+    JOIN devices d ON d.code = v.code
+"""
+# Último estado guardado de cada dispositivo (al arrancar)
+LAST_STATE_SQL = """
+    SELECT DISTINCT ON (e.device_id) d.code, e.status, e.reason,
+           (EXTRACT(EPOCH FROM e.at) * 1000)::bigint, (EXTRACT(EPOCH FROM e.last_seen) * 1000)::bigint
+    FROM device_liveness_events e
+    JOIN devices d ON d.id = e.device_id
+    WHERE d.code IS NOT NULL
+    ORDER BY e.device_id, e.at DESC
+"""
+_INSERT_TEMPLATE = ("(%s, %s, %s, to_timestamp(%s / 1000.0) AT TIME ZONE 'UTC', "
+                    "to_timestamp(%s / 1000.0) AT TIME ZONE 'UTC')")
+
+
+class TimerWheel:
+    """
+    Rueda de timers con hash: slots de tick_s segundos; cada entrada guarda su tick
+    de vencimiento. Con slots * tick_s mayor que el timeout más largo, todo lo que
+    hay en un slot vence en esa vuelta.
+    """
+
+    def __init__(self, tick_s: float, slots: int, now: float):
+        self.tick_s = tick_s
+        self._slots: List[List[tuple]] = [[] for _ in range(max(2, slots))]
+        self._current = int(now // tick_s)
+        self.size = 0
+
+    def schedule(self, key: Hashable, deadline: float):
+        tick = max(math.ceil(deadline / self.tick_s), self._current + 1)
+        self._slots[tick % len(self._slots)].append((tick, key))
+        self.size += 1
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Claves vencidas hasta 'now' (recorre solo los slots de los ticks transcurridos)."""
+        target = int(now // self.tick_s)
+        n = len(self._slots)
+        expired = []
+        for step in range(1, min(target - self._current, n) + 1):
+            i = (self._current + step) % n
+            slot = self._slots[i]
+            if not slot:
+                continue
+            keep = [entry for entry in slot if entry[0] > target]
+            if len(keep) != len(slot):
+                expired.extend(key for tick, key in slot if tick <= target)
+                self._slots[i] = keep
+        self._current = max(self._current, target)
+        self.size -= len(expired)
+        return expired
+
+
+class _Device:
+    __slots__ = ("status", "reason", "since", "last_seen", "last_seen_ms", "armed")
+
+    def __init__(self):
+        self.status: Optional[str] = None
+        self.reason: Optional[str] = None
+        self.since: Optional[int] = None        # ms del último cambio de estado
+        self.last_seen = 0.0                    # monotónico
+        self.last_seen_ms: Optional[int] = None
+        self.armed = False                      # está en la rueda
+
+
+def parse_status(payload) -> Optional[str]:
+    """'online' / 'offline' de un mensaje de estado (texto o {"status": ...})."""
+    if isinstance(payload, dict):
+        payload = payload.get("status")
+    if isinstance(payload, str) and payload.strip().lower() in (ONLINE, OFFLINE):
+        return payload.strip().lower()
+    return None
+
+
+class LivenessTracker:
+    """
+    Parámetros:
+    - pool: ConnectionPool para guardar los eventos (None = no se guardan)
+    - on_change: callback(evento) en cada cambio de estado; se llama sin locks tomados
+    """
+
+    def __init__(self, pool=None, on_change: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 timeout_s: float = LIVENESS_TIMEOUT_S, tick_s: float = LIVENESS_TICK_S,
+                 slots: int = LIVENESS_WHEEL_SLOTS, clock: Callable[[], float] = time.monotonic):
+        self._pool = pool
+        self.on_change = on_change
+        self.timeout_s = timeout_s
+        self.tick_s = tick_s
+        self._clock = clock
+        # Una vuelta de la rueda tiene que cubrir el timeout
+        slots = max(slots, math.ceil(timeout_s / tick_s) + 2)
+        self._wheel = TimerWheel(tick_s, slots, clock())
+        self._devices: Dict[str, _Device] = {}
+        self._lock = threading.Lock()
+        self._pending: deque = deque(maxlen=100000)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"seen": 0, "status_messages": 0, "ticks": 0, "expired": 0, "rearmed": 0,
+                      "recorded": 0, "record_failed": 0, "record_dropped": 0}
+
+    # ---------- Entradas (hilo MQTT) ----------
+    def seen(self, code: str, ts_ms: Optional[int] = None):
+        """Llegó una lectura del dispositivo."""
+        now = self._clock()
+        event = None
+        with self._lock:
+            dev = self._devices.get(code)
+            if dev is None:
+                dev = self._devices[code] = _Device()
+            dev.last_seen = now
+            dev.last_seen_ms = ts_ms if ts_ms is not None else int(time.time() * 1000)
+            if not dev.armed:
+                self._wheel.schedule(code, now + self.timeout_s)
+                dev.armed = True
+            if dev.status != ONLINE:
+                event = self._change(code, dev, ONLINE, "data")
+            self.stats["seen"] += 1
+        if event:
+            self._emit(event)
+
+    def status(self, code: str, status: str):
+        """Mensaje de estado (Last Will u 'online' al conectar)."""
+        now = self._clock()
+        event = None
+        with self._lock:
+            self.stats["status_messages"] += 1
+            dev = self._devices.get(code)
+            if dev is None:
+                dev = self._devices[code] = _Device()
+            if status == ONLINE:
+                dev.last_seen = now
+                if not dev.armed:
+                    self._wheel.schedule(code, now + self.timeout_s)
+                    dev.armed = True
+            if dev.status != status:
+                event = self._change(code, dev, status, "lwt")
+        if event:
+            self._emit(event)
+
+    # ---------- Watchdog ----------
+    def tick(self) -> int:
+        """Procesa los vencimientos hasta ahora; devuelve cuántos dispositivos pasaron a offline."""
+        now = self._clock()
+        events = []
+        with self._lock:
+            expired = self._wheel.advance(now)
+            self.stats["ticks"] += 1
+            self.stats["expired"] += len(expired)
+            for code in expired:
+                dev = self._devices[code]
+                dev.armed = False
+                if dev.status == OFFLINE:
+                    continue
+                deadline = dev.last_seen + self.timeout_s
+                if deadline > now:
+                    # Hubo lecturas desde que se agendó: volver a agendar
+                    self._wheel.schedule(code, deadline)
+                    dev.armed = True
+                    self.stats["rearmed"] += 1
+                    continue
+                events.append(self._change(code, dev, OFFLINE, "timeout"))
+        for event in events:
+            self._emit(event)
+        return len(events)
+
+    def start(self):
+        """Retoma el estado guardado (antes de que lleguen los Last Will retenidos) y arranca el watchdog."""
+        if self._pool is not None:
+            try:
+                log.info(f"Estado de conexión retomado de {self.load()} dispositivos")
+            except Exception as e:
+                log.warning(f"No se pudo leer device_liveness_events: {e}")
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="liveness-watchdog", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def load(self) -> int:
+        """
+        Retoma el último estado guardado de cada dispositivo: así un Last Will retenido que
+        llega al suscribirse no se registra de nuevo, y los que estaban online vencen si no
+        vuelven a mandar lecturas.
+        """
+        with self._pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                with timed(pg_query_seconds, "liveness_last_state"):
+                    cursor.execute(LAST_STATE_SQL)
+                    rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        now = self._clock()
+        with self._lock:
+            for code, status, reason, since, last_seen in rows:
+                if code in self._devices:
+                    continue  # ya hubo mensajes desde que arrancó
+                dev = self._devices[code] = _Device()
+                dev.status, dev.reason, dev.since, dev.last_seen_ms = status, reason, since, last_seen
+                if status == ONLINE:
+                    dev.last_seen = now
+                    self._wheel.schedule(code, now + self.timeout_s)
+                    dev.armed = True
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.wait(self.tick_s):
+            try:
+                self.tick()
+                self.flush()
+            except Exception as e:
+                log.exception(f"Error en el watchdog de conexión: {e}")
+
+    # ---------- Eventos ----------
+    def _change(self, code: str, dev: _Device, status: str, reason: str) -> Dict[str, Any]:
+        """Aplica el cambio (con _lock tomado) y arma el evento."""
+        now_ms = int(time.time() * 1000)
+        dev.status, dev.reason, dev.since = status, reason, now_ms
+        return {"device": code, "status": status, "reason": reason, "ts": now_ms,
+                "last_seen": dev.last_seen_ms}
+
+    def _emit(self, event: Dict[str, Any]):
+        liveness_changes.inc(event["status"], event["reason"])
+        if self._pool is not None:
+            with self._lock:
+                if len(self._pending) == self._pending.maxlen:
+                    # La base no responde hace rato: la cola descarta el evento más viejo
+                    self.stats["record_dropped"] += 1
+                self._pending.append(event)
+        if self.on_change:
+            try:
+                self.on_change(event)
+            except Exception as e:
+                log.warning(f"Error publicando cambio de conexión: {e}")
+
+    def flush(self) -> int:
+        """Guarda los eventos pendientes en device_liveness_events (un INSERT por lote)."""
+        if not self._pending:
+            return 0
+        batch = []
+        while self._pending:
+            batch.append(self._pending.popleft())
+        values = [(e["device"], e["status"], e["reason"], e["ts"],
+                   e["last_seen"] if e["last_seen"] is not None else e["ts"]) for e in batch]
+        try:
+            with self._pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    with timed(pg_query_seconds, "liveness_insert_events"):
+                        execute_values(cursor, INSERT_EVENTS_SQL, values, template=_INSERT_TEMPLATE)
+                        conn.commit()
+                finally:
+                    cursor.close()
+        except Exception as e:
+            self.stats["record_failed"] += len(batch)
+            log.warning(f"No se pudieron guardar {len(batch)} eventos de conexión: {e}")
+            return 0
+        self.stats["recorded"] += len(batch)
+        return len(batch)
+
+    # ---------- Lectura ----------
+    def get(self, code: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            dev = self._devices.get(code)
+            return self._as_dict(code, dev) if dev is not None else None
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self._as_dict(code, dev) for code, dev in self._devices.items()]
+
+    @staticmethod
+    def _as_dict(code: str, dev: _Device) -> Dict[str, Any]:
+        return {"device": code, "status": dev.status, "reason": dev.reason, "since": dev.since,
+                "last_seen": dev.last_seen_ms}
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            online = sum(1 for d in self._devices.values() if d.status == ONLINE)
+            offline = sum(1 for d in self._devices.values() if d.status == OFFLINE)
+            out = dict(self.stats, devices=len(self._devices), online=online, offline=offline,
+                       unknown=len(self._devices) - online - offline, wheel_entries=self._wheel.size)
+        out.update(timeout_s=self.timeout_s, tick_s=self.tick_s, pending=len(self._pending))
+        return out
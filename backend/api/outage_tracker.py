@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Cortes de luz y períodos sin datos detectados en la ingesta (tabla power_outages).
+
+OutageTracker.process_batch es un callback after_flush del TelemetryWriter. Por
+cada dispositivo del lote retoma su estado de device_outage_state (bloqueado con
+FOR UPDATE en orden de device_id, como energy.py), pasa las lecturas nuevas en
+orden de tiempo por un OutageDetector (las reglas de /metrics/power-outages con
+OUTAGE_MIN_VOLTAGE y OUTAGE_MAX_GAP_MINUTES) y, en una transacción:
+
+- cierra la fila abierta (end_at NULL) si el corte en curso terminó;
+- inserta los eventos cerrados del lote (power_outage y no_data) y, si quedó un
+  corte en curso, su fila abierta;
+- guarda el estado: última lectura, último punto fuera de corte y el corte en
+  curso (inicio, última lectura, min/max, puntos). Tamaño fijo por dispositivo.
+
+Una lectura con created_at anterior a la última procesada se ignora.
+
+read() es la lectura de /metrics/power-outages: range scan sobre
+(device_id, start_at), con el corte en curso completado desde device_outage_state.
+tracked_since es desde cuándo hay eventos del dispositivo; antes de eso el
+endpoint detecta sobre las lecturas.
+"""
+import os
+from datetime import datetime, timezone
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from energy import naive_utc
+from ingest import COL_CREATED_AT, COL_DEVICE_ID, COL_VOLTAJE
+from instrumentation import REGISTRY, pg_query_seconds, timed
+from outages import EXPECTED_INTERVAL_MS, OutageDetector, gap_event, outage_event
+
+OUTAGE_MIN_VOLTAGE = float(os.getenv("OUTAGE_MIN_VOLTAGE", "50"))
+OUTAGE_MAX_GAP_MINUTES = int(os.getenv("OUTAGE_MAX_GAP_MINUTES", "10"))
+
+outage_events = REGISTRY.counter(
+    "iot_outage_events_total", "Eventos de power_outages escritos por la ingesta", ("type",))
+
+LOCK_STATE_SQL = """
+    SELECT device_id, tracked_since, last_at, outside_at,
+           outage_start, outage_last, outage_min, outage_max, outage_points
+    FROM device_outage_state
+    WHERE device_id = ANY(%s)
+    ORDER BY device_id
+    FOR UPDATE
+"""
+
+SAVE_STATE_SQL = """
+    INSERT INTO device_outage_state (device_id, tracked_since, last_at, outside_at,
+                                     outage_start, outage_last, outage_min, outage_max, outage_points)
+    VALUES %s
+    ON CONFLICT (device_id) DO UPDATE SET
+        last_at = EXCLUDED.last_at,
+        outside_at = EXCLUDED.outside_at,
+        outage_start = EXCLUDED.outage_start,
+        outage_last = EXCLUDED.outage_last,
+        outage_min = EXCLUDED.outage_min,
+        outage_max = EXCLUDED.outage_max,
+        outage_points = EXCLUDED.outage_points,
+        updated_at = NOW()
+"""
+
+CLOSE_OPEN_SQL = """
+    UPDATE power_outages o
+    SET end_at = v.end_at, min_voltage = v.min_voltage, max_voltage = v.max_voltage,
+        data_points = v.data_points
+    FROM (VALUES %s) AS v(device_id, end_at, min_voltage, max_voltage, data_points)
+    WHERE o.device_id = v.device_id AND o.end_at IS NULL
+"""
+
+INSERT_EVENTS_SQL = """
+    INSERT INTO power_outages (device_id, type, start_at, end_at, min_voltage, max_voltage, data_points)
+    VALUES %s
+"""
+
+# El corte abierto toma el fin y las estadísticas del estado del dispositivo
+READ_SQL = """
+    SELECT o.type,
+           (EXTRACT(EPOCH FROM o.start_at) * 1000)::bigint,
+           (EXTRACT(EPOCH FROM COALESCE(o.end_at, s.outage_last, o.start_at)) * 1000)::bigint,
+           COALESCE(s.outage_min, o.min_voltage),
+           COALESCE(s.outage_max, o.max_voltage),
+           COALESCE(s.outage_points, o.data_points)
+    FROM power_outages o
+    LEFT JOIN device_outage_state s ON s.device_id = o.device_id AND o.end_at IS NULL
+    WHERE o.device_id = %(device_id)s
+      AND o.start_at <= %(end)s
+      AND COALESCE(o.end_at, s.outage_last, o.start_at) >= %(start)s
+    ORDER BY o.start_at
+"""
+
+
+def _ms(at: Optional[datetime]) -> Optional[int]:
+    """TIMESTAMP (UTC sin zona) -> epoch en ms."""
+    return None if at is None else int(at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _at(ts_ms: Optional[int]) -> Optional[datetime]:
+    return None if ts_ms is None else datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def _event_row(device_id: int, event: Dict[str, Any]) -> tuple:
+    if event["type"] == "power_outage":
+        return (device_id, "power_outage", _at(event["start_ts"]), _at(event["end_ts"]),
+                event["min_voltage"], event["max_voltage"], event["data_points"])
+    return (device_id, "no_data", _at(event["start_ts"]), _at(event["end_ts"]), None, None, None)
+
+
+class OutageTracker:
+    def __init__(self, min_voltage: float = OUTAGE_MIN_VOLTAGE, max_gap_minutes: int = OUTAGE_MAX_GAP_MINUTES,
+                 expected_interval_ms: int = EXPECTED_INTERVAL_MS):
+        self.min_voltage = min_voltage
+        self.max_gap_minutes = max_gap_minutes
+        self.expected_interval_ms = expected_interval_ms
+        self.stats = {"batches": 0, "readings": 0, "out_of_order": 0, "opened": 0, "closed": 0, "gaps": 0}
+
+    def matches(self, min_voltage: float, max_gap_minutes: float) -> bool:
+        """Si los eventos guardados valen para estos parámetros del endpoint."""
+        return min_voltage == self.min_voltage and max_gap_minutes == self.max_gap_minutes
+
+    def process_batch(self, cursor, conn, rows) -> int:
+        """Callback after_flush: avanza el estado de los dispositivos del lote; devuelve los eventos escritos."""
+        readings: Dict[int, List[Tuple[int, Optional[float]]]] = {}
+        for _, values, _ in rows:
+            device_id, created_at = values[COL_DEVICE_ID], values[COL_CREATED_AT]
+            if device_id is None or created_at is None:
+                continue
+            v = values[COL_VOLTAJE]
+            readings.setdefault(device_id, []).append(
+                (_ms(naive_utc(created_at)), None if v is None else float(v)))
+        if not readings:
+            return 0
+
+        device_ids = sorted(readings)
+        with timed(pg_query_seconds, "outages_lock_state"):
+            cursor.execute(LOCK_STATE_SQL, (device_ids,))
+            state = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        closes, inserts, saves = [], [], []
+        for device_id in device_ids:
+            tracked_since, last_at, outside_at, o_start, o_last, o_min, o_max, o_points = \
+                state.get(device_id, (None,) * 8)
+            detector = OutageDetector(self.min_voltage, self.max_gap_minutes, self.expected_interval_ms)
+            open_before = o_start is not None
+            detector.restore((_ms(o_start), _ms(o_last), o_min, o_max, o_points) if open_before else None,
+                             _ms(outside_at))
+            last_ms = _ms(last_at)
+            for ts, v in sorted(readings[device_id], key=itemgetter(0)):
+                if last_ms is not None and ts <= last_ms:
+                    self.stats["out_of_order"] += 1
+                    continue
+                if tracked_since is None:
+                    tracked_since = _at(ts)
+                detector.feed(ts, v)
+                last_ms = ts
+                self.stats["readings"] += 1
+
+            for event in detector.drain():
+                if open_before and event["type"] == "power_outage":
+                    # El primer corte cerrado es el que estaba abierto: se completa su fila
+                    closes.append((device_id, _at(event["end_ts"]), event["min_voltage"],
+                                   event["max_voltage"], event["data_points"]))
+                    open_before = False
+                else:
+                    inserts.append(_event_row(device_id, event))
+            outage, prev_ts = detector.state()
+            if outage is not None and not open_before:
+                inserts.append((device_id, "power_outage", _at(outage[0]), None,
+                                round(outage[2], 2), round(outage[3], 2), outage[4]))
+                self.stats["opened"] += 1
+            if outage is None:
+                outage = (None,) * 5
+            saves.append((device_id, tracked_since, _at(last_ms), _at(prev_ts),
+                          _at(outage[0]), _at(outage[1]), outage[2], outage[3], outage[4]))
+
+        with timed(pg_query_seconds, "outages_write_batch"):
+            # Primero los cierres: el índice único admite una sola fila abierta por dispositivo
+            if closes:
+                execute_values(cursor, CLOSE_OPEN_SQL, closes)
+            if inserts:
+                execute_values(cursor, INSERT_EVENTS_SQL, inserts, page_size=len(inserts))
+            execute_values(cursor, SAVE_STATE_SQL, saves, page_size=len(saves))
+            conn.commit()
+
+        closed = len(closes) + sum(1 for r in inserts if r[1] == "power_outage" and r[3] is not None)
+        gaps = sum(1 for r in inserts if r[1] == "no_data")
+        if closed:
+            outage_events.inc("power_outage", n=closed)
+        if gaps:
+            outage_events.inc("no_data", n=gaps)
+        self.stats["closed"] += closed
+        self.stats["gaps"] += gaps
+        self.stats["batches"] += 1
+        return closed + gaps
+
+    def read(self, cursor, device_id: int, start: datetime, end: datetime, device="UNKNOWN",
+             full: bool = True) -> Optional[List[Dict[str, Any]]]:
+        """
+        Eventos que se superponen con [start, end], en el formato de detect_outages. Con
+        full=True devuelve None si el dispositivo no tiene eventos guardados desde start.
+        """
+        start, end = naive_utc(start), naive_utc(end)
+        cursor.execute("SELECT tracked_since FROM device_outage_state WHERE device_id = %s", (device_id,))
+        row = cursor.fetchone()
+        if full and (row is None or row[0] > start):
+            return None
+        with timed(pg_query_seconds, "power_outages_read"):
+            cursor.execute(READ_SQL, {"device_id": device_id, "start": start, "end": end})
+            rows = cursor.fetchall()
+        events = []
+        for kind, start_ts, end_ts, vmin, vmax, count in rows:
+            if kind == "power_outage":
+                events.append(outage_event(start_ts, end_ts, vmin, vmax, count, device))
+            else:
+                events.append(gap_event(start_ts, end_ts, device))
+        return events
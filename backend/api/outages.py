@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Detección de cortes de luz y períodos sin datos sobre una serie ordenada por tiempo.
+
+OutageDetector procesa los puntos de a uno (feed) y emite cada evento en cuanto
+se cierra, así /metrics/power-outages puede consumir las filas directamente del
+cursor sin juntar toda la serie en memoria. Las reglas son las de siempre:
+
+- power_outage: racha de puntos con vrms < min_voltage. Los puntos sin vrms
+  dentro de la racha se absorben mientras no se supere el gap máximo (medido
+  desde el inicio del corte); termina con un punto con voltaje normal o un gap.
+- no_data: entre un punto fuera de corte y el siguiente pasan más de
+  expected_interval_ms * max_gap_minutes.
+
+detect_outages() aplica las mismas reglas sobre arrays columnares (ts, vrms con
+NaN = sin dato) con máscaras y runs de NumPy: el trabajo en Python es por evento,
+no por punto. ColumnarOutageDetector junta los bloques del cursor en arrays
+(16 bytes por punto) y es lo que usa /metrics/power-outages; OutageDetector queda
+como referencia (y para el benchmark, backend/bench/bench_outages.py).
+
+detect_outages_sql() hace la detección en PostgreSQL (gaps-and-islands con
+funciones de ventana sobre (device_id, created_at)) y solo trae los intervalos:
+lo transferido depende de la cantidad de eventos, no de puntos. Única diferencia
+con OutageDetector: si un corte se parte por una lectura sin voltaje más allá del
+gap máximo, las lecturas sin voltaje siguientes de la misma racha (sin una normal
+en el medio) ya no se absorben; cada tramo de lecturas bajas es un corte aparte.
+"""
+from datetime import datetime, timezone
+from operator import itemgetter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from instrumentation import pg_query_seconds, timed
+
+# Intervalo esperado entre mediciones: 1 minuto
+EXPECTED_INTERVAL_MS = 60000
+
+# mode= de /metrics/power-outages
+OUTAGE_MODES = ("auto", "table", "sql", "stream")
+
+
+def format_duration(seconds):
+    """Formatea una duración en segundos a formato legible"""
+    if seconds < 60:
+        return f"{int(seconds)}s"
+    elif seconds < 3600:
+        minutes = int(seconds / 60)
+        secs = int(seconds % 60)
+        return f"{minutes}m {secs}s"
+    else:
+        hours = int(seconds / 3600)
+        minutes = int((seconds % 3600) / 60)
+        secs = int(seconds % 60)
+        return f"{hours}h {minutes}m {secs}s"
+
+
+def _iso(ts_ms) -> str:
+    return datetime.fromtimestamp(ts_ms / 1000, tz=timezone.utc).isoformat()
+
+
+def outage_event(start_ts, end_ts, vmin, vmax, count, device) -> Dict[str, Any]:
+    duration_seconds = (end_ts - start_ts) / 1000
+    return {
+        "type": "power_outage",
+        "start": _iso(start_ts),
+        "end": _iso(end_ts),
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+        "duration_seconds": duration_seconds,
+        "duration_formatted": format_duration(duration_seconds),
+        "min_voltage": round(vmin, 2),
+        "max_voltage": round(vmax, 2),
+        "data_points": count,
+        "device": device,
+    }
+
+
+def gap_event(start_ts, end_ts, device) -> Dict[str, Any]:
+    gap_seconds = (end_ts - start_ts) / 1000
+    return {
+        "type": "no_data",
+        "start": _iso(start_ts),
+        "end": _iso(end_ts),
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+        "duration_seconds": gap_seconds,
+        "duration_formatted": format_duration(gap_seconds),
+        "gap_minutes": round(gap_seconds / 60, 1),
+        "device": device,
+    }
+
+
+class OutageDetector:
+    def __init__(self, min_voltage: float = 50, max_gap_minutes: float = 10,
+                 expected_interval_ms: int = EXPECTED_INTERVAL_MS):
+        self.min_voltage = min_voltage
+        self.max_gap_ms = expected_interval_ms * max_gap_minutes
+        self.events: List[Dict[str, Any]] = []
+        self.points = 0
+        # Corte en curso: [start_ts, last_ts, vmin, vmax, count, device]
+        self._outage: Optional[list] = None
+        # Último punto fuera de corte (candidato a inicio de un gap): (ts, device)
+        self._prev: Optional[tuple] = None
+
+    def feed(self, ts, vrms, device="UNKNOWN"):
+        """Procesa el siguiente punto (ts en ms, en orden creciente)."""
+        self.points += 1
+        ts = ts or 0
+        low = vrms is not None and vrms < self.min_voltage
+        outage = self._outage
+        if outage is not None:
+            if low:
+                outage[1] = ts
+                outage[2] = min(outage[2], vrms)
+                outage[3] = max(outage[3], vrms)
+                outage[4] += 1
+                return
+            if ts - outage[0] <= self.max_gap_ms and vrms is None:
+                # Punto sin voltaje dentro del corte: se absorbe
+                outage[1] = ts
+                return
+            self._close_outage()
+
+        prev = self._prev
+        if prev is not None and ts - prev[0] > self.max_gap_ms:
+            self.events.append(gap_event(prev[0], ts, prev[1]))
+        if low:
+            self._outage = [ts, ts, vrms, vrms, 1, device]
+            self._prev = None
+        else:
+            self._prev = (ts, device)
+
+    def restore(self, outage: Optional[Sequence] = None, prev_ts: Optional[int] = None, device="UNKNOWN"):
+        """Retoma un estado guardado con state(); prev_ts solo cuenta si no hay corte en curso."""
+        self._outage = [*outage, device] if outage is not None else None
+        self._prev = (prev_ts, device) if prev_ts is not None and outage is None else None
+
+    def state(self) -> Tuple[Optional[tuple], Optional[int]]:
+        """(corte en curso (start_ts, last_ts, vmin, vmax, count) o None, ts del último punto fuera de corte o None)."""
+        outage = tuple(self._outage[:5]) if self._outage is not None else None
+        return outage, (self._prev[0] if self._prev is not None else None)
+
+    def drain(self) -> List[Dict[str, Any]]:
+        """Eventos cerrados desde la última llamada; el corte en curso sigue abierto."""
+        events, self.events = self.events, []
+        return events
+
+    def _close_outage(self):
+        start_ts, last_ts, vmin, vmax, count, device = self._outage
+        self.events.append(outage_event(start_ts, last_ts, vmin, vmax, count, device))
+        self._outage = None
+
+    def finish(self) -> List[Dict[str, Any]]:
+        """Cierra un corte abierto al final de la serie y devuelve todos los eventos."""
+        if self._outage is not None:
+            self._close_outage()
+        return self.events
+
+
+def _next_true(mask: np.ndarray) -> np.ndarray:
+    """nxt[i] = primer j >= i con mask[j] (len(mask) si no hay); nxt tiene len(mask) + 1 elementos."""
+    n = len(mask)
+    idx = np.where(mask, np.arange(n), n)
+    return np.append(np.minimum.accumulate(idx[::-1])[::-1], n)
+
+
+def detect_outages(ts: np.ndarray, vrms: np.ndarray, device="UNKNOWN", min_voltage: float = 50,
+                   max_gap_minutes: float = 10,
+                   expected_interval_ms: int = EXPECTED_INTERVAL_MS) -> List[Dict[str, Any]]:
+    """
+    Los mismos eventos, en el mismo orden, que OutageDetector sobre la serie
+    (ts en ms ordenado, vrms con NaN donde no hay voltaje).
+    """
+    ts = np.asarray(ts, dtype=np.int64)
+    vrms = np.asarray(vrms, dtype=np.float64)
+    n = len(ts)
+    if n == 0:
+        return []
+    max_gap_ms = expected_interval_ms * max_gap_minutes
+    low = vrms < min_voltage            # NaN -> False
+    missing = np.isnan(vrms)
+    next_low = _next_true(low)
+    next_normal = _next_true(~low & ~missing)
+    next_missing = _next_true(missing)
+
+    # Cortes: desde un punto bajo hasta el primer punto normal, o el primer punto sin
+    # voltaje más allá del gap máximo desde el inicio (los anteriores se absorben).
+    # Un evento se emite al procesar el punto que lo cierra (e; n = al final).
+    emitted = []
+    starts, ends = [], []
+    i = next_low[0]
+    while i < n:
+        limit = np.searchsorted(ts, ts[i] + max_gap_ms, side="right")
+        e = min(next_normal[i + 1], next_missing[max(limit, i + 1)])
+        lows = low[i:e]
+        values = vrms[i:e][lows]
+        emitted.append((e, outage_event(int(ts[i]), int(ts[e - 1]), float(values.min()), float(values.max()),
+                                        int(lows.sum()), device)))
+        starts.append(i)
+        ends.append(e)
+        i = next_low[e]
+
+    # Gaps: pares consecutivos (i, i + 1) con i fuera de un corte (i + 1 puede abrir uno)
+    inside = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(inside, starts, 1)
+    np.add.at(inside, ends, -1)
+    outside = np.cumsum(inside[:n]) == 0
+    for i in np.nonzero(outside[:-1] & (np.diff(ts) > max_gap_ms))[0].tolist():
+        emitted.append((i + 1, gap_event(int(ts[i]), int(ts[i + 1]), device)))
+
+    emitted.sort(key=lambda item: item[0])
+    return [event for _, event in emitted]
+
+
+class ColumnarOutageDetector:
+    """Junta bloques de filas (ts, vrms, ...) en arrays y detecta al final con detect_outages()."""
+
+    def __init__(self, min_voltage: float = 50, max_gap_minutes: float = 10,
+                 expected_interval_ms: int = EXPECTED_INTERVAL_MS):
+        self.min_voltage = min_voltage
+        self.max_gap_minutes = max_gap_minutes
+        self.expected_interval_ms = expected_interval_ms
+        self.device = "UNKNOWN"
+        self.points = 0
+        self._ts: List[np.ndarray] = []
+        self._vrms: List[np.ndarray] = []
+
+    def feed_chunk(self, rows: Sequence[tuple], device=None):
+        """Filas con ts en la columna 0 y vrms en la 1 (None -> NaN), en orden de tiempo."""
+        if not rows:
+            return
+        n = len(rows)
+        self._ts.append(np.fromiter(map(itemgetter(0), rows), dtype=np.int64, count=n))
+        self._vrms.append(np.fromiter(map(itemgetter(1), rows), dtype=np.float64, count=n))
+        self.points += n
+        if device is not None:
+            self.device = device
+
+    def finish(self) -> List[Dict[str, Any]]:
+        if not self._ts:
+            return []
+        ts, vrms = np.concatenate(self._ts), np.concatenate(self._vrms)
+        self._ts, self._vrms = [], []
+        return detect_outages(ts, vrms, self.device, self.min_voltage, self.max_gap_minutes,
+                              self.expected_interval_ms)
+
+
+# Gaps-and-islands sobre las lecturas del rango, todas las ventanas en orden de
+# created_at (el del índice: sin sort). Por fila:
+#   lows            lecturas bajas hasta la fila
+#   lows_before_run lecturas bajas hasta la última normal (la racha actual empieza después)
+#   run_start       ts de la primera lectura baja de la racha más reciente
+#   inside          baja, o sin voltaje a no más de gap_ms del inicio de la racha
+#   island          lecturas fuera de corte hasta la fila: constante en cada corte
+OUTAGES_SQL = """
+WITH r AS (
+    SELECT created_at,
+           (EXTRACT(EPOCH FROM created_at) * 1000)::bigint AS ts,
+           voltaje::float8 AS v,
+           voltaje < %(min_voltage)s AS low
+    FROM telemetry_history
+    WHERE device_id = %(device_id)s
+      AND created_at >= %(start)s AND created_at <= %(end)s
+), counted AS (
+    SELECT *,
+           LEAD(ts) OVER w AS next_ts,
+           count(*) FILTER (WHERE low) OVER w AS lows
+    FROM r
+    WINDOW w AS (ORDER BY created_at ROWS UNBOUNDED PRECEDING)
+), runs AS (
+    SELECT *,
+           COALESCE(max(lows) FILTER (WHERE NOT low) OVER w, 0) AS lows_before_run
+    FROM counted
+    WINDOW w AS (ORDER BY created_at ROWS UNBOUNDED PRECEDING)
+), flagged AS (
+    SELECT ts, v, next_ts, created_at,
+           COALESCE(low OR (low IS NULL AND lows > lows_before_run
+                            AND ts - max(ts) FILTER (WHERE low AND lows - lows_before_run = 1) OVER w
+                                <= %(gap_ms)s), false) AS inside
+    FROM runs
+    WINDOW w AS (ORDER BY created_at ROWS UNBOUNDED PRECEDING)
+), islands AS (
+    SELECT *, count(*) FILTER (WHERE NOT inside) OVER (ORDER BY created_at ROWS UNBOUNDED PRECEDING) AS island
+    FROM flagged
+)
+SELECT 'power_outage' AS type, min(ts) AS start_ts, max(ts) AS end_ts,
+       min(v) AS vmin, max(v) AS vmax, count(v) AS points
+FROM islands
+WHERE inside
+GROUP BY island
+UNION ALL
+SELECT 'no_data', ts, next_ts, NULL::float8, NULL::float8, NULL::bigint
+FROM islands
+WHERE NOT inside AND next_ts - ts > %(gap_ms)s
+ORDER BY start_ts
+"""
+
+
+def detect_outages_sql(cursor, device_id: int, start, end, device="UNKNOWN", min_voltage: float = 50,
+                       max_gap_minutes: float = 10,
+                       expected_interval_ms: int = EXPECTED_INTERVAL_MS) -> List[Dict[str, Any]]:
+    """Eventos de cortes y gaps calculados en la base (OUTAGES_SQL), en el formato de detect_outages."""
+    params = {"device_id": device_id, "start": start, "end": end, "min_voltage": min_voltage,
+              "gap_ms": expected_interval_ms * max_gap_minutes}
+    with timed(pg_query_seconds, "power_outages_sql"):
+        cursor.execute(OUTAGES_SQL, params)
+        rows = cursor.fetchall()
+    events = []
+    for kind, start_ts, end_ts, vmin, vmax, count in rows:
+        if kind == "power_outage":
+            events.append(outage_event(start_ts, end_ts, vmin, vmax, count, device))
+        else:
+            events.append(gap_event(start_ts, end_ts, device))
+    return events
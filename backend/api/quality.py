@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+Estadísticas de calidad de energía por dispositivo y hora (tabla power_quality_1h).
+
+Cada fila (device_id, bucket) guarda, para la hora UTC que empieza en bucket:
+
+- samples y, para voltaje (v_) y factor de potencia (pf_): un sketch de cuantiles
+  (arrays paralelos _keys/_counts), suma, mínimo y máximo;
+- segundos en cada banda de tensión: interruption_s, sag_s, normal_s, swell_s.
+
+El sketch es el de DDSketch: el valor x > 0 cae en el bin ceil(log_gamma(x)), con
+gamma = (1 + a) / (1 - a) y a = SKETCH_RELATIVE_ACCURACY, así que cualquier cuantil
+se estima con error relativo <= a (0,5 %: ±1,1 V a 220 V). Dos sketches se combinan
+sumando los conteos bin a bin, sin perder precisión: el upsert los mezcla en la
+base y /metrics/quality suma los bins de todas las horas del rango con un GROUP BY
+en lugar de recorrer telemetry_history. Los valores menores que SKETCH_MIN_VALUE
+(p. ej. 0 V en un corte) van al bin ZERO_KEY y se estiman como 0.
+SKETCH_RELATIVE_ACCURACY es parte del formato guardado: cambiarlo invalida los
+sketches existentes.
+
+El factor de potencia se calcula como |P| / (V * I) (acotado a 1), igual que la
+potencia aparente de los rollups (V * I); las lecturas sin V, I o P no suman a su
+sketch.
+
+Bandas (porcentaje de QUALITY_NOMINAL_V): interruption < QUALITY_INTERRUPTION_PCT,
+sag < QUALITY_SAG_PCT, swell > QUALITY_SWELL_PCT, normal el resto. El intervalo
+entre dos lecturas consecutivas del dispositivo cuenta en la banda de la primera y
+en la hora de la que lo cierra (como energy_wh en rollups.py); si supera
+QUALITY_MAX_GAP_S o la primera no tiene voltaje, no cuenta en ninguna banda.
+
+QualityWriter.process_batch es un callback after_flush del TelemetryWriter: agrega
+el lote en memoria y hace un upsert (en orden de clave). La última lectura de cada
+dispositivo queda en memoria y avanza recién con el commit del upsert: un lote que
+hace rollback no mueve el estado. Tras un reinicio el primer intervalo no suma a las
+bandas. Las horas anteriores a la activación no tienen fila.
+
+read() es la lectura de /metrics/quality: una consulta de totales y una de bins por
+sketch, agrupadas en la base por ventana (total, hora, día o mes local); los
+cuantiles salen de los bins combinados, acotados al mínimo y máximo exactos.
+"""
+import math
+import os
+import threading
+from datetime import datetime, timezone, tzinfo
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from psycopg2.extras import execute_values
+
+from energy import ENERGY_MAX_GAP_S, naive_utc
+from ingest import COL_CORRIENTE, COL_CREATED_AT, COL_DEVICE_ID, COL_POTENCIA, COL_VOLTAJE
+from instrumentation import REGISTRY, pg_query_seconds, timed
+
+QUALITY_NOMINAL_V = float(os.getenv("QUALITY_NOMINAL_V", "220"))
+QUALITY_INTERRUPTION_PCT = float(os.getenv("QUALITY_INTERRUPTION_PCT", "10"))
+QUALITY_SAG_PCT = float(os.getenv("QUALITY_SAG_PCT", "90"))
+QUALITY_SWELL_PCT = float(os.getenv("QUALITY_SWELL_PCT", "110"))
+QUALITY_MAX_GAP_S = float(os.getenv("QUALITY_MAX_GAP_S", str(ENERGY_MAX_GAP_S)))
+
+SKETCH_RELATIVE_ACCURACY = 0.005
+SKETCH_MIN_VALUE = 1e-3
+ZERO_KEY = -(2 ** 31)
+
+_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+SKETCHES = ("v", "pf")
+BANDS = ("interruption", "sag", "normal", "swell")
+QUALITY_UNITS = ("total", "hour", "day", "month")
+DEFAULT_QUANTILES = (0.01, 0.05, 0.5, 0.95, 0.99)
+
+# Columnas escalares de power_quality_1h y cómo se combinan dos parciales
+SCALAR_COLUMNS = ("samples", "v_sum", "v_min", "v_max", "pf_sum", "pf_min", "pf_max") + \
+    tuple(f"{band}_s" for band in BANDS)
+_MERGE = {"min": "LEAST(t.{c}, EXCLUDED.{c})", "max": "GREATEST(t.{c}, EXCLUDED.{c})"}
+
+quality_rows = REGISTRY.counter(
+    "iot_quality_upsert_rows_total", "Filas de power_quality_1h escritas por upsert")
+
+
+def sketch_key(x: float) -> int:
+    """Bin del sketch para el valor x (>= 0)."""
+    if x < SKETCH_MIN_VALUE:
+        return ZERO_KEY
+    return math.ceil(math.log(x) / _LOG_GAMMA)
+
+
+def key_value(key: int) -> float:
+    """Estimación del bin: el punto con el mismo error relativo a ambos extremos."""
+    if key == ZERO_KEY:
+        return 0.0
+    return 2.0 * _GAMMA ** key / (_GAMMA + 1)
+
+
+class QuantileSketch:
+    """Histograma de bins logarítmicos {bin: conteo}; add() y merge() son O(1) por bin."""
+    __slots__ = ("bins",)
+
+    def __init__(self, bins: Optional[Dict[int, int]] = None):
+        self.bins: Dict[int, int] = bins if bins is not None else {}
+
+    @property
+    def count(self) -> int:
+        return sum(self.bins.values())
+
+    def add(self, x: float):
+        k = sketch_key(x)
+        self.bins[k] = self.bins.get(k, 0) + 1
+
+    def merge(self, other: "QuantileSketch"):
+        bins = self.bins
+        for k, c in other.bins.items():
+            bins[k] = bins.get(k, 0) + c
+
+    def arrays(self) -> Tuple[List[int], List[int]]:
+        """(keys, counts) ordenados por bin, como se guardan en power_quality_1h."""
+        keys = sorted(self.bins)
+        return keys, [self.bins[k] for k in keys]
+
+    @classmethod
+    def from_arrays(cls, keys: Sequence[int], counts: Sequence[int]) -> "QuantileSketch":
+        return cls(dict(zip(keys, counts)))
+
+    def quantiles(self, qs: Sequence[float], lo: Optional[float] = None,
+                  hi: Optional[float] = None) -> List[Optional[float]]:
+        """Cuantiles qs (0..1, en cualquier orden), acotados a [lo, hi] si se conocen los extremos."""
+        n = self.count
+        if n == 0:
+            return [None] * len(qs)
+        keys = sorted(self.bins)
+        out: Dict[float, float] = {}
+        i, cum = 0, self.bins[keys[0]]
+        for q in sorted(qs):
+            rank = q * (n - 1)
+            while cum <= rank and i < len(keys) - 1:
+                i += 1
+                cum += self.bins[keys[i]]
+            value = key_value(keys[i])
+            if lo is not None:
+                value = max(value, lo)
+            if hi is not None:
+                value = min(value, hi)
+            out[q] = value
+        return [out[q] for q in qs]
+
+
+def power_factor(v, i, p) -> Optional[float]:
+    """|P| / (V * I), acotado a 1; None si falta algún valor o V * I no es positivo."""
+    if v is None or i is None or p is None:
+        return None
+    s = v * i
+    if s <= 0:
+        return None
+    return min(abs(p) / s, 1.0)
+
+
+class Bands:
+    """Umbrales de tensión (V) de las bandas a partir de la nominal y los porcentajes."""
+
+    def __init__(self, nominal_v: float = QUALITY_NOMINAL_V, interruption_pct: float = QUALITY_INTERRUPTION_PCT,
+                 sag_pct: float = QUALITY_SAG_PCT, swell_pct: float = QUALITY_SWELL_PCT):
+        self.nominal_v = nominal_v
+        self.interruption_v = nominal_v * interruption_pct / 100.0
+        self.sag_v = nominal_v * sag_pct / 100.0
+        self.swell_v = nominal_v * swell_pct / 100.0
+
+    def index(self, v: float) -> int:
+        """Índice en BANDS para el voltaje v."""
+        if v < self.interruption_v:
+            return 0
+        if v < self.sag_v:
+            return 1
+        if v > self.swell_v:
+            return 3
+        return 2
+
+    def describe(self) -> Dict[str, float]:
+        return {"nominal_v": self.nominal_v, "interruption_below_v": round(self.interruption_v, 2),
+                "sag_below_v": round(self.sag_v, 2), "swell_above_v": round(self.swell_v, 2)}
+
+
+# ---------------------------------------------------------------------------
+# Escritura
+# ---------------------------------------------------------------------------
+
+def _sketch_merge_sql(s: str) -> str:
+    """Suma bin a bin el sketch guardado y el del lote."""
+    return f"""({s}_keys, {s}_counts) = (
+            SELECT COALESCE(array_agg(k ORDER BY k), '{{}}'), COALESCE(array_agg(c ORDER BY k), '{{}}')
+            FROM (SELECT k, SUM(c)::bigint AS c
+                  FROM unnest(t.{s}_keys || EXCLUDED.{s}_keys, t.{s}_counts || EXCLUDED.{s}_counts) AS u(k, c)
+                  GROUP BY k) m)"""
+
+
+_INSERT_COLUMNS = ("samples",) + tuple(f"{s}_{part}" for s in SKETCHES for part in ("keys", "counts")) + \
+    SCALAR_COLUMNS[1:]
+
+UPSERT_SQL = f"""
+    INSERT INTO power_quality_1h AS t (device_id, bucket, {", ".join(_INSERT_COLUMNS)})
+    VALUES %s
+    ON CONFLICT (device_id, bucket) DO UPDATE SET
+        {", ".join(f"{c} = " + _MERGE.get(c.rsplit("_", 1)[-1], "t.{c} + EXCLUDED.{c}").format(c=c)
+                   for c in SCALAR_COLUMNS)},
+        {", ".join(_sketch_merge_sql(s) for s in SKETCHES)},
+        updated_at = NOW()
+"""
+
+
+def _min(a, b):
+    return b if a is None else min(a, b)
+
+
+def _max(a, b):
+    return b if a is None else max(a, b)
+
+
+class _Hour:
+    """Acumulador de una (device_id, hora) dentro de un lote."""
+    __slots__ = ("samples", "v", "v_sum", "v_min", "v_max", "pf", "pf_sum", "pf_min", "pf_max", "band_s")
+
+    def __init__(self):
+        self.samples = 0
+        self.v, self.v_sum, self.v_min, self.v_max = QuantileSketch(), 0.0, None, None
+        self.pf, self.pf_sum, self.pf_min, self.pf_max = QuantileSketch(), 0.0, None, None
+        self.band_s = [0.0] * len(BANDS)
+
+    def row(self, device_id: int, bucket: datetime) -> tuple:
+        v_keys, v_counts = self.v.arrays()
+        pf_keys, pf_counts = self.pf.arrays()
+        return (device_id, bucket, self.samples, v_keys, v_counts, pf_keys, pf_counts,
+                self.v_sum, self.v_min, self.v_max, self.pf_sum, self.pf_min, self.pf_max, *self.band_s)
+
+
+class QualityWriter:
+    def __init__(self, bands: Optional[Bands] = None, max_gap_s: float = QUALITY_MAX_GAP_S):
+        self.bands = bands or Bands()
+        self.max_gap_s = max_gap_s
+        self._last: Dict[int, Tuple[datetime, Optional[float]]] = {}
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "samples": 0, "out_of_order": 0, "rows_upserted": 0}
+
+    def aggregate(self, rows) -> Tuple[Dict[Tuple[int, datetime], _Hour], Dict[int, Tuple[datetime, Optional[float]]]]:
+        """
+        Agrupa las filas del lote por (device_id, hora UTC). Devuelve también la nueva
+        última lectura de cada dispositivo; process_batch la aplica después del commit.
+        """
+        samples = []
+        for _, values, _ in rows:
+            device_id, created_at = values[COL_DEVICE_ID], values[COL_CREATED_AT]
+            v, i, p = values[COL_VOLTAJE], values[COL_CORRIENTE], values[COL_POTENCIA]
+            if device_id is None or created_at is None:
+                continue
+            samples.append((naive_utc(created_at), device_id,
+                            None if v is None else float(v),
+                            None if i is None else float(i),
+                            None if p is None else float(p)))
+        samples.sort(key=lambda s: s[0])
+
+        with self._lock:
+            last = {s[1]: self._last[s[1]] for s in samples if s[1] in self._last}
+        out: Dict[Tuple[int, datetime], _Hour] = {}
+        for ts, device_id, v, i, p in samples:
+            prev = last.get(device_id)
+            if prev is not None and ts <= prev[0]:
+                self.stats["out_of_order"] += 1
+                continue
+            last[device_id] = (ts, v)
+
+            bucket = ts.replace(minute=0, second=0, microsecond=0)
+            acc = out.get((device_id, bucket))
+            if acc is None:
+                acc = out[(device_id, bucket)] = _Hour()
+            acc.samples += 1
+            if v is not None:
+                acc.v.add(v)
+                acc.v_sum += v
+                acc.v_min, acc.v_max = _min(acc.v_min, v), _max(acc.v_max, v)
+            pf = power_factor(v, i, p)
+            if pf is not None:
+                acc.pf.add(pf)
+                acc.pf_sum += pf
+                acc.pf_min, acc.pf_max = _min(acc.pf_min, pf), _max(acc.pf_max, pf)
+            if prev is not None and prev[1] is not None:
+                dt = (ts - prev[0]).total_seconds()
+                if dt <= self.max_gap_s:
+                    acc.band_s[self.bands.index(prev[1])] += dt
+        self.stats["samples"] += len(samples)
+        return out, last
+
+    def process_batch(self, cursor, conn, rows) -> int:
+        """Callback after_flush: upsert de power_quality_1h en una transacción."""
+        hours, last = self.aggregate(rows)
+        if not hours:
+            return 0
+        # Orden fijo de claves: dos workers no se bloquean mutuamente
+        values = [acc.row(device_id, bucket) for (device_id, bucket), acc in sorted(hours.items())]
+        with timed(pg_query_seconds, "quality_upsert_batch"):
+            execute_values(cursor, UPSERT_SQL, values, page_size=len(values))
+            conn.commit()
+        with self._lock:
+            self._last.update(last)
+        quality_rows.inc(n=len(values))
+        self.stats["batches"] += 1
+        self.stats["rows_upserted"] += len(values)
+        return len(values)
+
+
+# ---------------------------------------------------------------------------
+# Lectura
+# ---------------------------------------------------------------------------
+
+# Ventanas locales: las horas UTC se corren offset_s antes de truncar (como /metrics/energy)
+def _group_expr(unit: str) -> str:
+    if unit == "total":
+        return "NULL::timestamp"
+    return "date_trunc(%(unit)s, q.bucket + make_interval(secs => %(offset_s)s))"
+
+
+def _bins_sql(s: str, unit: str) -> str:
+    return f"""
+        SELECT {_group_expr(unit)} AS g, u.k, SUM(u.c)::bigint
+        FROM power_quality_1h q, unnest(q.{s}_keys, q.{s}_counts) AS u(k, c)
+        WHERE q.device_id = %(device_id)s AND q.bucket >= %(start)s AND q.bucket < %(end)s
+        GROUP BY 1, 2
+    """
+
+
+def _totals_sql(unit: str) -> str:
+    return f"""
+        SELECT {_group_expr(unit)} AS g, count(*), sum(samples),
+               sum(v_sum), min(v_min), max(v_max), sum(pf_sum), min(pf_min), max(pf_max),
+               {", ".join(f"sum({band}_s)" for band in BANDS)}
+        FROM power_quality_1h q
+        WHERE q.device_id = %(device_id)s AND q.bucket >= %(start)s AND q.bucket < %(end)s
+        GROUP BY 1
+        ORDER BY 1
+    """
+
+
+READ_SQL = {unit: (_totals_sql(unit), {s: _bins_sql(s, unit) for s in SKETCHES}) for unit in QUALITY_UNITS}
+
+
+def parse_quantiles(value: Optional[str]) -> Tuple[float, ...]:
+    """q=0.01,0.5,0.99 -> (0.01, 0.5, 0.99). Lanza ValueError."""
+    if not value:
+        return DEFAULT_QUANTILES
+    qs = tuple(float(x) for x in value.split(",") if x.strip())
+    if not qs or any(not 0.0 <= q <= 1.0 for q in qs):
+        raise ValueError("q debe ser una lista de cuantiles entre 0 y 1")
+    return qs
+
+
+def _label(q: float) -> str:
+    return f"p{q * 100:g}"
+
+
+def _summary(sketch: QuantileSketch, total: float, lo, hi, qs: Sequence[float], digits: int) -> dict:
+    n = sketch.count
+    out = {"count": n, "mean": round(total / n, digits) if n else None,
+           "min": None if lo is None else round(lo, digits), "max": None if hi is None else round(hi, digits)}
+    for q, value in zip(qs, sketch.quantiles(qs, lo, hi)):
+        out[_label(q)] = None if value is None else round(value, digits)
+    return out
+
+
+def read(cursor, device_id: int, start: datetime, end: datetime, unit: str = "total", tz: tzinfo = timezone.utc,
+         qs: Sequence[float] = DEFAULT_QUANTILES) -> List[dict]:
+    """
+    Estadísticas de las horas [start, end) (start se trunca a la hora) por ventana
+    'unit': total, o hour/day/month en el huso tz. Un elemento por ventana con datos.
+    """
+    start = naive_utc(start).replace(minute=0, second=0, microsecond=0)
+    offset_s = int(tz.utcoffset(None).total_seconds())
+    params = {"device_id": device_id, "start": start, "end": naive_utc(end), "unit": unit, "offset_s": offset_s}
+    totals_sql, bins_sql = READ_SQL[unit]
+    sketches: Dict[str, Dict[Optional[datetime], QuantileSketch]] = {s: {} for s in SKETCHES}
+    with timed(pg_query_seconds, "quality_read"):
+        cursor.execute(totals_sql, params)
+        totals = cursor.fetchall()
+        for s in SKETCHES:
+            cursor.execute(bins_sql[s], params)
+            for g, k, c in cursor.fetchall():
+                sketches[s].setdefault(g, QuantileSketch()).bins[k] = c
+
+    items = []
+    for g, hours, samples, v_sum, v_min, v_max, pf_sum, pf_min, pf_max, *band_s in totals:
+        band_s = [float(x or 0.0) for x in band_s]
+        covered = sum(band_s)
+        item = {}
+        if g is not None:
+            local_start = g.replace(tzinfo=tz)
+            item["start"] = local_start.isoformat()
+            item["ts"] = int(local_start.timestamp() * 1000)
+        item.update({
+            "hours": hours,
+            "samples": int(samples or 0),
+            "voltage": _summary(sketches["v"].get(g, QuantileSketch()), float(v_sum or 0.0), v_min, v_max, qs, 2),
+            "pf": _summary(sketches["pf"].get(g, QuantileSketch()), float(pf_sum or 0.0), pf_min, pf_max, qs, 3),
+            "bands_s": {band: round(s, 1) for band, s in zip(BANDS, band_s)},
+            "bands_pct": {band: round(100.0 * s / covered, 3) if covered else None
+                          for band, s in zip(BANDS, band_s)},
+        })
+        items.append(item)
+    return items
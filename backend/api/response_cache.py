@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Cache de respuestas para los endpoints de historial (LRU acotado por bytes).
+
+Clave: ruta + todos los parámetros de la query ordenados (dispositivo, start/end,
+bucket/max_points, format, fields, ...). Vigencia según el final de la ventana:
+
+- end < ahora - CACHE_INGEST_LAG_S: la ventana ya no recibe datos; la entrada
+  vale hasta que el LRU la desaloje.
+- si no (la ventana toca el presente): vence a los CACHE_LIVE_TTL_S segundos.
+
+Cada entrada guarda el cuerpo ya codificado y su ETag (hash del cuerpo). Con
+If-None-Match igual al ETag se responde 304 sin consultar la base. Las respuestas
+en streaming se guardan al terminar de enviarse (la primera sale sin ETag) y solo
+si no superan CACHE_MAX_ENTRY_BYTES. Solo se guardan respuestas 200.
+
+Uso (app.py): response_cache = ResponseCache() y @response_cache.cached() debajo
+de @app.route(...); cached(PYT_TIMEZONE) si la vista lee start/end sin zona como
+hora de Paraguay.
+"""
+import os
+import time
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone, tzinfo
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+from flask import Response, make_response, request
+
+from instrumentation import REGISTRY
+from time_args import parse_time_arg
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") not in ("0", "false", "False")
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_MAX_ENTRY_BYTES = int(os.getenv("CACHE_MAX_ENTRY_BYTES", str(32 * 1024 * 1024)))
+CACHE_LIVE_TTL_S = float(os.getenv("CACHE_LIVE_TTL_S", "15"))
+CACHE_INGEST_LAG_S = float(os.getenv("CACHE_INGEST_LAG_S", "300"))
+# max-age que se anuncia al navegador para ventanas cerradas (después revalida con ETag)
+CACHE_IMMUTABLE_MAX_AGE_S = int(os.getenv("CACHE_IMMUTABLE_MAX_AGE_S", "3600"))
+
+cache_requests = REGISTRY.counter(
+    "iot_response_cache_requests_total", "Requests a endpoints cacheados por resultado", ("endpoint", "result"))
+
+
+class Entry(NamedTuple):
+    body: bytes
+    mimetype: str
+    headers: Tuple[Tuple[str, str], ...]
+    etag: str
+    expires_at: Optional[float]   # None = ventana cerrada (hasta desalojo)
+
+
+def _parse_end(value: Optional[str], default_tz: tzinfo = timezone.utc) -> Optional[datetime]:
+    """end con la misma regla que los endpoints (ver time_args.py); None si falta o no se puede leer."""
+    if not value:
+        return None
+    try:
+        return parse_time_arg(value, default_tz)
+    except ValueError:
+        return None
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, max_entry_bytes: int = CACHE_MAX_ENTRY_BYTES,
+                 live_ttl_s: float = CACHE_LIVE_TTL_S, ingest_lag_s: float = CACHE_INGEST_LAG_S,
+                 enabled: bool = CACHE_ENABLED):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.live_ttl_s = live_ttl_s
+        self.ingest_lag_s = ingest_lag_s
+        self.enabled = enabled
+        self._entries: "OrderedDict[str, Entry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "stored": 0, "evicted": 0,
+                      "expired": 0, "too_large": 0}
+
+    # --- almacenamiento ---
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at is not None and entry.expires_at <= time.monotonic():
+                self._drop(key)
+                self.stats["expired"] += 1
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: Entry):
+        size = len(entry.body)
+        if size > self.max_entry_bytes:
+            self.stats["too_large"] += 1
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = entry
+            self._bytes += size
+            self.stats["stored"] += 1
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.stats["evicted"] += 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= len(entry.body)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            return {"enabled": self.enabled, "entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, **self.stats}
+
+    # --- requests ---
+
+    @staticmethod
+    def key_for(req) -> str:
+        args = sorted(req.args.items(multi=True))
+        return req.path + "?" + "&".join(f"{k}={v}" for k, v in args)
+
+    def expires_at(self, end: Optional[datetime]) -> Optional[float]:
+        """None si la ventana está cerrada; si no, el instante (monotónico) de vencimiento."""
+        if end is not None and end.timestamp() < time.time() - self.ingest_lag_s:
+            return None
+        return time.monotonic() + self.live_ttl_s
+
+    def _respond(self, entry: Entry) -> Response:
+        resp = Response(entry.body, mimetype=entry.mimetype, headers=list(entry.headers))
+        resp.set_etag(entry.etag)
+        resp.headers["Cache-Control"] = self._cache_control(entry.expires_at)
+        return resp.make_conditional(request)
+
+    def _cache_control(self, expires_at: Optional[float]) -> str:
+        if expires_at is None:
+            return f"private, max-age={CACHE_IMMUTABLE_MAX_AGE_S}"
+        return f"private, max-age={max(0, int(expires_at - time.monotonic()))}"
+
+    def _capture(self, key: str, body: Iterable, mimetype: str, headers, expires_at) -> Iterable:
+        """Envía el cuerpo en streaming y lo guarda al terminar si entra en el límite."""
+        parts = []
+        size = 0
+        for part in body:
+            if parts is not None:
+                data = part.encode("utf-8") if isinstance(part, str) else part
+                size += len(data)
+                if size > self.max_entry_bytes:
+                    parts = None
+                    self.stats["too_large"] += 1
+                else:
+                    parts.append(data)
+            yield part
+        if parts is not None:
+            data = b"".join(parts)
+            self.put(key, Entry(data, mimetype, headers, _etag(data), expires_at))
+
+    def cached(self, default_tz: tzinfo = timezone.utc) -> Callable:
+        """
+        Decorador de vistas GET: sirve desde el cache, responde 304 y guarda las respuestas 200.
+        default_tz es el huso en que la vista lee un end sin zona (ver time_args.py).
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                endpoint = request.endpoint or request.path
+                key = self.key_for(request)
+                entry = self.get(key)
+                if entry is not None:
+                    resp = self._respond(entry)
+                    result = "not_modified" if resp.status_code == 304 else "hit"
+                    self.stats["not_modified" if result == "not_modified" else "hits"] += 1
+                    cache_requests.inc(endpoint, result)
+                    resp.headers["X-Cache"] = "HIT"
+                    return resp
+
+                self.stats["misses"] += 1
+                cache_requests.inc(endpoint, "miss")
+                expires_at = self.expires_at(_parse_end(request.args.get("end"), default_tz))
+                resp = make_response(view(*args, **kwargs))
+                resp.headers["X-Cache"] = "MISS"
+                if resp.status_code != 200:
+                    return resp
+                headers = tuple((k, v) for k, v in resp.headers.items()
+                                if k in ("Content-Disposition",))
+                if resp.is_streamed:
+                    resp.response = self._capture(key, resp.response, resp.mimetype, headers, expires_at)
+                    return resp
+                data = resp.get_data()
+                entry = Entry(data, resp.mimetype, headers, _etag(data), expires_at)
+                self.put(key, entry)
+                resp.set_etag(entry.etag)
+                resp.headers["Cache-Control"] = self._cache_control(expires_at)
+                return resp.make_conditional(request)
+            return wrapper
+        return decorator
+
+
+def _etag(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Agregados (rollups) de telemetry_history por minuto, hora y día.
+
+Tablas (ver scripts/init-db.js): telemetry_rollup_{device,company}_{1m,1h,1d},
+clave (device_id | company_id, bucket). bucket es el inicio de la ventana en UTC
+sin zona, igual que created_at (las ventanas 1d son días UTC). Cada fila guarda
+sumas y conteos en lugar de promedios para que dos parciales se puedan combinar
+con un upsert:
+
+  samples, v_n/v_sum/v_min/v_max, i_n/i_sum/i_min/i_max, s_n/s_sum (V*I),
+  p_n/p_sum/p_min/p_max, energy_wh
+
+energy_wh es la integral trapezoidal de la potencia entre lecturas consecutivas
+del dispositivo, asignada a la ventana de la lectura que cierra el intervalo. En la
+ingesta la calcula EnergyIntegrator (energy.py, con estado en device_energy_state)
+y llega en cada fila del callback; sin ENERGY_ENABLED los rollups no suman energía.
+El backfill aplica la misma regla en SQL.
+
+Solo el TelemetryWriter (MQTT) alimenta los rollups: las filas que escribe
+telegraf/postgres_writer.py no pasan por process_batch, así que no aparecen en los
+rollups ni en /metrics/energy hasta correr el backfill sobre esos días.
+
+- RollupWriter.process_batch: callback after_flush del TelemetryWriter. Agrega el
+  lote en memoria y hace un upsert por tabla (LEAST/GREATEST y sumas).
+- backfill(): reconstruye un rango de días desde telemetry_history
+  (1m desde las filas crudas, 1h desde 1m, 1d desde 1h, compañía desde dispositivo).
+- pick_tier() / stream_rollup_buckets(): lectura para /metrics/history-smart.
+
+Backfill:
+  python backend/api/rollups.py --from 2025-01-01 [--to 2025-02-01] [--device 12]
+"""
+import os
+import sys
+import argparse
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from psycopg2.extras import execute_values
+
+from energy import ENERGY_MAX_GAP_S, naive_utc
+from hotlog import get_logger
+from ingest import COL_COMPANY_ID, COL_CORRIENTE, COL_CREATED_AT, COL_DEVICE_ID, COL_POTENCIA, COL_VOLTAJE
+from instrumentation import REGISTRY, pg_query_seconds, timed
+from telemetry_queries import BUCKET_COLUMNS, stream_query
+
+log = get_logger("rollups")
+
+# (nombre, segundos, unidad de date_trunc)
+TIERS = (("1m", 60, "minute"), ("1h", 3600, "hour"), ("1d", 86400, "day"))
+SCOPES = ("device", "company")
+
+# Columnas agregadas y cómo se combinan dos parciales
+AGG_COLUMNS = ("samples", "v_n", "v_sum", "v_min", "v_max", "i_n", "i_sum", "i_min", "i_max",
+               "s_n", "s_sum", "p_n", "p_sum", "p_min", "p_max", "energy_wh")
+_MERGE = {"min": "LEAST(t.{c}, EXCLUDED.{c})", "max": "GREATEST(t.{c}, EXCLUDED.{c})"}
+
+# Filas de lectura: BUCKET_COLUMNS + energía de la ventana
+ROLLUP_COLUMNS = BUCKET_COLUMNS + ("energy_wh",)
+
+upsert_rows = REGISTRY.counter(
+    "iot_rollup_upsert_rows_total", "Filas de rollup escritas por upsert", ("table",))
+
+
+def table_name(scope: str, tier: str) -> str:
+    return f"telemetry_rollup_{scope}_{tier}"
+
+
+def _key(scope: str) -> str:
+    return "device_id" if scope == "device" else "company_id"
+
+
+def _upsert_sql(scope: str, tier: str) -> str:
+    sets = []
+    for c in AGG_COLUMNS:
+        kind = c.rsplit("_", 1)[-1]
+        sets.append(f"{c} = " + _MERGE.get(kind, "t.{c} + EXCLUDED.{c}").format(c=c))
+    return f"""
+        INSERT INTO {table_name(scope, tier)} AS t ({_key(scope)}, bucket, {", ".join(AGG_COLUMNS)})
+        VALUES %s
+        ON CONFLICT ({_key(scope)}, bucket) DO UPDATE SET
+            {", ".join(sets)}, updated_at = NOW()
+    """
+
+
+UPSERT_SQL = {(scope, tier): _upsert_sql(scope, tier) for scope in SCOPES for tier, _, _ in TIERS}
+
+
+def _truncate(ts: datetime, unit: str) -> datetime:
+    if unit == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if unit == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _num(value) -> Optional[float]:
+    return None if value is None else float(value)
+
+
+def _add_sample(acc: list, v, i, p, energy_wh: float):
+    acc[0] += 1
+    if v is not None:
+        acc[1] += 1
+        acc[2] += v
+        acc[3] = v if acc[3] is None else min(acc[3], v)
+        acc[4] = v if acc[4] is None else max(acc[4], v)
+    if i is not None:
+        acc[5] += 1
+        acc[6] += i
+        acc[7] = i if acc[7] is None else min(acc[7], i)
+        acc[8] = i if acc[8] is None else max(acc[8], i)
+    if v is not None and i is not None:
+        acc[9] += 1
+        acc[10] += v * i
+    if p is not None:
+        acc[11] += 1
+        acc[12] += p
+        acc[13] = p if acc[13] is None else min(acc[13], p)
+        acc[14] = p if acc[14] is None else max(acc[14], p)
+    acc[15] += energy_wh
+
+
+def _new_acc() -> list:
+    return [0, 0, 0.0, None, None, 0, 0.0, None, None, 0, 0.0, 0, 0.0, None, None, 0.0]
+
+
+class RollupWriter:
+    """
+    Mantiene los rollups a partir de cada lote escrito por el TelemetryWriter. La
+    energía de cada lectura es la que calculó EnergyIntegrator en la misma ingesta.
+    """
+
+    def __init__(self):
+        self.stats = {"batches": 0, "samples": 0, "rows_upserted": 0}
+
+    def aggregate(self, rows) -> Dict[Tuple[str, str], Dict[Tuple[int, datetime], list]]:
+        """Agrupa las filas del lote por (scope, tier) -> (id, bucket) -> acumulador."""
+        out = {(scope, tier): {} for scope in SCOPES for tier, _, _ in TIERS}
+        samples = 0
+        for _, values, energy_kwh in rows:
+            device_id, created_at = values[COL_DEVICE_ID], values[COL_CREATED_AT]
+            if device_id is None or created_at is None:
+                continue
+            ts = naive_utc(created_at)
+            company_id = values[COL_COMPANY_ID]
+            v, i, p = _num(values[COL_VOLTAJE]), _num(values[COL_CORRIENTE]), _num(values[COL_POTENCIA])
+            energy_wh = (energy_kwh or 0.0) * 1000.0
+            samples += 1
+            for tier, _, unit in TIERS:
+                bucket = _truncate(ts, unit)
+                keys = [("device", device_id)]
+                if company_id is not None:
+                    keys.append(("company", company_id))
+                for scope, key_id in keys:
+                    accs = out[(scope, tier)]
+                    acc = accs.get((key_id, bucket))
+                    if acc is None:
+                        acc = accs[(key_id, bucket)] = _new_acc()
+                    _add_sample(acc, v, i, p, energy_wh)
+        self.stats["samples"] += samples
+        return out
+
+    def process_batch(self, cursor, conn, rows) -> int:
+        """Callback after_flush: upsert de todas las tablas de rollup en una transacción."""
+        grouped = self.aggregate(rows)
+        written = 0
+        with timed(pg_query_seconds, "rollups_upsert_batch"):
+            for (scope, tier), accs in grouped.items():
+                if not accs:
+                    continue
+                # Orden fijo de claves: dos workers no se bloquean mutuamente
+                values = [(key_id, bucket, *acc) for (key_id, bucket), acc in sorted(accs.items())]
+                execute_values(cursor, UPSERT_SQL[(scope, tier)], values, page_size=len(values))
+                upsert_rows.inc(table_name(scope, tier), n=len(values))
+                written += len(values)
+            conn.commit()
+        self.stats["batches"] += 1
+        self.stats["rows_upserted"] += written
+        return written
+
+
+# ---------------------------------------------------------------------------
+# Lectura
+# ---------------------------------------------------------------------------
+
+def pick_tier(bucket_s: int, exact: bool = True) -> Optional[Tuple[str, int]]:
+    """
+    Tier más grueso que sirve para ventanas de bucket_s segundos, o None (usar filas crudas).
+    Con exact=True la ventana tiene que ser múltiplo del tier (bucket=... explícito);
+    con exact=False (max_points) se acepta cualquier tier no mayor que la ventana y la
+    ventana se redondea hacia arriba a un múltiplo del tier.
+    """
+    for tier, seconds, _ in reversed(TIERS):
+        if bucket_s >= seconds and (not exact or bucket_s % seconds == 0):
+            return tier, seconds
+    return None
+
+
+_READ_TS_EXPR = "(floor(EXTRACT(EPOCH FROM bucket) / %(bucket_s)s) * %(bucket_s)s * 1000)::bigint"
+READ_EXPRS = {
+    "ts": _READ_TS_EXPR,
+    "vrms": "(sum(v_sum) / NULLIF(sum(v_n), 0))::float8",
+    "vrms_min": "min(v_min)::float8",
+    "vrms_max": "max(v_max)::float8",
+    "irms": "(sum(i_sum) / NULLIF(sum(i_n), 0))::float8",
+    "irms_min": "min(i_min)::float8",
+    "irms_max": "max(i_max)::float8",
+    "s_apparent_va": "(sum(s_sum) / NULLIF(sum(s_n), 0))::float8",
+    "potencia_activa": "(sum(p_sum) / NULLIF(sum(p_n), 0))::float8",
+    "potencia_min": "min(p_min)::float8",
+    "potencia_max": "max(p_max)::float8",
+    "factor_potencia": ("((sum(p_sum) / NULLIF(sum(p_n), 0))"
+                        " / NULLIF(sum(s_sum) / NULLIF(sum(s_n), 0), 0))::float8"),
+    "count": "sum(samples)::bigint",
+    "energy_wh": "sum(energy_wh)::float8",
+}
+
+
+@lru_cache(maxsize=128)
+def read_sql(scope: str, tier: str, columns: Sequence[str] = ROLLUP_COLUMNS) -> str:
+    unknown = [c for c in columns if c not in READ_EXPRS]
+    if unknown or not columns:
+        raise ValueError(f"columnas inválidas: {', '.join(unknown) or '(ninguna)'}")
+    select = ",\n               ".join(f"{READ_EXPRS[c]} AS {c}" for c in columns)
+    return f"""
+        SELECT {select}
+        FROM {table_name(scope, tier)}
+        WHERE {_key(scope)} = %(key_id)s
+          AND bucket >= %(start)s AND bucket <= %(end)s
+        GROUP BY {_READ_TS_EXPR}
+        HAVING sum(samples) > 0
+        ORDER BY {_READ_TS_EXPR}
+    """
+
+
+@lru_cache(maxsize=128)
+def read_many_sql(scope: str, tier: str, columns: Sequence[str] = ROLLUP_COLUMNS) -> str:
+    """Como read_sql para varias claves (key = ANY): la clave primero, ordenado por (clave, ts)."""
+    unknown = [c for c in columns if c not in READ_EXPRS]
+    if unknown or not columns:
+        raise ValueError(f"columnas inválidas: {', '.join(unknown) or '(ninguna)'}")
+    select = ",\n               ".join(f"{READ_EXPRS[c]} AS {c}" for c in columns)
+    return f"""
+        SELECT {_key(scope)},
+               {select}
+        FROM {table_name(scope, tier)}
+        WHERE {_key(scope)} = ANY(%(key_ids)s)
+          AND bucket >= %(start)s AND bucket <= %(end)s
+        GROUP BY {_key(scope)}, {_READ_TS_EXPR}
+        HAVING sum(samples) > 0
+        ORDER BY {_key(scope)}, {_READ_TS_EXPR}
+    """
+
+
+def stream_rollup_buckets(conn, scope: str, key_id: int, tier: str, start, end, bucket_s: int,
+                          query_name: str = "rollup_buckets",
+                          columns: Sequence[str] = ROLLUP_COLUMNS) -> Iterator[List[tuple]]:
+    """
+    Filas (columns, por defecto ROLLUP_COLUMNS) por ventanas de bucket_s segundos leídas del tier.
+    Se incluye la ventana del tier que contiene 'start', así la primera ventana está completa.
+    """
+    seconds = dict((t, s) for t, s, _ in TIERS)[tier]
+    epoch = start.timestamp()
+    start_aligned = datetime.fromtimestamp(epoch - epoch % seconds, tz=start.tzinfo or timezone.utc)
+    params = {"key_id": key_id, "start": start_aligned, "end": end, "bucket_s": int(bucket_s)}
+    return stream_query(conn, read_sql(scope, tier, tuple(columns)), params, query_name)
+
+
+def stream_rollup_buckets_many(conn, scope: str, key_ids: Sequence[int], tier: str, start, end,
+                               bucket_s: int, query_name: str = "rollup_buckets_many",
+                               columns: Sequence[str] = ROLLUP_COLUMNS) -> Iterator[List[tuple]]:
+    """Filas (clave, *columns) de varias claves en una consulta; mismo alineado que stream_rollup_buckets."""
+    seconds = dict((t, s) for t, s, _ in TIERS)[tier]
+    epoch = start.timestamp()
+    start_aligned = datetime.fromtimestamp(epoch - epoch % seconds, tz=start.tzinfo or timezone.utc)
+    params = {"key_ids": list(key_ids), "start": start_aligned, "end": end, "bucket_s": int(bucket_s)}
+    return stream_query(conn, read_many_sql(scope, tier, tuple(columns)), params, query_name)
+
+
+# ---------------------------------------------------------------------------
+# Backfill
+# ---------------------------------------------------------------------------
+
+_REPLACE = ", ".join(f"{c} = EXCLUDED.{c}" for c in AGG_COLUMNS) + ", updated_at = NOW()"
+
+# 1m desde telemetry_history; lag() trae la lectura anterior aunque sea de antes del día
+BACKFILL_DEVICE_1M_SQL = f"""
+    INSERT INTO telemetry_rollup_device_1m AS t (device_id, bucket, {", ".join(AGG_COLUMNS)})
+    SELECT device_id, date_trunc('minute', created_at),
+           count(*),
+           count(voltaje), COALESCE(sum(voltaje), 0), min(voltaje), max(voltaje),
+           count(corriente), COALESCE(sum(corriente), 0), min(corriente), max(corriente),
+           count(voltaje * corriente), COALESCE(sum(voltaje * corriente), 0),
+           count(potencia), COALESCE(sum(potencia), 0), min(potencia), max(potencia),
+           COALESCE(sum(energy_wh), 0)
+    FROM (
+        SELECT device_id, created_at, voltaje, corriente, potencia,
+               CASE WHEN created_at > prev_at
+                         AND created_at - prev_at <= make_interval(secs => %(max_gap_s)s)
+                    THEN (potencia + prev_p) / 2 * EXTRACT(EPOCH FROM created_at - prev_at) / 3600
+               END AS energy_wh
+        FROM (
+            SELECT device_id, created_at, voltaje, corriente, potencia,
+                   lag(created_at) OVER w AS prev_at, lag(potencia) OVER w AS prev_p
+            FROM telemetry_history
+            WHERE device_id IS NOT NULL
+              AND created_at >= %(lookback)s AND created_at < %(end)s
+              AND (%(device_id)s::int IS NULL OR device_id = %(device_id)s)
+            WINDOW w AS (PARTITION BY device_id ORDER BY created_at)
+        ) s
+        WHERE created_at >= %(start)s
+    ) s
+    GROUP BY 1, 2
+    ON CONFLICT (device_id, bucket) DO UPDATE SET {_REPLACE}
+"""
+
+
+def _rebuild_sql(scope: str, tier: str, source: str, unit: str) -> str:
+    """Tier 'tier' de 'scope' a partir de la tabla 'source' (tier más fino o scope device)."""
+    if scope == "device":
+        key, join, where = "r.device_id", "", "(%(device_id)s::int IS NULL OR r.device_id = %(device_id)s)"
+    else:
+        key, join = "d.company_id", "JOIN devices d ON d.id = r.device_id"
+        where = ("(%(device_id)s::int IS NULL OR d.company_id = "
+                 "(SELECT company_id FROM devices WHERE id = %(device_id)s))")
+    return f"""
+        INSERT INTO {table_name(scope, tier)} AS t ({_key(scope)}, bucket, {", ".join(AGG_COLUMNS)})
+        SELECT {key}, date_trunc('{unit}', r.bucket),
+               sum(r.samples), sum(r.v_n), sum(r.v_sum), min(r.v_min), max(r.v_max),
+               sum(r.i_n), sum(r.i_sum), min(r.i_min), max(r.i_max),
+               sum(r.s_n), sum(r.s_sum),
+               sum(r.p_n), sum(r.p_sum), min(r.p_min), max(r.p_max),
+               sum(r.energy_wh)
+        FROM {source} r {join}
+        WHERE r.bucket >= %(start)s AND r.bucket < %(end)s AND {where}
+        GROUP BY 1, 2
+        ON CONFLICT ({_key(scope)}, bucket) DO UPDATE SET {_REPLACE}
+    """
+
+
+def _delete_sql(scope: str, tier: str) -> str:
+    if scope == "device":
+        where = "(%(device_id)s::int IS NULL OR device_id = %(device_id)s)"
+    else:
+        where = ("(%(device_id)s::int IS NULL OR company_id = "
+                 "(SELECT company_id FROM devices WHERE id = %(device_id)s))")
+    return f"DELETE FROM {table_name(scope, tier)} WHERE bucket >= %(start)s AND bucket < %(end)s AND {where}"
+
+
+def backfill(conn, start_day: date, end_day: date, device_id: Optional[int] = None,
+             max_gap_s: float = ENERGY_MAX_GAP_S) -> int:
+    """
+    Reconstruye los rollups de [start_day, end_day) día por día (una transacción por día).
+    Reemplaza lo que hubiera en esas ventanas; pensado para días cerrados: en el día en
+    curso, un lote ingerido durante el backfill puede quedar contado solo en parte.
+    Devuelve la cantidad de días procesados.
+    """
+    steps = [("device", "1m", BACKFILL_DEVICE_1M_SQL)]
+    for (tier, _, unit), (finer, _, _) in zip(TIERS[1:], TIERS):
+        steps.append(("device", tier, _rebuild_sql("device", tier, table_name("device", finer), unit)))
+    for tier, _, unit in TIERS:
+        steps.append(("company", tier, _rebuild_sql("company", tier, table_name("device", tier), unit)))
+
+    days = 0
+    day = start_day
+    cur = conn.cursor()
+    try:
+        while day < end_day:
+            start = datetime.combine(day, datetime.min.time())
+            params = {
+                "start": start,
+                "end": start + timedelta(days=1),
+                "lookback": start - timedelta(seconds=max_gap_s),
+                "device_id": device_id,
+                "max_gap_s": max_gap_s,
+            }
+            with timed(pg_query_seconds, "rollups_backfill_day"):
+                for scope, tier, _ in steps:
+                    cur.execute(_delete_sql(scope, tier), params)
+                for scope, tier, sql in steps:
+                    cur.execute(sql, params)
+                conn.commit()
+            log.info("Rollups reconstruidos para %s", day.isoformat())
+            days += 1
+            day += timedelta(days=1)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return days
+
+
+def _connect():
+    """Conexión con las mismas variables que la API (DATABASE_URL o POSTGRES_*)."""
+    import psycopg2
+    url = os.getenv("DATABASE_URL")
+    if url:
+        if url.startswith("postgres://"):
+            url = url.replace("postgres://", "postgresql://", 1)
+        return psycopg2.connect(url)
+    return psycopg2.connect(
+        host=os.getenv("POSTGRES_HOST", "localhost"),
+        port=os.getenv("POSTGRES_PORT", "5432"),
+        database=os.getenv("POSTGRES_DB", "tesis_iot_db"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+    )
+
+
+def main(argv=None) -> int:
+    from hotlog import flush, setup_logging
+
+    p = argparse.ArgumentParser(description="Reconstruye los rollups de telemetry_history")
+    p.add_argument("--from", dest="start", required=True, type=date.fromisoformat, help="primer día (YYYY-MM-DD)")
+    p.add_argument("--to", dest="end", type=date.fromisoformat, default=None,
+                   help="día siguiente al último (por defecto hoy, UTC)")
+    p.add_argument("--device", type=int, default=None, help="solo este device_id (y su compañía)")
+    p.add_argument("--max-gap-s", type=float, default=ENERGY_MAX_GAP_S)
+    args = p.parse_args(argv)
+
+    setup_logging()
+    end = args.end or datetime.now(timezone.utc).date()
+    conn = _connect()
+    try:
+        days = backfill(conn, args.start, end, args.device, args.max_gap_s)
+    finally:
+        conn.close()
+    log.info("Backfill terminado: %d días", days)
+    flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
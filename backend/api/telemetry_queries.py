@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Consultas de rango sobre telemetry_history para un dispositivo.
+
+El dispositivo se resuelve a su id antes de consultar (registro en memoria),
+así la consulta es un range scan sobre el índice
+idx_telemetry_device_created (device_id, created_at) INCLUDE (voltaje, corriente, potencia)
+(ver scripts/init-db.js), sin JOIN con devices, y sale ordenada por tiempo
+sin un sort aparte.
+
+stream_device_range() lee con un cursor con nombre (server-side) de a
+STREAM_CHUNK_ROWS filas, con el epoch en ms y S/PF ya calculados en SQL, y
+history_export.py codifica cada bloque a medida que sale: la memoria del
+worker no depende del tamaño del rango.
+
+Las columnas se eligen por nombre (RANGE_EXPRS / BUCKET_EXPRS): con fields= solo
+se leen las pedidas. Lo usan /metrics/history-postgres, /metrics/history-smart,
+/metrics/history-batch (variantes devices_*: device_id = ANY, una consulta para
+todos) y /metrics/power-outages.
+"""
+import os
+import itertools
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from instrumentation import pg_query_seconds, timed
+
+STREAM_CHUNK_ROWS = int(os.getenv("PG_STREAM_CHUNK_ROWS", "5000"))
+
+# Filas crudas: expresión de cada columna (ts en ms, S y PF calculados en SQL)
+RANGE_EXPRS: Dict[str, str] = {
+    "ts": "(EXTRACT(EPOCH FROM created_at) * 1000)::bigint",
+    "vrms": "voltaje::float8",
+    "irms": "corriente::float8",
+    "s_apparent_va": "(voltaje * corriente)::float8",
+    "potencia_activa": "potencia::float8",
+    "factor_potencia": ("CASE WHEN voltaje > 0 AND corriente > 0"
+                        " THEN (potencia / (voltaje * corriente))::float8 END"),
+    "energia_acumulada": "energia_acumulada::float8",
+}
+# Columnas por defecto (energia_acumulada no está en el INCLUDE del índice: solo si se pide)
+STREAM_COLUMNS = ("ts", "vrms", "irms", "s_apparent_va", "potencia_activa", "factor_potencia")
+
+# Agregado por ventanas fijas de %(bucket_s)s segundos (ts = inicio de la ventana, en ms)
+BUCKET_TS_EXPR = "(floor(EXTRACT(EPOCH FROM created_at) / %(bucket_s)s) * %(bucket_s)s * 1000)::bigint"
+BUCKET_EXPRS: Dict[str, str] = {
+    "ts": BUCKET_TS_EXPR,
+    "vrms": "avg(voltaje)::float8",
+    "vrms_min": "min(voltaje)::float8",
+    "vrms_max": "max(voltaje)::float8",
+    "irms": "avg(corriente)::float8",
+    "irms_min": "min(corriente)::float8",
+    "irms_max": "max(corriente)::float8",
+    "s_apparent_va": "avg(voltaje * corriente)::float8",
+    "potencia_activa": "avg(potencia)::float8",
+    "potencia_min": "min(potencia)::float8",
+    "potencia_max": "max(potencia)::float8",
+    # Ventanas agregadas: PF = P promedio / S promedio
+    "factor_potencia": "(avg(potencia) / NULLIF(avg(voltaje * corriente), 0))::float8",
+    "count": "count(*)",
+}
+BUCKET_COLUMNS = ("ts", "vrms", "vrms_min", "vrms_max", "irms", "irms_min", "irms_max",
+                  "s_apparent_va", "potencia_activa", "potencia_min", "potencia_max",
+                  "factor_potencia", "count")
+
+
+def _select_list(exprs: Dict[str, str], columns: Sequence[str]) -> str:
+    unknown = [c for c in columns if c not in exprs]
+    if unknown or not columns:
+        raise ValueError(f"columnas inválidas: {', '.join(unknown) or '(ninguna)'}")
+    return ",\n           ".join(f"{exprs[c]} AS {c}" for c in columns)
+
+
+@lru_cache(maxsize=64)
+def device_range_sql(columns: Sequence[str] = STREAM_COLUMNS) -> str:
+    """SELECT de las columnas pedidas del dispositivo en el rango, ordenado por tiempo."""
+    return f"""
+    SELECT {_select_list(RANGE_EXPRS, columns)}
+    FROM telemetry_history
+    WHERE device_id = %s
+      AND created_at >= %s AND created_at <= %s
+    ORDER BY created_at
+"""
+
+
+@lru_cache(maxsize=64)
+def device_buckets_sql(columns: Sequence[str] = BUCKET_COLUMNS) -> str:
+    """Agregado por ventanas de las columnas pedidas (se agrupa por ventana aunque no se pida ts)."""
+    return f"""
+    SELECT {_select_list(BUCKET_EXPRS, columns)}
+    FROM telemetry_history
+    WHERE device_id = %(device_id)s
+      AND created_at >= %(start)s AND created_at <= %(end)s
+    GROUP BY {BUCKET_TS_EXPR}
+    ORDER BY {BUCKET_TS_EXPR}
+"""
+
+
+@lru_cache(maxsize=64)
+def devices_range_sql(columns: Sequence[str] = STREAM_COLUMNS) -> str:
+    """Como device_range_sql para varios dispositivos: device_id primero, ordenado por (device_id, tiempo)."""
+    return f"""
+    SELECT device_id,
+           {_select_list(RANGE_EXPRS, columns)}
+    FROM telemetry_history
+    WHERE device_id = ANY(%(device_ids)s)
+      AND created_at >= %(start)s AND created_at <= %(end)s
+    ORDER BY device_id, created_at
+"""
+
+
+@lru_cache(maxsize=64)
+def devices_buckets_sql(columns: Sequence[str] = BUCKET_COLUMNS) -> str:
+    """Como device_buckets_sql para varios dispositivos, agrupado por (device_id, ventana)."""
+    return f"""
+    SELECT device_id,
+           {_select_list(BUCKET_EXPRS, columns)}
+    FROM telemetry_history
+    WHERE device_id = ANY(%(device_ids)s)
+      AND created_at >= %(start)s AND created_at <= %(end)s
+    GROUP BY device_id, {BUCKET_TS_EXPR}
+    ORDER BY device_id, {BUCKET_TS_EXPR}
+"""
+
+
+# Filas listas para serializar: (ts_ms, vrms, irms, s_apparent_va, potencia_activa, factor_potencia)
+DEVICE_RANGE_STREAM_SQL = device_range_sql(STREAM_COLUMNS)
+DEVICE_BUCKETS_SQL = device_buckets_sql(BUCKET_COLUMNS)
+
+_cursor_ids = itertools.count(1)
+
+
+def stream_query(conn, sql: str, params, query_name: str,
+                 chunk_rows: Optional[int] = None) -> Iterator[List[tuple]]:
+    """
+    Generador de bloques de filas de 'sql' usando un cursor con nombre.
+    La consulta corre en el primer next(): pedirlo antes de responder para que un
+    error de la base salga como 500 y no a mitad del stream.
+    El cursor vive en la transacción de 'conn'; al devolverla al pool se hace rollback.
+    """
+    chunk_rows = chunk_rows or STREAM_CHUNK_ROWS
+    cur = conn.cursor(name=f"th_range_{next(_cursor_ids)}")
+    cur.itersize = chunk_rows
+    try:
+        with timed(pg_query_seconds, query_name):
+            cur.execute(sql, params)
+            rows = cur.fetchmany(chunk_rows)
+        while rows:
+            yield rows
+            rows = cur.fetchmany(chunk_rows)
+    finally:
+        cur.close()
+
+
+def stream_device_range(conn, device_id: int, start, end, query_name: str = "device_range_stream",
+                        chunk_rows: Optional[int] = None,
+                        columns: Sequence[str] = STREAM_COLUMNS) -> Iterator[List[tuple]]:
+    """Filas crudas (columns, por defecto STREAM_COLUMNS) del dispositivo en el rango, ordenadas por tiempo."""
+    return stream_query(conn, device_range_sql(tuple(columns)), (device_id, start, end), query_name, chunk_rows)
+
+
+def stream_device_buckets(conn, device_id: int, start, end, bucket_s: int,
+                          query_name: str = "device_buckets",
+                          columns: Sequence[str] = BUCKET_COLUMNS) -> Iterator[List[tuple]]:
+    """Filas agregadas (columns, por defecto BUCKET_COLUMNS) por ventanas de bucket_s segundos."""
+    params = {"device_id": device_id, "start": start, "end": end, "bucket_s": int(bucket_s)}
+    return stream_query(conn, device_buckets_sql(tuple(columns)), params, query_name)
+
+
+def stream_devices_range(conn, device_ids: Sequence[int], start, end, query_name: str = "devices_range",
+                         columns: Sequence[str] = STREAM_COLUMNS) -> Iterator[List[tuple]]:
+    """Filas crudas (device_id, *columns) de varios dispositivos en una sola consulta."""
+    params = {"device_ids": list(device_ids), "start": start, "end": end}
+    return stream_query(conn, devices_range_sql(tuple(columns)), params, query_name)
+
+
+def stream_devices_buckets(conn, device_ids: Sequence[int], start, end, bucket_s: int,
+                           query_name: str = "devices_buckets",
+                           columns: Sequence[str] = BUCKET_COLUMNS) -> Iterator[List[tuple]]:
+    """Filas agregadas (device_id, *columns) por ventanas de bucket_s segundos de varios dispositivos."""
+    params = {"device_ids": list(device_ids), "start": start, "end": end, "bucket_s": int(bucket_s)}
+    return stream_query(conn, devices_buckets_sql(tuple(columns)), params, query_name)
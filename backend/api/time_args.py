@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Parámetros de fecha de los endpoints (start / end).
+
+Se aceptan un timestamp unix en ms (siempre UTC) o ISO 8601 ('Z' o con offset).
+Un ISO 8601 sin zona se interpreta en el huso por defecto del endpoint: UTC en
+los de historial y cortes, hora de Paraguay en /metrics/energy y /metrics/quality.
+El cache de respuestas (response_cache.py) usa la misma regla para decidir si la
+ventana ya está cerrada.
+"""
+from datetime import datetime, timezone, tzinfo
+
+
+def parse_time_arg(value: str, default_tz: tzinfo = timezone.utc) -> datetime:
+    """datetime con zona para un parámetro start / end. Lanza ValueError si no se puede leer."""
+    if value.isdigit():
+        return datetime.fromtimestamp(int(value) / 1000, tz=timezone.utc)
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return dt if dt.tzinfo else dt.replace(tzinfo=default_tz)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Difusión WebSocket sin bloqueo.
+
+- Cada cliente tiene su propia cola de salida acotada y su propio hilo emisor:
+  un cliente lento solo se atrasa a sí mismo.
+- Política con la cola llena: 'drop_oldest' (descarta lo más viejo) o
+  'disconnect' (cierra al cliente).
+- Suscripciones por tópico con comodines MQTT (+ y #). El cliente manda
+    {"subscribe": ["esp/energia/E2641D44/state"]}
+    {"unsubscribe": ["tesis/iot/esp32/samples/#"]}
+  Sin suscripciones explícitas recibe todo (compatibilidad con el front actual);
+  si se desuscribe de todo lo que había pedido, no recibe nada.
+- El conjunto de clientes es copy-on-write: publish() no toma locks.
+"""
+import json
+import itertools
+import threading
+from collections import deque
+from typing import Dict, Iterable, Optional, Tuple
+
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+_client_ids = itertools.count(1)
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """Coincidencia estilo MQTT: '+' = un nivel, '#' = el resto."""
+    if pattern == "#" or pattern == topic:
+        return True
+    p_parts = pattern.split("/")
+    t_parts = topic.split("/")
+    for i, p in enumerate(p_parts):
+        if p == "#":
+            return True
+        if i >= len(t_parts):
+            return False
+        if p != "+" and p != t_parts[i]:
+            return False
+    return len(p_parts) == len(t_parts)
+
+
+class WsClient:
+    def __init__(self, ws, hub: "WsHub", max_queue: int, policy: str):
+        self.id = next(_client_ids)
+        self.ws = ws
+        self.hub = hub
+        self.policy = policy
+        self.max_queue = max_queue
+        self._q: deque = deque()
+        self._cond = threading.Condition(threading.Lock())
+        # None = nunca se suscribió (todos los tópicos); () = se desuscribió de todo
+        self._filters: Optional[Tuple[str, ...]] = None
+        self._match_cache: Dict[str, bool] = {}
+        self.closed = False
+        self.dropped = 0
+        self.sent = 0
+        self._thread = threading.Thread(target=self._sender, name="ws-sender", daemon=True)
+
+    # ---------- Suscripciones ----------
+    def set_filters(self, subscribe: Iterable[str] = (), unsubscribe: Iterable[str] = ()):
+        subscribe = [str(t) for t in subscribe]
+        if self._filters is None and not subscribe:
+            return  # nunca se suscribió: sigue recibiendo todo
+        current = set(self._filters or ())
+        current.update(subscribe)
+        current.difference_update(str(t) for t in unsubscribe)
+        self._filters = tuple(sorted(current))
+        self._match_cache = {}
+
+    @property
+    def filters(self) -> Tuple[str, ...]:
+        return ("#",) if self._filters is None else self._filters
+
+    def wants(self, topic: str) -> bool:
+        filters = self._filters
+        if filters is None:
+            return True
+        hit = self._match_cache.get(topic)
+        if hit is None:
+            hit = any(topic_matches(p, topic) for p in filters)
+            if len(self._match_cache) < 1024:
+                self._match_cache[topic] = hit
+        return hit
+
+    # ---------- Cola de salida ----------
+    def offer(self, msg: str):
+        with self._cond:
+            if self.closed:
+                return
+            if len(self._q) >= self.max_queue:
+                if self.policy == DISCONNECT:
+                    self.dropped += len(self._q)
+                    self._q.clear()
+                    self.closed = True
+                    self._cond.notify()
+                    return
+                self._q.popleft()
+                self.dropped += 1
+            self._q.append(msg)
+            self._cond.notify()
+
+    def queue_depth(self) -> int:
+        return len(self._q)
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def _sender(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._q and not self.closed:
+                        self._cond.wait(30)
+                    if self.closed:
+                        break
+                    msg = self._q.popleft()
+                self.ws.send(msg)
+                self.sent += 1
+        except Exception:
+            pass
+        finally:
+            self.closed = True
+            self.hub.unregister(self)
+            if self.policy == DISCONNECT:
+                try:
+                    self.ws.close()
+                except Exception:
+                    pass
+
+
+class WsHub:
+    def __init__(self, max_queue: int = 1000, policy: str = DROP_OLDEST):
+        self.max_queue = max(1, max_queue)
+        self.policy = policy if policy in (DROP_OLDEST, DISCONNECT) else DROP_OLDEST
+        self._clients: Tuple[WsClient, ...] = ()
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "delivered": 0, "filtered": 0, "dropped_closed": 0}
+
+    def register(self, ws, initial: Optional[str] = None) -> WsClient:
+        """Alta de un cliente; 'initial' (snapshot) se encola antes que cualquier broadcast."""
+        client = WsClient(ws, self, self.max_queue, self.policy)
+        if initial is not None:
+            client.offer(initial)
+        client.start()
+        with self._lock:
+            self._clients = self._clients + (client,)
+        return client
+
+    def unregister(self, client: WsClient):
+        client.close()
+        with self._lock:
+            if client not in self._clients:
+                return
+            self._clients = tuple(c for c in self._clients if c is not client)
+            # Conservar los descartes de clientes ya desconectados (contador monótono)
+            self.stats["dropped_closed"] += client.dropped
+
+    def publish(self, topic: str, msg: str):
+        """Entrega msg (ya serializado) a la cola de cada cliente interesado en topic."""
+        self.stats["published"] += 1
+        for client in self._clients:
+            if client.wants(topic):
+                client.offer(msg)
+                self.stats["delivered"] += 1
+            else:
+                self.stats["filtered"] += 1
+
+    def handle_control(self, client: WsClient, raw: str) -> bool:
+        """Procesa un mensaje del cliente ({subscribe/unsubscribe}). True si lo entendió."""
+        try:
+            cmd = json.loads(raw)
+        except (TypeError, ValueError):
+            return False
+        if not isinstance(cmd, dict) or not ("subscribe" in cmd or "unsubscribe" in cmd):
+            return False
+        sub = cmd.get("subscribe") or []
+        unsub = cmd.get("unsubscribe") or []
+        if isinstance(sub, str):
+            sub = [sub]
+        if isinstance(unsub, str):
+            unsub = [unsub]
+        client.set_filters(sub, unsub)
+        client.offer(json.dumps({"type": "subscribed", "topics": list(client.filters)}))
+        return True
+
+    def clients(self) -> Tuple[WsClient, ...]:
+        return self._clients
+
+    def snapshot(self):
+        clients = self._clients
+        out = dict(self.stats)
+        out["clients"] = len(clients)
+        out["policy"] = self.policy
+        out["max_queue"] = self.max_queue
+        out["queue_depths"] = [c.queue_depth() for c in clients]
+        out["dropped"] = sum(c.dropped for c in clients)
+        return out
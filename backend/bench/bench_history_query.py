@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark antes/después de la consulta de rango por dispositivo sobre telemetry_history.
+
+Crea un esquema aparte (--schema, por defecto bench_history) con devices y
+telemetry_history sintéticos (--rows filas repartidas en --devices dispositivos,
+una lectura cada --interval-s segundos por dispositivo) y mide:
+
+  legacy : la consulta anterior (LEFT JOIN devices + OR sobre code/id, sin ORDER BY)
+           con los índices que ya existían (fecha, company/device/fecha, user/fecha)
+  indexed: telemetry_queries.DEVICE_RANGE_STREAM_SQL con idx_telemetry_device_created
+           (device_id, created_at) INCLUDE (voltaje, corriente, potencia)
+
+Para cada modo: latencia (p50/p90/p99) de --queries consultas sobre ventanas
+aleatorias de --window-hours, filas por consulta y el plan (EXPLAIN ANALYZE, BUFFERS).
+
+Uso:
+  python backend/bench/bench_history_query.py --rows 5000000 --devices 50 --out history_query.json
+  python backend/bench/bench_history_query.py --reuse --compare history_query.json
+
+--reuse no regenera los datos si el esquema ya tiene --rows filas. --drop borra el esquema al terminar.
+"""
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+
+from common import add_api_to_path, compare, connect_pg, percentiles, write_results
+
+add_api_to_path()
+from telemetry_queries import DEVICE_RANGE_STREAM_SQL  # noqa: E402
+
+# Consulta de /metrics/history-postgres antes del cambio (para comparar)
+LEGACY_SQL = """
+    SELECT
+        th.created_at as "time",
+        COALESCE(d.code, d.id::text, 'UNKNOWN') as device,
+        th.voltaje as vrms,
+        th.corriente as irms,
+        (th.voltaje * th.corriente) as s_apparent_va,
+        th.potencia as potencia_activa,
+        CASE
+            WHEN th.voltaje > 0 AND th.corriente > 0
+            THEN (th.potencia / (th.voltaje * th.corriente))
+            ELSE NULL
+        END as factor_potencia
+    FROM telemetry_history th
+    LEFT JOIN devices d ON th.device_id = d.id
+    WHERE th.created_at >= %s AND th.created_at <= %s
+    AND (d.code = %s OR d.id::text = %s OR th.device_id::text = %s)
+"""
+
+LEGACY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS bench_idx_telemetry_fecha ON telemetry_history(fecha)",
+    "CREATE INDEX IF NOT EXISTS bench_idx_telemetry_user_fecha ON telemetry_history(user_id, fecha)",
+    "CREATE INDEX IF NOT EXISTS bench_idx_telemetry_company_device ON telemetry_history(company_id, device_id, fecha)",
+]
+NEW_INDEX = ("CREATE INDEX IF NOT EXISTS bench_idx_telemetry_device_created "
+             "ON telemetry_history(device_id, created_at) INCLUDE (voltaje, corriente, potencia)")
+
+
+def prepare(conn, args):
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA IF NOT EXISTS {args.schema}")
+    cur.execute(f"SET search_path TO {args.schema}")
+    if args.reuse:
+        cur.execute("SELECT to_regclass('telemetry_history') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT count(*) FROM telemetry_history")
+            if cur.fetchone()[0] >= args.rows:
+                cur.execute("DROP INDEX IF EXISTS bench_idx_telemetry_device_created")
+                return
+    cur.execute("DROP TABLE IF EXISTS telemetry_history")
+    cur.execute("DROP TABLE IF EXISTS devices")
+    cur.execute("""
+        CREATE TABLE devices (
+            id SERIAL PRIMARY KEY,
+            company_id INTEGER,
+            name VARCHAR(200) NOT NULL,
+            code VARCHAR(50) NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE telemetry_history (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER,
+            fecha DATE NOT NULL,
+            voltaje DECIMAL(10,2),
+            corriente DECIMAL(10,2),
+            potencia DECIMAL(10,2),
+            energia_acumulada DECIMAL(10,2),
+            company_id INTEGER,
+            device_id INTEGER,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    cur.execute("""
+        INSERT INTO devices (company_id, name, code)
+        SELECT 1 + (n %% 5), 'Bench ' || n, 'BENCH-' || lpad(n::text, 5, '0')
+        FROM generate_series(1, %s) n
+    """, (args.devices,))
+    # Una lectura por dispositivo cada interval_s, hacia atrás desde ahora
+    t0 = time.monotonic()
+    cur.execute("""
+        INSERT INTO telemetry_history (user_id, fecha, voltaje, corriente, potencia, company_id, device_id, created_at)
+        SELECT 1, ts::date, 220 + random() * 10 - 5, 5 + random() * 3, 1000 + random() * 500,
+               1 + (dev %% 5), dev, ts
+        FROM (
+            SELECT 1 + (n %% %(devices)s) AS dev,
+                   date_trunc('second', NOW()) - make_interval(secs => (n / %(devices)s) * %(interval)s) AS ts
+            FROM generate_series(0, %(rows)s - 1) n
+        ) g
+    """, {"devices": args.devices, "interval": args.interval_s, "rows": args.rows})
+    for sql in LEGACY_INDEXES:
+        cur.execute(sql)
+    conn.commit()
+    print(f"Generadas {args.rows} filas en {time.monotonic() - t0:.1f}s", file=sys.stderr)
+
+
+def vacuum_analyze(conn):
+    conn.commit()
+    old = conn.autocommit
+    conn.autocommit = True
+    conn.cursor().execute("VACUUM ANALYZE telemetry_history")
+    conn.autocommit = old
+
+
+def data_span(cur):
+    cur.execute("SELECT min(created_at), max(created_at) FROM telemetry_history")
+    return cur.fetchone()
+
+
+def windows(cur, args):
+    lo, hi = data_span(cur)
+    window = args.window_hours * 3600
+    span = max(0.0, (hi - lo).total_seconds() - window)
+    rnd = random.Random(args.seed)
+    out = []
+    for _ in range(args.queries):
+        start = lo.timestamp() + rnd.random() * span
+        device_id = rnd.randint(1, args.devices)
+        out.append((device_id, f"BENCH-{device_id:05d}", start, start + window))
+    return out
+
+
+def _params(mode, device_id, code, start, end):
+    s, e = datetime.fromtimestamp(start), datetime.fromtimestamp(end)
+    if mode == "legacy":
+        return LEGACY_SQL, (s, e, code, code, code)
+    return DEVICE_RANGE_STREAM_SQL, (device_id, s, e)
+
+
+def explain(cur, sql, params):
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+    doc = cur.fetchone()[0]
+    doc = doc[0] if isinstance(doc, list) else json.loads(doc)[0]
+    plan = doc["Plan"]
+    nodes = []
+
+    def walk(node):
+        label = node["Node Type"]
+        if node.get("Index Name"):
+            label += f" using {node['Index Name']}"
+        nodes.append(label)
+        for child in node.get("Plans", []):
+            walk(child)
+
+    walk(plan)
+    return {
+        "nodes": nodes,
+        "execution_ms": doc.get("Execution Time"),
+        "shared_hit_blocks": plan.get("Shared Hit Blocks"),
+        "shared_read_blocks": plan.get("Shared Read Blocks"),
+    }
+
+
+def measure(conn, mode, wins):
+    cur = conn.cursor()
+    # Calentar cache con una consulta para no medir la primera lectura de disco
+    sql, params = _params(mode, *wins[0])
+    cur.execute(sql, params)
+    cur.fetchall()
+    lat, rows = [], []
+    for w in wins:
+        sql, params = _params(mode, *w)
+        t0 = time.perf_counter()
+        cur.execute(sql, params)
+        fetched = cur.fetchall()
+        lat.append(time.perf_counter() - t0)
+        rows.append(len(fetched))
+    plan = explain(cur, *_params(mode, *wins[0]))
+    conn.commit()
+    return {
+        "latency_s": percentiles(lat),
+        "rows_per_query_avg": sum(rows) / len(rows) if rows else 0,
+        "plan": plan,
+    }
+
+
+def run(args):
+    conn = connect_pg()
+    try:
+        prepare(conn, args)
+        cur = conn.cursor()
+        cur.execute(f"SET search_path TO {args.schema}")
+        vacuum_analyze(conn)
+        cur = conn.cursor()
+        wins = windows(cur, args)
+
+        results = {"legacy": measure(conn, "legacy", wins)}
+        t0 = time.monotonic()
+        cur.execute(NEW_INDEX)
+        conn.commit()
+        vacuum_analyze(conn)
+        results["index_build_s"] = round(time.monotonic() - t0, 2)
+        results["indexed"] = measure(conn, "indexed", wins)
+
+        old_p50 = results["legacy"]["latency_s"]["p50"]
+        new_p50 = results["indexed"]["latency_s"]["p50"]
+        results["speedup_p50"] = round(old_p50 / new_p50, 1) if old_p50 and new_p50 else None
+
+        if args.drop:
+            cur = conn.cursor()
+            cur.execute(f"DROP SCHEMA {args.schema} CASCADE")
+            conn.commit()
+    finally:
+        conn.close()
+
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    doc = write_results(args.out, "history_query", config, results)
+    if args.compare:
+        regressions = compare(args.compare, doc, higher_is_better=["speedup_p50"],
+                              lower_is_better=["indexed.latency_s.p50", "indexed.latency_s.p99"],
+                              tolerance=args.tolerance)
+        for r in regressions:
+            print(f"REGRESIÓN {r}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark de consultas de rango por dispositivo")
+    p.add_argument("--schema", default="bench_history")
+    p.add_argument("--rows", type=int, default=5_000_000)
+    p.add_argument("--devices", type=int, default=50)
+    p.add_argument("--interval-s", type=int, default=10, help="segundos entre lecturas de un dispositivo")
+    p.add_argument("--window-hours", type=float, default=24)
+    p.add_argument("--queries", type=int, default=50)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--reuse", action="store_true", help="reutilizar los datos si ya existen")
+    p.add_argument("--drop", action="store_true", help="borrar el esquema al terminar")
+    p.add_argument("--out", default="-")
+    p.add_argument("--compare", default=None)
+    p.add_argument("--tolerance", type=float, default=0.15)
+    sys.exit(run(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
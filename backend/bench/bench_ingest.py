@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de ingesta MQTT -> telemetry_history.
+
+Genera payloads sintéticos esp/energia/<code>/state para N dispositivos a una
+tasa dada y los entrega:
+  --mode direct : llamando a app.on_message() en el mismo proceso (sin broker)
+  --mode mqtt   : publicando en un broker local (Mosquitto) al que la app está suscrita
+
+Mide, contra un PostgreSQL local (mismas variables POSTGRES_* / DATABASE_URL que la API):
+  - mensajes/s enviados y filas/s confirmadas (commit) sostenidas
+  - latencia publicación -> commit (p50/p90/p99/p99.9/max)
+  - costo de on_message por mensaje (solo modo direct)
+  - crecimiento de memoria (RSS) e hilos
+  - contadores del escritor por lotes (descartes, bloqueos, lotes)
+
+Uso:
+  python backend/bench/bench_ingest.py --setup --devices 200 --rate 2000 --duration 30 --out ingest.json
+  python backend/bench/bench_ingest.py --devices 200 --rate 0 --duration 30 --compare ingest.json
+
+--setup crea (si no existen) la empresa BENCH y los dispositivos BENCH-00001...
+--rate 0 envía tan rápido como se pueda. --compare sale con código 1 si algún
+indicador empeoró más que --tolerance respecto del resultado anterior.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from types import SimpleNamespace
+
+from common import ProcessSampler, add_api_to_path, compare, percentiles, write_results
+
+DEVICE_PREFIX = "BENCH-"
+
+
+def device_codes(n: int):
+    return [f"{DEVICE_PREFIX}{i:05d}" for i in range(1, n + 1)]
+
+
+def setup_devices(app, n: int):
+    """Crea la empresa y los dispositivos de benchmark (idempotente)."""
+    with app.pg_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO companies (name, code) VALUES ('Benchmark', 'BENCH')
+            ON CONFLICT (code) DO UPDATE SET name = EXCLUDED.name
+            RETURNING id
+        """)
+        company_id = cur.fetchone()[0]
+        for code in device_codes(n):
+            cur.execute("""
+                INSERT INTO devices (company_id, name, code) VALUES (%s, %s, %s)
+                ON CONFLICT (company_id, code) DO NOTHING
+            """, (company_id, f"Bench {code}", code))
+        conn.commit()
+        cur.close()
+
+
+def cleanup_rows(app):
+    with app.pg_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            DELETE FROM telemetry_history th USING devices d
+            WHERE th.device_id = d.id AND d.code LIKE %s
+        """, (DEVICE_PREFIX + "%",))
+        deleted = cur.rowcount
+        conn.commit()
+        cur.close()
+    return deleted
+
+
+def wait_for_registry(app, codes, timeout_s: float) -> bool:
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if app.device_registry.ready and all(app.device_registry.resolve(c) for c in codes):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def make_payload(code: str, seq: int) -> bytes:
+    v = 220.0 + (seq % 7) - 3
+    i = 5.0 + (seq % 11) / 10.0
+    return json.dumps({
+        "device": code,
+        # ms con decimales: la latencia publicación -> commit se mide contra este valor
+        "ts": time.time() * 1000.0,
+        "V": v,
+        "I": i,
+        "S": v * i,
+        "P": v * i * 0.9,
+        "PF": 0.9,
+    }).encode()
+
+
+def run(args):
+    if args.mode == "direct":
+        os.environ["MQTT_ENABLED"] = "0"
+    add_api_to_path()
+    import app  # noqa: E402  (la API arranca pool, registro y escritor al importarse)
+    from ingest import COL_CREATED_AT  # noqa: E402
+
+    codes = device_codes(args.devices)
+    if args.setup:
+        setup_devices(app, args.devices)
+    if not wait_for_registry(app, codes, args.registry_timeout):
+        print("Los dispositivos de benchmark no están en el registro (¿falta --setup?)", file=sys.stderr)
+        return 2
+
+    # Latencia publicación -> commit: envolver el callback after_flush del escritor
+    latencies = []
+    writer = app.telemetry_writer
+    original_after_flush = writer.after_flush
+
+    def after_flush(cursor, conn, rows):
+        now = time.time()
+        for code, values, _ in rows:
+            if code.startswith(DEVICE_PREFIX):
+                latencies.append(now - values[COL_CREATED_AT].timestamp())
+        if original_after_flush:
+            return original_after_flush(cursor, conn, rows)
+
+    writer.after_flush = after_flush
+
+    publisher = None
+    if args.mode == "mqtt":
+        import paho.mqtt.client as mqtt
+        publisher = mqtt.Client(client_id=f"bench-{int(time.time())}", clean_session=True)
+        if app.MQTT_USER and app.MQTT_PASS:
+            publisher.username_pw_set(app.MQTT_USER, app.MQTT_PASS)
+        publisher.connect(args.broker or app.MQTT_BROKER, args.port or app.MQTT_PORT, keepalive=60)
+        publisher.loop_start()
+        time.sleep(1.0)  # dar tiempo a la suscripción de la app
+
+    stats_before = writer.stats()
+    sampler = ProcessSampler(args.sample_interval)
+    sampler.start()
+    handler_s = []
+    sent = 0
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    t_start = time.monotonic()
+    t_end = t_start + args.duration
+    next_t = t_start
+    while True:
+        now = time.monotonic()
+        if now >= t_end:
+            break
+        if interval:
+            if now < next_t:
+                time.sleep(min(next_t - now, 0.01))
+                continue
+            next_t += interval
+        code = codes[sent % len(codes)]
+        topic = f"esp/energia/{code}/state"
+        payload = make_payload(code, sent)
+        if publisher is not None:
+            publisher.publish(topic, payload, qos=args.qos)
+        else:
+            t0 = time.perf_counter()
+            app.on_message(None, None, SimpleNamespace(topic=topic, payload=payload))
+            handler_s.append(time.perf_counter() - t0)
+        sent += 1
+    send_elapsed = time.monotonic() - t_start
+
+    # Esperar a que el escritor vacíe la cola
+    drain_deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < drain_deadline:
+        st = writer.stats()
+        done = st["written"] + st["dropped_full"] + st["dropped_unknown_device"] + st["failed"] \
+            - (stats_before["written"] + stats_before["dropped_full"]
+               + stats_before["dropped_unknown_device"] + stats_before["failed"])
+        if st["queue_depth"] == 0 and done >= sent:
+            break
+        time.sleep(0.05)
+    total_elapsed = time.monotonic() - t_start
+    process = sampler.stop()
+    writer.after_flush = original_after_flush
+    if publisher is not None:
+        publisher.loop_stop()
+        publisher.disconnect()
+
+    stats_after = writer.stats()
+    delta = {k: stats_after[k] - stats_before[k] for k in
+             ("enqueued", "written", "dropped_full", "dropped_unknown_device", "failed",
+              "blocked", "batches", "batch_fallbacks")}
+    results = {
+        "sent": sent,
+        "send_seconds": round(send_elapsed, 3),
+        "total_seconds": round(total_elapsed, 3),
+        "sent_per_s": round(sent / send_elapsed, 1) if send_elapsed else None,
+        "committed_per_s": round(delta["written"] / total_elapsed, 1) if total_elapsed else None,
+        "commit_latency_s": percentiles(latencies),
+        "on_message_s": percentiles(handler_s) if handler_s else None,
+        "ingest": delta,
+        "process": process,
+    }
+    if args.cleanup:
+        results["cleanup_deleted_rows"] = cleanup_rows(app)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    config["ingest_writer"] = {k: stats_after[k] for k in ("batch_size", "linger_ms", "queue_capacity")}
+    doc = write_results(args.out, "ingest", config, results)
+
+    if args.compare:
+        regressions = compare(
+            args.compare, doc,
+            higher_is_better=["committed_per_s", "sent_per_s"],
+            lower_is_better=["commit_latency_s.p50", "commit_latency_s.p99", "on_message_s.p99",
+                             "process.rss_growth_bytes", "process.threads_max"],
+            tolerance=args.tolerance,
+        )
+        for r in regressions:
+            print(f"REGRESIÓN {r}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark de ingesta MQTT -> PostgreSQL")
+    p.add_argument("--mode", choices=("direct", "mqtt"), default="direct")
+    p.add_argument("--devices", type=int, default=100)
+    p.add_argument("--rate", type=float, default=1000, help="mensajes/s en total (0 = sin límite)")
+    p.add_argument("--duration", type=float, default=30, help="segundos enviando")
+    p.add_argument("--qos", type=int, default=0, choices=(0, 1))
+    p.add_argument("--broker", default=None, help="host MQTT (por defecto MQTT_BROKER)")
+    p.add_argument("--port", type=int, default=None)
+    p.add_argument("--setup", action="store_true", help="crear empresa/dispositivos BENCH")
+    p.add_argument("--cleanup", action="store_true", help="borrar las filas BENCH al terminar")
+    p.add_argument("--registry-timeout", type=float, default=30)
+    p.add_argument("--drain-timeout", type=float, default=60)
+    p.add_argument("--sample-interval", type=float, default=1.0)
+    p.add_argument("--out", default="-", help="archivo JSON de resultados ('-' = stdout)")
+    p.add_argument("--compare", default=None, help="JSON de una corrida anterior")
+    p.add_argument("--tolerance", type=float, default=0.10)
+    sys.exit(run(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
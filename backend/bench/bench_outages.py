@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark antes/después de la detección de cortes y gaps de /metrics/power-outages.
+
+Genera en memoria una serie sintética de un dispositivo (--days días, una lectura
+cada --interval-s segundos) con cortes (vrms bajo, con lecturas sin voltaje
+intercaladas), lecturas sueltas sin vrms y períodos sin datos, y mide:
+
+  legacy  : el algoritmo anterior del endpoint (lista de dicts ordenada + while anidado)
+  rowwise : outages.OutageDetector, punto a punto sobre los bloques del cursor
+  columnar: outages.ColumnarOutageDetector (bloques -> arrays NumPy -> detect_outages)
+
+Para cada modo: tiempo (mejor de --repeats), puntos/s, pico de memoria asignada
+durante la detección (tracemalloc, sin contar la serie de entrada) y cantidad de
+eventos. Verifica que los tres modos devuelvan los mismos eventos.
+
+Uso:
+  python backend/bench/bench_outages.py --days 30 --interval-s 1 --out outages.json
+  python backend/bench/bench_outages.py --compare outages.json
+
+--compare sale con código 1 si algún indicador empeoró más que --tolerance.
+"""
+import sys
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from common import add_api_to_path, compare, write_results
+
+add_api_to_path()
+from outages import ColumnarOutageDetector, OutageDetector, format_duration  # noqa: E402
+from telemetry_queries import STREAM_CHUNK_ROWS  # noqa: E402
+
+DEVICE = "BENCH-00001"
+
+
+def series(args):
+    """(ts ms int64, vrms float64 con NaN = sin dato) ordenados por tiempo."""
+    rng = np.random.default_rng(args.seed)
+    step_ms = int(args.interval_s * 1000)
+    n = int(args.days * 86400 / args.interval_s)
+    ts = 1_700_000_000_000 + np.arange(n, dtype=np.int64) * step_ms
+    vrms = rng.normal(220.0, 3.0, n)
+
+    for start in rng.integers(0, n, int(args.outages_per_day * args.days)):
+        length = int(rng.integers(60, 2 * 3600) / args.interval_s) + 1
+        end = min(n, start + length)
+        vrms[start:end] = rng.uniform(0.0, 30.0, end - start)
+        holes = rng.random(end - start) < 0.05
+        vrms[start:end][holes] = np.nan
+    vrms[rng.random(n) < args.missing] = np.nan
+
+    keep = np.ones(n, dtype=bool)
+    for start in rng.integers(0, n, int(args.gaps_per_day * args.days)):
+        length = int(rng.integers(11 * 60, 2 * 3600) / args.interval_s)
+        keep[start:start + length] = False
+    return ts[keep], vrms[keep]
+
+
+def row_chunks(ts, vrms):
+    """Bloques de tuplas (ts, vrms) como los entrega stream_device_range (None = sin dato)."""
+    values = [None if v != v else v for v in vrms.tolist()]
+    rows = list(zip(ts.tolist(), values))
+    return [rows[i:i + STREAM_CHUNK_ROWS] for i in range(0, len(rows), STREAM_CHUNK_ROWS)]
+
+
+def legacy_detect(data, min_voltage, max_gap_minutes):
+    """Detección de /metrics/power-outages antes del cambio (sin el jsonify)."""
+    from datetime import datetime, timezone
+    outages = []
+    sorted_data = sorted(data, key=lambda x: x.get("ts", 0))
+    expected_interval_ms = 60000
+    i = 0
+    while i < len(sorted_data):
+        current = sorted_data[i]
+        current_ts = current.get("ts", 0)
+        current_vrms = current.get("vrms")
+        if current_vrms is not None and current_vrms < min_voltage:
+            outage_start = current_ts
+            outage_start_date = datetime.fromtimestamp(current_ts / 1000, tz=timezone.utc)
+            min_voltage_during_outage = current_vrms
+            max_voltage_during_outage = current_vrms
+            count = 1
+            j = i + 1
+            while j < len(sorted_data):
+                next_point = sorted_data[j]
+                next_ts = next_point.get("ts", 0)
+                next_vrms = next_point.get("vrms")
+                if next_vrms is not None and next_vrms < min_voltage:
+                    min_voltage_during_outage = min(min_voltage_during_outage, next_vrms)
+                    max_voltage_during_outage = max(max_voltage_during_outage, next_vrms)
+                    count += 1
+                    j += 1
+                else:
+                    gap = next_ts - current_ts
+                    if gap > expected_interval_ms * max_gap_minutes or (next_vrms is not None and next_vrms >= min_voltage):
+                        break
+                    j += 1
+            outage_end_ts = sorted_data[j - 1].get("ts", current_ts) if j > i else current_ts
+            outage_end_date = datetime.fromtimestamp(outage_end_ts / 1000, tz=timezone.utc)
+            duration_seconds = (outage_end_ts - outage_start) / 1000
+            outages.append({
+                "type": "power_outage",
+                "start": outage_start_date.isoformat(),
+                "end": outage_end_date.isoformat(),
+                "start_ts": outage_start,
+                "end_ts": outage_end_ts,
+                "duration_seconds": duration_seconds,
+                "duration_formatted": format_duration(duration_seconds),
+                "min_voltage": round(min_voltage_during_outage, 2),
+                "max_voltage": round(max_voltage_during_outage, 2),
+                "data_points": count,
+                "device": current.get("device", "UNKNOWN")
+            })
+            i = j
+            continue
+        if i < len(sorted_data) - 1:
+            next_point = sorted_data[i + 1]
+            next_ts = next_point.get("ts", 0)
+            gap_ms = next_ts - current_ts
+            if gap_ms > expected_interval_ms * max_gap_minutes:
+                gap_start_date = datetime.fromtimestamp(current_ts / 1000, tz=timezone.utc)
+                gap_end_date = datetime.fromtimestamp(next_ts / 1000, tz=timezone.utc)
+                gap_seconds = gap_ms / 1000
+                outages.append({
+                    "type": "no_data",
+                    "start": gap_start_date.isoformat(),
+                    "end": gap_end_date.isoformat(),
+                    "start_ts": current_ts,
+                    "end_ts": next_ts,
+                    "duration_seconds": gap_seconds,
+                    "duration_formatted": format_duration(gap_seconds),
+                    "gap_minutes": round(gap_seconds / 60, 1),
+                    "device": current.get("device", "UNKNOWN")
+                })
+        i += 1
+    return outages
+
+
+def run_legacy(chunks, args):
+    # El endpoint anterior armaba un dict por punto antes de detectar
+    data = [{"ts": ts, "device": DEVICE, "vrms": v} for chunk in chunks for ts, v in chunk]
+    return legacy_detect(data, args.min_voltage, args.max_gap_minutes)
+
+
+def run_rowwise(chunks, args):
+    detector = OutageDetector(args.min_voltage, args.max_gap_minutes)
+    feed = detector.feed
+    for chunk in chunks:
+        for ts, v in chunk:
+            feed(ts, v, DEVICE)
+    return detector.finish()
+
+
+def run_columnar(chunks, args):
+    detector = ColumnarOutageDetector(args.min_voltage, args.max_gap_minutes)
+    for chunk in chunks:
+        detector.feed_chunk(chunk, DEVICE)
+    return detector.finish()
+
+
+MODES = {"legacy": run_legacy, "rowwise": run_rowwise, "columnar": run_columnar}
+
+
+def measure(fn, chunks, points, args):
+    best = None
+    events = None
+    for _ in range(args.repeats):
+        t0 = time.perf_counter()
+        events = fn(chunks, args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    fn(chunks, args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return events, {
+        "seconds": round(best, 4),
+        "points_per_s": round(points / best) if best else None,
+        "peak_alloc_bytes": peak,
+        "events": len(events),
+        "outages": sum(1 for e in events if e["type"] == "power_outage"),
+        "gaps": sum(1 for e in events if e["type"] == "no_data"),
+    }
+
+
+def run(args):
+    t0 = time.monotonic()
+    ts, vrms = series(args)
+    chunks = row_chunks(ts, vrms)
+    points = len(ts)
+    print(f"serie: {points} puntos en {time.monotonic() - t0:.1f}s", file=sys.stderr)
+
+    results = {"points": points}
+    events = {}
+    for mode in args.modes.split(","):
+        events[mode], results[mode] = measure(MODES[mode], chunks, points, args)
+        print(f"{mode}: {results[mode]['seconds']}s, {results[mode]['events']} eventos", file=sys.stderr)
+
+    reference = next(iter(events.values()))
+    results["events_match"] = all(e == reference for e in events.values())
+    if "legacy" in results and "columnar" in results:
+        results["speedup_columnar"] = round(results["legacy"]["seconds"] / results["columnar"]["seconds"], 1)
+    if "rowwise" in results and "columnar" in results:
+        results["speedup_columnar_vs_rowwise"] = round(
+            results["rowwise"]["seconds"] / results["columnar"]["seconds"], 1)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    doc = write_results(args.out, "outages", config, results)
+    status = 0
+    if not results["events_match"]:
+        print("ERROR los modos no devuelven los mismos eventos", file=sys.stderr)
+        status = 1
+    if args.compare:
+        regressions = compare(args.compare, doc, higher_is_better=["columnar.points_per_s"],
+                              lower_is_better=["columnar.seconds", "columnar.peak_alloc_bytes"],
+                              tolerance=args.tolerance)
+        for r in regressions:
+            print(f"REGRESIÓN {r}", file=sys.stderr)
+        if regressions:
+            status = 1
+    return status
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark de detección de cortes y gaps")
+    p.add_argument("--days", type=float, default=30)
+    p.add_argument("--interval-s", type=float, default=1, help="segundos entre lecturas")
+    p.add_argument("--outages-per-day", type=float, default=4, help="cortes a inyectar (1 min a 2 h)")
+    p.add_argument("--gaps-per-day", type=float, default=2, help="períodos sin datos a inyectar (11 min a 2 h)")
+    p.add_argument("--missing", type=float, default=0.001, help="fracción de lecturas sin vrms")
+    p.add_argument("--min-voltage", type=float, default=50)
+    p.add_argument("--max-gap-minutes", type=float, default=10)
+    p.add_argument("--modes", default="legacy,rowwise,columnar")
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--out", default="-")
+    p.add_argument("--compare", default=None)
+    p.add_argument("--tolerance", type=float, default=0.15)
+    sys.exit(run(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Utilidades compartidas por los benchmarks de backend/bench.
+
+- connect_pg(), percentiles(), ProcessSampler (RSS e hilos durante la corrida)
+- write_results(): JSON con la configuración, las métricas y el entorno
+- compare(): compara contra un resultado anterior y marca regresiones
+"""
+import os
+import sys
+import json
+import math
+import time
+import platform
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+
+def add_api_to_path():
+    """Permite 'import app', 'import ingest', etc. desde backend/api."""
+    api = os.path.normpath(API_DIR)
+    if api not in sys.path:
+        sys.path.insert(0, api)
+
+
+def connect_pg():
+    """Conexión psycopg2 con las mismas variables que la API (DATABASE_URL o POSTGRES_*)."""
+    import psycopg2
+    url = os.getenv("DATABASE_URL")
+    if url:
+        if url.startswith("postgres://"):
+            url = url.replace("postgres://", "postgresql://", 1)
+        return psycopg2.connect(url)
+    return psycopg2.connect(
+        host=os.getenv("POSTGRES_HOST", "localhost"),
+        port=os.getenv("POSTGRES_PORT", "5432"),
+        database=os.getenv("POSTGRES_DB", "tesis_iot_db"),
+        user=os.getenv("POSTGRES_USER", "postgres"),
+        password=os.getenv("POSTGRES_PASSWORD", "postgres"),
+    )
+
+
+def percentiles(values: Iterable[float], ps=(50, 90, 99, 99.9)) -> Dict[str, Optional[float]]:
+    data = sorted(values)
+    out: Dict[str, Optional[float]] = {}
+    for p in ps:
+        key = f"p{p:g}".replace(".", "_")
+        if not data:
+            out[key] = None
+            continue
+        idx = min(len(data) - 1, max(0, math.ceil(p / 100.0 * len(data)) - 1))  # nearest-rank
+        out[key] = data[idx]
+    out["max"] = data[-1] if data else None
+    out["count"] = len(data)
+    return out
+
+
+def rss_bytes() -> Optional[int]:
+    """RSS actual del proceso (Linux: /proc/self/statm)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+            # Sin /proc: pico de RSS (ru_maxrss está en KB en Linux, bytes en macOS)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+        except Exception:
+            return None
+
+
+class ProcessSampler:
+    """Muestrea RSS y cantidad de hilos cada 'interval_s' en un hilo de fondo."""
+
+    def __init__(self, interval_s: float = 1.0):
+        self.interval_s = interval_s
+        self.samples: List[Dict[str, Any]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+
+    def _sample(self):
+        self.samples.append({
+            "t": time.monotonic(),
+            "rss_bytes": rss_bytes(),
+            "threads": threading.active_count(),
+        })
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        self._thread.start()
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        rss = [s["rss_bytes"] for s in self.samples if s["rss_bytes"] is not None]
+        threads = [s["threads"] for s in self.samples]
+        return {
+            "rss_start_bytes": rss[0] if rss else None,
+            "rss_end_bytes": rss[-1] if rss else None,
+            "rss_max_bytes": max(rss) if rss else None,
+            "rss_growth_bytes": (rss[-1] - rss[0]) if rss else None,
+            "threads_start": threads[0],
+            "threads_end": threads[-1],
+            "threads_max": max(threads),
+        }
+
+
+def write_results(path: Optional[str], name: str, config: Dict[str, Any], results: Dict[str, Any]) -> Dict[str, Any]:
+    doc = {
+        "benchmark": name,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "env": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": config,
+        "results": results,
+    }
+    body = json.dumps(doc, indent=2, default=str)
+    if path and path != "-":
+        with open(path, "w") as f:
+            f.write(body + "\n")
+    else:
+        print(body)
+    return doc
+
+
+def _lookup(results: Dict[str, Any], dotted: str):
+    cur: Any = results
+    for part in dotted.split("."):
+        if not isinstance(cur, dict) or part not in cur:
+            return None
+        cur = cur[part]
+    return cur
+
+
+def compare(baseline_path: str, current: Dict[str, Any], higher_is_better: List[str],
+            lower_is_better: List[str], tolerance: float) -> List[str]:
+    """
+    Compara 'current' (doc de write_results) contra el JSON en baseline_path.
+    Devuelve la lista de regresiones (vacía si está todo dentro de la tolerancia).
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for key in higher_is_better + lower_is_better:
+        old = _lookup(baseline.get("results", {}), key)
+        new = _lookup(current.get("results", {}), key)
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)) or old == 0:
+            continue
+        change = (new - old) / abs(old)
+        worse = change < -tolerance if key in higher_is_better else change > tolerance
+        if worse:
+            regressions.append(f"{key}: {old:.4g} -> {new:.4g} ({change:+.1%})")
+    return regressions
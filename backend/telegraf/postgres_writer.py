@@ -5,8 +5,11 @@ Parsea el formato InfluxDB line protocol que Telegraf envía
 """
 import sys
 import os
+import queue
+import logging
 import psycopg2
 from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 
 # Configuración de PostgreSQL desde variables de entorno
 # Soporta DATABASE_URL o variables individuales
@@ -17,6 +20,46 @@ POSTGRES_DB = os.getenv('POSTGRES_DB', 'tesis_iot_db')
 POSTGRES_USER = os.getenv('POSTGRES_USER', 'postgres')
 POSTGRES_PASSWORD = os.getenv('POSTGRES_PASSWORD', 'postgres')
 
+# Integración de energía: misma regla que backend/api/energy.py (estado en device_energy_state)
+ENERGY_MAX_GAP_S = float(os.getenv('ENERGY_MAX_GAP_S', '300'))
+
+# Canal en el que los triggers de devices/users/roles avisan cambios (ver scripts/init-db.js)
+NOTIFY_CHANNEL = 'device_registry'
+
+DEVICES_SQL = """
+    SELECT d.code, d.id::text, d.id as device_id, d.company_id,
+           COALESCE(
+               (SELECT u.id FROM users u
+                INNER JOIN roles r ON u.role_id = r.id
+                WHERE u.company_id = d.company_id
+                AND (r.name = 'admin' OR r.name = 'super_admin')
+                LIMIT 1),
+               (SELECT u.id FROM users u
+                WHERE u.company_id = d.company_id
+                LIMIT 1),
+               NULL
+           ) as user_id
+    FROM devices d
+"""
+
+# Logging: stderr (stdout es de Telegraf), nivel por LOG_LEVEL.
+# El detalle por línea va en DEBUG; en INFO solo un resumen cada LOG_EVERY_LINES líneas.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_EVERY_LINES = int(os.getenv('LOG_EVERY_LINES', '1000'))
+log = logging.getLogger('postgres_writer')
+
+def setup_logging():
+    """Handler en cola: escribir a stderr no frena el bucle de inserción"""
+    log_queue = queue.Queue(maxsize=10000)
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    listener = QueueListener(log_queue, handler)
+    log.setLevel(LOG_LEVEL)
+    log.handlers[:] = [QueueHandler(log_queue)]
+    log.propagate = False
+    listener.start()
+    return listener
+
 def connect_db():
     """Conecta a PostgreSQL"""
     try:
@@ -38,7 +81,7 @@ def connect_db():
             )
         return conn
     except Exception as e:
-        print(f"Error conectando a PostgreSQL: {e}", file=sys.stderr)
+        log.error("Error conectando a PostgreSQL: %s", e)
         return None
 
 def parse_influx_line(line):
@@ -100,48 +143,86 @@ def parse_influx_line(line):
             'time': dt
         }
     except Exception as e:
-        print(f"Error parseando línea: {e} - {line}", file=sys.stderr)
+        log.warning("Error parseando línea: %s - %.200s", e, line)
         return None
 
-def insert_telemetry(conn, data):
+def load_devices(conn):
+    """Carga todos los dispositivos en memoria: code/id -> (device_id, company_id, user_id)"""
+    cursor = conn.cursor()
+    cursor.execute(DEVICES_SQL)
+    devices = {}
+    rows = cursor.fetchall()
+    for code, id_text, device_id, company_id, user_id in rows:
+        devices[id_text] = (device_id, company_id, user_id)
+    for code, id_text, device_id, company_id, user_id in rows:
+        if code is not None and code not in devices:
+            devices[code] = (device_id, company_id, user_id)
+    cursor.close()
+    conn.commit()
+    return devices
+
+def refresh_devices_if_notified(conn, devices):
+    """Recarga el mapa de dispositivos si llegó un NOTIFY desde el último commit"""
+    if not conn.notifies:
+        return devices
+    del conn.notifies[:]
+    return load_devices(conn)
+
+def integrate_energy(cursor, device_id, created_at, potencia):
+    """
+    Avanza el acumulador del dispositivo con esta lectura (trapecio desde la anterior,
+    sin sumar si pasaron más de ENERGY_MAX_GAP_S) y devuelve el total en kWh.
+    Bloquea la fila de estado hasta el commit del INSERT.
+    """
+    at = created_at.astimezone(timezone.utc).replace(tzinfo=None) if created_at.tzinfo else created_at
+    p = None if potencia is None else float(potencia)
+    cursor.execute(
+        "SELECT last_at, last_potencia, total_kwh FROM device_energy_state WHERE device_id = %s FOR UPDATE",
+        (device_id,))
+    row = cursor.fetchone()
+    if row is None:
+        last_at, last_p, total = at, p, 0.0
+    else:
+        last_at, last_p, total = row
+        total = total or 0.0
+        if last_at is None or at > last_at:
+            if last_at is not None and last_p is not None and p is not None:
+                dt = (at - last_at).total_seconds()
+                if dt <= ENERGY_MAX_GAP_S:
+                    total += (last_p + p) / 2.0 * dt / 3600000.0
+            last_at, last_p = at, p
+    cursor.execute("""
+        INSERT INTO device_energy_state (device_id, last_at, last_potencia, total_kwh)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (device_id) DO UPDATE SET
+            last_at = EXCLUDED.last_at,
+            last_potencia = EXCLUDED.last_potencia,
+            total_kwh = EXCLUDED.total_kwh,
+            updated_at = NOW()
+    """, (device_id, last_at, last_p, total))
+    return round(total, 6)
+
+def insert_telemetry(conn, data, devices):
     """Inserta datos de telemetría en PostgreSQL - tabla telemetry_history"""
     try:
         # Procesar measurements telemetry y esp
         if data['measurement'] not in ['telemetry', 'esp']:
-            print(f"DEBUG: Ignorando measurement '{data['measurement']}' (solo procesamos 'telemetry' y 'esp')", file=sys.stderr)
+            log.debug("Ignorando measurement '%s' (solo procesamos 'telemetry' y 'esp')", data['measurement'])
             return
         
         device_code = data['tags'].get('device')
         if not device_code:
-            print(f"DEBUG: No se encontró tag 'device' en los datos: {data}", file=sys.stderr)
+            log.debug("No se encontró tag 'device' en los datos: %s", data)
             return
         
         fields = data['fields']
         cursor = conn.cursor()
         
-        # Obtener device_id, company_id y user_id desde el código del dispositivo
+        # Obtener device_id, company_id y user_id desde el mapa en memoria
         # Buscar por código del dispositivo o por device_id si el código es un ID
-        cursor.execute("""
-            SELECT d.id as device_id, d.company_id, 
-                   COALESCE(
-                       (SELECT u.id FROM users u 
-                        INNER JOIN roles r ON u.role_id = r.id
-                        WHERE u.company_id = d.company_id 
-                        AND (r.name = 'admin' OR r.name = 'super_admin')
-                        LIMIT 1),
-                       (SELECT u.id FROM users u 
-                        WHERE u.company_id = d.company_id 
-                        LIMIT 1),
-                       NULL
-                   ) as user_id
-            FROM devices d
-            WHERE d.code = %s OR d.id::text = %s
-            LIMIT 1
-        """, (device_code, device_code))
-        
-        device_info = cursor.fetchone()
+        device_info = devices.get(device_code)
         if not device_info:
-            print(f"DEBUG: No se encontró dispositivo con code/id='{device_code}'", file=sys.stderr)
+            log.debug("No se encontró dispositivo con code/id='%s'", device_code)
             cursor.close()
             return
         
@@ -156,7 +237,13 @@ def insert_telemetry(conn, data):
         voltaje = fields.get('vrms')
         corriente = fields.get('irms')
         potencia = fields.get('potencia_activa')
-        energia_acumulada = None  # No se calcula aquí
+        try:
+            energia_acumulada = integrate_energy(cursor, device_id, data['time'], potencia)
+        except psycopg2.Error as e:
+            # Sin device_energy_state (base sin migrar): insertar sin energía
+            conn.rollback()
+            log.debug("No se pudo integrar energía: %s", e)
+            energia_acumulada = None
         
         # Insertar en telemetry_history
         cursor.execute("""
@@ -178,24 +265,34 @@ def insert_telemetry(conn, data):
         ))
         conn.commit()
         cursor.close()
-        print(f"DEBUG: Insertado en telemetry_history: device={device_code}, device_id={device_id}, fecha={fecha}, voltaje={voltaje}, corriente={corriente}, potencia={potencia}", file=sys.stderr)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Insertado en telemetry_history: device=%s, device_id=%s, fecha=%s, voltaje=%s, corriente=%s, potencia=%s",
+                      device_code, device_id, fecha, voltaje, corriente, potencia)
     except Exception as e:
-        print(f"Error insertando datos: {e} - {data}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+        log.exception("Error insertando datos: %s - %s", e, data)
         conn.rollback()
 
 def main():
     """Lee datos de stdin (desde Telegraf) y los escribe a PostgreSQL"""
-    print("DEBUG: Iniciando script postgres_writer.py", file=sys.stderr)
+    listener = setup_logging()
+    log.info("Iniciando script postgres_writer.py")
     conn = connect_db()
     if not conn:
-        print("DEBUG: No se pudo conectar a PostgreSQL", file=sys.stderr)
+        log.error("No se pudo conectar a PostgreSQL")
+        listener.stop()
         sys.exit(1)
     
-    print("DEBUG: Conectado a PostgreSQL exitosamente", file=sys.stderr)
+    log.info("Conectado a PostgreSQL exitosamente")
     line_count = 0
     
+    # Escuchar cambios de dispositivos: las notificaciones llegan con cada commit
+    cursor = conn.cursor()
+    cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+    cursor.close()
+    conn.commit()
+    devices = load_devices(conn)
+    log.info("%d claves de dispositivos cargadas en memoria", len(devices))
+    
     try:
         # Leer todas las líneas disponibles
         import select
@@ -207,29 +304,28 @@ def main():
                 continue
                 
             line_count += 1
-            if line_count % 10 == 0:
-                print(f"DEBUG: Procesadas {line_count} líneas", file=sys.stderr)
+            if line_count % LOG_EVERY_LINES == 0:
+                log.info("Procesadas %d líneas", line_count)
             
-            # Log cada línea recibida para debug
+            # Las primeras líneas se muestran siempre en DEBUG para diagnóstico
             if line_count <= 5:
-                print(f"DEBUG: Línea {line_count} recibida: {line[:200]}", file=sys.stderr)
+                log.debug("Línea %d recibida: %.200s", line_count, line)
             
             data = parse_influx_line(line)
             if data:
-                print(f"DEBUG: Datos parseados - measurement={data['measurement']}, tags={data['tags']}, fields={list(data['fields'].keys())}", file=sys.stderr)
-                insert_telemetry(conn, data)
+                devices = refresh_devices_if_notified(conn, devices)
+                insert_telemetry(conn, data, devices)
             else:
-                print(f"DEBUG: No se pudo parsear la línea: {line[:100]}", file=sys.stderr)
+                log.debug("No se pudo parsear la línea: %.100s", line)
     except KeyboardInterrupt:
         pass
     except Exception as e:
-        print(f"ERROR en main: {e}", file=sys.stderr)
-        import traceback
-        traceback.print_exc(file=sys.stderr)
+        log.exception("ERROR en main: %s", e)
     finally:
-        print(f"DEBUG: Cerrando conexión. Total líneas procesadas: {line_count}", file=sys.stderr)
+        log.info("Cerrando conexión. Total líneas procesadas: %d", line_count)
         if conn:
             conn.close()
+        listener.stop()
 
 if __name__ == '__main__':
     main()
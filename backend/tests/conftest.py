@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Tests unitarios de backend/api: sin PostgreSQL ni broker MQTT.
+
+Los módulos se importan como en la API ('import ingest', 'import quality', ...);
+las conexiones y cursores son dobles en memoria (FakeConn / FakeCursor).
+"""
+import os
+import sys
+
+API_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+if API_DIR not in sys.path:
+    sys.path.insert(0, API_DIR)
+
+
+class FakeCursor:
+    """Cursor que registra las consultas; 'results' es la cola de respuestas de fetchall()."""
+
+    def __init__(self, conn=None):
+        self.conn = conn
+        self.executed = []
+        self.batches = []
+        self.results = []
+        self.closed = False
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConn:
+    """Conexión mínima para ConnectionPool y los writers."""
+
+    def __init__(self, status=0):
+        self.closed = 0
+        self.status = status
+        self.commits = 0
+        self.rollbacks = 0
+        self.cursors = []
+
+    def cursor(self):
+        cur = FakeCursor(self)
+        self.cursors.append(cur)
+        return cur
+
+    def get_transaction_status(self):
+        return self.status
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = 0
+
+    def close(self):
+        self.closed = 1
+
+
+def record_execute_values(cursor, sql, rows, template=None, page_size=100):
+    """Reemplazo de psycopg2.extras.execute_values: guarda (sql, filas) en el cursor."""
+    cursor.batches.append((sql, list(rows)))
+
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""AlertEngine: prioridad de umbrales, de-duplicación y alertas de un INSERT fallido."""
+from datetime import datetime
+
+import pytest
+
+import alert_engine
+from alert_engine import DEFAULT_UMBRALES, AlertEngine
+from conftest import FakeConn, FakeCursor, record_execute_values
+from device_registry import DeviceInfo
+
+AT = datetime(2026, 3, 1)
+
+
+class FakeRegistry:
+    ready = True
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def subscribe(self, channel, callback):
+        self.callbacks[channel] = callback
+
+    def get_by_id(self, device_id):
+        return DeviceInfo(device_id, f"dev-{device_id}", f"Medidor {device_id}", 10, 100)
+
+
+@pytest.fixture(autouse=True)
+def fake_execute_values(monkeypatch):
+    monkeypatch.setattr(alert_engine, "execute_values", record_execute_values)
+
+
+def engine_with(thresholds, **kw):
+    engine = AlertEngine(registry=FakeRegistry(), **kw)
+    cur = FakeCursor()
+    cur.results.append(thresholds)
+    engine.load_thresholds(cur)
+    return engine
+
+
+def row(device_id, voltaje=220.0, potencia=100.0, company_id=10, user_id=100):
+    values = (user_id, AT, voltaje, 1.0, potencia, None, company_id, device_id, AT)
+    return (f"dev-{device_id}", values, None)
+
+
+def run(engine, rows):
+    conn = FakeConn()
+    cur = conn.cursor()
+    written = engine.process_batch(cur, conn, rows)
+    return written, [r for _, batch in cur.batches for r in batch]
+
+
+def test_company_rule_wins_over_user_rule_and_defaults():
+    engine = engine_with([(10, None, 210, 230, 1000), (None, 100, 100, 300, 9000), (None, 200, None, 1, 1)])
+    assert engine.rule_for(10, 100) == (210, 230, 1000)
+    assert engine.rule_for(99, 100) == (100, 300, 9000)
+    assert engine.rule_for(99, 200) == DEFAULT_UMBRALES        # fila sin voltaje_min: no cuenta
+    assert engine.rule_for(None, None) == DEFAULT_UMBRALES
+
+
+def test_evaluate():
+    engine = engine_with([])
+    assert engine.evaluate(220, 100, None, None) == []
+    assert [a[0] for a in engine.evaluate(260, -6000, None, None)] == ["Alta tensión", "Alto consumo"]
+    assert [a[0] for a in engine.evaluate(190, None, None, None)] == ["Baja tensión"]
+
+
+def test_alerts_are_deduplicated_per_device_and_type():
+    engine = engine_with([])
+    written, alerts = run(engine, [row(1, voltaje=260), row(1, voltaje=270), row(2, voltaje=260)])
+    assert written == 2
+    assert [(a[5], a[2]) for a in alerts] == [("Medidor 1", "Alta tensión"), ("Medidor 2", "Alta tensión")]
+    assert run(engine, [row(1, voltaje=260), row(1, voltaje=190)])[0] == 1    # solo 'Baja tensión'
+    assert engine.stats["alerts_deduped"] == 2
+
+
+def test_alerts_repeat_after_window(monkeypatch):
+    engine = engine_with([], dedup_window_s=20)
+    now = [1000.0]
+    monkeypatch.setattr(alert_engine.time, "monotonic", lambda: now[0])
+    assert run(engine, [row(1, voltaje=260)])[0] == 1
+    now[0] += 19
+    assert run(engine, [row(1, voltaje=260)])[0] == 0
+    now[0] += 2
+    assert run(engine, [row(1, voltaje=260)])[0] == 1
+
+
+def test_failed_insert_does_not_start_dedup_window(monkeypatch):
+    engine = engine_with([])
+
+    def failing(cursor, sql, rows, **kw):
+        raise RuntimeError("insert rechazado")
+
+    monkeypatch.setattr(alert_engine, "execute_values", failing)
+    with pytest.raises(RuntimeError):
+        run(engine, [row(1, voltaje=260)])
+    monkeypatch.setattr(alert_engine, "execute_values", record_execute_values)
+    assert run(engine, [row(1, voltaje=260)])[0] == 1
+
+
+def test_notify_reload_replaces_rules():
+    engine = engine_with([])
+    assert engine.rule_for(10, 100) == DEFAULT_UMBRALES
+    conn = FakeConn()
+    conn.cursor = lambda: _cursor_with([(10, None, 1, 2, 3)])
+    engine.registry.callbacks["umbrales"](conn)
+    assert engine.rule_for(10, 100) == (1, 2, 3)
+    assert engine.stats["threshold_reloads"] == 2
+
+
+def _cursor_with(rows):
+    cur = FakeCursor()
+    cur.results.append(rows)
+    return cur
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""ConnectionPool: reutilización, límite maxconn, conexiones rotas y transacciones abiertas."""
+import threading
+
+import psycopg2
+import pytest
+from psycopg2 import extensions
+
+from conftest import FakeConn
+from db_pool import ConnectionPool, PoolError
+
+
+class Connector:
+    def __init__(self, fail=False):
+        self.opened = []
+        self.fail = fail
+
+    def __call__(self):
+        if self.fail:
+            return None
+        conn = FakeConn()
+        self.opened.append(conn)
+        return conn
+
+
+def test_returned_connection_is_reused():
+    connect = Connector()
+    pool = ConnectionPool(connect, minconn=0, maxconn=2)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert len(connect.opened) == 1
+    stats = pool.stats()
+    assert stats["checkouts"] == 2 and stats["in_use"] == 1 and stats["size"] == 1
+
+
+def test_prefill_opens_minconn():
+    pool = ConnectionPool(Connector(), minconn=3, maxconn=5)
+    pool.prefill()
+    assert pool.stats()["idle"] == 3
+
+
+def test_timeout_when_pool_is_exhausted():
+    pool = ConnectionPool(Connector(), minconn=0, maxconn=1)
+    pool.getconn()
+    with pytest.raises(PoolError):
+        pool.getconn(timeout=0.05)
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiter_gets_connection_when_returned():
+    pool = ConnectionPool(Connector(), minconn=0, maxconn=1)
+    conn = pool.getconn()
+    got = []
+    t = threading.Thread(target=lambda: got.append(pool.getconn(timeout=2)))
+    t.start()
+    threading.Timer(0.05, pool.putconn, (conn,)).start()
+    t.join(3)
+    assert got == [conn]
+
+
+def test_open_transaction_is_rolled_back_on_return():
+    pool = ConnectionPool(Connector(), minconn=0, maxconn=1)
+    conn = pool.getconn()
+    conn.status = extensions.TRANSACTION_STATUS_INTRANS
+    pool.putconn(conn)
+    assert conn.rollbacks == 1
+    assert pool.getconn() is conn
+
+
+def test_broken_and_closed_connections_are_replaced():
+    connect = Connector()
+    pool = ConnectionPool(connect, minconn=0, maxconn=1)
+    first = pool.getconn()
+    pool.putconn(first, broken=True)
+    assert first.closed
+    second = pool.getconn()
+    assert second is not first
+    pool.putconn(second)
+    second.closed = 1                       # se cerró mientras estaba ociosa
+    third = pool.getconn()
+    assert third is not second
+    assert pool.stats()["recycled"] == 2 and pool.stats()["size"] == 1
+
+
+def test_idle_connection_is_pinged():
+    pool = ConnectionPool(Connector(), minconn=0, maxconn=1, ping_idle_s=0)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    (sql, _), = conn.cursors[-1].executed
+    assert sql == "SELECT 1"
+
+
+def test_connect_failure_raises_and_frees_slot():
+    connect = Connector(fail=True)
+    pool = ConnectionPool(connect, minconn=0, maxconn=1)
+    with pytest.raises(PoolError):
+        pool.getconn()
+    assert pool.stats()["size"] == 0 and pool.stats()["connect_errors"] == 1
+    connect.fail = False
+    assert pool.getconn() is not None
+
+
+def test_context_manager_discards_on_operational_error():
+    pool = ConnectionPool(Connector(), minconn=0, maxconn=1)
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            raise psycopg2.OperationalError("se cayó")
+    assert conn.closed
+    with pool.connection() as other:
+        assert other is not conn
+    assert pool.stats()["idle"] == 1
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""DeviceRegistry: índice por id/código y recargas por NOTIFY (completas, por id y de suscriptores)."""
+import json
+
+from conftest import FakeConn, FakeCursor
+from device_registry import DeviceInfo, DeviceRegistry, _index
+
+
+class QueryConn(FakeConn):
+    """Cada cursor nuevo devuelve la siguiente respuesta de 'answers' en fetchall()."""
+
+    def __init__(self, *answers):
+        super().__init__()
+        self.answers = list(answers)
+
+    def cursor(self):
+        cur = FakeCursor(self)
+        if self.answers:
+            cur.results.append(self.answers.pop(0))
+        self.cursors.append(cur)
+        return cur
+
+
+def notify(**msg):
+    return json.dumps(msg)
+
+
+def loaded(*rows):
+    registry = DeviceRegistry(connect=lambda: None)
+    registry._load_all(QueryConn(list(rows)))
+    return registry
+
+
+def test_index_by_id_and_code_without_code_shadowing_an_id():
+    a = DeviceInfo(1, "abc", "A", 10, 100)
+    b = DeviceInfo(2, "1", "B", 10, 100)          # su code coincide con el id de 'a'
+    by_key = _index([a, b])
+    assert by_key["1"] is a and by_key["2"] is b and by_key["abc"] is a
+
+
+def test_resolve_accepts_code_or_numeric_id():
+    registry = loaded((7, "dev-7", "Medidor", 10, 100))
+    assert registry.resolve("dev-7").id == 7
+    assert registry.resolve(7).code == "dev-7"
+    assert registry.resolve("7").name == "Medidor"
+    assert registry.resolve(None) is None and registry.resolve("otro") is None
+    assert registry.devices_for_company(10) == [registry.get_by_id(7)]
+
+
+def test_device_notify_reloads_only_that_device():
+    registry = loaded((1, "a", "A", 10, 100), (2, "b", "B", 10, 100))
+    conn = QueryConn([(2, "b2", "B nuevo", 20, 200)])
+    registry._apply(conn, [notify(table="devices", id=2)])
+    (sql, params), = conn.cursors[0].executed
+    assert "ANY(%s)" in sql and params == ([2],)
+    assert registry.resolve("b") is None
+    assert registry.resolve("b2").company_id == 20
+    assert registry.resolve("a").name == "A"
+    assert registry.stats["incremental_updates"] == 1
+
+
+def test_deleted_device_disappears():
+    registry = loaded((1, "a", "A", 10, 100))
+    registry._apply(QueryConn([]), [notify(table="devices", id=1)])
+    assert registry.resolve("a") is None and registry.get_by_id(1) is None
+
+
+def test_users_roles_or_bad_payload_trigger_full_reload():
+    registry = loaded((1, "a", "A", 10, 100))
+    registry._apply(QueryConn([(1, "a", "A", 10, 300)]), [notify(table="users", id=5)])
+    assert registry.resolve("a").user_id == 300
+    registry._apply(QueryConn([(1, "a", "A", 10, 400)]), ["no es json"])
+    assert registry.resolve("a").user_id == 400
+    assert registry.stats["full_reloads"] == 3
+
+
+def test_subscriber_tables_go_to_their_callback_once_per_batch():
+    registry = loaded((1, "a", "A", 10, 100))
+    calls = []
+    registry.subscribe("umbrales", calls.append)
+    conn = QueryConn()
+    registry._apply(conn, [notify(table="umbrales", id=1), notify(table="umbrales", id=2)])
+    assert calls == [conn]
+    assert conn.cursors == []                     # no recargó dispositivos
+    assert registry.stats["full_reloads"] == 1
+
+
+def test_failing_subscriber_does_not_stop_the_others():
+    registry = loaded()
+    calls = []
+
+    def broken(conn):
+        raise RuntimeError("umbrales rotos")
+
+    registry.subscribe("umbrales", broken)
+    registry.subscribe("umbrales", calls.append)
+    registry._apply(QueryConn(), [notify(table="umbrales")])
+    assert len(calls) == 1
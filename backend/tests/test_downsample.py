@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""LTTB: cantidad de puntos, extremos incluidos y NaN; parámetros de downsample."""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from downsample import from_args, lttb_indices, lttb_rows, parse_duration_s
+
+
+@pytest.mark.parametrize("size,n", [(1000, 3), (1000, 100), (1001, 999), (10, 9)])
+def test_lttb_returns_n_sorted_points_with_endpoints(size, n):
+    rng = np.random.default_rng(size + n)
+    x = np.arange(size, dtype=np.float64)
+    idx = lttb_indices(x, rng.normal(size=size), n)
+    assert len(idx) == n
+    assert idx[0] == 0 and idx[-1] == size - 1
+    assert np.all(np.diff(idx) > 0)
+
+
+def test_lttb_keeps_everything_when_n_is_large():
+    x = np.arange(5, dtype=np.float64)
+    assert lttb_indices(x, x, 5).tolist() == [0, 1, 2, 3, 4]
+    assert lttb_indices(x, x, 50).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_lttb_picks_spike():
+    y = np.zeros(101)
+    y[37] = 100.0
+    assert 37 in lttb_indices(np.arange(101, dtype=np.float64), y, 10)
+
+
+def test_lttb_avoids_nan_when_possible():
+    y = np.sin(np.arange(100) / 5.0)
+    y[1:99:2] = np.nan
+    idx = lttb_indices(np.arange(100, dtype=np.float64), y, 20)
+    assert not np.isnan(y[idx[1:-1]]).any()
+
+
+def test_lttb_rows_over_chunks():
+    chunks = [[(i * 1000, float(i % 7), None if i % 5 else 1.0) for i in range(k, k + 50)] for k in (0, 50)]
+    rows = lttb_rows(chunks + [[]], 1, 10)
+    assert len(rows) == 10
+    assert rows[0][0] == 0 and rows[-1][0] == 99000
+    assert all(isinstance(r[0], int) for r in rows)
+    assert any(r[2] is None for r in rows)
+    assert lttb_rows([], 1, 10) == []
+
+
+def test_parse_duration_s():
+    assert parse_duration_s("30s") == 30
+    assert parse_duration_s("5m") == 300
+    assert parse_duration_s("1.5h") == 5400
+    assert parse_duration_s("2") == 2
+    for bad in ("", "0.2s", "5x"):
+        with pytest.raises(ValueError):
+            parse_duration_s(bad)
+
+
+def test_from_args():
+    start = datetime(2026, 1, 1)
+    end = start + timedelta(days=1)
+    assert from_args({}, start, end).mode == "raw"
+    assert from_args({"downsample": "lttb", "max_points": "500"}, start, end).max_points == 500
+    ds = from_args({"max_points": "100"}, start, end)
+    assert ds.mode == "bucket" and ds.bucket_s == 864
+    assert from_args({"bucket": "1h", "max_points": "100000"}, start, end).bucket_s == 3600
+    for args in ({"downsample": "lttb"}, {"max_points": "2"}, {"downsample": "x"},
+                 {"lttb_field": "otro"}, {"max_points": "abc"}):
+        with pytest.raises(ValueError):
+            from_args(args, start, end)
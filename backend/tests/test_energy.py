@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""EnergyIntegrator.assign: energía acumulada y deltas por fila, con el estado guardado."""
+from datetime import datetime, timedelta
+
+import pytest
+
+import energy
+from conftest import FakeCursor, record_execute_values
+from energy import EnergyIntegrator, trapezoid_kwh
+
+T0 = datetime(2026, 3, 1)
+
+
+@pytest.fixture(autouse=True)
+def fake_execute_values(monkeypatch):
+    monkeypatch.setattr(energy, "execute_values", record_execute_values)
+
+
+def values(device_id, seconds, p):
+    at = T0 + timedelta(seconds=seconds)
+    return (1, at, 220.0, 1.0, p, None, 10, device_id, at)
+
+
+def test_trapezoid():
+    assert trapezoid_kwh(T0, 1000.0, T0 + timedelta(hours=1), 3000.0, max_gap_s=3600) == pytest.approx(2.0)
+    assert trapezoid_kwh(T0, None, T0 + timedelta(hours=1), 3000.0, max_gap_s=3600) == 0.0
+    assert trapezoid_kwh(T0, 1000.0, T0 + timedelta(hours=1), 3000.0, max_gap_s=60) == 0.0
+
+
+def test_deltas_follow_time_order_and_state():
+    integrator = EnergyIntegrator(max_gap_s=600)
+    cur = FakeCursor()
+    # Estado previo del dispositivo 1: última lectura a T0 con 3600 W y 5 kWh acumulados
+    cur.results.append([(1, T0, 3600.0, 5.0)])
+    batch = [values(1, 120, 3600.0), values(1, 60, 3600.0), values(2, 0, 100.0), values(1, 60, 0.0),
+             values(1, 3600, 3600.0)]
+    rows, deltas = integrator.assign(cur, batch)
+
+    assert deltas == pytest.approx([0.06, 0.06, 0.0, 0.0, 0.0])
+    assert [r[5] for r in rows] == pytest.approx([5.12, 5.06, 0.0, 5.06, 5.12])
+    assert integrator.stats["out_of_order"] == 1
+    assert integrator.stats["gaps"] == 1
+    (_, saved), = cur.batches
+    assert saved == [(1, T0 + timedelta(seconds=3600), 3600.0, pytest.approx(5.12)), (2, T0, 100.0, 0.0)]
+
+
+def test_rows_without_device_pass_through():
+    rows, deltas = EnergyIntegrator().assign(FakeCursor(), [values(None, 0, 1.0)])
+    assert rows == [values(None, 0, 1.0)] and deltas == [0.0]
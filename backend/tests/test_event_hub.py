@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""EventHub: ring de eventos, reanudación con Last-Event-ID y suscriptores lentos."""
+import json
+
+import pytest
+
+from event_hub import EventHub, Lagged
+
+
+def test_publish_returns_json_and_assigns_ids():
+    hub = EventHub(16)
+    msg = hub.publish("telemetry", {"v": 1})
+    assert json.loads(msg) == {"topic": "telemetry", "data": {"v": 1}}
+    assert hub.publish_raw("x") == 2
+    assert hub.last_id == 2
+    assert hub.stats["published"] == 2
+
+
+def test_size_has_a_minimum():
+    assert EventHub(1).size == 16
+
+
+def test_read_returns_events_after_cursor():
+    hub = EventHub(16)
+    for i in range(5):
+        hub.publish_raw(f"m{i}")
+    assert hub.read(2, timeout=0) == [(3, "m2"), (4, "m3"), (5, "m4")]
+    assert hub.read(5, timeout=0.01) == []
+
+
+def test_ring_overwrites_oldest_and_lagged_reader_fails():
+    hub = EventHub(16)
+    for i in range(40):
+        hub.publish_raw(f"m{i}")
+    # 40 - 24 = 16 eventos: el cursor todavía está en el ring
+    events = hub.read(24, timeout=0)
+    assert [seq for seq, _ in events] == list(range(25, 41))
+    with pytest.raises(Lagged):
+        hub.read(23, timeout=0)
+    assert hub.stats["dropped_slow"] == 1
+
+
+def test_resume_cursor():
+    hub = EventHub(16)
+    for i in range(40):
+        hub.publish_raw(f"m{i}")
+    assert hub.resume_cursor(None) == (40, False)
+    assert hub.resume_cursor("abc") == (40, False)
+    assert hub.resume_cursor("41") == (40, False)
+    # El evento 25 es el más viejo que queda: se puede reanudar desde 24
+    assert hub.resume_cursor("24") == (24, True)
+    assert hub.stats["replayed"] == 16
+    assert hub.resume_cursor("23") == (40, False)
+
+
+def test_subscribers_count():
+    hub = EventHub()
+    hub.subscribe()
+    hub.subscribe()
+    hub.unsubscribe()
+    assert hub.subscribers == 1
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""history-batch: devices=, códigos en las filas, LTTB por dispositivo, JSON agrupado y start/end."""
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import history_batch as hb
+from history_export import grouped_json_body
+from time_args import parse_time_arg
+
+CODES = {1: "a", 2: "b"}
+
+
+def test_parse_devices_dedups_and_validates(monkeypatch):
+    assert hb.parse_devices(" a, b,,a ,12") == ["a", "b", "12"]
+    with pytest.raises(ValueError):
+        hb.parse_devices(None)
+    with pytest.raises(ValueError):
+        hb.parse_devices(" , ")
+    monkeypatch.setattr(hb, "HISTORY_BATCH_MAX_DEVICES", 2)
+    with pytest.raises(ValueError, match="a lo sumo 2"):
+        hb.parse_devices("a,b,c")
+
+
+def test_with_codes_moves_the_device_to_the_last_column():
+    chunks = [[(1, 1000, 220.0), (2, 1000, 230.0)]]
+    assert list(hb.with_codes(iter(chunks), CODES)) == [[(1000, 220.0, "a"), (1000, 230.0, "b")]]
+
+
+def test_lttb_runs_per_device_across_chunk_boundaries():
+    rows_a = [(1, t * 1000, float(t % 3)) for t in range(10)]
+    rows_b = [(2, t * 1000, 5.0) for t in range(3)]
+    chunks = [rows_a[:4], rows_a[4:] + rows_b[:1], rows_b[1:]]
+    out = list(hb.lttb_by_device(iter(chunks), 1, 4, CODES))
+    assert [len(block) for block in out] == [4, 3]
+    assert out[0][0] == (0, 0.0, "a") and out[0][-1] == (9000, 0.0, "a")
+    assert {row[-1] for row in out[1]} == {"b"}
+
+
+def test_grouped_json_body_merges_chunks_and_lists_missing_devices():
+    columns = ("ts", "vrms", "device")
+    chunks = [[(1, 220.0, "a"), (2, 221.0, "a")], [(3, 222.0, "a"), (1, 230.0, "b")]]
+    body = json.loads("".join(grouped_json_body(iter(chunks), columns, columns, keys=("a", "b", "c"))))
+    assert body == {
+        "a": [{"ts": 1, "vrms": 220.0}, {"ts": 2, "vrms": 221.0}, {"ts": 3, "vrms": 222.0}],
+        "b": [{"ts": 1, "vrms": 230.0}],
+        "c": [],
+    }
+    assert json.loads("".join(grouped_json_body(iter([]), columns, columns, keys=("x",)))) == {"x": []}
+
+
+def test_parse_time_arg():
+    assert parse_time_arg("1772323200000") == datetime(2026, 3, 1, tzinfo=timezone.utc)
+    assert parse_time_arg("2026-03-01T00:00:00Z") == datetime(2026, 3, 1, tzinfo=timezone.utc)
+    py = timezone(timedelta(hours=-3))
+    assert parse_time_arg("2026-03-01T00:00:00", py).utcoffset() == timedelta(hours=-3)
+    with pytest.raises(ValueError):
+        parse_time_arg("ayer")
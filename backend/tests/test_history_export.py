@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""history_export: format=/fields= y los cuerpos json, csv, msgpack, arrow y parquet."""
+import io
+import json
+
+import msgpack
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import history_export as hx
+
+COLUMNS = ("ts", "vrms", "count")
+CHUNKS = [[(1000, 220.5, 3), (2000, 221.0, 4)], [], [(3000, None, 5)]]
+
+
+def render(fmt, out=COLUMNS + ("device",), chunks=CHUNKS):
+    parts = list(hx.body(fmt, iter(chunks), COLUMNS, out, "dev-1"))
+    return parts[0][:0].join(parts)
+
+
+def test_parse_format_and_fields():
+    assert hx.parse_format(None) == "json" and hx.parse_format("CSV") == "csv"
+    with pytest.raises(ValueError):
+        hx.parse_format("xml")
+    assert hx.parse_fields(None, COLUMNS) is None
+    assert hx.parse_fields("vrms, ts,vrms,device", COLUMNS) == ("vrms", "ts", "device")
+    with pytest.raises(ValueError, match="voltios"):
+        hx.parse_fields("ts,voltios", COLUMNS)
+    with pytest.raises(ValueError):
+        hx.parse_fields("device", COLUMNS)
+
+
+def test_columns_to_read_and_output_columns():
+    assert hx.columns_to_read(None, COLUMNS) == COLUMNS
+    assert hx.columns_to_read(("device", "vrms"), COLUMNS) == ("vrms",)
+    assert hx.output_columns(None, COLUMNS) == COLUMNS + ("device",)
+    assert hx.output_columns(("device", "vrms"), ("vrms",)) == ("device", "vrms")
+
+
+def test_json_body_adds_the_device_column():
+    points = json.loads(render("json"))
+    assert points[0] == {"ts": 1000, "vrms": 220.5, "count": 3, "device": "dev-1"}
+    assert len(points) == 3 and points[2]["vrms"] is None
+    assert json.loads(render("json", chunks=[])) == []
+
+
+def test_projection_reorders_columns():
+    assert json.loads(render("json", out=("vrms", "ts")))[0] == {"vrms": 220.5, "ts": 1000}
+
+
+def test_csv_body():
+    assert render("csv", out=("device", "ts", "vrms")).splitlines() == [
+        "device,ts,vrms", "dev-1,1000,220.5", "dev-1,2000,221.0", "dev-1,3000,"]
+
+
+def test_msgpack_body_is_a_header_then_row_arrays():
+    unpacker = msgpack.Unpacker(io.BytesIO(render("msgpack")), raw=False)
+    header, *blocks = list(unpacker)
+    assert header == {"columns": ["ts", "vrms", "count", "device"]}
+    assert [len(b) for b in blocks] == [2, 1] and blocks[1][0] == [3000, None, 5, "dev-1"]
+
+
+def test_arrow_body_types():
+    table = pa.ipc.open_stream(render("arrow")).read_all()
+    assert table.num_rows == 3
+    assert table.schema.field("ts").type == pa.timestamp("ms", tz="UTC")
+    assert table.schema.field("count").type == pa.int64()
+    assert table.column("device").to_pylist() == ["dev-1"] * 3
+
+
+def test_parquet_body_splits_row_groups(monkeypatch):
+    monkeypatch.setattr(hx, "EXPORT_PARQUET_ROW_GROUP", 2)
+    data = render("parquet")
+    parquet = pq.ParquetFile(io.BytesIO(data))
+    assert parquet.metadata.num_rows == 3 and parquet.metadata.num_row_groups == 2
+    assert parquet.read().column("vrms").to_pylist() == [220.5, 221.0, None]
+
+
+def test_headers_only_for_downloads():
+    assert hx.headers("json", "dev-1") == {}
+    assert hx.headers("arrow", "dev-1")["Content-Disposition"].endswith('history_dev-1.arrows"')
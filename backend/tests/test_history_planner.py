@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""HistoryPlanner: plan por cobertura, merge_streams y el stream de Influx con fallback."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from conftest import FakeCursor
+from history_planner import HistoryPlanner, InfluxStream, Part, merge_streams
+
+T0 = datetime(2026, 3, 1, tzinfo=timezone.utc)
+
+
+class NoInflux:
+    configured = False
+
+
+@pytest.fixture
+def planner():
+    p = HistoryPlanner(NoInflux(), workers=2)
+    yield p
+    p._executor.shutdown(wait=False)
+
+
+def start(planner, rows, fallback=lambda: iter([[("pg", 1)]])):
+    stream = InfluxStream(planner, fallback)
+    stream.future = planner._executor.submit(stream.produce, rows)
+    return stream
+
+
+def test_merge_streams_orders_and_drops_duplicates(planner):
+    a = iter([[(1, "a"), (3, "a")], [(5, "a")]])
+    b = iter([[(2, "b"), (3, "b"), (6, "b")]])
+    out = list(merge_streams([a, b], 0, planner.incr, chunk_rows=2))
+    assert [len(c) for c in out] == [2, 2, 1]
+    assert [r for c in out for r in c] == [(1, "a"), (2, "b"), (3, "a"), (5, "a"), (6, "b")]
+    assert planner.snapshot()["duplicates"] == 1
+
+
+def test_merge_streams_single_part_passes_through():
+    chunks = [[(1,), (1,)]]
+    assert list(merge_streams([iter(chunks)], 0)) == chunks
+
+
+def test_influx_stream_delivers_chunks(planner):
+    stream = start(planner, lambda: iter([[(1,)], [(2,)]]))
+    assert list(stream) == [[(1,)], [(2,)]]
+
+
+def test_influx_failure_before_rows_uses_fallback(planner):
+    def rows():
+        raise ConnectionError("influx caído")
+        yield
+
+    assert list(start(planner, rows)) == [[("pg", 1)]]
+    snap = planner.snapshot()
+    assert snap["influx_errors"] == 1 and snap["influx_fallbacks"] == 1
+
+
+def test_influx_failure_mid_stream_aborts(planner):
+    def rows():
+        yield [(1,)]
+        raise ConnectionError("se cortó")
+
+    stream = start(planner, rows)
+    it = iter(stream)
+    assert next(it) == [(1,)]
+    with pytest.raises(ConnectionError):
+        next(it)
+    assert planner.snapshot()["influx_fallbacks"] == 0
+
+
+def test_producer_killed_by_base_exception_does_not_block_reader(planner):
+    class Killed(BaseException):
+        pass
+
+    def rows():
+        yield [(1,)]
+        raise Killed()
+
+    stream = start(planner, rows)
+    it = iter(stream)
+    assert next(it) == [(1,)]
+    with pytest.raises(RuntimeError):
+        next(it)
+
+
+def test_plan_without_influx_is_postgres_only(planner):
+    cur = FakeCursor()
+    cur.fetchone = lambda: (T0.replace(tzinfo=None),)
+    parts = planner.plan(cur, 1, "dev-1", T0 - timedelta(days=1), T0 + timedelta(days=1))
+    assert parts == [Part("postgres", T0 - timedelta(days=1), T0 + timedelta(days=1))]
+    # La cobertura queda en cache: la segunda vez no consulta la base
+    planner.plan(cur, 1, "dev-1", T0, T0 + timedelta(days=1))
+    assert len(cur.executed) == 1
+    assert planner.snapshot()["coverage"] == {"entries": 1, "hits": 1, "loads": 1}
+
+
+def test_plan_before_first_row_is_empty(planner):
+    cur = FakeCursor()
+    cur.fetchone = lambda: (T0.replace(tzinfo=None),)
+    assert planner.plan(cur, 1, "dev-1", T0 - timedelta(days=2), T0 - timedelta(days=1)) == []
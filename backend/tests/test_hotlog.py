@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""hotlog: muestreo, límite por sitio, cola que descarta y formato JSON."""
+import json
+import logging
+import queue
+
+import hotlog
+
+
+def record(msg="hola", level=logging.INFO, lineno=10):
+    return logging.LogRecord("iot.test", level, "/api/ingest.py", lineno, msg, None, None)
+
+
+def test_sampled_is_true_once_every_n_calls_per_key():
+    hits = [hotlog.sampled("test-sampled", 3) for _ in range(7)]
+    assert hits == [True, False, False, True, False, False, True]
+    assert all(hotlog.sampled("test-sampled-1", 1) for _ in range(3))
+
+
+def test_rate_limit_per_site_and_reports_suppressed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(hotlog.time, "monotonic", lambda: now[0])
+    monkeypatch.setitem(hotlog.stats, "suppressed_rate_limit", 0)
+    limit = hotlog.SiteRateLimit(2)
+    assert [limit.filter(record()) for _ in range(4)] == [True, True, False, False]
+    assert limit.filter(record(lineno=11))                      # otro sitio, otra ventana
+    assert limit.filter(record(level=logging.ERROR))            # los errores nunca se suprimen
+    assert hotlog.stats["suppressed_rate_limit"] == 2
+    now[0] += 1
+    rec = record()
+    assert limit.filter(rec)
+    assert rec.msg == "hola (+2 suprimidos)"
+
+
+def test_queue_handler_drops_instead_of_blocking(monkeypatch):
+    monkeypatch.setitem(hotlog.stats, "dropped_queue_full", 0)
+    handler = hotlog._DroppingQueueHandler(queue.Queue(maxsize=1))
+    handler.emit(record("uno"))
+    handler.emit(record("dos"))
+    assert handler.queue.qsize() == 1
+    assert hotlog.stats["dropped_queue_full"] == 1
+
+
+def test_json_formatter():
+    out = json.loads(hotlog.JsonFormatter().format(record("valor %s" % "ñ")))
+    assert out["level"] == "INFO" and out["logger"] == "iot.test" and out["msg"] == "valor ñ"
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""influx_queries: parámetros de las consultas, parser CSV de rows() y textos Flux."""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import influx_queries as iq
+from influx_queries import InfluxQueries
+
+
+class FakeQueryApi:
+    def __init__(self, lines):
+        self.lines = lines
+        self.calls = []
+
+    def query_csv(self, flux, org=None, dialect=None, params=None):
+        self.calls.append((flux, org, params))
+        return iter(self.lines)
+
+
+class FakeClient:
+    def __init__(self, lines=()):
+        self.api = FakeQueryApi(list(lines))
+
+    def query_api(self):
+        return self.api
+
+
+def queries(lines=()):
+    return InfluxQueries(FakeClient(lines), "telemetry", "org")
+
+
+def test_not_configured_without_client_or_bucket():
+    assert not InfluxQueries(None, "b", "o").configured
+    assert not InfluxQueries(FakeClient(), None, "o").configured
+    assert queries().configured
+
+
+def test_params_always_include_bucket_and_use_utc():
+    local = datetime(2026, 3, 1, 12, 0, tzinfo=timezone(timedelta(hours=-3)))
+    params = queries().params(start=local, device="dev-1")
+    assert params == {"bucket": "telemetry", "start": datetime(2026, 3, 1, 15, 0, tzinfo=timezone.utc),
+                      "device": "dev-1"}
+
+
+def test_rows_parses_csv_in_chunks_with_fallback_columns():
+    lines = [
+        ["", "result", "table", "ts", "V", "vrms", "I"],
+        ["", "_result", "0", "1000", "220.5", "", "1.5"],
+        ["", "_result", "0", "2000", "", "221", ""],
+        [""],
+        # otra tabla con otro esquema (sin I)
+        ["", "result", "table", "ts", "vrms", "device"],
+        ["", "_result", "1", "3000", "222", "dev-1"],
+    ]
+    q = queries(lines)
+    columns = {"ts": ("ts",), "vrms": ("vrms", "V"), "irms": ("irms", "I"), "device": ("device",)}
+    chunks = list(q.rows("test", "FLUX", q.params(device="dev-1"), columns, chunk_rows=2))
+    assert chunks == [[(1000, 220.5, 1.5, None), (2000, 221.0, None, None)], [(3000, 222.0, None, "dev-1")]]
+    flux, org, params = q._api.calls[0]
+    assert (flux, org, params) == ("FLUX", "org", {"bucket": "telemetry", "device": "dev-1"})
+
+
+def test_value_column_keeps_non_numeric_text():
+    lines = [["", "result", "table", "_field", "_value"],
+             ["", "_result", "0", "vrms", "220"],
+             ["", "_result", "0", "estado", "online"]]
+    rows, = queries(lines).rows("test", "FLUX", {}, ("_field", "_value"))
+    assert rows == [("vrms", 220.0), ("estado", "online")]
+
+
+def test_device_range_flux_uses_params_and_known_fields_only():
+    flux = iq.device_range_flux(("vrms", "potencia_activa"))
+    assert "r.device == params.device" in flux and "stop: params.stop" in flux
+    assert 'r._field == "P"' in flux and 'r._field == "potencia_actesp"' in flux
+    assert 'r._field == "irms"' not in flux
+    with pytest.raises(ValueError):
+        iq.device_range_flux(("vrms", 'x" or true'))
+
+
+def test_parse_range():
+    assert iq.parse_range("-15m") == timedelta(minutes=15)
+    assert iq.parse_range("7d") == timedelta(days=7)
+    with pytest.raises(ValueError, match="range inválido"):
+        iq.parse_range("ayer")
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""TelemetryWriter: lotes, descarte con cola llena, reparto por dispositivo y chain_hooks."""
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import ingest
+from conftest import FakeConn, record_execute_values
+from device_registry import DeviceInfo
+
+
+class FakePool:
+    def __init__(self):
+        self.conns = []
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = FakeConn()
+        self.conns.append(conn)
+        yield conn
+
+
+class FakeRegistry:
+    ready = True
+
+    def __init__(self, devices):
+        self._devices = {d.code: d for d in devices}
+
+    def resolve(self, code):
+        return self._devices.get(code)
+
+
+DEVICES = [DeviceInfo(n, f"dev-{n}", None, 10, 100 + n) for n in range(1, 6)]
+
+
+def row(code, i):
+    at = datetime(2026, 1, 1, 0, 0, i)
+    return (code, at, 220.0, 1.0, 200.0, at)
+
+
+@pytest.fixture(autouse=True)
+def fake_execute_values(monkeypatch):
+    monkeypatch.setattr(ingest, "execute_values", record_execute_values)
+
+
+def inserted(pool):
+    return [rows for conn in pool.conns for cur in conn.cursors for _, rows in cur.batches]
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timeout esperando al writer"
+        time.sleep(0.01)
+
+
+def test_batches_up_to_batch_size():
+    pool = FakePool()
+    flushed = []
+    writer = ingest.TelemetryWriter(pool, batch_size=2, linger_ms=0, queue_capacity=10,
+                                    registry=FakeRegistry(DEVICES),
+                                    after_flush=lambda cur, conn, rows: flushed.append(rows))
+    for i in range(5):
+        assert writer.submit(row("dev-1", i))
+    writer.start()
+    wait_for(lambda: writer.stats()["written"] == 5)
+    writer.stop()
+
+    assert [len(rows) for rows in inserted(pool)] == [2, 2, 1]
+    assert writer.stats()["batches"] == 3
+    assert all(conn.commits == 1 for conn in pool.conns)
+    # after_flush recibe (device_code, values, energy_kwh); sin integrador energy_kwh es None
+    code, values, energy_kwh = flushed[0][0]
+    assert code == "dev-1" and energy_kwh is None
+    assert values[0] == 101 and values[6] == 10 and values[7] == 1
+
+
+def test_linger_collects_rows_submitted_later():
+    writer = ingest.TelemetryWriter(FakePool(), batch_size=10, linger_ms=200, queue_capacity=10)
+    writer.submit(row("dev-1", 0))
+    t0 = time.monotonic()
+    batch = writer._collect(writer._queues[0])
+    assert len(batch) == 1
+    assert time.monotonic() - t0 >= 0.15
+
+
+def test_drop_on_full_without_block():
+    writer = ingest.TelemetryWriter(FakePool(), queue_capacity=2, block_ms=0)
+    assert writer.submit(row("dev-1", 0))
+    assert writer.submit(row("dev-1", 1))
+    assert not writer.submit(row("dev-1", 2))
+    stats = writer.stats()
+    assert stats["enqueued"] == 2
+    assert stats["dropped_full"] == 1
+    assert stats["queue_depth"] == 2
+
+
+def test_block_then_drop_when_queue_stays_full():
+    writer = ingest.TelemetryWriter(FakePool(), queue_capacity=1, block_ms=50)
+    assert writer.submit(row("dev-1", 0))
+    assert not writer.submit(row("dev-1", 1))
+    stats = writer.stats()
+    assert stats["blocked"] == 1
+    assert stats["dropped_full"] == 1
+    assert stats["blocked_ms_total"] >= 40
+
+
+def test_rows_of_a_device_share_one_worker_queue():
+    writer = ingest.TelemetryWriter(FakePool(), queue_capacity=300, workers=3)
+    assert [q.maxsize for q in writer._queues] == [100, 100, 100]
+    for i in range(20):
+        for dev in DEVICES:
+            writer.submit(row(dev.code, i))
+    for q in writer._queues:
+        codes = {}
+        while not q.empty():
+            r = q.get_nowait()
+            codes.setdefault(r[0], []).append(r[1])
+        for times in codes.values():
+            assert times == sorted(times)
+            assert len(times) == 20
+    assert writer.stats()["queue_depth"] == 0
+
+
+def test_unknown_devices_are_dropped():
+    pool = FakePool()
+    writer = ingest.TelemetryWriter(pool, registry=FakeRegistry(DEVICES))
+    conn = FakeConn()
+    writer._flush(conn, [row("dev-1", 0), row("nope", 1)])
+    assert writer.stats()["dropped_unknown_device"] == 1
+    assert writer.stats()["written"] == 1
+
+
+def test_chain_hooks_isolates_failures():
+    calls = []
+
+    def broken(cur, conn, rows):
+        raise RuntimeError("falla")
+
+    hook = ingest.chain_hooks(broken, lambda cur, conn, rows: calls.append(rows))
+    conn = FakeConn()
+    hook(conn.cursor(), conn, ["fila"])
+    assert calls == [["fila"]]
+    assert conn.rollbacks == 1
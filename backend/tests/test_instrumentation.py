@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Registry / Counter / Histogram / Gauge: formato de exposición y shards por hilo."""
+import gc
+import threading
+
+from instrumentation import Registry, timed
+
+
+def test_counter_sums_shards_of_all_threads():
+    reg = Registry()
+    c = reg.counter("x_total", "ayuda", ("kind",))
+
+    def work():
+        for _ in range(1000):
+            c.inc("a")
+        c.inc("b", n=5)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    del threads
+    gc.collect()                    # los shards de hilos terminados pasan al acumulado
+    c.inc("a")
+    assert c.expose() == ['x_total{kind="a"} 4001', 'x_total{kind="b"} 20']
+
+
+def test_histogram_buckets_are_cumulative():
+    reg = Registry()
+    h = reg.histogram("lat_seconds", "ayuda", ("q",), buckets=(0.1, 1.0))
+    for v in (0.05, 0.1, 0.5, 3.0):
+        h.observe(v, "select")
+    assert h.expose() == [
+        'lat_seconds_bucket{q="select",le="0.1"} 2',
+        'lat_seconds_bucket{q="select",le="1.0"} 3',
+        'lat_seconds_bucket{q="select",le="+Inf"} 4',
+        'lat_seconds_sum{q="select"} 3.65',
+        'lat_seconds_count{q="select"} 4',
+    ]
+
+
+def test_timed_observes_even_on_error():
+    reg = Registry()
+    h = reg.histogram("op_seconds", "ayuda")
+    try:
+        with timed(h):
+            raise ValueError()
+    except ValueError:
+        pass
+    with timed(None):
+        pass
+    assert h.expose()[-1] == "op_seconds_count 1"
+
+
+def test_registry_expose_format_and_broken_gauge():
+    reg = Registry()
+    reg.gauge("depth", "Profundidad", lambda: {"b": 2, "a": 1}, ("queue",))
+    reg.counter_func("sent_total", "Enviados", lambda: 7)
+    reg.gauge("broken", "Falla", lambda: 1 / 0)
+    reg.gauge("empty", "Sin valor", lambda: None)
+    assert reg.counter("c", "x") is reg.counter("c", "otra")
+    text = reg.expose()
+    assert text.endswith("\n")
+    assert '# TYPE depth gauge\ndepth{queue="a"} 1\ndepth{queue="b"} 2' in text
+    assert "# TYPE sent_total counter\nsent_total 7" in text
+    assert "broken" not in text
+    assert "# HELP empty Sin valor" in text
+
+
+def test_label_values_are_escaped():
+    reg = Registry()
+    c = reg.counter("e_total", "x", ("v",))
+    c.inc('a"b\\c\nd')
+    assert c.expose() == ['e_total{v="a\\"b\\\\c\\nd"} 1']
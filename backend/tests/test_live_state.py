@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""LiveState: versiones, consultas incrementales, JSON de la flota y long-polling."""
+import json
+import threading
+
+from live_state import LiveState
+
+
+def update(state, code, vrms=220.0, ts=1):
+    return state.update(code, ts, vrms, 1.0, 220.0, 200.0, 0.9)
+
+
+def test_each_update_bumps_the_global_version():
+    state = LiveState()
+    assert state.version == 0 and state.latest() is None
+    update(state, "a")
+    rec = update(state, "b")
+    assert state.version == 2 and rec.version == 2
+    assert state.latest() is rec and state.get("a").version == 1
+
+
+def test_changed_since_returns_only_newer_records():
+    state = LiveState()
+    update(state, "a")
+    update(state, "b")
+    update(state, "a", vrms=230.0)
+    version, changed = state.changed_since(1)
+    assert version == 3
+    assert sorted(changed) == ["a", "b"] and changed["a"]["vrms"] == 230.0
+    version, changed = state.changed_since(2)
+    assert list(changed) == ["a"]
+    assert state.changed_since(3) == (3, {})
+
+
+def test_fleet_json_is_cached_per_version():
+    state = LiveState()
+    update(state, "a")
+    version, body = state.fleet_json()
+    assert version == 1 and json.loads(body)["devices"]["a"]["device"] == "a"
+    assert state.fleet_json()[1] is body
+    update(state, "b")
+    version, body2 = state.fleet_json()
+    assert version == 2 and body2 is not body and set(json.loads(body2)["devices"]) == {"a", "b"}
+
+
+def test_wait_for_change_wakes_on_update_and_times_out_otherwise():
+    state = LiveState()
+    update(state, "a")
+    assert state.wait_for_change(0, timeout=0.01)
+    assert not state.wait_for_change(1, timeout=0.01)
+    timer = threading.Timer(0.05, update, (state, "b"))
+    timer.start()
+    try:
+        assert state.wait_for_change(1, timeout=5)
+    finally:
+        timer.join()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""TimerWheel y LivenessTracker: lecturas, Last Will, timeout, load() y eventos pendientes."""
+from collections import deque
+from contextlib import contextmanager
+
+import liveness
+from conftest import FakeConn, FakeCursor
+from liveness import LivenessTracker, TimerWheel
+
+
+def test_expires_only_after_deadline():
+    wheel = TimerWheel(1.0, 8, now=0.0)
+    wheel.schedule("a", 2.5)
+    wheel.schedule("b", 5.0)
+    assert wheel.size == 2
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ["a"]
+    assert wheel.advance(4.9) == []
+    assert wheel.advance(5.0) == ["b"]
+    assert wheel.size == 0
+
+
+def test_past_deadline_fires_on_next_tick():
+    wheel = TimerWheel(1.0, 8, now=10.0)
+    wheel.schedule("a", 3.0)
+    assert wheel.advance(10.5) == []
+    assert wheel.advance(11.0) == ["a"]
+
+
+def test_entries_of_a_later_lap_stay_in_the_slot():
+    wheel = TimerWheel(1.0, 4, now=0.0)
+    wheel.schedule("near", 1.0)
+    wheel.schedule("far", 5.0)      # mismo slot que 'near', una vuelta después
+    assert wheel.advance(1.0) == ["near"]
+    assert wheel.size == 1
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.0) == ["far"]
+
+
+def test_jump_longer_than_a_lap_expires_everything_due():
+    wheel = TimerWheel(1.0, 4, now=0.0)
+    for n in range(1, 4):
+        wheel.schedule(n, float(n))
+    assert sorted(wheel.advance(100.0)) == [1, 2, 3]
+    assert wheel.size == 0
+
+
+def test_same_key_scheduled_twice_expires_twice():
+    wheel = TimerWheel(0.5, 16, now=0.0)
+    wheel.schedule("a", 1.0)
+    wheel.schedule("a", 2.0)
+    assert wheel.advance(1.0) == ["a"]
+    assert wheel.advance(2.0) == ["a"]
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class StatePool:
+    """Pool con una conexión cuyo cursor devuelve 'rows' (LAST_STATE_SQL)."""
+
+    def __init__(self, rows=()):
+        self.rows = list(rows)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = FakeConn()
+        conn.cursor = lambda: _cursor(self.rows)
+        yield conn
+
+
+def _cursor(rows):
+    cur = FakeCursor()
+    cur.results.append(rows)
+    return cur
+
+
+def tracker(pool=None, timeout_s=60.0):
+    clock = Clock()
+    events = []
+    t = LivenessTracker(pool, on_change=events.append, timeout_s=timeout_s, tick_s=1.0, slots=8, clock=clock)
+    return t, clock, events
+
+
+def changes(events):
+    return [(e["device"], e["status"], e["reason"]) for e in events]
+
+
+def test_data_brings_device_online_and_timeout_takes_it_offline():
+    t, clock, events = tracker()
+    t.seen("dev-1", ts_ms=1)
+    t.seen("dev-1", ts_ms=2)
+    assert changes(events) == [("dev-1", "online", "data")]
+    clock.now += 59
+    assert t.tick() == 0
+    clock.now += 2
+    assert t.tick() == 1
+    assert changes(events)[-1] == ("dev-1", "offline", "timeout")
+    assert t.get("dev-1")["last_seen"] == 2
+    # Sin agendar: otro tick no vuelve a emitir
+    clock.now += 100
+    assert t.tick() == 0
+
+
+def test_fresh_data_rearms_instead_of_expiring():
+    t, clock, events = tracker()
+    t.seen("dev-1")
+    clock.now += 50
+    t.seen("dev-1")
+    clock.now += 11
+    assert t.tick() == 0
+    assert t.stats["rearmed"] == 1
+    clock.now += 48
+    assert t.tick() == 0
+    clock.now += 2
+    assert t.tick() == 1
+    assert changes(events) == [("dev-1", "online", "data"), ("dev-1", "offline", "timeout")]
+
+
+def test_last_will_offline_then_online():
+    t, clock, events = tracker()
+    t.seen("dev-1")
+    t.status("dev-1", "offline")
+    t.status("dev-1", "offline")          # repetido: sin evento
+    t.status("dev-1", "online")
+    assert changes(events) == [("dev-1", "online", "data"), ("dev-1", "offline", "lwt"),
+                               ("dev-1", "online", "lwt")]
+    # El 'online' del LWT también vence si no llegan lecturas
+    clock.now += 61
+    assert t.tick() == 1
+    assert changes(events)[-1] == ("dev-1", "offline", "timeout")
+
+
+def test_offline_device_returns_with_data():
+    t, clock, events = tracker()
+    t.status("dev-1", "offline")
+    t.seen("dev-1")
+    assert changes(events) == [("dev-1", "offline", "lwt"), ("dev-1", "online", "data")]
+
+
+def test_load_suppresses_retained_last_will_and_arms_online_devices():
+    pool = StatePool([("dev-1", "offline", "lwt", 10, 5), ("dev-2", "online", "data", 20, 15)])
+    t, clock, events = tracker(pool)
+    assert t.load() == 2
+    # El broker reenvía los Last Will retenidos al suscribirse
+    t.status("dev-1", "offline")
+    t.status("dev-2", "online")
+    assert events == []
+    clock.now += 61
+    assert t.tick() == 1
+    assert changes(events) == [("dev-2", "offline", "timeout")]
+
+
+def test_load_keeps_messages_received_before_it():
+    t, _, events = tracker(StatePool([("dev-1", "offline", "lwt", 10, 5)]))
+    t.seen("dev-1")
+    t.load()
+    assert t.get("dev-1")["status"] == "online"
+
+
+def test_summary_counts_unknown_status_separately():
+    t, _, _ = tracker()
+    t.seen("dev-1")
+    t.status("dev-2", "offline")
+    with t._lock:
+        t._devices["dev-3"] = liveness._Device()
+    summary = t.summary()
+    assert (summary["devices"], summary["online"], summary["offline"], summary["unknown"]) == (3, 1, 1, 1)
+
+
+def test_pending_overflow_is_counted():
+    t, _, _ = tracker(StatePool())
+    t._pending = deque(maxlen=2)
+    for n in range(3):
+        t.seen(f"dev-{n}")
+    assert t.stats["record_dropped"] == 1
+    assert [e["device"] for e in t._pending] == ["dev-1", "dev-2"]
+
+
+def test_flush_records_pending_events(monkeypatch):
+    inserted = []
+    monkeypatch.setattr(liveness, "execute_values", lambda cur, sql, rows, **kw: inserted.extend(rows))
+    t, _, _ = tracker(StatePool())
+    t.seen("dev-1", ts_ms=1234)
+    assert t.flush() == 1
+    (code, status, reason, ts, last_seen), = inserted
+    assert (code, status, reason, last_seen) == ("dev-1", "online", "data", 1234)
+    assert t.flush() == 0 and t.stats["recorded"] == 1
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""OutageTracker.process_batch: apertura, continuación y cierre de cortes entre lotes."""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import outage_tracker
+from outage_tracker import (CLOSE_OPEN_SQL, INSERT_EVENTS_SQL, LOCK_STATE_SQL, SAVE_STATE_SQL, OutageTracker,
+                            _event_row)
+from outages import EXPECTED_INTERVAL_MS, OutageDetector
+
+T0 = datetime(2026, 3, 1)
+STEP = timedelta(milliseconds=EXPECTED_INTERVAL_MS)
+
+
+class OutageDB:
+    """device_outage_state y power_outages en memoria, con el índice único de cortes abiertos."""
+
+    def __init__(self):
+        self.state = {}
+        self.outages = []
+        self.commits = 0
+
+    def execute_values(self, cursor, sql, rows, template=None, page_size=100):
+        if sql == CLOSE_OPEN_SQL:
+            for device_id, end_at, vmin, vmax, points in rows:
+                open_rows = [o for o in self.outages if o[0] == device_id and o[3] is None]
+                assert len(open_rows) == 1
+                open_rows[0][3:] = [end_at, vmin, vmax, points]
+        elif sql == INSERT_EVENTS_SQL:
+            for r in rows:
+                if r[3] is None:
+                    assert not any(o[0] == r[0] and o[3] is None for o in self.outages), "dos cortes abiertos"
+                self.outages.append(list(r))
+        elif sql == SAVE_STATE_SQL:
+            for device_id, tracked_since, *rest in rows:
+                if device_id in self.state:
+                    tracked_since = self.state[device_id][0]
+                self.state[device_id] = (tracked_since, *rest)
+        else:
+            raise AssertionError(f"SQL inesperado: {sql}")
+
+    def cursor(self):
+        return OutageCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class OutageCursor:
+    def __init__(self, db):
+        self.db = db
+        self._result = []
+
+    def execute(self, sql, params=None):
+        assert sql == LOCK_STATE_SQL
+        self._result = [(d,) + self.db.state[d] for d in params[0] if d in self.db.state]
+
+    def fetchall(self):
+        return self._result
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = OutageDB()
+    monkeypatch.setattr(outage_tracker, "execute_values", db.execute_values)
+    return db
+
+
+def reading(device_id, n, v):
+    at = T0 + n * STEP
+    return (f"dev-{device_id}", (1, at, v, 1.0, 100.0, None, 10, device_id, at), None)
+
+
+def run(tracker, db, rows):
+    return tracker.process_batch(db.cursor(), db, rows)
+
+
+def test_outage_opens_continues_and_closes_across_batches(db):
+    tracker = OutageTracker(min_voltage=50, max_gap_minutes=10)
+    assert run(tracker, db, [reading(1, 0, 220.0), reading(1, 1, 221.0)]) == 0
+    assert db.outages == []
+
+    run(tracker, db, [reading(1, 2, 10.0), reading(1, 3, 20.0)])
+    assert db.outages == [[1, "power_outage", T0 + 2 * STEP, None, 10.0, 20.0, 2]]
+    assert db.state[1][3] == T0 + 2 * STEP          # outage_start
+
+    run(tracker, db, [reading(1, 4, 15.0)])
+    assert len(db.outages) == 1
+    assert db.state[1][4:] == (T0 + 4 * STEP, 10.0, 20.0, 3)
+
+    assert run(tracker, db, [reading(1, 5, 220.0)]) == 1
+    assert db.outages == [[1, "power_outage", T0 + 2 * STEP, T0 + 4 * STEP, 10.0, 20.0, 3]]
+    assert db.state[1][3:] == (None,) * 5
+    assert db.state[1][0] == T0
+    assert tracker.stats["opened"] == 1 and tracker.stats["closed"] == 1
+
+
+def test_out_of_order_readings_are_skipped(db):
+    tracker = OutageTracker(min_voltage=50, max_gap_minutes=10)
+    run(tracker, db, [reading(1, 5, 220.0)])
+    run(tracker, db, [reading(1, 3, 10.0), reading(1, 5, 10.0), reading(1, 6, 220.0)])
+    assert tracker.stats["out_of_order"] == 2
+    assert db.outages == []
+    assert db.state[1][1] == T0 + 6 * STEP
+
+
+def test_gap_between_batches_writes_no_data(db):
+    tracker = OutageTracker(min_voltage=50, max_gap_minutes=10)
+    run(tracker, db, [reading(1, 0, 220.0)])
+    assert run(tracker, db, [reading(1, 30, 220.0)]) == 1
+    assert db.outages == [[1, "no_data", T0, T0 + 30 * STEP, None, None, None]]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_batches_match_detector_over_whole_series(db, seed):
+    rng = np.random.default_rng(seed)
+    tracker = OutageTracker(min_voltage=50, max_gap_minutes=5)
+    series = {}
+    for device_id in (1, 2):
+        n = np.cumsum(np.where(rng.random(600) < 0.02, rng.integers(6, 20, 600), 1))
+        v = rng.normal(220, 5, 600)
+        for start in rng.integers(0, 600, 15):
+            v[start:start + rng.integers(1, 25)] = rng.uniform(0, 40)
+        series[device_id] = [(int(k), None if rng.random() < 0.05 else float(x)) for k, x in zip(n, v)]
+
+    rows = [reading(d, k, v) for d in series for k, v in series[d]]
+    rows.sort(key=lambda r: r[1][8])
+    i = 0
+    while i < len(rows):
+        size = int(rng.integers(1, 80))
+        run(tracker, db, rows[i:i + size])
+        i += size
+
+    for device_id, points in series.items():
+        det = OutageDetector(50, 5)
+        for k, v in points:
+            det.feed(outage_tracker._ms(T0 + k * STEP), v)
+        expected = [list(_event_row(device_id, e)) for e in det.events]
+        assert expected, "la serie debería tener eventos"
+        got = [o for o in db.outages if o[0] == device_id]
+        outage, _ = det.state()
+        if outage is not None:
+            open_row = got.pop(next(j for j, o in enumerate(got) if o[3] is None))
+            assert open_row[2] == outage_tracker._at(outage[0])
+            assert db.state[device_id][4] == outage_tracker._at(outage[1])
+        assert sorted(got, key=lambda o: (o[2], o[1])) == sorted(expected, key=lambda o: (o[2], o[1]))
+
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+detect_outages (columnar) da los mismos eventos que OutageDetector (punto a punto).
+detect_outages_sql: parámetros de OUTAGES_SQL y filas -> eventos (sin PostgreSQL no se corre la consulta).
+"""
+import numpy as np
+import pytest
+
+from conftest import FakeCursor
+from outages import (EXPECTED_INTERVAL_MS, OUTAGES_SQL, ColumnarOutageDetector, OutageDetector,
+                     detect_outages, detect_outages_sql)
+
+
+def random_series(seed, n=2000):
+    rng = np.random.default_rng(seed)
+    # Intervalos normales con algunos huecos largos
+    steps = np.where(rng.random(n) < 0.02, rng.integers(10, 40, n), 1) * EXPECTED_INTERVAL_MS
+    ts = np.cumsum(steps) + 1_700_000_000_000
+    v = rng.normal(220, 5, n)
+    # Rachas bajas y lecturas sin voltaje (NaN)
+    for start in rng.integers(0, n, 30):
+        v[start:start + rng.integers(1, 30)] = rng.uniform(0, 40)
+    v[rng.random(n) < 0.05] = np.nan
+    return ts, v
+
+
+def stream(ts, vrms, **kw):
+    det = OutageDetector(**kw)
+    for t, v in zip(ts.tolist(), vrms.tolist()):
+        det.feed(t, None if v != v else v, "dev")
+    return det.finish()
+
+
+@pytest.mark.parametrize("seed", range(8))
+@pytest.mark.parametrize("max_gap_minutes", [1, 10])
+def test_detect_outages_matches_streaming_detector(seed, max_gap_minutes):
+    ts, v = random_series(seed)
+    expected = stream(ts, v, min_voltage=50, max_gap_minutes=max_gap_minutes)
+    assert expected, "la serie debería tener eventos"
+    assert detect_outages(ts, v, "dev", 50, max_gap_minutes) == expected
+
+
+def test_columnar_detector_over_chunks():
+    ts, v = random_series(99, 500)
+    rows = [(t, None if x != x else x) for t, x in zip(ts.tolist(), v.tolist())]
+    det = ColumnarOutageDetector(50, 10)
+    for i in range(0, len(rows), 64):
+        det.feed_chunk(rows[i:i + 64], device="dev")
+    assert det.finish() == stream(ts, v, min_voltage=50, max_gap_minutes=10)
+
+
+def test_outage_absorbs_missing_points_and_closes_on_normal():
+    step = EXPECTED_INTERVAL_MS
+    ts = np.arange(6) * step
+    v = np.array([220.0, 10.0, np.nan, 20.0, 220.0, 220.0])
+    events = detect_outages(ts, v, "dev", 50, 10)
+    assert len(events) == 1
+    assert events[0] == stream(ts, v, min_voltage=50, max_gap_minutes=10)[0]
+    assert events[0]["data_points"] == 2
+
+
+def test_empty_series():
+    assert detect_outages(np.array([]), np.array([])) == []
+
+
+def sql_rows(events):
+    """Filas que devuelve OUTAGES_SQL para esos eventos: (type, start_ts, end_ts, vmin, vmax, points)."""
+    rows = []
+    for e in events:
+        if e["type"] == "power_outage":
+            rows.append(("power_outage", e["start_ts"], e["end_ts"], e["min_voltage"], e["max_voltage"],
+                         e["data_points"]))
+        else:
+            rows.append(("no_data", e["start_ts"], e["end_ts"], None, None, None))
+    return rows
+
+
+def test_detect_outages_sql_params_and_events():
+    ts, v = random_series(3)
+    expected = detect_outages(ts, v, "dev", 50, 5)
+    cur = FakeCursor()
+    cur.results.append(sql_rows(expected))
+    events = detect_outages_sql(cur, 7, "s", "e", "dev", min_voltage=50, max_gap_minutes=5)
+    assert events == expected
+    (sql, params), = cur.executed
+    assert sql is OUTAGES_SQL
+    assert params == {"device_id": 7, "start": "s", "end": "e", "min_voltage": 50,
+                      "gap_ms": 5 * EXPECTED_INTERVAL_MS}
+
+
+def test_outages_sql_reads_the_device_range_in_index_order():
+    assert "WHERE device_id = %(device_id)s" in OUTAGES_SQL
+    assert "JOIN" not in OUTAGES_SQL.upper()
+    assert OUTAGES_SQL.rstrip().endswith("ORDER BY start_ts")
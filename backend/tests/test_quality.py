@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""QuantileSketch (error relativo, merge) y QualityWriter (bandas, estado tras el commit)."""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import quality
+from quality import (SKETCH_RELATIVE_ACCURACY, ZERO_KEY, Bands, QualityWriter, QuantileSketch, key_value,
+                     parse_quantiles, power_factor, sketch_key)
+
+QS = (0.0, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1.0)
+
+
+def sketch_of(values):
+    s = QuantileSketch()
+    for x in values:
+        s.add(float(x))
+    return s
+
+
+def test_key_value_within_relative_accuracy():
+    for x in np.geomspace(1e-3, 1e4, 500):
+        assert abs(key_value(sketch_key(x)) - x) <= SKETCH_RELATIVE_ACCURACY * x * (1 + 1e-9)
+    assert sketch_key(0.0) == ZERO_KEY
+    assert key_value(ZERO_KEY) == 0.0
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_quantiles_within_relative_accuracy(seed):
+    rng = np.random.default_rng(seed)
+    values = np.concatenate([rng.normal(220, 8, 5000), rng.uniform(0, 30, 200), rng.lognormal(0, 1, 300)])
+    values = np.abs(values)
+    got = sketch_of(values).quantiles(QS)
+    exact = np.quantile(values, QS, method="lower")
+    for g, e in zip(got, exact):
+        assert abs(g - e) <= SKETCH_RELATIVE_ACCURACY * e + 1e-3
+
+
+def test_merge_equals_sketch_of_combined_data():
+    rng = np.random.default_rng(7)
+    a, b = rng.normal(220, 10, 1000), rng.normal(200, 30, 700)
+    merged = sketch_of(a)
+    merged.merge(sketch_of(b))
+    assert merged.bins == sketch_of(np.concatenate([a, b])).bins
+    assert merged.count == 1700
+
+
+def test_arrays_round_trip_and_bounds():
+    s = sketch_of([1.0, 2.0, 2.0, 300.0])
+    keys, counts = s.arrays()
+    assert keys == sorted(keys) and sum(counts) == 4
+    assert QuantileSketch.from_arrays(keys, counts).bins == s.bins
+    lo, hi = s.quantiles([0.0, 1.0], lo=1.0, hi=300.0)
+    assert lo == 1.0 and hi == 300.0
+    assert QuantileSketch().quantiles([0.5]) == [None]
+
+
+def test_quantiles_keep_requested_order():
+    s = sketch_of(range(1, 101))
+    p99, p1 = s.quantiles([0.99, 0.01])
+    assert p1 < p99
+
+
+def test_bands_and_power_factor():
+    bands = Bands(nominal_v=220, interruption_pct=10, sag_pct=90, swell_pct=110)
+    assert [bands.index(v) for v in (5, 150, 220, 250)] == [0, 1, 2, 3]
+    assert power_factor(220, 1, 110) == 0.5
+    assert power_factor(220, 1, -500) == 1.0
+    assert power_factor(0, 1, 10) is None
+    assert power_factor(None, 1, 10) is None
+
+
+def test_parse_quantiles():
+    assert parse_quantiles("0.1, 0.9") == (0.1, 0.9)
+    assert parse_quantiles(None)
+    with pytest.raises(ValueError):
+        parse_quantiles("1.5")
+
+
+class _Conn:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.commits = 0
+
+    def commit(self):
+        if self.fail:
+            raise RuntimeError("commit rechazado")
+        self.commits += 1
+
+
+def _row(device_id, seconds, v, i=1.0, p=100.0):
+    at = datetime(2026, 3, 1) + timedelta(seconds=seconds)
+    return (f"dev-{device_id}", (1, at, v, i, p, None, 10, device_id, at), None)
+
+
+@pytest.fixture
+def upserts(monkeypatch):
+    rows = []
+    monkeypatch.setattr(quality, "execute_values", lambda cur, sql, values, **kw: rows.extend(values))
+    return rows
+
+
+def test_writer_band_seconds_and_hour_rows(upserts):
+    writer = QualityWriter(Bands(220, 10, 90, 110), max_gap_s=60)
+    assert writer.process_batch(None, _Conn(), [_row(1, 0, 220.0), _row(1, 10, 150.0), _row(1, 40, 230.0),
+                                                _row(1, 3590, 245.0), _row(1, 3610, 220.0)]) == 2
+    first, second = upserts
+    assert first[:3] == (1, datetime(2026, 3, 1, 0), 4)
+    # normal 10 s, sag 30 s; el hueco de 3550 s no cuenta
+    assert first[-4:] == (0.0, 30.0, 10.0, 0.0)
+    assert second[2] == 1 and second[-4:] == (0.0, 0.0, 0.0, 20.0)
+
+
+def test_failed_upsert_does_not_advance_last_reading(upserts):
+    writer = QualityWriter(Bands(220, 10, 90, 110), max_gap_s=60)
+    writer.process_batch(None, _Conn(), [_row(1, 0, 150.0)])
+    with pytest.raises(RuntimeError):
+        writer.process_batch(None, _Conn(fail=True), [_row(1, 10, 250.0)])
+    assert writer._last[1][0] == datetime(2026, 3, 1)
+    # El reintento del mismo lote no se descarta como fuera de orden y cuenta desde la lectura guardada
+    upserts.clear()
+    writer.process_batch(None, _Conn(), [_row(1, 10, 250.0)])
+    assert upserts[0][-4:] == (0.0, 10.0, 0.0, 0.0)
+    assert writer.stats["out_of_order"] == 0
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""ResponseCache: LRU por bytes, vigencia según el fin de la ventana y ETag / 304."""
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from flask import Flask, Response
+
+from response_cache import Entry, ResponseCache, _parse_end
+from time_args import parse_time_arg
+
+PYT = timezone(timedelta(hours=-3))
+CLOSED_END = "2020-01-01T00:00:00Z"
+
+
+def entry(body, expires_at=None):
+    return Entry(body, "application/json", (), "etag", expires_at)
+
+
+def make_app(cache, default_tz=timezone.utc):
+    app = Flask(__name__)
+    calls = []
+
+    @app.route("/history")
+    @cache.cached(default_tz)
+    def history():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    @app.route("/stream")
+    @cache.cached()
+    def stream():
+        calls.append(1)
+        return Response((part for part in ("a" * 10, "b" * 10)), mimetype="text/csv")
+
+    @app.route("/missing")
+    @cache.cached()
+    def missing():
+        calls.append(1)
+        return {"error": "no"}, 404
+
+    return app.test_client(), calls
+
+
+def test_lru_evicts_least_recently_used_by_bytes():
+    cache = ResponseCache(max_bytes=10, max_entry_bytes=10)
+    cache.put("a", entry(b"aaaa"))
+    cache.put("b", entry(b"bbbb"))
+    assert cache.get("a") is not None          # 'a' pasa a ser la más reciente
+    cache.put("c", entry(b"cccc"))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.snapshot()["bytes"] == 8
+    assert cache.stats["evicted"] == 1
+
+
+def test_entry_larger_than_limit_is_not_stored():
+    cache = ResponseCache(max_bytes=100, max_entry_bytes=5)
+    cache.put("a", entry(b"123456"))
+    assert cache.get("a") is None
+    assert cache.stats["too_large"] == 1
+
+
+def test_expired_entry_is_dropped():
+    cache = ResponseCache()
+    cache.put("a", entry(b"x", expires_at=time.monotonic() - 1))
+    assert cache.get("a") is None
+    assert cache.stats["expired"] == 1
+    assert cache.snapshot()["entries"] == 0
+
+
+def test_expires_at_depends_on_window_end():
+    cache = ResponseCache(live_ttl_s=15, ingest_lag_s=300)
+    assert cache.expires_at(datetime(2020, 1, 1, tzinfo=timezone.utc)) is None
+    live = cache.expires_at(datetime.now(timezone.utc))
+    assert live == pytest.approx(time.monotonic() + 15, abs=1)
+    assert cache.expires_at(None) is not None
+
+
+def test_parse_end_uses_default_timezone():
+    assert _parse_end("2026-01-01T00:00:00", PYT) == datetime(2026, 1, 1, 3, tzinfo=timezone.utc)
+    assert _parse_end("2026-01-01T00:00:00Z", PYT) == datetime(2026, 1, 1, tzinfo=timezone.utc)
+    assert _parse_end("1767225600000", PYT) == datetime(2026, 1, 1, tzinfo=timezone.utc)
+    assert _parse_end("basura") is None
+    assert _parse_end(None) is None
+    assert parse_time_arg("2026-01-01T00:00:00") == datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def test_closed_window_hit_and_etag_revalidation():
+    cache = ResponseCache()
+    client, calls = make_app(cache)
+    first = client.get(f"/history?end={CLOSED_END}&device=1")
+    assert first.headers["X-Cache"] == "MISS"
+    etag = first.headers["ETag"].strip('"')
+
+    # Los parámetros en otro orden usan la misma entrada
+    second = client.get(f"/history?device=1&end={CLOSED_END}")
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.get_json() == {"n": 1}
+
+    not_modified = client.get(f"/history?end={CLOSED_END}&device=1", headers={"If-None-Match": f'"{etag}"'})
+    assert not_modified.status_code == 304
+    assert len(calls) == 1
+    assert cache.stats["hits"] == 1 and cache.stats["not_modified"] == 1
+
+
+def test_live_window_expires_after_ttl():
+    cache = ResponseCache(live_ttl_s=0)
+    client, calls = make_app(cache)
+    end = datetime.now(timezone.utc).isoformat()
+    client.get("/history", query_string={"end": end})
+    assert client.get("/history", query_string={"end": end}).headers["X-Cache"] == "MISS"
+    assert len(calls) == 2
+
+
+def test_naive_end_is_read_in_the_view_timezone():
+    # Ventana que en UTC ya está cerrada pero en hora de Paraguay todavía no
+    cache = ResponseCache(live_ttl_s=60, ingest_lag_s=3 * 3600 - 600)
+    client, _ = make_app(cache, PYT)
+    end = (datetime.now(PYT) - timedelta(minutes=30)).replace(tzinfo=None).isoformat()
+    client.get("/history", query_string={"end": end})
+    (stored,) = cache._entries.values()
+    assert stored.expires_at is not None
+
+
+def test_streamed_response_is_stored_after_sending():
+    cache = ResponseCache()
+    client, calls = make_app(cache)
+    first = client.get(f"/stream?end={CLOSED_END}")
+    assert first.data == b"a" * 10 + b"b" * 10
+    assert "ETag" not in first.headers
+    second = client.get(f"/stream?end={CLOSED_END}")
+    assert second.headers["X-Cache"] == "HIT" and second.data == first.data
+    assert second.mimetype == "text/csv"
+    assert len(calls) == 1
+
+
+def test_errors_and_disabled_cache_are_not_stored():
+    cache = ResponseCache()
+    client, calls = make_app(cache)
+    client.get("/missing")
+    client.get("/missing")
+    assert len(calls) == 2
+    cache.enabled = False
+    client.get(f"/history?end={CLOSED_END}")
+    client.get(f"/history?end={CLOSED_END}")
+    assert cache.snapshot()["entries"] == 0
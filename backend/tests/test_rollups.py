@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""rollups: SQL de upsert, agregado de un lote, elección de tier y backfill día por día."""
+from datetime import date, datetime, timezone
+
+import pytest
+
+import rollups
+from conftest import FakeConn, record_execute_values
+from rollups import RollupWriter, pick_tier
+
+T0 = datetime(2026, 3, 1, 10, 0, 30)
+
+
+@pytest.fixture(autouse=True)
+def fake_execute_values(monkeypatch):
+    monkeypatch.setattr(rollups, "execute_values", record_execute_values)
+
+
+def row(device_id, created_at, voltaje=220.0, corriente=2.0, potencia=400.0, company_id=10, energy_kwh=0.001):
+    values = (100, created_at, voltaje, corriente, potencia, None, company_id, device_id, created_at)
+    return (f"dev-{device_id}", values, energy_kwh)
+
+
+def test_upsert_sql_merges_partials():
+    sql = rollups.UPSERT_SQL[("device", "1m")]
+    assert "INSERT INTO telemetry_rollup_device_1m AS t (device_id, bucket," in sql
+    assert "ON CONFLICT (device_id, bucket) DO UPDATE" in sql
+    assert "v_min = LEAST(t.v_min, EXCLUDED.v_min)" in sql
+    assert "p_max = GREATEST(t.p_max, EXCLUDED.p_max)" in sql
+    assert "samples = t.samples + EXCLUDED.samples" in sql
+    assert "energy_wh = t.energy_wh + EXCLUDED.energy_wh" in sql
+    assert "ON CONFLICT (company_id, bucket)" in rollups.UPSERT_SQL[("company", "1d")]
+
+
+def test_aggregate_groups_by_scope_tier_and_bucket():
+    rows = [
+        row(1, T0, voltaje=210.0, potencia=100.0),
+        row(1, T0.replace(second=50), voltaje=230.0, corriente=None, potencia=300.0),
+        row(1, T0.replace(minute=1), voltaje=220.0),
+        row(2, T0, company_id=None),
+        row(None, T0),                                     # sin device_id: no cuenta
+    ]
+    grouped = RollupWriter().aggregate(rows)
+    minute = grouped[("device", "1m")][(1, datetime(2026, 3, 1, 10, 0))]
+    acc = dict(zip(rollups.AGG_COLUMNS, minute))
+    assert acc["samples"] == 2 and acc["v_n"] == 2 and acc["v_sum"] == 440.0
+    assert (acc["v_min"], acc["v_max"], acc["p_min"], acc["p_max"]) == (210.0, 230.0, 100.0, 300.0)
+    assert acc["i_n"] == 1 and acc["s_n"] == 1 and acc["s_sum"] == 420.0
+    assert acc["energy_wh"] == pytest.approx(2.0)
+    hour = grouped[("device", "1h")][(1, datetime(2026, 3, 1, 10, 0))]
+    assert hour[0] == 3
+    company_day = grouped[("company", "1d")]
+    assert list(company_day) == [(10, datetime(2026, 3, 1))] and company_day[(10, datetime(2026, 3, 1))][0] == 3
+    assert (2, datetime(2026, 3, 1)) in grouped[("device", "1d")]
+
+
+def test_aware_timestamps_are_bucketed_in_utc():
+    aware = datetime(2026, 3, 1, 23, 30, tzinfo=timezone.utc).astimezone()
+    grouped = RollupWriter().aggregate([row(1, aware)])
+    assert list(grouped[("device", "1d")]) == [(1, datetime(2026, 3, 1))]
+
+
+def test_process_batch_upserts_every_table_in_one_commit():
+    conn = FakeConn()
+    cur = conn.cursor()
+    writer = RollupWriter()
+    written = writer.process_batch(cur, conn, [row(1, T0), row(2, T0)])
+    tables = [sql.split("INTO ")[1].split()[0] for sql, _ in cur.batches]
+    assert len(tables) == 6 and "telemetry_rollup_company_1h" in tables
+    # 3 tiers x (2 dispositivos + 1 compañía)
+    assert written == 9 and conn.commits == 1
+    device_rows = cur.batches[0][1]
+    assert [r[0] for r in device_rows] == [1, 2]
+
+
+def test_pick_tier():
+    assert pick_tier(30) is None
+    assert pick_tier(60) == ("1m", 60)
+    assert pick_tier(7200) == ("1h", 3600)
+    assert pick_tier(86400 * 7) == ("1d", 86400)
+    assert pick_tier(90) is None                           # no es múltiplo de 1m
+    assert pick_tier(90, exact=False) == ("1m", 60)
+    assert pick_tier(5400, exact=False) == ("1h", 3600)
+
+
+def test_read_sql_validates_columns():
+    sql = rollups.read_sql("company", "1h", ("ts", "energy_wh"))
+    assert "FROM telemetry_rollup_company_1h" in sql and "company_id = %(key_id)s" in sql
+    with pytest.raises(ValueError):
+        rollups.read_sql("device", "1m", ("ts", "nope"))
+
+
+def test_backfill_rebuilds_each_day_in_its_own_transaction():
+    conn = FakeConn()
+    assert rollups.backfill(conn, date(2026, 3, 1), date(2026, 3, 3), device_id=7, max_gap_s=300) == 2
+    assert conn.commits == 2
+    executed = conn.cursors[0].executed
+    # 6 tablas: DELETE + reconstrucción por día
+    assert len(executed) == 24
+    sql, params = executed[6]
+    assert "INSERT INTO telemetry_rollup_device_1m" in sql
+    assert params["device_id"] == 7 and params["start"] == datetime(2026, 3, 1)
+    assert params["lookback"] == datetime(2026, 2, 28, 23, 55)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""telemetry_queries: SQL por device_id sobre el índice (device_id, created_at) y selección de columnas."""
+import os
+import re
+
+import pytest
+
+import telemetry_queries as tq
+
+INIT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "scripts", "init-db.js")
+
+
+def test_range_sql_filters_by_device_id_without_join_and_orders_by_time():
+    sql = tq.DEVICE_RANGE_STREAM_SQL
+    assert "JOIN" not in sql.upper() and "::text" not in sql
+    assert re.search(r"WHERE device_id = %s\s+AND created_at >= %s AND created_at <= %s", sql)
+    assert sql.rstrip().endswith("ORDER BY created_at")
+
+
+def test_default_columns_are_covered_by_the_index():
+    with open(INIT_DB, encoding="utf-8") as f:
+        init_db = f.read()
+    assert "telemetry_history(device_id, created_at) INCLUDE (voltaje, corriente, potencia)" in init_db
+    select = tq.DEVICE_RANGE_STREAM_SQL.split("FROM")[0]
+    assert "energia_acumulada" not in select
+
+
+def test_only_requested_columns_are_selected():
+    sql = tq.device_range_sql(("ts", "vrms"))
+    assert "AS ts" in sql and "AS vrms" in sql and "AS irms" not in sql
+    assert tq.device_range_sql(("ts", "vrms")) is sql          # cacheado
+
+
+def test_unknown_or_empty_columns_are_rejected():
+    with pytest.raises(ValueError, match="voltios"):
+        tq.device_range_sql(("ts", "voltios"))
+    with pytest.raises(ValueError):
+        tq.device_buckets_sql(())
+
+
+def test_multi_device_sql_uses_any_and_orders_by_device_then_time():
+    sql = tq.devices_range_sql(tq.STREAM_COLUMNS)
+    assert "device_id = ANY(%(device_ids)s)" in sql
+    assert sql.rstrip().endswith("ORDER BY device_id, created_at")
+    assert "GROUP BY device_id, " + tq.BUCKET_TS_EXPR in tq.devices_buckets_sql(tq.BUCKET_COLUMNS)
+
+
+class NamedCursor:
+    """Cursor con nombre: fetchmany() entrega 'rows' de a bloques."""
+
+    def __init__(self, rows, fail=None):
+        self.rows = list(rows)
+        self.fail = fail
+        self.executed = []
+        self.fetches = 0
+        self.closed = False
+        self.itersize = None
+
+    def execute(self, sql, params=None):
+        if self.fail:
+            raise self.fail
+        self.executed.append((sql, params))
+
+    def fetchmany(self, n):
+        self.fetches += 1
+        out, self.rows = self.rows[:n], self.rows[n:]
+        return out
+
+    def close(self):
+        self.closed = True
+
+
+class StreamConn:
+    def __init__(self, cur):
+        self.cur = cur
+        self.names = []
+
+    def cursor(self, name=None):
+        self.names.append(name)
+        return self.cur
+
+
+def test_stream_query_reads_in_chunks_with_a_named_cursor():
+    cur = NamedCursor([(i,) for i in range(5)])
+    conn = StreamConn(cur)
+    chunks = tq.stream_query(conn, "SELECT 1", ("p",), "test", chunk_rows=2)
+    assert cur.executed == []                 # perezoso: la consulta corre en el primer next()
+    assert list(chunks) == [[(0,), (1,)], [(2,), (3,)], [(4,)]]
+    assert conn.names[0].startswith("th_range_") and cur.itersize == 2
+    assert cur.executed == [("SELECT 1", ("p",))] and cur.closed
+
+
+def test_stream_query_closes_the_cursor_when_abandoned_or_failing():
+    cur = NamedCursor([(i,) for i in range(5)])
+    chunks = tq.stream_query(StreamConn(cur), "SELECT 1", (), "test", chunk_rows=2)
+    next(chunks)
+    chunks.close()
+    assert cur.closed and cur.fetches == 1
+
+    cur = NamedCursor([], fail=RuntimeError("canceling statement"))
+    with pytest.raises(RuntimeError):
+        next(tq.stream_query(StreamConn(cur), "SELECT 1", (), "test"))
+    assert cur.closed
+
+
+def test_stream_device_helpers_pass_the_right_params():
+    cur = NamedCursor([])
+    list(tq.stream_device_range(StreamConn(cur), 7, "s", "e"))
+    assert cur.executed[-1] == (tq.DEVICE_RANGE_STREAM_SQL, (7, "s", "e"))
+    list(tq.stream_devices_buckets(StreamConn(cur), (1, 2), "s", "e", 60.0))
+    assert cur.executed[-1][1] == {"device_ids": [1, 2], "start": "s", "end": "e", "bucket_s": 60}
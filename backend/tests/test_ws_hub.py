@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""WsHub: filtros por tópico y políticas de cola llena (drop_oldest / disconnect)."""
+import json
+
+import pytest
+
+from ws_hub import DISCONNECT, DROP_OLDEST, WsClient, WsHub, topic_matches
+
+
+class FakeWs:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize("pattern,topic,expected", [
+    ("#", "telemetry/dev-1", True),
+    ("telemetry/dev-1", "telemetry/dev-1", True),
+    ("telemetry/+", "telemetry/dev-1", True),
+    ("telemetry/+", "telemetry/dev-1/extra", False),
+    ("telemetry/#", "telemetry/dev-1/extra", True),
+    ("+/dev-1", "liveness/dev-1", True),
+    ("telemetry/+", "liveness/dev-1", False),
+    ("telemetry/dev-1/x", "telemetry/dev-1", False),
+    ("telemetry", "telemetry/dev-1", False),
+])
+def test_topic_matches(pattern, topic, expected):
+    assert topic_matches(pattern, topic) is expected
+
+
+def client(policy, max_queue=3):
+    hub = WsHub(max_queue=max_queue, policy=policy)
+    # Sin start(): la cola no se vacía y se puede inspeccionar
+    return WsClient(FakeWs(), hub, hub.max_queue, hub.policy)
+
+
+def test_drop_oldest_keeps_newest_messages():
+    c = client(DROP_OLDEST)
+    for i in range(5):
+        c.offer(f"m{i}")
+    assert list(c._q) == ["m2", "m3", "m4"]
+    assert c.dropped == 2
+    assert not c.closed
+
+
+def test_disconnect_drops_queue_and_closes():
+    c = client(DISCONNECT)
+    for i in range(4):
+        c.offer(f"m{i}")
+    assert c.closed
+    assert c.queue_depth() == 0
+    assert c.dropped == 3
+    c.offer("tarde")
+    assert c.queue_depth() == 0
+
+
+def test_unknown_policy_falls_back_to_drop_oldest():
+    assert WsHub(policy="otra").policy == DROP_OLDEST
+
+
+def test_publish_filters_by_subscription():
+    hub = WsHub()
+    a, b = client(DROP_OLDEST, 10), client(DROP_OLDEST, 10)
+    a.hub = b.hub = hub
+    hub._clients = (a, b)
+    assert hub.handle_control(b, json.dumps({"subscribe": "telemetry/+"}))
+    assert json.loads(b._q.popleft()) == {"type": "subscribed", "topics": ["telemetry/+"]}
+
+    hub.publish("telemetry/dev-1", "t")
+    hub.publish("liveness/dev-1", "l")
+    assert list(a._q) == ["t", "l"]
+    assert list(b._q) == ["t"]
+    assert hub.stats == {"published": 2, "delivered": 3, "filtered": 1, "dropped_closed": 0}
+
+    hub.handle_control(b, json.dumps({"unsubscribe": ["telemetry/+"]}))
+    assert b.filters == ()
+    assert not hub.handle_control(b, "no es json")
+    assert not hub.handle_control(b, json.dumps({"otra": 1}))
+
+
+def test_registered_client_sends_snapshot_first_and_unregisters_on_close():
+    hub = WsHub(max_queue=10)
+    ws = FakeWs()
+    c = hub.register(ws, initial="snapshot")
+    hub.publish("telemetry/dev-1", "t")
+    c._thread.join(0.2)
+    c.close()
+    c._thread.join(2)
+    assert ws.sent[:2] == ["snapshot", "t"]
+    assert hub.clients() == ()
+
+
+def test_unsubscribing_the_last_topic_stops_delivery():
+    hub = WsHub()
+    c = client(DROP_OLDEST, 10)
+    c.hub = hub
+    hub._clients = (c,)
+    assert c.filters == ("#",)
+    # Sin suscripciones previas, desuscribirse no cambia nada
+    hub.handle_control(c, json.dumps({"unsubscribe": "samples/#"}))
+    assert c.filters == ("#",)
+    hub.handle_control(c, json.dumps({"subscribe": ["telemetry/+"]}))
+    hub.handle_control(c, json.dumps({"unsubscribe": "telemetry/+"}))
+    assert json.loads(c._q.pop()) == {"type": "subscribed", "topics": []}
+    c._q.clear()
+    hub.publish("telemetry/dev-1", "t")
+    hub.publish("samples/dev-1", "s")
+    assert c.queue_depth() == 0
+    assert hub.stats["filtered"] == 2
+    # Volver a suscribirse reactiva la entrega
+    hub.handle_control(c, json.dumps({"subscribe": "samples/#"}))
+    c._q.clear()
+    hub.publish("samples/dev-1", "s")
+    assert list(c._q) == ["s"]
@@ -378,6 +378,212 @@ async function createTables() {
       } catch (e) {
         // Ignorar si ya existe
       }
+
+      // Consultas de rango por dispositivo (/metrics/history-postgres, /metrics/power-outages):
+      // range scan ordenado por (device_id, created_at); INCLUDE permite index-only scan
+      try {
+        await pool.query(`
+          CREATE INDEX IF NOT EXISTS idx_telemetry_device_created 
+          ON telemetry_history(device_id, created_at) INCLUDE (voltaje, corriente, potencia);
+        `);
+        console.log('Índice idx_telemetry_device_created verificado.');
+      } catch (e) {
+        console.error('Error creando idx_telemetry_device_created:', e.message);
+      }
+
+      // Rollups de telemetry_history por minuto/hora/día, por dispositivo y por compañía.
+      // Los mantiene el backend en cada lote (upsert) y los reconstruye backend/api/rollups.py;
+      // se guardan sumas y conteos (no promedios) para poder combinar parciales.
+      for (const [scope, keyRef] of [
+        ['device', 'device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE'],
+        ['company', 'company_id INTEGER NOT NULL REFERENCES companies(id) ON DELETE CASCADE'],
+      ]) {
+        for (const tier of ['1m', '1h', '1d']) {
+          const table = `telemetry_rollup_${scope}_${tier}`;
+          try {
+            await pool.query(`
+              CREATE TABLE IF NOT EXISTS ${table} (
+                ${keyRef},
+                bucket TIMESTAMP NOT NULL,
+                samples INTEGER NOT NULL DEFAULT 0,
+                v_n INTEGER NOT NULL DEFAULT 0,
+                v_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                v_min DOUBLE PRECISION,
+                v_max DOUBLE PRECISION,
+                i_n INTEGER NOT NULL DEFAULT 0,
+                i_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                i_min DOUBLE PRECISION,
+                i_max DOUBLE PRECISION,
+                s_n INTEGER NOT NULL DEFAULT 0,
+                s_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                p_n INTEGER NOT NULL DEFAULT 0,
+                p_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+                p_min DOUBLE PRECISION,
+                p_max DOUBLE PRECISION,
+                energy_wh DOUBLE PRECISION NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+                PRIMARY KEY (${scope}_id, bucket)
+              );
+            `);
+          } catch (e) {
+            console.error(`Error creando ${table}:`, e.message);
+          }
+        }
+      }
+      console.log('Tablas de rollup de telemetría verificadas.');
+
+      // Acumulador de energía por dispositivo (integración trapezoidal de potencia en la ingesta,
+      // ver backend/api/energy.py): última lectura y total en kWh, sobrevive a reinicios del backend
+      try {
+        await pool.query(`
+          CREATE TABLE IF NOT EXISTS device_energy_state (
+            device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+            last_at TIMESTAMP,
+            last_potencia DOUBLE PRECISION,
+            total_kwh DOUBLE PRECISION NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+          );
+        `);
+        console.log('Tabla device_energy_state verificada.');
+      } catch (e) {
+        console.error('Error creando device_energy_state:', e.message);
+      }
+
+      // Cortes de luz y períodos sin datos detectados en la ingesta (ver backend/api/outage_tracker.py).
+      // end_at NULL = corte en curso (a lo sumo uno por dispositivo); su estado actual está en
+      // device_outage_state y /metrics/power-outages lo combina al leer
+      try {
+        await pool.query(`
+          CREATE TABLE IF NOT EXISTS power_outages (
+            id BIGSERIAL PRIMARY KEY,
+            device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+            type VARCHAR(20) NOT NULL,
+            start_at TIMESTAMP NOT NULL,
+            end_at TIMESTAMP,
+            min_voltage DOUBLE PRECISION,
+            max_voltage DOUBLE PRECISION,
+            data_points INTEGER,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW()
+          );
+        `);
+        await pool.query(`
+          CREATE INDEX IF NOT EXISTS idx_power_outages_device_start
+          ON power_outages(device_id, start_at);
+        `);
+        await pool.query(`
+          CREATE UNIQUE INDEX IF NOT EXISTS idx_power_outages_device_open
+          ON power_outages(device_id) WHERE end_at IS NULL;
+        `);
+        await pool.query(`
+          CREATE TABLE IF NOT EXISTS device_outage_state (
+            device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+            tracked_since TIMESTAMP NOT NULL,
+            last_at TIMESTAMP,
+            outside_at TIMESTAMP,
+            outage_start TIMESTAMP,
+            outage_last TIMESTAMP,
+            outage_min DOUBLE PRECISION,
+            outage_max DOUBLE PRECISION,
+            outage_points INTEGER,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+          );
+        `);
+        console.log('Tablas power_outages y device_outage_state verificadas.');
+      } catch (e) {
+        console.error('Error creando power_outages:', e.message);
+      }
+
+      // Cambios de conexión online/offline (Last Will o timeout sin lecturas, ver backend/api/liveness.py)
+      try {
+        await pool.query(`
+          CREATE TABLE IF NOT EXISTS device_liveness_events (
+            id BIGSERIAL PRIMARY KEY,
+            device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+            status VARCHAR(10) NOT NULL,
+            reason VARCHAR(10) NOT NULL,
+            at TIMESTAMP NOT NULL,
+            last_seen TIMESTAMP
+          );
+        `);
+        await pool.query(`
+          CREATE INDEX IF NOT EXISTS idx_device_liveness_events_device_at
+          ON device_liveness_events(device_id, at);
+        `);
+        console.log('Tabla device_liveness_events verificada.');
+      } catch (e) {
+        console.error('Error creando device_liveness_events:', e.message);
+      }
+
+      // Calidad de energía por dispositivo y hora (backend/api/quality.py): sketches de cuantiles
+      // de voltaje y factor de potencia (bins logarítmicos, arrays paralelos keys/counts que se
+      // combinan sumando conteos) y segundos en cada banda de tensión
+      try {
+        await pool.query(`
+          CREATE TABLE IF NOT EXISTS power_quality_1h (
+            device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+            bucket TIMESTAMP NOT NULL,
+            samples INTEGER NOT NULL DEFAULT 0,
+            v_keys INTEGER[] NOT NULL DEFAULT '{}',
+            v_counts BIGINT[] NOT NULL DEFAULT '{}',
+            v_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            v_min DOUBLE PRECISION,
+            v_max DOUBLE PRECISION,
+            pf_keys INTEGER[] NOT NULL DEFAULT '{}',
+            pf_counts BIGINT[] NOT NULL DEFAULT '{}',
+            pf_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+            pf_min DOUBLE PRECISION,
+            pf_max DOUBLE PRECISION,
+            interruption_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+            sag_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+            normal_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+            swell_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (device_id, bucket)
+          );
+        `);
+        console.log('Tabla power_quality_1h verificada.');
+      } catch (e) {
+        console.error('Error creando power_quality_1h:', e.message);
+      }
+
+      // Avisar al backend (LISTEN device_registry) cuando cambian devices, users, roles o umbrales
+      // para que su registro de dispositivos y sus umbrales en memoria se actualicen sin consultar por mensaje
+      try {
+        await pool.query(`
+          CREATE OR REPLACE FUNCTION notify_device_registry() RETURNS trigger AS $$
+          BEGIN
+            PERFORM pg_notify('device_registry', json_build_object(
+              'table', TG_TABLE_NAME,
+              'op', TG_OP,
+              'id', CASE WHEN TG_OP = 'DELETE' THEN OLD.id ELSE NEW.id END
+            )::text);
+            RETURN NULL;
+          END;
+          $$ LANGUAGE plpgsql;
+        `);
+        await pool.query(`
+          CREATE OR REPLACE TRIGGER trg_devices_device_registry
+          AFTER INSERT OR UPDATE OR DELETE ON devices
+          FOR EACH ROW EXECUTE FUNCTION notify_device_registry();
+        `);
+        await pool.query(`
+          CREATE OR REPLACE TRIGGER trg_users_device_registry
+          AFTER INSERT OR DELETE OR UPDATE OF company_id, role_id ON users
+          FOR EACH ROW EXECUTE FUNCTION notify_device_registry();
+        `);
+        await pool.query(`
+          CREATE OR REPLACE TRIGGER trg_roles_device_registry
+          AFTER INSERT OR DELETE OR UPDATE OF name ON roles
+          FOR EACH ROW EXECUTE FUNCTION notify_device_registry();
+        `);
+        await pool.query(`
+          CREATE OR REPLACE TRIGGER trg_umbrales_device_registry
+          AFTER INSERT OR UPDATE OR DELETE ON umbrales
+          FOR EACH ROW EXECUTE FUNCTION notify_device_registry();
+        `);
+      } catch (e) {
+        console.error('No se pudieron crear los triggers de device_registry:', e?.message || e);
+      }
     }
 
   // Crear índices para mejor rendimiento